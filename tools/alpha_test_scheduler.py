@@ -0,0 +1,267 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import heapq
+import itertools
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from gms_tools.inundate_gms import gms_branch_tasks, inundate_branch_task
+
+# tasks handed to the pool per worker at a time, so steps released meanwhile are not queued behind every branch
+TASKS_IN_FLIGHT_PER_WORKER = 2
+
+# number of intervals of the utilization timeline when no interval is given
+UTILIZATION_INTERVALS = 20
+
+
+def Schedule_alpha_tests( test_cases, workers,
+                          calibrated = False,
+                          model = '',
+                          mask_type = 'huc',
+                          overwrite = True,
+                          verbose = False,
+                          zonal_stats = False,
+                          utilization_csv = None,
+                          utilization_interval = None ):
+
+    """
+    Runs the alpha tests of many test cases in one pool of workers
+
+    Every magnitude and lid of every test case is broken into tasks of one work queue. FR
+    and MS evaluations are a task each. GMS evaluations are a task per group of branches, as
+    Inundate_gms groups them, and a mosaic and evaluation task released once their last
+    branch is done. A test case is finished (AHPS clean up and meta-data) once its last
+    evaluation is done. Released mosaic and evaluation tasks go before queued branches and
+    only TASKS_IN_FLIGHT_PER_WORKER tasks per worker are in the pool at a time, so test cases
+    finish, and their branch rasters are removed, as early as possible.
+
+    zonal_stats also writes the stats of each HydroID of the predicted rasters (see
+    test_case._inundate_and_compute).
+
+    Returns a DataFrame of the kind, test case, magnitude, lid, branches, worker, start and
+    end of each task. utilization_csv writes the utilization of the workers over time (see
+    utilization_timeline).
+    """
+
+    workers = int(workers)
+
+    # heap of (rank, instance, order, kind, job), rank 0 for released steps
+    queue = []
+    order = itertools.count()
+
+    number_of_evaluations = 0
+    for test_case in test_cases:
+
+        validation_data = test_case.prepare_alpha_test(model, mask_type, overwrite=overwrite)
+        if validation_data is None:
+            continue
+
+        test_case_state = { 'test_case' : test_case, 'validation_data' : validation_data, 'remaining' : 0 }
+
+        for magnitude in validation_data:
+            for lid in validation_data[magnitude]:      # lid is '' for non-AHPS sites
+
+                if not test_case._instance_paths(magnitude, lid)['available']:
+                    continue
+
+                instance = { 'test_case_state' : test_case_state, 'magnitude' : magnitude, 'lid' : lid }
+                test_case_state['remaining'] += 1
+                number_of_evaluations += 1
+
+                # GMS branches are listed when the instance comes up
+                instance_idx = next(order)
+                heapq.heappush(queue, (1, instance_idx, next(order), 'expand' if model == 'GMS' else 'evaluate', instance))
+
+        if test_case_state['remaining'] == 0:
+            test_case.finish_alpha_test(calibrated, model, validation_data)
+
+    task_records = []
+    progress = tqdm(total=number_of_evaluations,
+                    desc="Running {} alpha test cases with {} workers".format(model, workers),
+                    disable=(not verbose))
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        running = {}
+        while queue or running:
+
+            while queue and (len(running) < workers * TASKS_IN_FLIGHT_PER_WORKER):
+
+                _, instance_idx, _, kind, job = heapq.heappop(queue)
+
+                if kind == 'expand':
+                    __expand_gms_instance(job, instance_idx, queue, order)
+                    continue
+
+                if kind == 'branches':
+                    instance, task = job
+                    future = executor.submit(__run_task, inundate_branch_task, [inp for inp,_,_ in task])
+                else:
+                    instance = job
+                    test_case = instance['test_case_state']['test_case']
+                    future = executor.submit(__run_task, __evaluate_instance, test_case, instance['magnitude'], instance['lid'],
+                                             model, zonal_stats, instance.get('map_rows'))
+
+                running[future] = (kind, job)
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+            for future in done:
+
+                kind, job = running.pop(future)
+                result, exc, worker, start, end = future.result()
+
+                instance = job[0] if kind == 'branches' else job
+                test_case_state = instance['test_case_state']
+                test_case = test_case_state['test_case']
+
+                task_records.append( ( kind, test_case.test_id, instance['magnitude'], instance['lid'],
+                                       len(job[1]) if kind == 'branches' else 0, worker, start, end, exc is None ) )
+
+                if kind == 'branches':
+                    __collect_branch_results(instance, job[1], result, exc, verbose)
+
+                    instance['remaining_branch_tasks'] -= 1
+                    if instance['remaining_branch_tasks'] == 0:
+                        heapq.heappush(queue, (0, 0, next(order), 'evaluate', instance))
+                    continue
+
+                if exc is not None:
+                    print('{}, {}, {}, {}'.format(test_case.test_id, instance['magnitude'], exc.__class__.__name__, exc))
+
+                progress.update(1)
+                test_case_state['remaining'] -= 1
+                if test_case_state['remaining'] == 0:
+                    test_case.finish_alpha_test(calibrated, model, test_case_state['validation_data'])
+
+    progress.close()
+
+    task_records = pd.DataFrame(task_records, columns=['kind','test_id','magnitude','lid','branches',
+                                                       'worker','start','end','success'])
+
+    if len(task_records) > 0:
+        timeline = utilization_timeline(task_records, workers, utilization_interval)
+
+        if verbose:
+            busy_seconds = (task_records['end'] - task_records['start']).sum()
+            wall_seconds = task_records['end'].max() - task_records['start'].min()
+            print("Worker utilization: {:.0%} of {} workers over {:.1f} s in {} tasks".format(
+                  busy_seconds / (workers * wall_seconds) if wall_seconds > 0 else 1, workers, wall_seconds, len(task_records)))
+            print(' '.join('{:.0%}'.format(u) for u in timeline['utilization']))
+
+        if utilization_csv is not None:
+            timeline.to_csv(utilization_csv, index=False)
+
+    return(task_records)
+
+
+def utilization_timeline(task_records, workers, interval=None):
+
+    """
+    Busy workers over time from the start and end of tasks
+
+    Returns a DataFrame of the seconds since the first task started at the start of each
+    interval, the mean number of busy workers in it, and their utilization of workers.
+    interval defaults to 1/UTILIZATION_INTERVALS of the run and at least a second.
+    """
+
+    starts = task_records['start'].to_numpy(dtype=np.float64)
+    ends = task_records['end'].to_numpy(dtype=np.float64)
+
+    first, last = starts.min(), ends.max()
+    if interval is None:
+        interval = max((last - first) / UTILIZATION_INTERVALS, 1.0)
+
+    interval_starts = np.arange(first, last, interval) if last > first else np.array([first])
+    interval_ends = interval_starts + interval
+
+    # seconds of every task in every interval
+    busy_workers = np.zeros(len(interval_starts))
+    for task_start, task_end in zip(starts, ends):
+        busy_workers += np.clip(np.minimum(task_end, interval_ends) - np.maximum(task_start, interval_starts), 0, None)
+    busy_workers /= interval
+
+    return(pd.DataFrame({ 'seconds' : interval_starts - first,
+                          'busy_workers' : busy_workers,
+                          'utilization' : busy_workers / workers }))
+
+
+def __expand_gms_instance(instance, instance_idx, queue, order):
+
+    """ Queues the branch tasks of a GMS instance, or its evaluation if no branch has discharges """
+
+    test_case = instance['test_case_state']['test_case']
+    paths = test_case._instance_paths(instance['magnitude'], instance['lid'])
+
+    os.makedirs(paths['test_case_out_dir'], exist_ok=True)
+
+    # every branch is mapped, as Inundate_gms does in test_case._inundate_and_compute
+    tasks = gms_branch_tasks( os.path.dirname(test_case.fim_dir), paths['benchmark_flows'],
+                              hucs = test_case.huc,
+                              inundation_raster = paths['predicted_raster_path'],
+                              prune_branches = False )
+
+    instance['map_rows'] = []
+    instance['remaining_branch_tasks'] = len(tasks)
+
+    if len(tasks) == 0:
+        heapq.heappush(queue, (0, 0, next(order), 'evaluate', instance))
+
+    for task in tasks:
+        heapq.heappush(queue, (1, instance_idx, next(order), 'branches', (instance, task)))
+
+
+def __collect_branch_results(instance, task, task_results, exc, verbose):
+
+    """ Adds the inundation rasters of the branches of a task to the mosaic rows of their instance """
+
+    if exc is not None:
+        # the worker died, the whole task failed
+        task_results = [ (None, exc, np.nan, False) ] * len(task)
+
+    for (_, (hucCode, branch_id), _), (result, branch_exc, _, _) in zip(task, task_results):
+
+        if branch_exc is not None:
+            if verbose:
+                print('{}, {}, {}, {}'.format(hucCode, branch_id, branch_exc.__class__.__name__, branch_exc))
+            continue
+
+        try:
+            inundation_raster = result[0][0]
+        except TypeError:
+            inundation_raster = None
+
+        instance['map_rows'].append( ( hucCode, branch_id, inundation_raster ) )
+
+
+def __evaluate_instance(test_case, magnitude, lid, model, zonal_stats=False, map_rows=None):
+
+    """ Process pool worker. Mosaics the branches of GMS instances and evaluates a magnitude and lid of a test case """
+
+    if map_rows is None:
+        return(test_case._inundate_and_compute(magnitude, lid, model=model, zonal_stats=zonal_stats))
+
+    map_file = pd.DataFrame(map_rows, columns=['huc8','branchID','inundation_rasters'])
+    if map_file['inundation_rasters'].notna().any():
+        test_case._mosaic_branches(map_file, test_case._instance_paths(magnitude, lid)['predicted_raster_path'])
+
+    return(test_case._inundate_and_compute(magnitude, lid, compute_only=True, model=model, zonal_stats=zonal_stats))
+
+
+def __run_task(function, *args):
+
+    """ Process pool worker. Returns the result or exception of a task with the worker and wall clock start and end """
+
+    start = time.time()
+
+    try:
+        result, exc = function(*args), None
+    except Exception as e:
+        result, exc = None, e
+
+    return(result, exc, os.getpid(), start, time.time())
@@ -0,0 +1,1075 @@
+#!/usr/bin/env python3
+
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import fiona
+import numpy as np
+import pandas as pd
+import rasterio
+from collections import OrderedDict
+from numba import typed, types
+from rasterio.enums import Resampling
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from shapely.geometry import box, mapping
+
+import inundation
+from gms_tools.overlapping_inundation import OverlapWindowMerge, cog_writer
+from gms_tools.inundate_gms import Inundate_gms
+from gms_tools.inundation_service import InundationService
+from inundate_nation import create_bool_rasters, vrt_raster_mosaic
+from tools_shared_functions import get_contingency_table_from_binary_rasters, CONTINGENCY_BLOCK_SIZE
+
+
+def make_synthetic_branch(size, number_of_catchments=5000, catchment_block=50,
+                          lake_fraction=0.05, nodata_fraction=0.1, seed=0):
+
+    """
+    Makes a synthetic REM, catchments grid and catchment stages dictionary
+
+    Catchments are square blocks of catchment_block pixels assigned HydroIDs with a
+    fossid style prefix. A fraction of the HydroIDs are left out of the stages
+    dictionary to emulate lakes, and a fraction of pixels are set to nodata.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    hydroIDs = (np.arange(number_of_catchments) + 32460001).astype(np.int32)
+
+    # blocky catchments grid
+    blocks_per_side = int(np.ceil(size / catchment_block))
+    block_ids = rng.choice(hydroIDs, size=(blocks_per_side, blocks_per_side))
+    catchments = np.repeat(np.repeat(block_ids, catchment_block, axis=0), catchment_block, axis=1)
+    catchments = np.ascontiguousarray(catchments[:size,:size])
+
+    rem = rng.uniform(0, 20, size=(size, size)).astype(np.float32)
+
+    nodata_mask = rng.random((size, size)) < nodata_fraction
+    rem[nodata_mask] = -9999.0
+    catchments[nodata_mask] = 0
+
+    # stages for non-lake catchments
+    catchmentStagesDict = typed.Dict.empty(types.int32,types.float64)
+    stages = rng.uniform(0, 10, size=number_of_catchments)
+    lakes = rng.random(number_of_catchments) < lake_fraction
+    for hid, h in zip(hydroIDs[~lakes], stages[~lakes]):
+        catchmentStagesDict[types.int32(hid)] = types.float32(round(h,4))
+
+    return(rem, catchments, catchmentStagesDict)
+
+
+def __initial_outputs(rem, catchments, rem_nodata=-9999.0, catchments_nodata=0):
+
+    # mirrors the output initialization in inundation.__inundate_in_huc
+    depths = rem.copy()
+    inundation_array = catchments.copy()
+    depths[depths != rem_nodata] = 0
+    valid = inundation_array != catchments_nodata
+    inundation_array[valid] = inundation_array[valid] * -1
+
+    return(depths, inundation_array)
+
+
+def benchmark_lookup_modes(size=10000, repeats=3, verbose=True):
+
+    """
+    Compares the numba typed-dict engine against the compiled array engine
+
+    Asserts the outputs are bit-identical and returns a dictionary of the best
+    wall times in seconds per engine.
+    """
+
+    rem, catchments, catchmentStagesDict = make_synthetic_branch(size)
+    rem = rem.ravel() ; catchments = catchments.ravel()
+
+    # warm up the jits outside of the timings
+    d, i = __initial_outputs(rem[:100], catchments[:100])
+    inundation.__go_fast_mapping(rem[:100], catchments[:100], catchmentStagesDict, i, d)
+    for max_dense_ratio in (4, 0):
+        d, i = __initial_outputs(rem[:100], catchments[:100])
+        inundation.__go_fast_mapping_array(rem[:100], catchments[:100],
+                                           inundation.make_stages_lookup(catchmentStagesDict, max_dense_ratio),
+                                           i, d)
+
+    timings = { 'dict' : [], 'array' : [], 'array_sparse' : [], 'compile_lookup' : [] }
+
+    for _ in range(repeats):
+
+        depths, inundation_array = __initial_outputs(rem, catchments)
+        start = time.perf_counter()
+        dict_inundation, dict_depths = inundation.__go_fast_mapping(rem, catchments, catchmentStagesDict,
+                                                                    inundation_array, depths)
+        timings['dict'].append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        catchmentStagesLookup = inundation.make_stages_lookup(catchmentStagesDict)
+        timings['compile_lookup'].append(time.perf_counter() - start)
+
+        depths, inundation_array = __initial_outputs(rem, catchments)
+        start = time.perf_counter()
+        array_inundation, array_depths = inundation.__go_fast_mapping_array(rem, catchments, catchmentStagesLookup,
+                                                                            inundation_array, depths)
+        timings['array'].append(time.perf_counter() - start)
+
+        # sorted HydroIDs with np.searchsorted, as used for sparse HydroIDs
+        sparse_lookup = inundation.make_stages_lookup(catchmentStagesDict, max_dense_ratio=0)
+        depths, inundation_array = __initial_outputs(rem, catchments)
+        start = time.perf_counter()
+        sparse_inundation, sparse_depths = inundation.__go_fast_mapping_array(rem, catchments, sparse_lookup,
+                                                                              inundation_array, depths)
+        timings['array_sparse'].append(time.perf_counter() - start)
+
+        # bit-identical outputs
+        for other_inundation, other_depths in ((array_inundation, array_depths), (sparse_inundation, sparse_depths)):
+            assert np.array_equal(dict_inundation, other_inundation), "Inundation outputs differ between engines"
+            assert np.array_equal(dict_depths.view(np.uint32), other_depths.view(np.uint32)), "Depth outputs differ between engines"
+
+        del dict_inundation, dict_depths, array_inundation, array_depths, sparse_inundation, sparse_depths
+
+    best_timings = { k : min(v) for k,v in timings.items() }
+
+    if verbose:
+        print(f"Synthetic REM : {size} x {size} ({size * size:,} pixels), {len(catchmentStagesDict)} catchments")
+        print(f"dict engine  : {best_timings['dict']:.3f} s")
+        print(f"array engine : {best_timings['array']:.3f} s dense, {best_timings['array_sparse']:.3f} s sorted "
+              f"(+ {best_timings['compile_lookup']:.4f} s to compile lookup)")
+        print(f"speed up     : {best_timings['dict'] / best_timings['array']:.2f}x dense, "
+              f"{best_timings['dict'] / best_timings['array_sparse']:.2f}x sorted")
+
+    return(best_timings)
+
+
+def write_synthetic_hydrofabric(out_dir, size=8000, hucs_per_side=4, catchments_per_huc=2000,
+                                catchment_block=50, resolution=10, seed=0):
+
+    """
+    Writes a synthetic REM, catchments raster, hydro-table, forecast and HUC8 polygons
+
+    The raster is split into hucs_per_side x hucs_per_side HUC8s, each with its own
+    HydroIDs and feature_ids, to emulate an aggregated batch mode run. Returns a
+    dictionary of file paths.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    huc_size = size // hucs_per_side
+    size = huc_size * hucs_per_side
+    transform = from_origin(500000, 3000000, resolution, resolution)
+
+    profile = { 'driver' : 'GTiff', 'width' : size, 'height' : size, 'count' : 1, 'crs' : 'EPSG:5070',
+                'transform' : transform, 'tiled' : True, 'blockxsize' : 256, 'blockysize' : 256,
+                'compress' : 'lzw' }
+
+    paths = { 'rem' : os.path.join(out_dir, 'rem.tif'),
+              'catchments' : os.path.join(out_dir, 'catchments.tif'),
+              'hydro_table' : os.path.join(out_dir, 'hydroTable.csv'),
+              'forecast' : os.path.join(out_dir, 'forecast.csv'),
+              'hucs' : os.path.join(out_dir, 'hucs.gpkg') }
+
+    hucs_schema = { 'geometry' : 'Polygon', 'properties' : OrderedDict([('HUC8', 'str')]) }
+    stage_steps = np.arange(0, 20.5, 0.5)
+
+    hydro_tables = [] ; forecasts = []
+    with rasterio.open(paths['rem'], 'w', dtype='float32', nodata=-9999.0, **profile) as rem, \
+         rasterio.open(paths['catchments'], 'w', dtype='int32', nodata=0, **profile) as catchments, \
+         fiona.open(paths['hucs'], 'w', driver='GPKG', crs='EPSG:5070', schema=hucs_schema) as hucs:
+
+        for huc_idx in range(hucs_per_side * hucs_per_side):
+
+            huc_row, huc_col = divmod(huc_idx, hucs_per_side)
+            huc_code = str(12090301 + huc_idx)
+            window = rasterio.windows.Window(huc_col * huc_size, huc_row * huc_size, huc_size, huc_size)
+
+            huc_rem, huc_catchments, _ = make_synthetic_branch(huc_size, number_of_catchments=catchments_per_huc,
+                                                               catchment_block=catchment_block, lake_fraction=0,
+                                                               seed=seed + huc_idx)
+            # unique HydroIDs per HUC
+            huc_catchments[huc_catchments != 0] += huc_idx * catchments_per_huc
+            rem.write(huc_rem, 1, window=window)
+            catchments.write(huc_catchments, 1, window=window)
+
+            hucs.write({ 'geometry' : mapping(box(*rasterio.windows.bounds(window, transform))),
+                         'properties' : { 'HUC8' : huc_code } })
+
+            # rating curves and flows
+            hydroIDs = np.unique(huc_catchments[huc_catchments != 0])
+            feature_ids = (hydroIDs // 3).astype(str)
+            hydro_tables.append(pd.DataFrame({ 'HUC' : huc_code,
+                                               'feature_id' : np.repeat(feature_ids, len(stage_steps)),
+                                               'HydroID' : np.repeat(hydroIDs, len(stage_steps)),
+                                               'stage' : np.tile(stage_steps, len(hydroIDs)),
+                                               'discharge_cms' : np.tile(3 * stage_steps ** 2, len(hydroIDs)),
+                                               'LakeID' : -999 }))
+            unique_feature_ids = np.unique(feature_ids)
+            forecasts.append(pd.DataFrame({ 'feature_id' : unique_feature_ids,
+                                            'discharge' : rng.uniform(0, 1200, len(unique_feature_ids)) }))
+
+    pd.concat(hydro_tables).to_csv(paths['hydro_table'], index=False)
+    pd.concat(forecasts).to_csv(paths['forecast'], index=False)
+
+    return(paths)
+
+
+def benchmark_batch_backends(size=8000, hucs_per_side=4, workers=(1, 2, 4, 8), verbose=True):
+
+    """
+    Measures batch mode throughput of the thread and process backends of inundate()
+
+    Inundation and depth rasters are written for every HUC. Returns a DataFrame of
+    wall times and HUCs per second by backend and number of workers.
+    """
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        paths = write_synthetic_hydrofabric(tmp_dir, size=size, hucs_per_side=hucs_per_side)
+
+        for parallel_backend in ('thread', 'process'):
+            for num_workers in workers:
+
+                out_dir = os.path.join(tmp_dir, f'{parallel_backend}_{num_workers}')
+                os.makedirs(out_dir)
+
+                start = time.perf_counter()
+                inundation_rasters, _, _ = inundation.inundate(paths['rem'], paths['catchments'], None,
+                                                               paths['hydro_table'], paths['forecast'], 'huc',
+                                                               hucs=paths['hucs'], num_workers=num_workers,
+                                                               inundation_raster=os.path.join(out_dir, 'inundation.tif'),
+                                                               depths=os.path.join(out_dir, 'depths.tif'),
+                                                               quiet=True, parallel_backend=parallel_backend)
+                wall_time = time.perf_counter() - start
+
+                records.append({ 'backend' : parallel_backend, 'workers' : num_workers,
+                                 'hucs' : len(inundation_rasters), 'seconds' : wall_time,
+                                 'hucs_per_second' : len(inundation_rasters) / wall_time })
+
+                if verbose:
+                    print(f"{parallel_backend:>7} backend, {num_workers:>2} workers : {wall_time:7.2f} s "
+                          f"({records[-1]['hucs_per_second']:.2f} HUCs/s)")
+
+    return(pd.DataFrame(records))
+
+
+def make_synthetic_hydro_table(number_of_catchments=100000, number_of_forecasts=1, seed=0):
+
+    """
+    Makes a joined hydro-table with random rating curves and forecasts
+
+    Forecasts include discharges below, above and exactly on the rating curves as
+    well as missing discharges.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    stage = np.arange(0, 20.5, 0.5)
+    hydroIDs = np.repeat(np.arange(number_of_catchments) + 10000001, len(stage))
+    feature_ids = hydroIDs // 4
+    stages = np.tile(stage, number_of_catchments)
+    discharge_cms = np.round(rng.uniform(1, 5, number_of_catchments).repeat(len(stage)) * stages ** 2, 4)
+
+    hydroTable = pd.DataFrame({ 'HUC' : '12090301', 'feature_id' : feature_ids, 'HydroID' : hydroIDs,
+                                'stage' : stages, 'discharge_cms' : discharge_cms })
+
+    forecast_columns = []
+    for f in range(number_of_forecasts):
+        discharge = np.round(rng.uniform(-10, 2500, number_of_catchments), 2)
+        on_curve = rng.random(number_of_catchments) < 0.05
+        discharge[on_curve] = discharge_cms.reshape(number_of_catchments, -1)[on_curve, 3]
+        discharge[rng.random(number_of_catchments) < 0.01] = np.nan
+        hydroTable[f'forecast_{f}'] = discharge.repeat(len(stage))
+        forecast_columns.append(f'forecast_{f}')
+
+    hydroTable = hydroTable.set_index(['HUC','feature_id','HydroID'])
+
+    return(hydroTable, forecast_columns)
+
+
+def __interpolate_stages_by_loop(hydroTable, forecast_columns):
+
+    """ Former per HydroID and per forecast interpolation loop, used as reference """
+
+    hydroIDs = [] ; stages = []
+
+    for hid,sub_table in hydroTable.groupby(level='HydroID'):
+        hid_stages = np.full(len(forecast_columns),np.nan)
+        for f,forecast_column in enumerate(forecast_columns):
+            discharge = sub_table.loc[:,forecast_column].unique()
+            interpolated_stage = np.interp(discharge,sub_table.loc[:,'discharge_cms'],sub_table.loc[:,'stage'])
+            hid_stages[f] = types.float32(round(interpolated_stage[0],4))
+        hydroIDs += [int(hid)] ; stages += [hid_stages]
+
+    return(np.array(hydroIDs,dtype=np.int32), np.array(stages,dtype=np.float64).reshape(len(hydroIDs),-1))
+
+
+def benchmark_interpolation(number_of_catchments=100000, number_of_forecasts=(1, 8), repeats=3, verbose=True):
+
+    """
+    Compares the vectorized stage interpolation against the per HydroID loop
+
+    Asserts the interpolated stages are bit-identical and returns a DataFrame of the
+    best wall times in seconds by number of forecasts.
+    """
+
+    records = []
+    for n in number_of_forecasts:
+
+        hydroTable, forecast_columns = make_synthetic_hydro_table(number_of_catchments, n)
+
+        timings = { 'loop' : [], 'vectorized' : [] }
+        for _ in range(repeats):
+
+            start = time.perf_counter()
+            loop_hydroIDs, loop_stages = __interpolate_stages_by_loop(hydroTable, forecast_columns)
+            timings['loop'].append(time.perf_counter() - start)
+
+            start = time.perf_counter()
+            hydroIDs, stages = inundation.__interpolate_stages(hydroTable, forecast_columns)
+            timings['vectorized'].append(time.perf_counter() - start)
+
+            assert np.array_equal(loop_hydroIDs, hydroIDs), "HydroIDs differ between implementations"
+            assert np.array_equal(loop_stages, stages, equal_nan=True), "Stages differ between implementations"
+
+        records.append({ 'forecasts' : n, 'catchments' : number_of_catchments,
+                         'loop' : min(timings['loop']), 'vectorized' : min(timings['vectorized']) })
+
+        if verbose:
+            print(f"{number_of_catchments:,} catchments, {n:>2} forecasts : loop {records[-1]['loop']:.3f} s, "
+                  f"vectorized {records[-1]['vectorized']:.3f} s "
+                  f"({records[-1]['loop'] / records[-1]['vectorized']:.1f}x)")
+
+    return(pd.DataFrame(records))
+
+
+def benchmark_polygon_modes(size=4000, repeats=1, simplify_tolerance=20, coherent=True, verbose=True):
+
+    """
+    Times writing inundation polygons in each polygon mode against the former single list write
+
+    With coherent, the synthetic REM is made of 8 x 8 pixel plateaus so floods form
+    contiguous areas. Otherwise every pixel is random, which gives very fragmented floods.
+    Returns a DataFrame of the best wall times in seconds and the number of features
+    written by mode.
+    """
+
+    rem, catchments, catchmentStagesDict = make_synthetic_branch(size)
+
+    # spatially coherent REM
+    if coherent:
+        rng = np.random.default_rng(0)
+        coarse = rng.uniform(0, 20, size=(size // 8 + 1, size // 8 + 1)).astype(np.float32)
+        rem = np.where(rem == -9999.0, rem, np.repeat(np.repeat(coarse, 8, axis=0), 8, axis=1)[:size,:size])
+
+    inundation_array, _ = inundation.__map_window(rem, catchments, -9999.0, 0, catchmentStagesDict)
+    transform = from_origin(500000, 3000000, 10, 10)
+    schemas = { 'features' : { 'geometry' : 'Polygon', 'properties' : OrderedDict([('HydroID', 'int')]) },
+                'dissolved' : { 'geometry' : 'MultiPolygon', 'properties' : OrderedDict([('HydroID', 'int')]) },
+                'extent' : { 'geometry' : 'MultiPolygon', 'properties' : OrderedDict() } }
+
+    def __write_former(inundation_polygon):
+        records = []
+        for g,h in rasterio.features.shapes(inundation_array, mask=inundation_array>0, connectivity=8, transform=transform):
+            records += [{ 'geometry' : g, 'properties' : {'HydroID' : int(h)} }]
+        inundation_polygon.writerecords(records)
+
+    modes = OrderedDict([ ('former', ('features', None)), ('features', ('features', None)),
+                          ('dissolved', ('dissolved', None)), ('dissolved_simplified', ('dissolved', simplify_tolerance)),
+                          ('extent', ('extent', None)) ])
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for name, (polygon_mode, tolerance) in modes.items():
+
+            timings = []
+            for r in range(repeats):
+                inundation_polygon = fiona.open(os.path.join(tmp_dir, f'{name}_{r}.gpkg'), 'w', driver='GPKG',
+                                                crs='EPSG:5070', schema=schemas[polygon_mode])
+                start = time.perf_counter()
+                if name == 'former':
+                    __write_former(inundation_polygon)
+                else:
+                    inundation.__write_inundation_polygons(inundation_array, transform, inundation_polygon,
+                                                           polygon_mode, tolerance)
+                inundation_polygon.close()
+                timings.append(time.perf_counter() - start)
+
+            with fiona.open(os.path.join(tmp_dir, f'{name}_0.gpkg')) as inundation_polygon:
+                number_of_features = len(inundation_polygon)
+
+            records.append({ 'mode' : name, 'seconds' : min(timings), 'features' : number_of_features })
+
+            if verbose:
+                print(f"{name:>20} : {records[-1]['seconds']:7.2f} s, {number_of_features:,} features")
+
+    return(pd.DataFrame(records))
+
+
+def write_synthetic_branch_rasters(out_dir, number_of_rasters=500, size=8000, branch_size=1000,
+                                   resolution=10, seed=0):
+
+    """
+    Writes overlapping synthetic branch depth rasters over a size x size pixel unit
+
+    Each branch is a float32 raster of branch_size x branch_size pixels or less placed at
+    a random grid aligned offset with random depths along a band, emulating level path
+    rasters of a HUC. Returns the list of file paths.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    profile = { 'driver' : 'GTiff', 'count' : 1, 'dtype' : 'float32', 'nodata' : -9999.0,
+                'crs' : 'EPSG:5070', 'tiled' : True, 'blockxsize' : 256, 'blockysize' : 256,
+                'compress' : 'lzw' }
+
+    paths = []
+    for i in range(number_of_rasters):
+
+        height, width = rng.integers(branch_size // 4, branch_size + 1, size=2)
+        row_off, col_off = rng.integers(0, size - height + 1), rng.integers(0, size - width + 1)
+
+        # depths along a diagonal band
+        rows, cols = np.mgrid[0:height, 0:width]
+        band = np.abs(rows / height - cols / width) < rng.uniform(0.05, 0.3)
+        depths = np.where(band, rng.uniform(0, 5, size=(height, width)), -9999.0).astype(np.float32)
+
+        transform = from_origin(500000 + col_off * resolution, 3000000 - row_off * resolution, resolution, resolution)
+        paths.append(os.path.join(out_dir, f'depths_{i}.tif'))
+        with rasterio.open(paths[-1], 'w', width=width, height=height, transform=transform, **profile) as dst:
+            dst.write(depths, 1)
+
+    return(paths)
+
+
+def benchmark_mosaic(number_of_rasters=500, size=8000, workers=(1, 2, 4, 8, 16), backend='thread', verbose=True):
+
+    """
+    Times mosaicking overlapping synthetic branch rasters with the serial and parallel merge
+
+    The parallel mosaics are checked against the serial one. Returns a DataFrame of wall
+    times in seconds by number of workers, where 0 workers is the serial merge.
+    """
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        paths = write_synthetic_branch_rasters(tmp_dir, number_of_rasters, size)
+
+        serial_mosaic = os.path.join(tmp_dir, 'mosaic_serial.tif')
+        start = time.perf_counter()
+        OverlapWindowMerge(paths, (30, 30)).merge_rasters(serial_mosaic, nodata=-9999)
+        records.append({ 'workers' : 0, 'seconds' : time.perf_counter() - start, 'matches_serial' : True })
+
+        if verbose:
+            print(f"{'serial':>10} : {records[-1]['seconds']:7.2f} s")
+
+        with rasterio.open(serial_mosaic) as mosaic:
+            expected = mosaic.read(1)
+
+        for number_of_workers in workers:
+
+            parallel_mosaic = os.path.join(tmp_dir, f'mosaic_{number_of_workers}.tif')
+            start = time.perf_counter()
+            OverlapWindowMerge(paths, (30, 30)).merge_rasters(parallel_mosaic, nodata=-9999, threaded=True,
+                                                              workers=number_of_workers, backend=backend)
+            seconds = time.perf_counter() - start
+
+            with rasterio.open(parallel_mosaic) as mosaic:
+                matches_serial = np.array_equal(mosaic.read(1), expected)
+
+            records.append({ 'workers' : number_of_workers, 'seconds' : seconds, 'matches_serial' : matches_serial })
+
+            if verbose:
+                print(f"{number_of_workers:>10} : {seconds:7.2f} s, matches serial: {matches_serial}")
+
+    return(pd.DataFrame(records))
+
+
+def write_synthetic_gms_hydrofabric(out_dir, number_of_hucs=2, branches_per_huc=8, size=1000,
+                                    catchments_per_branch=200, catchment_block=50, resolution=10, seed=0):
+
+    """
+    Writes a synthetic GMS hydrofabric of overlapping branches and a forecast
+
+    Branches of a HUC shrink and shift along a diagonal so they overlap as level paths do.
+    Each has its own REM, catchments raster and hydroTable in the GMS branch layout, and
+    gms_inputs.csv lists them. Returns the hydrofabric directory and forecast csv path.
+    """
+
+    rng = np.random.default_rng(seed)
+    stage_steps = np.arange(0, 20.5, 0.5)
+
+    profile = { 'driver' : 'GTiff', 'count' : 1, 'crs' : 'EPSG:5070',
+                'tiled' : True, 'blockxsize' : 256, 'blockysize' : 256, 'compress' : 'lzw' }
+
+    gms_inputs = [] ; forecasts = []
+    for huc_idx in range(number_of_hucs):
+
+        huc_code = str(12090301 + huc_idx)
+
+        for branch_idx in range(branches_per_huc):
+
+            branch_id = str(branch_idx)
+            branch_dir = os.path.join(out_dir, huc_code, 'branches', branch_id)
+            os.makedirs(branch_dir, exist_ok=True)
+
+            branch_size = size - branch_idx * size // (2 * branches_per_huc)
+            branch_seed = seed + huc_idx * branches_per_huc + branch_idx
+            rem, catchments, _ = make_synthetic_branch(branch_size, number_of_catchments=catchments_per_branch,
+                                                       catchment_block=catchment_block, lake_fraction=0,
+                                                       seed=branch_seed)
+
+            # unique HydroIDs per branch
+            catchments[catchments != 0] += branch_seed * catchments_per_branch
+
+            offset = branch_idx * size // (4 * branches_per_huc)
+            transform = from_origin(500000 + (huc_idx * size + offset) * resolution,
+                                    3000000 - offset * resolution, resolution, resolution)
+
+            for file_name, array, dtype, nodata in ((f'rem_zeroed_masked_{branch_id}.tif', rem, 'float32', -9999.0),
+                                                    (f'gw_catchments_reaches_filtered_addedAttributes_{branch_id}.tif',
+                                                     catchments, 'int32', 0)):
+                with rasterio.open(os.path.join(branch_dir, file_name), 'w', width=branch_size, height=branch_size,
+                                   transform=transform, dtype=dtype, nodata=nodata, **profile) as dst:
+                    dst.write(array, 1)
+
+            # rating curves and flows
+            hydroIDs = np.unique(catchments[catchments != 0])
+            feature_ids = (hydroIDs // 3).astype(str)
+            pd.DataFrame({ 'HUC' : huc_code,
+                           'feature_id' : np.repeat(feature_ids, len(stage_steps)),
+                           'HydroID' : np.repeat(hydroIDs, len(stage_steps)),
+                           'stage' : np.tile(stage_steps, len(hydroIDs)),
+                           'discharge_cms' : np.tile(3 * stage_steps ** 2, len(hydroIDs)),
+                           'LakeID' : -999 }).to_csv(os.path.join(branch_dir, f'hydroTable_{branch_id}.csv'), index=False)
+
+            unique_feature_ids = np.unique(feature_ids)
+            forecasts.append(pd.DataFrame({ 'feature_id' : unique_feature_ids,
+                                            'discharge' : rng.uniform(0, 1200, len(unique_feature_ids)) }))
+            gms_inputs.append((huc_code, branch_id))
+
+    pd.DataFrame(gms_inputs).to_csv(os.path.join(out_dir, 'gms_inputs.csv'), header=False, index=False)
+
+    forecast = os.path.join(out_dir, 'forecast.csv')
+    pd.concat(forecasts).drop_duplicates('feature_id').to_csv(forecast, index=False)
+
+    return(out_dir, forecast)
+
+
+def benchmark_service(number_of_forecasts=4, number_of_hucs=2, branches_per_huc=8, size=1000,
+                      num_workers=2, verbose=True):
+
+    """
+    Times a series of forecasts with Inundate_gms against an InundationService with warm workers
+
+    Every forecast scales the synthetic discharges. Inundate_gms starts a new process pool for
+    each forecast, the service once. Branch rasters of both are checked to match. Returns a
+    DataFrame of seconds by forecast, where forecast 0 is the startup of the service.
+    """
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        hydrofabric_dir, base_forecast = write_synthetic_gms_hydrofabric(os.path.join(tmp_dir, 'hydrofabric'),
+                                                                         number_of_hucs, branches_per_huc, size)
+
+        forecast = pd.read_csv(base_forecast, dtype={'feature_id' : str})
+        forecasts = []
+        for i in range(number_of_forecasts):
+            forecasts.append(os.path.join(tmp_dir, f'forecast_{i + 1}.csv'))
+            forecast.assign(discharge=forecast['discharge'] * (0.5 + i / number_of_forecasts)).to_csv(forecasts[-1], index=False)
+
+        start = time.perf_counter()
+        with InundationService(hydrofabric_dir, num_workers=num_workers) as service:
+
+            records.append({ 'forecast' : 0, 'Inundate_gms' : np.nan, 'service' : time.perf_counter() - start })
+
+            for i, forecast_file in enumerate(forecasts):
+
+                for runner in ('Inundate_gms', 'service'):
+                    os.makedirs(os.path.join(tmp_dir, runner, str(i)))
+
+                start = time.perf_counter()
+                Inundate_gms(hydrofabric_dir, forecast_file, num_workers=num_workers,
+                             inundation_raster=os.path.join(tmp_dir, 'Inundate_gms', str(i), 'inundation.tif'))
+                gms_seconds = time.perf_counter() - start
+
+                start = time.perf_counter()
+                service_fileNames = service.inundate(forecast_file, os.path.join(tmp_dir, 'service', str(i), 'inundation.tif'))
+                service_seconds = time.perf_counter() - start
+
+                matches = True
+                for raster in service_fileNames['inundation_rasters']:
+                    with rasterio.open(raster) as service_raster, \
+                         rasterio.open(raster.replace(os.sep + 'service' + os.sep, os.sep + 'Inundate_gms' + os.sep)) as gms_raster:
+                        matches &= np.array_equal(service_raster.read(1), gms_raster.read(1))
+
+                records.append({ 'forecast' : i + 1, 'Inundate_gms' : gms_seconds, 'service' : service_seconds,
+                                 'matches' : matches })
+
+    records = pd.DataFrame(records)
+
+    if verbose:
+        print(f"service startup        : {records.loc[0, 'service']:7.2f} s")
+        for _, record in records.iloc[1:].iterrows():
+            print(f"forecast {record['forecast']:>2} Inundate_gms : {record['Inundate_gms']:7.2f} s, "
+                  f"service : {record['service']:7.2f} s, matches: {record['matches']}")
+
+    return(records)
+
+
+def benchmark_cog_reads(size=8000, hucs_per_side=4, zoom_levels=(1, 4, 16, 64), reads=20, tile_size=256,
+                        resolution=10, seed=0, verbose=True):
+
+    """
+    Times reading map tiles of a national extent mosaic at several zoom levels
+
+    Synthetic HUC extent rasters are made boolean as in inundate_nation, as plain tiled
+    GeoTIFFs and as cloud optimized GeoTIFFs (COGs). A tile is a tile_size x tile_size read
+    of a window of tile_size * zoom pixels at a random place, from a freshly opened dataset as
+    a viewer or tiling job would do. Tiles are read from the mosaic written as a plain
+    GeoTIFF, from it written as a COG, and through a VRT index over the HUC COGs. Returns a
+    DataFrame of the median milliseconds per tile by output and zoom level.
+    """
+
+    rng = np.random.default_rng(seed)
+    huc_size = size // hucs_per_side
+
+    # coherent wet areas, positive HydroIDs where wet and negative where dry
+    coarse = rng.uniform(size=(size // 50 + 1, size // 50 + 1))
+    wet = np.kron(coarse, np.ones((50, 50)))[:size, :size] > 0.7
+    extent = np.where(wet, 1000, -1000).astype(np.int32)
+
+    profile = { 'driver' : 'GTiff', 'count' : 1, 'dtype' : 'int32', 'nodata' : -9999,
+                'crs' : 'EPSG:5070', 'tiled' : True, 'blockxsize' : 256, 'blockysize' : 256,
+                'compress' : 'lzw' }
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        extent_dir, plain_dir, cog_dir = [ os.path.join(tmp_dir, d) for d in ('extent','plain','cogs') ]
+        for d in (extent_dir, plain_dir, cog_dir):
+            os.mkdir(d)
+
+        for i in range(hucs_per_side):
+            for j in range(hucs_per_side):
+                transform = from_origin(500000 + j * huc_size * resolution, 3000000 - i * huc_size * resolution,
+                                        resolution, resolution)
+                rasfile = f'extent_{i}_{j}.tif'
+                with rasterio.open(os.path.join(extent_dir, rasfile), 'w', width=huc_size, height=huc_size,
+                                   transform=transform, **profile) as dst:
+                    dst.write(extent[i * huc_size:(i + 1) * huc_size, j * huc_size:(j + 1) * huc_size], 1)
+
+                create_bool_rasters([extent_dir, rasfile, plain_dir, False])
+                create_bool_rasters([extent_dir, rasfile, cog_dir, True])
+
+        # the mosaic as a plain GeoTIFF and as a COG, and the VRT index over the HUC COGs
+        bool_profile = { 'driver' : 'GTiff', 'count' : 1, 'dtype' : 'int8', 'nodata' : 0, 'crs' : 'EPSG:5070',
+                         'width' : huc_size * hucs_per_side, 'height' : huc_size * hucs_per_side,
+                         'transform' : from_origin(500000, 3000000, resolution, resolution),
+                         'compress' : 'lzw', 'predictor' : 2 }
+        bool_mosaic = wet[:huc_size * hucs_per_side, :huc_size * hucs_per_side].astype(np.int8)
+
+        outputs = OrderedDict()
+        outputs['plain'] = os.path.join(tmp_dir, 'mosaic.tif')
+        with rasterio.open(outputs['plain'], 'w', tiled=True, **bool_profile) as dst:
+            dst.write(bool_mosaic, 1)
+
+        outputs['cog'] = os.path.join(tmp_dir, 'mosaic_cog.tif')
+        with cog_writer(outputs['cog'], overview_resampling='average', **bool_profile) as dst:
+            dst.write(bool_mosaic, 1)
+
+        outputs['vrt'] = vrt_raster_mosaic(cog_dir, tmp_dir, 'cogs', vrt_only=True)
+
+        for zoom in zoom_levels:
+
+            span = tile_size * zoom
+            if span > bool_mosaic.shape[0]:
+                continue
+
+            offsets = rng.integers(0, bool_mosaic.shape[0] - span + 1, size=(reads, 2))
+
+            for output, path in outputs.items():
+                seconds = []
+                for row_off, col_off in offsets:
+                    start = time.perf_counter()
+                    with rasterio.open(path) as dataset:
+                        dataset.read(1, window=Window(int(col_off), int(row_off), span, span),
+                                     out_shape=(tile_size, tile_size), resampling=Resampling.nearest)
+                    seconds.append(time.perf_counter() - start)
+
+                records.append({ 'output' : output, 'zoom' : zoom, 'milliseconds' : 1000 * np.median(seconds),
+                                 'bytes' : os.path.getsize(path) if output != 'vrt' else
+                                           sum(os.path.getsize(os.path.join(cog_dir, f)) for f in os.listdir(cog_dir)) })
+
+                if verbose:
+                    print(f"zoom {zoom:>3} {output:>6} : {records[-1]['milliseconds']:8.1f} ms per tile")
+
+    return(pd.DataFrame(records))
+
+
+def __contingency_table_by_full_arrays(benchmark_raster_path, predicted_raster_path, agreement_raster=None, mask_values=None, mask_dict=None):
+    """ Former full array get_contingency_table_from_binary_rasters, used as reference """
+    from rasterio.warp import reproject, Resampling
+    import rasterio
+    import numpy as np
+    import os
+    import rasterio.mask
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    # Load rasters.
+    benchmark_src = rasterio.open(benchmark_raster_path)
+    predicted_src = rasterio.open(predicted_raster_path)
+    predicted_array = predicted_src.read(1)
+
+    benchmark_array_original = benchmark_src.read(1)
+
+    if benchmark_array_original.shape != predicted_array.shape:
+        benchmark_array = np.empty(predicted_array.shape, dtype=np.int8)
+
+        reproject(benchmark_array_original,
+              destination = benchmark_array,
+              src_transform = benchmark_src.transform,
+              src_crs = benchmark_src.crs,
+              src_nodata = benchmark_src.nodata,
+              dst_transform = predicted_src.transform,
+              dst_crs = predicted_src.crs,
+              dst_nodata = benchmark_src.nodata,
+              dst_resolution = predicted_src.res,
+              resampling = Resampling.nearest)
+
+    predicted_array_raw = predicted_src.read(1)
+
+    # Align the benchmark domain to the modeled domain.
+    benchmark_array = np.where(predicted_array==predicted_src.nodata, 10, benchmark_array)
+
+    # Ensure zeros and ones for binary comparison. Assume that positive values mean flooding and 0 or negative values mean dry.
+    predicted_array = np.where(predicted_array==predicted_src.nodata, 10, predicted_array)  # Reclassify NoData to 10
+    predicted_array = np.where(predicted_array<0, 0, predicted_array)
+    predicted_array = np.where(predicted_array>0, 1, predicted_array)
+
+    benchmark_array = np.where(benchmark_array==benchmark_src.nodata, 10, benchmark_array)  # Reclassify NoData to 10
+
+    agreement_array = np.add(benchmark_array, 2*predicted_array)
+    agreement_array = np.where(agreement_array>4, 10, agreement_array)
+
+    del benchmark_src, benchmark_array, predicted_array, predicted_array_raw
+
+    # Loop through exclusion masks and mask the agreement_array.
+    if mask_dict:
+        for poly_layer in mask_dict:
+
+            operation = mask_dict[poly_layer]['operation']
+
+            if operation == 'exclude':
+
+                poly_path = mask_dict[poly_layer]['path']
+                buffer_val = mask_dict[poly_layer]['buffer']
+
+                reference = predicted_src
+
+                bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
+                #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
+                poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+
+                # Make sure features are present in bounding box area before projecting. Continue to next layer if features are absent.
+                if poly_all.empty:
+                    continue
+
+                #Project layer to reference crs.
+                poly_all_proj = poly_all.to_crs(reference.crs)
+                # check if there are any lakes within our reference raster extent.
+                if poly_all_proj.empty:
+                    #If no features within reference raster extent, create a zero array of same shape as reference raster.
+                    poly_mask = np.zeros(reference.shape)
+                else:
+                    #Check if a buffer value is passed to function.
+                    if buffer_val is None:
+                        #If features are present and no buffer is passed, assign geometry to variable.
+                        geometry = poly_all_proj.geometry
+                    else:
+                        #If  features are present and a buffer is passed, assign buffered geometry to variable.
+                        geometry = poly_all_proj.buffer(buffer_val)
+
+                    #Perform mask operation on the reference raster and using the previously declared geometry geoseries. Invert set to true as we want areas outside of poly areas to be False and areas inside poly areas to be True.
+                    in_poly,transform,c = rasterio.mask.raster_geometry_mask(reference, geometry, invert = True)
+                    #Write mask array, areas inside polys are set to 1 and areas outside poly are set to 0.
+                    poly_mask = np.where(in_poly == True, 1,0)
+
+                    # Perform mask.
+                    masked_agreement_array = np.where(poly_mask == 1, 4, agreement_array)
+
+                    # Get rid of masked values outside of the modeled domain.
+                    agreement_array = np.where(agreement_array == 10, 10, masked_agreement_array)
+
+    contingency_table_dictionary = {}  # Initialize empty dictionary.
+
+    # Only write the agreement raster if user-specified.
+    if agreement_raster != None:
+        with rasterio.Env():
+            profile = predicted_src.profile
+            profile.update(nodata=10)
+            with rasterio.open(agreement_raster, 'w', **profile) as dst:
+                dst.write(agreement_array, 1)
+
+
+    # Store summed pixel counts in dictionary.
+    contingency_table_dictionary.update({'total_area':{'true_negatives': int((agreement_array == 0).sum()),
+                                                      'false_negatives': int((agreement_array == 1).sum()),
+                                                      'false_positives': int((agreement_array == 2).sum()),
+                                                      'true_positives': int((agreement_array == 3).sum()),
+                                                      'masked_count': int((agreement_array == 4).sum()),
+                                                      'file_handle': 'total_area'
+
+                                                      }})
+
+    # After agreement_array is masked with default mask layers, check for inclusion masks in mask_dict.
+    if mask_dict:
+        for poly_layer in mask_dict:
+
+            operation = mask_dict[poly_layer]['operation']
+
+            if operation == 'include':
+
+                poly_path = mask_dict[poly_layer]['path']
+                buffer_val = mask_dict[poly_layer]['buffer']
+
+                reference = predicted_src
+
+                bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
+                #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
+                poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+
+                # Make sure features are present in bounding box area before projecting. Continue to next layer if features are absent.
+                if poly_all.empty:
+                    continue
+
+                #Project layer to reference crs.
+                poly_all_proj = poly_all.to_crs(reference.crs)
+                # check if there are any lakes within our reference raster extent.
+                if poly_all_proj.empty:
+                    #If no features within reference raster extent, create a zero array of same shape as reference raster.
+                    poly_mask = np.zeros(reference.shape)
+                else:
+                    #Check if a buffer value is passed to function.
+                    if buffer_val is None:
+                        #If features are present and no buffer is passed, assign geometry to variable.
+                        geometry = poly_all_proj.geometry
+                    else:
+                        #If  features are present and a buffer is passed, assign buffered geometry to variable.
+                        geometry = poly_all_proj.buffer(buffer_val)
+
+                    #Perform mask operation on the reference raster and using the previously declared geometry geoseries. Invert set to true as we want areas outside of poly areas to be False and areas inside poly areas to be True.
+                    in_poly,transform,c = rasterio.mask.raster_geometry_mask(reference, geometry, invert = True)
+                    #Write mask array, areas inside polys are set to 1 and areas outside poly are set to 0.
+                    poly_mask = np.where(in_poly == True, 1, 0)
+
+                    # Perform mask.
+                    masked_agreement_array = np.where(poly_mask == 0, 4, agreement_array)  # Changed to poly_mask == 0
+
+                    # Get rid of masked values outside of the modeled domain.
+                    temp_agreement_array = np.where(agreement_array == 10, 10, masked_agreement_array)
+
+                    if buffer_val == None:  # The buffer used is added to filename, and 0 is easier to read than None.
+                        buffer_val = 0
+
+                    poly_handle = poly_layer + '_b' + str(buffer_val) + 'm'
+
+                    # Write the layer_agreement_raster.
+                    layer_agreement_raster = os.path.join(os.path.split(agreement_raster)[0], poly_handle + '_agreement.tif')
+                    with rasterio.Env():
+                        profile = predicted_src.profile
+                        profile.update(nodata=10)
+                        with rasterio.open(layer_agreement_raster, 'w', **profile) as dst:
+                            dst.write(temp_agreement_array, 1)
+
+
+                    # Store summed pixel counts in dictionary.
+                    contingency_table_dictionary.update({poly_handle:{'true_negatives': int((temp_agreement_array == 0).sum()),
+                                                                     'false_negatives': int((temp_agreement_array == 1).sum()),
+                                                                     'false_positives': int((temp_agreement_array == 2).sum()),
+                                                                     'true_positives': int((temp_agreement_array == 3).sum()),
+                                                                     'masked_count': int((temp_agreement_array == 4).sum()),
+                                                                     'file_handle': poly_handle
+                                                                      }})
+
+    return contingency_table_dictionary
+
+
+def write_synthetic_contingency_rasters(out_dir, size=20000, resolution=10, rows_per_write=1024, seed=0):
+
+    """
+    Writes a synthetic predicted and benchmark raster pair and mask layers for contingency tables
+
+    The predicted raster holds positive (inundated) and negative (dry) HydroIDs with a NoData
+    border. The benchmark agrees with it but for 10 % of the pixels, and is on a grid 3 pixels
+    larger on each side as benchmark rasters are, so it is reprojected to the predicted grid.
+    The rasters are written in strips of rows_per_write rows to keep memory bounded. Returns the
+    paths of the predicted and benchmark rasters and a mask_dict with an exclusion mask of
+    lakes and inclusion masks of a domain and of buffered levee lines.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # coherent wet areas
+    coarse = rng.uniform(size=(size // 50 + 1, size // 50 + 1))
+    transform = from_origin(500000, 3000000, resolution, resolution)
+
+    profile = { 'driver' : 'GTiff', 'count' : 1, 'crs' : 'EPSG:5070', 'tiled' : True,
+                'blockxsize' : 256, 'blockysize' : 256, 'compress' : 'lzw' }
+
+    predicted_raster = os.path.join(out_dir, 'predicted.tif')
+    benchmark_raster = os.path.join(out_dir, 'benchmark.tif')
+
+    with rasterio.open(predicted_raster, 'w', width=size, height=size, transform=transform,
+                       dtype='int32', nodata=-9999, **profile) as predicted, \
+         rasterio.open(benchmark_raster, 'w', width=size + 6, height=size + 6,
+                       transform=transform * transform.translation(-3, -3),
+                       dtype='int8', nodata=-1, **profile) as benchmark:
+
+        benchmark.write(np.full((3, size + 6), -1, dtype=np.int8), 1, window=Window(0, 0, size + 6, 3))
+        benchmark.write(np.full((3, size + 6), -1, dtype=np.int8), 1, window=Window(0, size + 3, size + 6, 3))
+
+        for row_off in range(0, size, rows_per_write):
+            rows = min(rows_per_write, size - row_off)
+            row_idx = np.arange(row_off, row_off + rows)
+
+            wet = coarse[row_idx // 50][:, np.arange(size) // 50] > 0.6
+            hydroIDs = 1000 + (row_idx[:, np.newaxis] // 100) * 1000 + np.arange(size) // 100
+            strip = np.where(wet, hydroIDs, -hydroIDs).astype(np.int32)
+            strip[:, :size // 100] = -9999
+            predicted.write(strip, 1, window=Window(0, row_off, size, rows))
+
+            benchmark_strip = np.full((rows, size + 6), -1, dtype=np.int8)
+            benchmark_strip[:, 3:-3] = wet ^ (rng.random((rows, size)) < 0.1)
+            benchmark.write(benchmark_strip, 1, window=Window(0, row_off + 3, size + 6, rows))
+
+    # masks in map units
+    extent = size * resolution
+    left, top = 500000, 3000000
+    random_boxes = lambda n, width: [ box(x, y, x + width, y + width) for x, y in
+                                      zip(left + rng.uniform(0, extent - width, n), top - rng.uniform(width, extent, n)) ]
+
+    layers = { 'lakes' : (random_boxes(200, extent / 50), None, 'exclude'),
+               'domain' : ([ box(left + extent / 10, top - 0.9 * extent, left + 0.9 * extent, top - extent / 10) ], None, 'include'),
+               'levees' : ([ box(x, top - extent, x + 1, top) for x in left + rng.uniform(0, extent, 20) ], 100, 'include') }
+
+    mask_dict = {}
+    for layer, (geometries, buffer_val, operation) in layers.items():
+        mask_path = os.path.join(out_dir, f'{layer}.gpkg')
+        with fiona.open(mask_path, 'w', driver='GPKG', crs='EPSG:5070',
+                        schema={ 'geometry' : 'Polygon', 'properties' : { 'id' : 'int' } }) as dst:
+            dst.writerecords([ { 'geometry' : mapping(g), 'properties' : { 'id' : i } } for i, g in enumerate(geometries) ])
+        mask_dict[layer] = { 'path' : mask_path, 'buffer' : buffer_val, 'operation' : operation }
+
+    return(predicted_raster, benchmark_raster, mask_dict)
+
+
+def benchmark_contingency(size=20000, block_size=CONTINGENCY_BLOCK_SIZE, reference=True, verbose=True):
+
+    """
+    Compares the blockwise contingency table engine against the full array one it replaced
+
+    Contingency tables of a synthetic size x size raster pair are made with an exclusion mask
+    and two inclusion masks, writing the agreement rasters. Asserts the tables and the agreement
+    rasters are identical and returns a DataFrame of wall times in seconds and peak numpy
+    memory in MB by implementation. Pass reference=False to time the blockwise engine alone on
+    sizes the full array implementation can not hold in memory.
+    """
+
+    records = []
+    with tempfile.TemporaryDirectory() as tmp_dir:
+
+        predicted_raster, benchmark_raster, mask_dict = write_synthetic_contingency_rasters(tmp_dir, size)
+
+        implementations = OrderedDict()
+        if reference:
+            implementations['full arrays'] = __contingency_table_by_full_arrays
+        implementations['blockwise'] = lambda *args, **kwargs: get_contingency_table_from_binary_rasters(*args, block_size=block_size, **kwargs)
+
+        tables = {}
+        for name, function in implementations.items():
+
+            agreement_dir = os.path.join(tmp_dir, name.replace(' ', '_'))
+            os.mkdir(agreement_dir)
+
+            tracemalloc.start()
+            start = time.perf_counter()
+            tables[name] = function(benchmark_raster, predicted_raster, os.path.join(agreement_dir, 'total_area_agreement.tif'),
+                                    mask_dict=mask_dict)
+            seconds = time.perf_counter() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+            records.append({ 'implementation' : name, 'size' : size, 'seconds' : seconds, 'peak_mb' : peak / 2**20 })
+
+            if verbose:
+                print(f"{size:,} x {size:,} {name:>12} : {seconds:7.2f} s, peak numpy memory {peak / 2**20:8.1f} MB")
+
+        if reference:
+            assert tables['full arrays'] == tables['blockwise'], "Contingency tables differ between implementations"
+            for agreement_raster in os.listdir(os.path.join(tmp_dir, 'full_arrays')):
+                if not agreement_raster.endswith('.tif'):
+                    continue
+                with rasterio.open(os.path.join(tmp_dir, 'full_arrays', agreement_raster)) as full, \
+                     rasterio.open(os.path.join(tmp_dir, 'blockwise', agreement_raster)) as blockwise:
+                    for _, window in full.block_windows(1):
+                        assert np.array_equal(full.read(1, window=window), blockwise.read(1, window=window)), \
+                               f"{agreement_raster} differs between implementations"
+
+    return(pd.DataFrame(records))
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmarks for inundation mapping engines on synthetic data.')
+    parser.add_argument('-b','--benchmark', help='Benchmark to run',
+                        required=False, default='lookup', choices=['lookup','batch','interp','polygons','mosaic','service','cog','contingency'])
+    parser.add_argument('-s','--size', help='Width and height of synthetic REM in pixels',
+                        required=False, default=10000, type=int)
+    parser.add_argument('-r','--repeats', help='Number of timed repeats',
+                        required=False, default=3, type=int)
+    parser.add_argument('-w','--workers', help='Numbers of workers to benchmark',
+                        required=False, default=[1,2,4,8], type=int, nargs='+')
+    parser.add_argument('-c','--catchments', help='Interpolation benchmark only. Number of synthetic catchments',
+                        required=False, default=100000, type=int)
+    parser.add_argument('-f','--forecasts', help='Interpolation benchmark only. Numbers of forecasts to benchmark',
+                        required=False, default=[1,8], type=int, nargs='+')
+    parser.add_argument('-u','--hucs-per-side', help='Batch and cog benchmarks only. Number of synthetic HUCs along each side of the REM',
+                        required=False, default=4, type=int)
+    parser.add_argument('-n','--number-of-rasters', help='Mosaic benchmark only. Number of synthetic branch rasters',
+                        required=False, default=500, type=int)
+    parser.add_argument('-g','--number-of-forecasts', help='Service benchmark only. Number of forecasts inundated in a row',
+                        required=False, default=4, type=int)
+    parser.add_argument('-z','--zoom-levels', help='Cog benchmark only. Zoom levels, pixels per tile pixel, to read tiles at',
+                        required=False, default=[1,4,16,64], type=int, nargs='+')
+    parser.add_argument('-x','--backend', help="Mosaic benchmark only. 'thread' or 'process' pool of workers",
+                        required=False, default='thread', choices=['thread','process'])
+    parser.add_argument('-k','--skip-reference', help='Contingency benchmark only. Time the blockwise engine alone, for sizes the full array reference can not hold in memory',
+                        required=False, default=False, action='store_true')
+
+    args = vars(parser.parse_args())
+
+    if args['benchmark'] == 'lookup':
+        benchmark_lookup_modes(size=args['size'], repeats=args['repeats'])
+    elif args['benchmark'] == 'batch':
+        benchmark_batch_backends(size=args['size'], hucs_per_side=args['hucs_per_side'], workers=args['workers'])
+    elif args['benchmark'] == 'interp':
+        benchmark_interpolation(number_of_catchments=args['catchments'], number_of_forecasts=args['forecasts'],
+                                repeats=args['repeats'])
+    elif args['benchmark'] == 'polygons':
+        benchmark_polygon_modes(size=args['size'], repeats=args['repeats'])
+    elif args['benchmark'] == 'mosaic':
+        benchmark_mosaic(number_of_rasters=args['number_of_rasters'], size=args['size'], workers=args['workers'],
+                         backend=args['backend'])
+    elif args['benchmark'] == 'service':
+        benchmark_service(number_of_forecasts=args['number_of_forecasts'], size=args['size'],
+                          num_workers=args['workers'][0])
+    elif args['benchmark'] == 'cog':
+        benchmark_cog_reads(size=args['size'], hucs_per_side=args['hucs_per_side'], zoom_levels=args['zoom_levels'],
+                            reads=args['repeats'])
+    elif args['benchmark'] == 'contingency':
+        benchmark_contingency(size=args['size'], reference=not args['skip_reference'])
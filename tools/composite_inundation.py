@@ -13,7 +13,8 @@ from tqdm import tqdm
 
 from inundation import inundate
 from gms_tools.mosaic_inundation import Mosaic_inundation
-from gms_tools.inundate_gms import Inundate_gms
+from gms_tools.inundate_gms import Inundate_gms, Inundate_gms_fused
+from gms_tools.overlapping_inundation import OverlapWindowComposite, COMPOSITE_RULES
 from utils.shared_functions import FIM_Helpers as fh
 from utils.shared_variables import elev_raster_ndv
 
@@ -26,13 +27,14 @@ class InundateModel_HUC(object):
         self.huc = huc        
 
     def inundate_huc(self, flows_file, composite_output_dir, output_name, log_file_path,
-                     num_workers_branches, no_cleanup, verbose):
+                     num_workers_branches, no_cleanup, verbose, composite_depths=False):
         '''
         Processing:
-            Will inundate a single huc directory and if gms, will create an aggregate mosiac per huc
+            Will inundate a single huc directory and if gms, will create an aggregate mosiac per huc.
+            With composite_depths, a depths raster is made along with the inundation raster.
 
         Returns:
-            The map file of the inundated raster.
+            The map file of the inundated raster (model, huc, inundation raster, depths raster or None).
         '''
 
         source_huc_dir = os.path.join(self.source_directory, self.huc)
@@ -59,6 +61,9 @@ class InundateModel_HUC(object):
 
         output_raster_name = os.path.join(output_huc_dir, output_name)
         output_raster_name = fh.append_id_to_file_name(output_raster_name, [self.huc,self.model])
+        output_depths_name = None
+        if composite_depths:
+            output_depths_name = fh.append_id_to_file_name(output_raster_name, 'depths')
 
         # adjust to add model and huc number
         log_file = None
@@ -94,6 +99,7 @@ class InundateModel_HUC(object):
                                 mask_type = None, 
                                 num_workers = 1,
                                 inundation_raster = output_raster_name,
+                                depths = output_depths_name,
                                 quiet = not verbose)
 
             #if verbose:
@@ -104,7 +110,31 @@ class InundateModel_HUC(object):
                 raise Exception(f"Failed to inundate {extent_friendly} using the provided flows.")
 
             mosaic_file_path = map_file[0][0]
-            inundation_map_file = [self.model, self.huc, mosaic_file_path]            
+            depths_file_path = map_file[1][0] if composite_depths else None
+            inundation_map_file = [self.model, self.huc, mosaic_file_path, depths_file_path]
+
+        elif composite_depths:  # gms
+            # inundation and depths branches are reduced in to the huc mosaics in memory
+            mosaic_file_df = Inundate_gms_fused( hydrofabric_dir = self.source_directory,
+                                                 forecast = flows_file,
+                                                 num_workers = num_workers_branches,
+                                                 hucs = self.huc,
+                                                 inundation_raster = output_raster_name,
+                                                 depths_raster = output_depths_name,
+                                                 mask = os.path.join(source_huc_dir, 'wbd.gpkg'),
+                                                 nodata = elev_raster_ndv,
+                                                 verbose = verbose,
+                                                 log_file = log_file,
+                                                 output_fileNames = inundation_list_file )
+
+            if len(mosaic_file_df) == 0:
+                raise Exception(f"Failed to inundate {extent_friendly} using the provided flows.")
+
+            inundation_map_file = [self.model, self.huc,
+                                   mosaic_file_df.loc[0, 'inundation_rasters'],
+                                   mosaic_file_df.loc[0, 'depths_rasters']]
+
+            if verbose: print(f"Inundation for HUC {self.huc} is complete")
 
         else:  # gms
             # we are doing each huc one at a time
@@ -132,7 +162,7 @@ class InundateModel_HUC(object):
                                                   subset = None,
                                                   verbose = verbose )
 
-            inundation_map_file = [self.model, self.huc, mosaic_file_path]
+            inundation_map_file = [self.model, self.huc, mosaic_file_path, None]
             
             if verbose: print(f"Inundation for HUC {self.huc} is complete")
 
@@ -162,13 +192,14 @@ class Composite_HUC(object):
                                         args["log_file_path"],
                                         args["num_workers_branches"],
                                         args["no_cleanup"],
-                                        args["verbose"])
+                                        args["verbose"],
+                                        args["composite_depths"])
             if map_file is not None:
                 composite_model_map_files.append(map_file)
 
         # Composite the two final model outputs
         inundation_map_file_df = pd.DataFrame(composite_model_map_files,
-                                              columns = ['model', 'huc8', 'inundation_rasters'])
+                                              columns = ['model', 'huc8', 'inundation_rasters', 'depths_rasters'])
 
         if args["verbose"]:
             print("inundation_map_file_df")
@@ -177,23 +208,48 @@ class Composite_HUC(object):
         composite_file_output = os.path.join(args["composite_output_dir"], huc, args["output_name"])
         composite_file_output = fh.append_id_to_file_name(composite_file_output, huc)
 
-        # NOTE: Leave workers as 1, it fails to composite correctly if more than one.
-        #    - Also. by adding the is_mosaic_for_gms_branches = False, Mosaic_inudation
-        #      will not auto add the HUC into the output name (its default behaviour)
-        mosaic_file_path = Mosaic_inundation( inundation_map_file_df,
-                                            mosaic_attribute='inundation_rasters',
-                                            mosaic_output = composite_file_output,
-                                            mask = None,
-                                            unit_attribute_name = 'huc8',
-                                            nodata = elev_raster_ndv,
-                                            workers = 1,
-                                            remove_inputs = not args["no_cleanup"],
-                                            subset = None,
-                                            verbose = args["verbose"] )
-
-        if args["is_bin_raster"]:
-            if args["verbose"]: print("Converting to binary")
-            CompositeInundation.hydroid_to_binary(composite_file_output)
+        # The depths (or the inundation extents) of the models are read once and composited
+        # by the composite rule in to the extent, depths and source model rasters together.
+        # Without is_bin_raster, the extent is the maximum HydroID of the models as before.
+        extent_file_output = composite_file_output if args["is_bin_raster"] else None
+        if args["composite_depths"]:
+            composite_inputs = inundation_map_file_df.loc[:,'depths_rasters']
+            depths_file_output = fh.append_id_to_file_name(composite_file_output, 'depths')
+        else:
+            composite_inputs = inundation_map_file_df.loc[:,'inundation_rasters']
+            depths_file_output = None
+        source_file_output = fh.append_id_to_file_name(composite_file_output, 'source')
+
+        composite = OverlapWindowComposite(list(composite_inputs),
+                                           list(inundation_map_file_df.loc[:,'model']),
+                                           (30, 30))
+        composite.composite_rasters(depths_output = depths_file_output,
+                                    extent_output = extent_file_output,
+                                    source_output = source_file_output,
+                                    rule = args["composite_rule"],
+                                    priority = [ model for model in args["priority"] if model in composite.models ],
+                                    values = 'depths' if args["composite_depths"] else 'extent',
+                                    nodata = elev_raster_ndv)
+
+        if not args["is_bin_raster"]:
+            # NOTE: Leave workers as 1, it fails to composite correctly if more than one.
+            #    - Also. by adding the is_mosaic_for_gms_branches = False, Mosaic_inudation
+            #      will not auto add the HUC into the output name (its default behaviour)
+            Mosaic_inundation( inundation_map_file_df,
+                               mosaic_attribute = 'inundation_rasters',
+                               mosaic_output = composite_file_output,
+                               mask = None,
+                               unit_attribute_name = 'huc8',
+                               nodata = elev_raster_ndv,
+                               workers = 1,
+                               remove_inputs = False,
+                               subset = None,
+                               verbose = args["verbose"] )
+
+        if not args["no_cleanup"]:
+            for model_file in inundation_map_file_df.loc[:,['inundation_rasters','depths_rasters']].values.ravel():
+                if (model_file is not None) and os.path.exists(model_file):
+                    os.remove(model_file)
 
 
 class CompositeInundation(object):
@@ -229,7 +285,16 @@ class CompositeInundation(object):
             output_name : str, optional
                 Name for output raster. If not specified, by default the raster will be named 'inundation_composite_{flows_root}.tif'.
             is_bin_raster : bool, optional
-                Flag to create binary raster as output.
+                Flag to create binary raster as output, int8 wet (1), dry (0) and no data (-128)
+                by the composite rule. Otherwise the output is the maximum HydroID of the models.
+            composite_rule : str, optional
+                Per pixel rule to composite the models with: max (default), priority or mean.
+            priority : str, optional
+                Comma-separated models (ms, fr, gms) from first to last priority for the
+                priority rule. Defaults to the order ms, fr, gms.
+            composite_depths : bool, optional
+                Inundates depths rasters and composites depths, writing the composite depths
+                raster along with the extent and source model rasters.
             num_workers_huc : int, optional
                 defaults to 1 and means the number of processes to be used for processing hucs
             num_workers_branches : int, optional
@@ -277,6 +342,17 @@ class CompositeInundation(object):
             if len(dir_list_lowercase) != len(set(dir_list_lowercase)):
                 raise ValueError("The two sources directories are the same path.")
 
+            if args["composite_rule"] not in COMPOSITE_RULES:
+                raise ValueError("Composite rule must be one of {}".format(", ".join(COMPOSITE_RULES)))
+
+            if args["priority"]:
+                args["priority"] = [ model.strip().lower() for model in args["priority"].split(',') ]
+                if sorted(args["priority"]) != sorted(set(args["priority"])) or \
+                   not set(args["models"]).issubset(args["priority"]):
+                    raise ValueError("Priority must list each submitted model (ms, fr and/or gms) once")
+            else:
+                args["priority"] = list(args["models"])
+
             if not os.path.exists(args["flows_file"]):
                 print(f'{args["flows_file"]} does not exist. Please specify a flow file.')
 
@@ -353,7 +429,8 @@ class CompositeInundation(object):
         #if len(huc_list == 1): # skip iterator
         if (number_huc_workers == 1):
             for huc in sorted(huc_list):
-                Composite_HUC.composite_huc(huc, args)
+                args["current_huc"] = huc
+                Composite_HUC.composite_huc(args)
         else:
 
             print(f"Processing {len(huc_list)} hucs")
@@ -417,6 +494,9 @@ if __name__ == '__main__':
 
         b) fr and gms (single huc)
         python3 /foss_fim/tools/composite_inundation.py -fr /outputs/inundation_test_1_FIM3_fr -gms /outputs/inundation_test_1_gms -u 13090001 -f /data/inundation_review/inundation_nwm_recurr/nwm_recurr_flow_data/nwm21_17C_recurr_25_0_cms.csv -o /outputs/inundation_test_1_comp/ -n test_inundation.tif
+
+        c) fr and gms depths, gms where it has data and fr elsewhere (single huc)
+        python3 /foss_fim/tools/composite_inundation.py -fr /outputs/inundation_test_1_FIM3_fr -gms /outputs/inundation_test_1_gms -u 13090001 -f /data/inundation_review/inundation_nwm_recurr/nwm_recurr_flow_data/nwm21_17C_recurr_25_0_cms.csv -o /outputs/inundation_test_1_comp/ -n test_inundation.tif -d -r priority -p gms,fr
     '''
 
     # parse arguments
@@ -440,7 +520,19 @@ if __name__ == '__main__':
     parser.add_argument('-n','--output-name', help='File name for output(s).', 
                         default=None, required=False)
     parser.add_argument('-b','--is-bin-raster', 
-                        help="If flag is included, the output raster will be changed to wet/dry.", 
+                        help="""If flag is included, the output raster will be changed to wet/dry by the composite rule.
+                        Otherwise it holds the maximum HydroID of the models.""", 
+                        required=False, default=False, action='store_true')
+    parser.add_argument('-r','--composite-rule',
+                        help="""Per pixel rule to composite the models with. max keeps the deepest model,
+                        priority the first model in the priority list with data and mean averages the models.""",
+                        required=False, default='max', choices=COMPOSITE_RULES)
+    parser.add_argument('-p','--priority',
+                        help='Comma-separated models from first to last priority for the priority rule, e.g. gms,fr.',
+                        required=False, default=None)
+    parser.add_argument('-d','--composite-depths',
+                        help="""If flag is included, depths are inundated and composited and a depths raster
+                        (_depths) is written with the extent and source model (_source) rasters.""",
                         required=False, default=False, action='store_true')
     parser.add_argument('-jh', '--num-workers-huc',
                         help='Number of processes to use for HUC scale operations. HUC and Batch job numbers should multiply to no more than one less than the CPU count of the machine.',
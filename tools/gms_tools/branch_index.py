@@ -0,0 +1,222 @@
+#!/usr/bin/env python3
+
+import os
+import argparse
+import tempfile
+import zipfile
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+from tqdm import tqdm
+from inundation import read_hydroTable, read_forecast
+
+# stored beside gms_inputs.csv
+BRANCH_INDEX_FILE_NAME = 'gms_branch_index.npz'
+
+# bump when the layout of the branch index changes
+BRANCH_INDEX_VERSION = 1
+
+
+class BranchIndex:
+
+    """
+    Feature_ids and extents of the branches of a GMS hydrofabric
+
+    branches is a DataFrame of the huc8, branchID and REM bounds (minx, miny, maxx, maxy) of
+    every branch in gms_inputs.csv, in order. features is a DataFrame of the non-lake
+    feature_ids of the hydroTable of each branch, with branch the row of the branch in
+    branches. Branches with a missing REM have NaN bounds and those with a missing or lake
+    only hydroTable have no feature_ids.
+
+    read() loads the index stored beside gms_inputs.csv and builds it when it is missing or
+    out of date with gms_inputs.csv or any hydroTable, so forecasts can be matched to
+    branches without opening their files.
+    """
+
+    def __init__(self, branches, features):
+
+        self.branches = branches
+        self.features = features
+
+    @classmethod
+    def read(cls, hydrofabric_dir, build=True, verbose=False):
+
+        """ Loads the branch index of a hydrofabric, building it when missing or out of date and build is True """
+
+        index_file = os.path.join(hydrofabric_dir, BRANCH_INDEX_FILE_NAME)
+
+        try:
+            branch_index = cls.__read_index_file(index_file, hydrofabric_dir)
+        except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+            branch_index = None
+
+        if (branch_index is None) and build:
+            branch_index = cls.build(hydrofabric_dir, verbose=verbose)
+        elif branch_index is None:
+            raise ValueError("Branch index of {} is missing or out of date".format(hydrofabric_dir))
+
+        return(branch_index)
+
+    @classmethod
+    def build(cls, hydrofabric_dir, verbose=False):
+
+        """ Builds the branch index of a hydrofabric and stores it beside gms_inputs.csv if the directory is writable """
+
+        gms_inputs = os.path.join(hydrofabric_dir, 'gms_inputs.csv')
+        hucs_branches = pd.read_csv(gms_inputs, header=None, dtype={0:str,1:str})
+
+        bounds = np.full((len(hucs_branches), 4), np.nan)
+        hydro_table_signatures = np.zeros((len(hucs_branches), 2), dtype=np.int64)
+        feature_ids = [] ; feature_branches = []
+
+        for branch_idx, (hucCode, branch_id) in enumerate(tqdm(zip(hucs_branches.loc[:,0], hucs_branches.loc[:,1]),
+                                                               total=len(hucs_branches),
+                                                               desc="Indexing branches",
+                                                               disable=(not verbose))):
+
+            branch_dir = os.path.join(hydrofabric_dir, hucCode, 'branches', branch_id)
+
+            try:
+                with rasterio.open(os.path.join(branch_dir, 'rem_zeroed_masked_{}.tif'.format(branch_id))) as rem:
+                    bounds[branch_idx] = tuple(rem.bounds)
+            except rasterio.errors.RasterioIOError:
+                pass
+
+            hydro_table = os.path.join(branch_dir, 'hydroTable_{}.csv'.format(branch_id))
+            hydro_table_signatures[branch_idx] = cls.__file_signature(hydro_table)
+
+            if hydro_table_signatures[branch_idx, 0] < 0:
+                continue
+
+            branch_feature_ids = read_hydroTable(hydro_table).index.get_level_values('feature_id').unique()
+            feature_ids.append(np.asarray(branch_feature_ids, dtype=str))
+            feature_branches.append(np.full(len(branch_feature_ids), branch_idx, dtype=np.int32))
+
+        feature_ids = np.concatenate(feature_ids) if feature_ids else np.array([], dtype=str)
+        feature_branches = np.concatenate(feature_branches) if feature_branches else np.array([], dtype=np.int32)
+
+        try:
+            cls.__write_index_file( os.path.join(hydrofabric_dir, BRANCH_INDEX_FILE_NAME),
+                                    version = np.array(BRANCH_INDEX_VERSION),
+                                    gms_inputs_signature = np.array(cls.__file_signature(gms_inputs)),
+                                    hucs = np.asarray(hucs_branches.loc[:,0], dtype=str),
+                                    branch_ids = np.asarray(hucs_branches.loc[:,1], dtype=str),
+                                    bounds = bounds,
+                                    hydro_table_signatures = hydro_table_signatures,
+                                    feature_ids = feature_ids,
+                                    feature_branches = feature_branches )
+        except OSError:
+            pass
+
+        return(cls.__from_arrays(hucs_branches.loc[:,0], hucs_branches.loc[:,1], bounds, feature_ids, feature_branches))
+
+    def branch_forecasts(self, forecast, skip_dry=False):
+
+        """
+        Forecast discharges of each branch
+
+        forecast is a forecast file or a DataFrame of discharges indexed by feature_id. Returns
+        a dictionary of DataFrames of the discharges of the feature_ids of a branch, keyed by
+        (huc8, branchID). Branches without any discharge are left out, and with skip_dry also
+        those whose discharges are all zero.
+        """
+
+        forecast = read_forecast(forecast)
+
+        branch_discharges = self.features.join(forecast.loc[:,['discharge']], on='feature_id', how='inner')
+
+        # branches with some flow
+        if skip_dry:
+            wet_branches = branch_discharges.loc[branch_discharges['discharge'] > 0, 'branch'].unique()
+            branch_discharges = branch_discharges.loc[branch_discharges['branch'].isin(wet_branches),:]
+
+        branch_forecasts = {}
+        for branch_idx, group in branch_discharges.groupby('branch'):
+            ids = tuple(self.branches.loc[branch_idx, ['huc8','branchID']])
+            branch_forecasts[ids] = group.set_index('feature_id').loc[:,['discharge']]
+
+        return(branch_forecasts)
+
+    def branches_in_bounds(self, bounds):
+
+        """ Boolean Series of the branches whose REM intersects bounds (minx, miny, maxx, maxy) """
+
+        minx, miny, maxx, maxy = bounds
+
+        return( (self.branches['minx'] <= maxx) & (self.branches['maxx'] >= minx) &
+                (self.branches['miny'] <= maxy) & (self.branches['maxy'] >= miny) )
+
+    @classmethod
+    def __from_arrays(cls, hucs, branch_ids, bounds, feature_ids, feature_branches):
+
+        branches = pd.DataFrame({ 'huc8' : np.asarray(hucs, dtype=object),
+                                  'branchID' : np.asarray(branch_ids, dtype=object),
+                                  'minx' : bounds[:,0], 'miny' : bounds[:,1],
+                                  'maxx' : bounds[:,2], 'maxy' : bounds[:,3] })
+
+        # feature_ids are strings as in hydroTables and forecasts
+        features = pd.DataFrame({ 'feature_id' : np.asarray(feature_ids, dtype=object),
+                                  'branch' : feature_branches })
+
+        return(cls(branches, features))
+
+    @classmethod
+    def __read_index_file(cls, index_file, hydrofabric_dir):
+
+        """ Returns the stored branch index, or None if it is out of date """
+
+        with np.load(index_file) as index:
+
+            if int(index['version']) != BRANCH_INDEX_VERSION:
+                return(None)
+
+            if tuple(index['gms_inputs_signature']) != cls.__file_signature(os.path.join(hydrofabric_dir, 'gms_inputs.csv')):
+                return(None)
+
+            hucs = index['hucs'] ; branch_ids = index['branch_ids']
+
+            # only stats of the hydroTables, no reads
+            for hucCode, branch_id, signature in zip(hucs, branch_ids, index['hydro_table_signatures']):
+                hydro_table = os.path.join(hydrofabric_dir, hucCode, 'branches', branch_id,
+                                           'hydroTable_{}.csv'.format(branch_id))
+                if tuple(signature) != cls.__file_signature(hydro_table):
+                    return(None)
+
+            return(cls.__from_arrays(hucs, branch_ids, index['bounds'], index['feature_ids'], index['feature_branches']))
+
+    @staticmethod
+    def __file_signature(file_name):
+
+        """ Size and modification time of a file, (-1, -1) if missing """
+
+        try:
+            stat = os.stat(file_name)
+        except OSError:
+            return((-1, -1))
+
+        return((stat.st_size, stat.st_mtime_ns))
+
+
+    @staticmethod
+    def __write_index_file(index_file, **arrays):
+
+        # written to a temporary file first so readers never see a partial index
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(index_file), suffix='.npz', delete=False) as temp_file:
+            np.savez(temp_file, **arrays)
+        os.replace(temp_file.name, index_file)
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Builds the index of branch feature_ids and extents beside gms_inputs.csv')
+    parser.add_argument('-y','--hydrofabric_dir', help='Directory path to FIM hydrofabric by processing unit', required=True)
+    parser.add_argument('-v','--verbose',help='Verbose printing',required=False,default=False,action='store_true')
+
+    args = vars(parser.parse_args())
+
+    branch_index = BranchIndex.build(args['hydrofabric_dir'], verbose=args['verbose'])
+
+    print("Indexed {} branches and {} branch feature_ids".format(len(branch_index.branches), len(branch_index.features)))
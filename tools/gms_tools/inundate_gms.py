@@ -1,24 +1,71 @@
 #!/usr/bin/env python3
 
 import os
+import time
 import argparse
 # import logging
 
+import numpy as np
 import pandas as pd
+import rasterio
 
 from tqdm import tqdm
-from inundation import inundate
-from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor,as_completed
-from inundation import hydroTableHasOnlyLakes, NoForecastFound
+from inundation import inundate, inundate_arrays, encode_compact_depths, encode_compact_inundation
+from inundation import COMPACT_DEPTHS_PROFILE, COMPACT_DEPTHS_SCALE, COMPACT_INUNDATION_PROFILE, RASTER_COMPRESSION_PROFILES
+from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor,as_completed,wait,FIRST_COMPLETED
+from inundation import hydroTableHasOnlyLakes, NoForecastFound, InundationProfiler
+from gms_tools.overlapping_inundation import OverlapWindowMerge, MosaicMask, cog_writer
+from rasterio.windows import Window
+from gms_tools.branch_index import BranchIndex
+from utils.shared_variables import elev_raster_ndv
 from utils.shared_functions import FIM_Helpers as fh
 
+# estimated seconds per REM pixel, per byte of hydroTable and per branch to schedule branches by cost.
+# Calibrate from a branch runtimes CSV with calibrate_branch_costs
+BRANCH_COST_COEFFICIENTS = (2e-7, 4e-8, 0.05)
+
+# branches inundated by a process pool worker
+__worker_branches = 0
+
 def Inundate_gms( hydrofabric_dir, forecast, num_workers = 1,
                   hucs = None,
                   inundation_raster = None,
                   inundation_polygon = None, depths_raster = None,
                   verbose = False,
                   log_file = None,
-                  output_fileNames = None ):
+                  output_fileNames = None,
+                  raster_encoding = 'native',
+                  raster_compression = 'lzw',
+                  instrumentation_csv = None,
+                  scheduling = 'input',
+                  min_task_seconds = 1.0,
+                  cost_coefficients = BRANCH_COST_COEFFICIENTS,
+                  branch_runtimes_csv = None,
+                  prune_branches = False,
+                  skip_dry_branches = False ):
+
+    """
+    Inundates the branches of GMS HUCs in a process pool
+
+    scheduling='input' submits one branch per task in the order of gms_inputs.csv. With
+    scheduling='cost' the cost of each branch is estimated from the pixel count of its
+    REM and the size of its hydroTable, and the largest branches are submitted first so they
+    do not end up last on a single worker. Branches of a HUC estimated below min_task_seconds
+    are grouped into one task until the group reaches min_task_seconds, cutting the process
+    overhead of tiny branches. Cost scheduling opens every REM in the calling process before
+    submitting, and the rows of the output file names follow the new submission order.
+
+    branch_runtimes_csv writes the estimated and measured seconds of each branch. Pass it to
+    calibrate_branch_costs for the cost_coefficients of a hydrofabric.
+
+    With prune_branches, branches whose feature_ids have no forecast discharge, which are
+    otherwise mapped all dry, are skipped using the branch index beside gms_inputs.csv (see
+    BranchIndex) before any of their files are opened, and each branch is sent only its own
+    discharges. skip_dry_branches also skips branches whose discharges are all zero. Skipped
+    branches write no rasters, so their dry (negative HydroID) cells are left nodata in
+    mosaics, which evaluations count as nodata rather than true negatives, and a HUC with
+    every branch skipped gets no mosaic at all. Both are meant for sparse event forecasts.
+    """
 
     # input handling
     if hucs is not None:
@@ -43,28 +90,24 @@ def Inundate_gms( hydrofabric_dir, forecast, num_workers = 1,
         #logging.basicConfig(filename=log_file, level=logging.INFO)
         #logging.info('HUC8,BranchID,Exception')
 
-    # load gms inputs
-    hucs_branches = pd.read_csv( os.path.join(hydrofabric_dir,'gms_inputs.csv'),
-                                 header=None,
-                                 dtype= {0:str,1:str} )
-    
-    if hucs is not None:
-        hucs = set(hucs)
-        huc_indices = hucs_branches.loc[:,0].isin(hucs)
-        hucs_branches = hucs_branches.loc[huc_indices,:]
+    # branches grouped and ordered into tasks
+    tasks = gms_branch_tasks( hydrofabric_dir, forecast,
+                              hucs = hucs,
+                              inundation_raster = inundation_raster,
+                              inundation_polygon = inundation_polygon,
+                              depths_raster = depths_raster,
+                              raster_encoding = raster_encoding,
+                              raster_compression = raster_compression,
+                              instrument = (instrumentation_csv is not None),
+                              scheduling = scheduling,
+                              min_task_seconds = min_task_seconds,
+                              cost_coefficients = cost_coefficients,
+                              prune_branches = prune_branches,
+                              skip_dry_branches = skip_dry_branches,
+                              verbose = verbose )
 
     # get number of branches
-    number_of_branches = len(hucs_branches)
-    
-    # make inundate generator
-    inundate_input_generator = __inundate_gms_generator( hucs_branches,
-                                                         number_of_branches,
-                                                         hydrofabric_dir,
-                                                         inundation_raster,
-                                                         inundation_polygon,
-                                                         depths_raster,
-                                                         forecast,
-                                                         verbose=False )
+    number_of_branches = sum(len(task) for task in tasks)
 
     # start up process pool
     # better results with Process pool
@@ -76,63 +119,63 @@ def Inundate_gms( hydrofabric_dir, forecast, num_workers = 1,
     depths_raster_fileNames = [None] * number_of_branches
     hucCodes = [None] * number_of_branches
     branch_ids = [None] * number_of_branches
-       
-    executor_generator = { 
-                executor.submit(inundate,**inp) : ids for inp,ids in inundate_input_generator 
-                }          
+    stage_records = []
+    branch_runtimes = []
+
+    executor_generator = {
+                executor.submit(inundate_branch_task, [inp for inp,_,_ in task]) : (task_idx, task)
+                for task_idx, task in enumerate(tasks)
+                }
+    progress = tqdm(total=number_of_branches,
+                    desc="Inundating branches with {} workers".format(num_workers),
+                    disable=(not verbose) )
     idx = 0
-    for future in tqdm(as_completed(executor_generator),
-                       total=len(executor_generator),
-                       desc="Inundating branches with {} workers".format(num_workers),
-                       disable=(not verbose) ):
-        
-        hucCode, branch_id = executor_generator[future]
+    for future in as_completed(executor_generator):
+
+        task_idx, task = executor_generator[future]
 
         try:
-            future.result()
-        
-        except NoForecastFound as exc:
-            if log_file is not None:
-                print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}',
-                      file=open(log_file,'a'))
-            elif verbose:
-                print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}')
-
-        except hydroTableHasOnlyLakes as exc:
-            if log_file is not None:
-                print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}',
-                      file=open(log_file,'a'))
-            elif verbose:
-                print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}')
-        
+            task_results = future.result()
         except Exception as exc:
-            if log_file is not None:
-                print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}',
-                      file=open(log_file,'a'))
-            else:
-                print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}')
-        else:
-            
+            # the worker died, the whole task failed
+            task_results = [ (None, exc, np.nan, False) ] * len(task)
+
+        for (inp, (hucCode, branch_id), cost), (result, exc, seconds, cold_start) in zip(task, task_results):
+
+            branch_runtimes += [ ( hucCode, branch_id, task_idx, len(task) ) + cost + ( seconds, cold_start, exc is None ) ]
+            progress.update(1)
+
+            if exc is not None:
+                __log_branch_exception(exc, hucCode, branch_id, log_file, verbose)
+                continue
+
             hucCodes[idx] = hucCode
             branch_ids[idx] = branch_id
 
             try:
-                #print(hucCode,branch_id,future.result()[0][0])                
-                inundation_raster_fileNames[idx] = future.result()[0][0]
+                inundation_raster_fileNames[idx] = result[0][0]
             except TypeError:
                 pass
 
             try:
-                depths_raster_fileNames[idx] = future.result()[1][0]
+                depths_raster_fileNames[idx] = result[1][0]
             except TypeError:
                 pass
 
             try:
-                inundation_polygon_fileNames[idx] = future.result()[2][0]
+                inundation_polygon_fileNames[idx] = result[2][0]
             except TypeError:
                 pass
 
-            idx += 1 
+            # stage timings of branch
+            if instrumentation_csv is not None:
+                stage_records += [ result[3].assign(huc8=hucCode,branchID=branch_id) ]
+
+            idx += 1
+
+        del executor_generator[future]
+
+    progress.close()
     
     # power down pool
     executor.shutdown(wait=True)
@@ -147,16 +190,626 @@ def Inundate_gms( hydrofabric_dir, forecast, num_workers = 1,
     if output_fileNames is not None:
         output_fileNames_df.to_csv(output_fileNames,index=False)
 
+    # stage timings of all branches
+    if (instrumentation_csv is not None) and (len(stage_records) > 0):
+        stage_records = pd.concat(stage_records,ignore_index=True)
+        stage_records = stage_records.loc[:,['huc8','branchID'] + InundationProfiler.columns[1:]]
+        stage_records.to_csv(instrumentation_csv,index=False)
+
+    # estimated and measured runtimes of all branches
+    branch_runtimes = pd.DataFrame( branch_runtimes,
+                                    columns=['huc8','branchID','task','task_branches','rem_pixels',
+                                             'hydro_table_bytes','estimated_seconds','seconds','cold_start','success'] )
+
+    if verbose and (len(branch_runtimes) > 0):
+        print( "Branch runtimes: {:.1f} s estimated, {:.1f} s measured in {} tasks".format(
+               branch_runtimes['estimated_seconds'].sum(), branch_runtimes['seconds'].sum(), len(tasks) ) )
+
+    if branch_runtimes_csv is not None:
+        branch_runtimes.to_csv(branch_runtimes_csv,index=False)
+
     return(output_fileNames_df)
 
 
+def gms_branch_tasks( hydrofabric_dir, forecast,
+                      hucs = None,
+                      inundation_raster = None,
+                      inundation_polygon = None,
+                      depths_raster = None,
+                      raster_encoding = 'native',
+                      raster_compression = 'lzw',
+                      instrument = False,
+                      scheduling = 'input',
+                      min_task_seconds = 1.0,
+                      cost_coefficients = BRANCH_COST_COEFFICIENTS,
+                      prune_branches = False,
+                      skip_dry_branches = False,
+                      verbose = False ):
+
+    """
+    Branches of GMS HUCs grouped and ordered into tasks as Inundate_gms submits them
+
+    Returns a list of tasks, each a list of (inundate_input, (huc8, branchID), cost) of the
+    branches to pass to inundate_branch_task, so other schedulers can run the branches of
+    many forecasts in one pool.
+    """
+
+    # load gms inputs
+    hucs_branches = pd.read_csv( os.path.join(hydrofabric_dir,'gms_inputs.csv'),
+                                 header=None,
+                                 dtype= {0:str,1:str} )
+
+    if isinstance(hucs,str):
+        hucs = [hucs]
+
+    if hucs is not None:
+        hucs = set(hucs)
+        huc_indices = hucs_branches.loc[:,0].isin(hucs)
+        hucs_branches = hucs_branches.loc[huc_indices,:]
+
+    # skip dry branches
+    branch_forecasts = None
+    if prune_branches:
+        hucs_branches, branch_forecasts = __prune_branches(hydrofabric_dir, hucs_branches, forecast,
+                                                           skip_dry_branches, verbose)
+
+    number_of_branches = len(hucs_branches)
+
+    # make inundate generator
+    inundate_input_generator = __inundate_gms_generator( hucs_branches,
+                                                         number_of_branches,
+                                                         hydrofabric_dir,
+                                                         inundation_raster,
+                                                         inundation_polygon,
+                                                         depths_raster,
+                                                         forecast,
+                                                         raster_encoding,
+                                                         raster_compression,
+                                                         instrument=instrument,
+                                                         branch_forecasts=branch_forecasts,
+                                                         verbose=False )
+
+    # group and order branches into tasks
+    tasks = __schedule_branch_tasks( inundate_input_generator, scheduling, min_task_seconds, cost_coefficients )
+
+    return(tasks)
+
+
+def calibrate_branch_costs(branch_runtimes):
+
+    """
+    Fits the cost_coefficients of Inundate_gms to measured branch runtimes
+
+    branch_runtimes is the DataFrame or CSV file written to branch_runtimes_csv. Returns the
+    seconds per REM pixel, per byte of hydroTable and per branch, by least squares on the
+    successful branches that were not the first of their worker. Negative coefficients are
+    set to zero.
+    """
+
+    if isinstance(branch_runtimes,str):
+        branch_runtimes = pd.read_csv(branch_runtimes,dtype={'huc8':str,'branchID':str})
+
+    branch_runtimes = branch_runtimes.loc[ branch_runtimes['success'] & ~branch_runtimes['cold_start'] &
+                                           branch_runtimes['seconds'].notna(), : ]
+
+    if len(branch_runtimes) < 3:
+        raise ValueError("At least three successful branches are needed to calibrate branch costs")
+
+    predictors = np.column_stack( ( branch_runtimes['rem_pixels'].to_numpy(dtype=np.float64),
+                                    branch_runtimes['hydro_table_bytes'].to_numpy(dtype=np.float64),
+                                    np.ones(len(branch_runtimes)) ) )
+
+    coefficients = np.linalg.lstsq(predictors, branch_runtimes['seconds'].to_numpy(dtype=np.float64), rcond=None)[0]
+
+    return(tuple(float(c) for c in np.clip(coefficients,0,None)))
+
+
+def __estimate_branch_cost(inundate_input, cost_coefficients):
+
+    """ Returns the REM pixels, hydroTable bytes and estimated seconds of a branch """
+
+    # missing inputs fail fast in the worker
+    try:
+        with rasterio.open(inundate_input['rem']) as rem:
+            rem_pixels = rem.width * rem.height
+    except rasterio.errors.RasterioIOError:
+        rem_pixels = 0
+
+    try:
+        hydro_table_bytes = os.path.getsize(inundate_input['hydro_table'])
+    except OSError:
+        hydro_table_bytes = 0
+
+    per_pixel, per_byte, per_branch = cost_coefficients
+    estimated_seconds = per_pixel * rem_pixels + per_byte * hydro_table_bytes + per_branch
+
+    return(rem_pixels, hydro_table_bytes, estimated_seconds)
+
+
+def __schedule_branch_tasks(inundate_input_generator, scheduling, min_task_seconds, cost_coefficients):
+
+    """ Groups branches into tasks of (inundate_input, identifiers, cost) lists, largest tasks first """
+
+    if scheduling not in ('cost','input'):
+        raise ValueError("scheduling must be 'cost' or 'input'")
+
+    if scheduling == 'input':
+        return( [ [ ( inp, ids, (np.nan, np.nan, np.nan) ) ] for inp, ids in inundate_input_generator ] )
+
+    tasks = []
+    small_tasks = {}
+
+    for inp, ids in inundate_input_generator:
+
+        cost = __estimate_branch_cost(inp, cost_coefficients)
+
+        if cost[2] >= min_task_seconds:
+            tasks.append( [ ( inp, ids, cost ) ] )
+            continue
+
+        # tiny branches of a HUC share a task
+        huc = ids[0]
+        small_task = small_tasks.setdefault(huc, [])
+        small_task.append( ( inp, ids, cost ) )
+
+        if sum(c[2] for _,_,c in small_task) >= min_task_seconds:
+            tasks.append(small_tasks.pop(huc))
+
+    tasks += list(small_tasks.values())
+
+    # longest processing time first
+    tasks.sort(key=lambda task: sum(c[2] for _,_,c in task), reverse=True)
+
+    return(tasks)
+
+
+def inundate_branch_task(inundate_inputs):
+
+    """ Process pool worker. Inundates the branches of a task and returns their results, exceptions and seconds """
+
+    global __worker_branches
+
+    task_results = []
+    for inundate_input in inundate_inputs:
+
+        start = time.perf_counter()
+
+        try:
+            result, exc = inundate(**inundate_input), None
+        except Exception as e:
+            result, exc = None, e
+
+        # the first branch of a worker also pays for imports and compilation
+        task_results.append( ( result, exc, time.perf_counter() - start, __worker_branches == 0 ) )
+        __worker_branches += 1
+
+    return(task_results)
+
+
+def Inundate_gms_fused( hydrofabric_dir, forecast, num_workers = 1,
+                        hucs = None,
+                        inundation_raster = None,
+                        depths_raster = None,
+                        branch_inundation_raster = None,
+                        branch_depths_raster = None,
+                        mask = None,
+                        nodata = elev_raster_ndv,
+                        verbose = False,
+                        log_file = None,
+                        output_fileNames = None,
+                        raster_encoding = 'native',
+                        raster_compression = 'lzw',
+                        prune_branches = False,
+                        skip_dry_branches = False,
+                        mask_cache = None,
+                        cog = False ):
+
+    """
+    Inundates GMS branches and reduces them in memory into HUC mosaics
+
+    Does the work of Inundate_gms followed by Mosaic_inundation without writing and
+    reading back a GeoTIFF per branch. Each branch is mapped by a worker and its arrays
+    are reduced into the HUC grid of the mosaic as they come in, keeping the maximum
+    depth and the maximum inundation value, so positive (inundated) HydroIDs win over
+    negative (dry) ones. A HUC is written once all its branches are done.
+
+    inundation_raster and depths_raster are the HUC mosaic outputs, with the HUC appended
+    when it is not in the name already. Branch rasters are only written when
+    branch_inundation_raster or branch_depths_raster are passed. As in Mosaic_inundation,
+    the HUC grid spans the REMs of the branches that were inundated. prune_branches and
+    skip_dry_branches skip branches as in Inundate_gms. With mask, the HUC mosaics are
+    cropped and masked to its polygons as in Mosaic_inundation, with rasterized masks
+    also cached on disk in mask_cache if passed. With cog, HUC mosaics are written as cloud
+    optimized GeoTIFFs with internal overviews.
+
+    Returns a DataFrame with the mosaic file names of each HUC, the number of branches
+    reduced, their uncompressed raster bytes, and the uncompressed bytes of raster I/O saved
+    against writing every branch raster and reading it back in the mosaic. Branch rasters
+    are compressed, so the I/O saved on disk is smaller.
+    """
+
+    if (inundation_raster is None) and (depths_raster is None):
+        raise ValueError("Pass inundation_raster and/or depths_raster for the HUC mosaics")
+
+    if hucs is not None:
+        try:
+            _ = (i for i in hucs)
+        except TypeError:
+            raise ValueError("hucs argument must be an iterable")
+
+    if isinstance(hucs,str):
+        hucs = [hucs]
+
+    num_workers = int(num_workers)
+
+    # log file
+    if log_file is not None:
+        if os.path.exists(log_file):
+            os.remove(log_file)
+
+        if verbose :
+            print('HUC8,BranchID,Exception',file=open(log_file,'w'))
+
+    # load gms inputs
+    hucs_branches = pd.read_csv( os.path.join(hydrofabric_dir,'gms_inputs.csv'),
+                                 header=None,
+                                 dtype= {0:str,1:str} )
+
+    if hucs is not None:
+        hucs_branches = hucs_branches.loc[hucs_branches.loc[:,0].isin(set(hucs)),:]
+
+    # the HUC grids span all branches
+    all_hucs_branches = hucs_branches
+
+    # skip dry branches
+    branch_forecasts = None
+    if prune_branches:
+        hucs_branches, branch_forecasts = __prune_branches(hydrofabric_dir, hucs_branches, forecast,
+                                                           skip_dry_branches, verbose)
+
+    number_of_branches = len(hucs_branches)
+
+    inundate_input_generator = __inundate_gms_generator( hucs_branches,
+                                                         number_of_branches,
+                                                         hydrofabric_dir,
+                                                         branch_inundation_raster,
+                                                         None,
+                                                         branch_depths_raster,
+                                                         forecast,
+                                                         raster_encoding,
+                                                         raster_compression,
+                                                         branch_forecasts=branch_forecasts,
+                                                         verbose=False )
+
+    # branches left by HUC and HUC mosaics being reduced
+    branches_left = hucs_branches.loc[:,0].value_counts().to_dict()
+    mosaics = {}
+    mosaic_records = []
+
+    executor = ProcessPoolExecutor(max_workers = num_workers)
+    pending = {}
+
+    progress = tqdm(total=number_of_branches,
+                    desc="Inundating and mosaicking branches with {} workers".format(num_workers),
+                    disable=(not verbose) )
+
+    def __reduce_done(done):
+
+        for future in done:
+
+            hucCode, branch_id = pending.pop(future)
+
+            # HUC grid from the REMs of all its branches, cropped to the branches reduced when written
+            if hucCode not in mosaics:
+                mosaics[hucCode] = HucMosaic( hydrofabric_dir, hucCode,
+                                                all_hucs_branches.loc[all_hucs_branches.loc[:,0] == hucCode,1],
+                                                inundation_raster is not None, depths_raster is not None,
+                                                nodata )
+
+            try:
+                branch_result = future.result()
+            except Exception as exc:
+                __log_branch_exception(exc, hucCode, branch_id, log_file, verbose)
+            else:
+                mosaics[hucCode].reduce(*branch_result, branch_id=branch_id)
+
+            del future
+            progress.update(1)
+
+            # write finished HUCs
+            branches_left[hucCode] -= 1
+            if branches_left[hucCode] == 0:
+                mosaic = mosaics.pop(hucCode)
+                mosaic_records.append( mosaic.write( __huc_output_name(inundation_raster,hucCode),
+                                                     __huc_output_name(depths_raster,hucCode),
+                                                     mask, raster_encoding, raster_compression,
+                                                     mask_cache, cog ) )
+
+    # bound the branch arrays held in memory
+    for inp, ids in inundate_input_generator:
+
+        pending[executor.submit( __inundate_branch_arrays, inp,
+                                 inundation_raster is not None, depths_raster is not None )] = ids
+
+        if len(pending) >= 2 * num_workers:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            __reduce_done(done)
+
+    while pending:
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        __reduce_done(done)
+
+    progress.close()
+    executor.shutdown(wait=True)
+
+    mosaic_fileNames_df = pd.DataFrame( mosaic_records,
+                                        columns=['huc8','inundation_rasters','depths_rasters',
+                                                 'branches','branch_raster_bytes','uncompressed_io_bytes_saved'] )
+
+    if verbose:
+        print( "Reduced {} branches in memory. Uncompressed raster I/O saved: {:.1f} MB".format(
+               mosaic_fileNames_df['branches'].sum(),
+               mosaic_fileNames_df['uncompressed_io_bytes_saved'].sum() / 2**20 ) )
+
+    if output_fileNames is not None:
+        mosaic_fileNames_df.to_csv(output_fileNames,index=False)
+
+    return(mosaic_fileNames_df)
+
+
+def __inundate_branch_arrays(inundate_input, keep_inundation, keep_depths):
+
+    """ Process pool worker. Maps a branch and returns the arrays needed by the HUC mosaics """
+
+    inundation_array, depths_array, transform, inundation_nodata, depths_nodata, output_names = \
+        inundate_arrays( inundate_input['rem'], inundate_input['catchments'],
+                         inundate_input['hydro_table'], inundate_input['forecast'],
+                         inundation_raster = inundate_input['inundation_raster'],
+                         depths = inundate_input['depths'],
+                         raster_encoding = inundate_input['raster_encoding'],
+                         raster_compression = inundate_input['raster_compression'] )
+
+    # only send back the arrays that are mosaicked
+    if not keep_inundation: inundation_array = None
+    if not keep_depths: depths_array = None
+
+    # uncompressed raster bytes written by the worker
+    bytes_written = sum( a.nbytes for a,name in zip((inundation_array,depths_array),output_names)
+                         if (a is not None) and (name is not None) )
+
+    return(inundation_array, depths_array, transform, inundation_nodata, depths_nodata, bytes_written)
+
+
+class HucMosaic:
+
+    """
+    Inundation and depth grids of a HUC mosaic that branch arrays are reduced into
+
+    Branches are reduced into the grid of the REMs of all branch_ids. When written, the grids
+    are cropped to the grid Mosaic_inundation makes of the branches reduced.
+    """
+
+    def __init__(self, hydrofabric_dir, hucCode, branch_ids, keep_inundation, keep_depths, nodata):
+
+        self.rems = { branch_id : os.path.join(hydrofabric_dir, hucCode, 'branches', branch_id,
+                                               'rem_zeroed_masked_{}.tif'.format(branch_id))
+                      for branch_id in branch_ids }
+
+        # same grid as Mosaic_inundation
+        self.overlap = OverlapWindowMerge(list(self.rems.values()), (30, 30))
+        self.crs = self.overlap.depth_rsts[0].crs
+
+        self.hucCode = hucCode
+        self.transform = self.overlap.proc_unit_transform
+        self.shape = (self.overlap.proc_unit_height, self.overlap.proc_unit_width)
+        self.keep = { 'inundation' : keep_inundation, 'depths' : keep_depths }
+        self.nodata = nodata
+        self.clear()
+
+    def clear(self):
+
+        """ Empties the grids and counts to reduce the branches of another forecast """
+
+        self.grids = {} ; self.nodatas = {}
+        self.branches = 0 ; self.branch_raster_bytes = 0 ; self.bytes_written = 0
+        self.reduced_branch_ids = set()
+
+    def reduce(self, inundation_array, depths_array, transform, inundation_nodata, depths_nodata, bytes_written,
+               branch_id=None):
+
+        """ Reduces the arrays of a branch into the grids. Branches without branch_id are taken to span the HUC grid. """
+
+        self.branches += 1
+        self.bytes_written += bytes_written
+        self.reduced_branch_ids.add(branch_id)
+
+        # location of branch in HUC grid
+        row_off = int(round((transform.f - self.transform.f) / self.transform.e))
+        col_off = int(round((transform.c - self.transform.c) / self.transform.a))
+
+        for name, array, array_nodata in (('inundation', inundation_array, inundation_nodata),
+                                          ('depths', depths_array, depths_nodata)):
+            if array is None:
+                continue
+
+            self.branch_raster_bytes += array.nbytes
+
+            if name not in self.grids:
+                self.nodatas[name] = self.output_nodata(array.dtype, array_nodata)
+                self.grids[name] = np.full(self.shape, self.nodatas[name], dtype=array.dtype)
+
+            grid = self.grids[name] ; grid_nodata = self.nodatas[name]
+
+            rows = slice(max(row_off, 0), min(row_off + array.shape[0], self.shape[0]))
+            cols = slice(max(col_off, 0), min(col_off + array.shape[1], self.shape[1]))
+            array = array[rows.start - row_off:rows.stop - row_off, cols.start - col_off:cols.stop - col_off]
+
+            # maximum of valid values
+            grid_window = grid[rows, cols]
+            has_data = array != array_nodata
+            replace = has_data & ((grid_window == grid_nodata) | (array > grid_window))
+            grid_window[replace] = array[replace]
+
+    def output_nodata(self, dtype, array_nodata):
+
+        # integer outputs can not hold every nodata value, use the nodata of the branches then
+        if np.issubdtype(dtype, np.integer):
+            dtype_info = np.iinfo(dtype)
+            if not (dtype_info.min <= float(self.nodata) <= dtype_info.max):
+                return(array_nodata)
+
+        return(np.array(self.nodata).astype(dtype).item())
+
+    def write(self, inundation_raster, depths_raster, mask=None, raster_encoding='native', raster_compression='lzw',
+              mask_cache=None, cog=False):
+
+        """
+        Writes the HUC mosaics, cropped and masked to the mask polygons if passed, as cloud
+        optimized GeoTIFFs if cog, and returns their record
+        """
+
+        output_names = { 'inundation' : None, 'depths' : None }
+
+        # grid of the branches reduced
+        grid_transform, grid_shape, grid_offsets = self.reduced_grid()
+
+        transform, shape = grid_transform, grid_shape
+        mosaic_mask = None
+        if mask and self.grids:
+            mosaic_mask = MosaicMask.rasterize(mask, grid_transform, grid_shape[1], grid_shape[0], mask_cache=mask_cache)
+            transform, shape = mosaic_mask.transform, (mosaic_mask.window.height, mosaic_mask.window.width)
+
+        for name, output in (('inundation', inundation_raster), ('depths', depths_raster)):
+            if (output is None) or (name not in self.grids):
+                continue
+
+            grid_nodata = self.nodatas[name]
+            grid = self.crop(self.grids.pop(name), grid_nodata, grid_shape, grid_offsets)
+
+            if mosaic_mask is not None:
+                _, grid = mosaic_mask.apply(grid, Window(0, 0, grid_shape[1], grid_shape[0]), grid_nodata)
+
+            profile = { 'driver' : 'GTiff', 'height' : shape[0], 'width' : shape[1], 'count' : 1,
+                        'crs' : self.crs, 'transform' : transform,
+                        'dtype' : grid.dtype.name, 'nodata' : grid_nodata,
+                        'tiled' : True, 'blockxsize' : 256, 'blockysize' : 256 }
+            profile.update(**RASTER_COMPRESSION_PROFILES[raster_compression])
+
+            if raster_encoding == 'compact':
+                if name == 'depths':
+                    grid = encode_compact_depths(grid, grid_nodata)
+                    profile.update(**COMPACT_DEPTHS_PROFILE)
+                else:
+                    grid = encode_compact_inundation(grid, grid_nodata)
+                    profile.update(**COMPACT_INUNDATION_PROFILE)
+
+            if raster_compression != 'lzw':
+                profile.update(predictor=3 if np.dtype(profile['dtype']).kind == 'f' else 2)
+
+            if cog:
+                writer = cog_writer(output, **profile)
+            else:
+                writer = rasterio.open(output, 'w', **profile)
+
+            with writer as rst:
+                if (raster_encoding == 'compact') and (name == 'depths'):
+                    rst.scales = (COMPACT_DEPTHS_SCALE,)
+                    rst.offsets = (0.0,)
+                rst.write(grid, 1)
+
+            output_names[name] = output
+
+        # the unfused run writes every branch raster and reads it back in the mosaic
+        uncompressed_io_bytes_saved = 2 * self.branch_raster_bytes - self.bytes_written
+
+        return( { 'huc8' : self.hucCode,
+                  'inundation_rasters' : output_names['inundation'],
+                  'depths_rasters' : output_names['depths'],
+                  'branches' : self.branches,
+                  'branch_raster_bytes' : self.branch_raster_bytes,
+                  'uncompressed_io_bytes_saved' : uncompressed_io_bytes_saved } )
+
+    def reduced_grid(self):
+
+        """ Transform, shape and offset in the HUC grid of the grid Mosaic_inundation makes of the branches reduced """
+
+        if (None in self.reduced_branch_ids) or (self.reduced_branch_ids >= set(self.rems)) or \
+           (len(self.reduced_branch_ids) == 0):
+            return(self.transform, self.shape, (0, 0))
+
+        overlap = OverlapWindowMerge([ self.rems[b] for b in self.rems if b in self.reduced_branch_ids ], (30, 30))
+        transform = overlap.proc_unit_transform
+        shape = (overlap.proc_unit_height, overlap.proc_unit_width)
+
+        row_off = int(round((transform.f - self.transform.f) / self.transform.e))
+        col_off = int(round((transform.c - self.transform.c) / self.transform.a))
+
+        return(transform, shape, (row_off, col_off))
+
+    @staticmethod
+    def crop(grid, nodata, shape, offsets):
+
+        """ Window of shape at offsets (rows, columns) of grid, nodata outside of grid """
+
+        row_off, col_off = offsets
+        if (offsets == (0, 0)) and (grid.shape == tuple(shape)):
+            return(grid)
+
+        cropped = np.full(shape, nodata, dtype=grid.dtype)
+
+        rows = slice(max(row_off, 0), min(row_off + shape[0], grid.shape[0]))
+        cols = slice(max(col_off, 0), min(col_off + shape[1], grid.shape[1]))
+        if (rows.stop > rows.start) and (cols.stop > cols.start):
+            cropped[rows.start - row_off:rows.stop - row_off, cols.start - col_off:cols.stop - col_off] = grid[rows, cols]
+
+        return(cropped)
+
+
+def __huc_output_name(output, hucCode):
+
+    # Some callers already added the HUC to the file name
+    if (output is None) or (hucCode in output):
+        return(output)
+
+    return(fh.append_id_to_file_name(output, hucCode))
+
+
+def __log_branch_exception(exc, hucCode, branch_id, log_file, verbose):
+
+    if log_file is not None:
+        print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}',
+              file=open(log_file,'a'))
+    elif verbose or not isinstance(exc,(NoForecastFound,hydroTableHasOnlyLakes)):
+        print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}')
+
+
+def __prune_branches(hydrofabric_dir, hucs_branches, forecast, skip_dry=False, verbose=False):
+
+    """ Drops branches without (positive with skip_dry) forecast discharges. Returns the kept branches and their forecasts """
+
+    branch_forecasts = BranchIndex.read(hydrofabric_dir, verbose=verbose).branch_forecasts(forecast, skip_dry)
+
+    is_kept = [ ids in branch_forecasts for ids in zip(hucs_branches.loc[:,0], hucs_branches.loc[:,1]) ]
+
+    if verbose:
+        print("Skipping {} of {} branches without {}forecast discharges".format(
+              len(is_kept) - sum(is_kept), len(is_kept), 'positive ' if skip_dry else ''))
+
+    return(hucs_branches.loc[is_kept,:], branch_forecasts)
+
+
 def __inundate_gms_generator( hucs_branches,
                               number_of_branches,
                               hydrofabric_dir,
                               inundation_raster,
                               inundation_polygon,
                               depths_raster,
-                              forecast, verbose = False ):
+                              forecast,
+                              raster_encoding = 'native',
+                              raster_compression = 'lzw',
+                              instrument = False,
+                              branch_forecasts = None,
+                              verbose = False ):
 
     # iterate over branches
     for idx,row in hucs_branches.iterrows():
@@ -198,6 +851,9 @@ def __inundate_gms_generator( hucs_branches,
         # identifiers
         identifiers = (huc,branch_id)
 
+        # discharges of the branch only
+        branch_forecast = forecast if branch_forecasts is None else branch_forecasts[identifiers]
+
         #print(f"inundation_branch_raster is {inundation_branch_raster}")
 
         # inundate input
@@ -205,7 +861,7 @@ def __inundate_gms_generator( hucs_branches,
                             'catchments' : catchments_branch, 
                             'catchment_poly' : catchment_poly,
                             'hydro_table' : hydroTable_branch,
-                            'forecast' : forecast,
+                            'forecast' : branch_forecast,
                             'mask_type' : 'filter',
                             'hucs' : None,
                             'hucs_layerName' : None,
@@ -217,7 +873,10 @@ def __inundate_gms_generator( hucs_branches,
                             'depths' : depths_branch_raster,
                             'out_raster_profile' : None,
                             'out_vector_profile' : None,
-                            'quiet' : not verbose }
+                            'quiet' : not verbose,
+                            'raster_encoding' : raster_encoding,
+                            'raster_compression' : raster_compression,
+                            'instrument' : instrument }
         
         yield (inundate_input, identifiers)
 
@@ -235,7 +894,29 @@ if __name__ == '__main__':
     parser.add_argument('-o','--output-fileNames',help='Output CSV file with filenames for inundation rasters, inundation polygons, and depth rasters',required=False,default=None)
     parser.add_argument('-w','--num-workers', help='Number of Workers', required=False,default=1)
     parser.add_argument('-v','--verbose',help='Verbose printing',required=False,default=None,action='store_true')
+    parser.add_argument('-e','--raster-encoding',help="'native' or 'compact' (int16 centimeter depths and int8 inundation) output rasters",required=False,default='native',choices=['native','compact'])
+    parser.add_argument('-c','--raster-compression',help='GeoTIFF compression of output rasters',required=False,default='lzw',choices=['lzw','deflate','zstd'])
+    parser.add_argument('-t','--instrumentation-csv',help='Output CSV file with the wall time, bytes read and written, and peak memory of each inundation stage by branch',required=False,default=None)
+    parser.add_argument('-m','--fused',help='Reduce branches in memory into HUC mosaics written to the inundation and depths raster outputs instead of writing branch rasters',required=False,default=False,action='store_true')
+    parser.add_argument('-n','--branch-inundation-raster',help='Fused mode only. Branch inundation raster output. Only writes if designated.',required=False,default=None)
+    parser.add_argument('-b','--branch-depths-raster',help='Fused mode only. Branch depths raster output. Only writes if designated.',required=False,default=None)
+    parser.add_argument('-s','--scheduling',help="'cost' submits the branches with the largest estimated cost first and groups tiny branches of a HUC into one task. 'input' submits one branch per task in input order",required=False,default='input',choices=['cost','input'])
+    parser.add_argument('-g','--min-task-seconds',help='Estimated seconds below which branches of a HUC are grouped into one task',required=False,default=1.0,type=float)
+    parser.add_argument('-a','--prune-branches',help='Skip branches without forecast discharges instead of mapping them dry. Their cells are left nodata',required=False,default=False,action='store_true')
+    parser.add_argument('-k','--skip-dry-branches',help='With --prune-branches, also skip branches whose forecast discharges are all zero. Their dry cells are left nodata',required=False,default=False,action='store_true')
+    parser.add_argument('-r','--branch-runtimes-csv',help='Output CSV file with the estimated and measured runtime of each branch to calibrate the branch costs',required=False,default=None)
     
     
     # extract to dictionary and run
-    Inundate_gms( **vars(parser.parse_args()) )
+    args = vars(parser.parse_args())
+    fused = args.pop('fused')
+    branch_outputs = { 'branch_inundation_raster' : args.pop('branch_inundation_raster'),
+                       'branch_depths_raster' : args.pop('branch_depths_raster') }
+
+    if fused:
+        if (args.pop('inundation_polygon') is not None) or (args.pop('instrumentation_csv') is not None):
+            parser.error('Inundation polygons and instrumentation are not available in fused mode')
+        for scheduling_arg in ('scheduling','min_task_seconds','branch_runtimes_csv'): args.pop(scheduling_arg)
+        Inundate_gms_fused( **args, **branch_outputs )
+    else:
+        Inundate_gms( **args )
@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+
+import os
+import time
+import argparse
+from collections import OrderedDict
+
+import pandas as pd
+import rasterio
+
+from tqdm import tqdm
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from inundation import inundate_arrays, read_hydroTable
+from gms_tools.inundate_gms import HucMosaic
+from gms_tools.branch_index import BranchIndex
+from utils.shared_variables import elev_raster_ndv
+from utils.shared_functions import FIM_Helpers as fh
+
+# branch datasets and hydroTables kept by a service worker process
+__service_worker = None
+
+
+class InundationService:
+
+    """
+    Long lived GMS inundation service over one hydrofabric
+
+    Reads the branch index (see BranchIndex) once and starts a process pool whose workers
+    stay up between forecasts. Workers compile the mapping kernels when they
+    start and keep the REM and catchments datasets of the branches they mapped open and their
+    hydroTables parsed, up to max_cached_branches per worker. Each call to inundate() reads
+    the forecast once and sends every branch only its own discharges. Branches without any
+    are mapped all dry, or skipped with prune_branches as in Inundate_gms, where
+    skip_dry_branches also skips those without positive ones. The hydrofabric is assumed not to change while the service is up.
+
+    Use as a context manager or call close() to stop the workers. The seconds taken to start
+    the service and by each forecast are kept in startup_seconds and latencies.
+    """
+
+    def __init__(self, hydrofabric_dir, num_workers=1, hucs=None, max_cached_branches=256,
+                 raster_encoding='native', raster_compression='lzw', skip_dry_branches=False, verbose=False):
+
+        start = time.perf_counter()
+
+        if isinstance(hucs,str):
+            hucs = [hucs]
+
+        self.hydrofabric_dir = hydrofabric_dir
+        self.num_workers = int(num_workers)
+        self.raster_encoding = raster_encoding
+        self.raster_compression = raster_compression
+        self.skip_dry_branches = skip_dry_branches
+        self.verbose = verbose
+
+        # feature_ids of each branch to route forecast discharges
+        self.branch_index = BranchIndex.read(hydrofabric_dir, verbose=verbose)
+
+        branches = self.branch_index.branches
+        if hucs is not None:
+            branches = branches.loc[branches['huc8'].isin(set(hucs)),:]
+
+        self.branches = list(zip(branches['huc8'],branches['branchID']))
+
+        features = self.branch_index.features
+        features = features.loc[features['branch'].isin(branches.index),:]
+
+        if len(features) == 0:
+            raise ValueError("No branch in {} has a hydroTable with non-lake catchments".format(hydrofabric_dir))
+
+        # one discharge of the first branch compiles the mapping kernels in every worker
+        warm_up = tuple(branches.loc[features['branch'].iloc[0],['huc8','branchID']]) + \
+                  ( pd.DataFrame({ 'discharge' : [0.0] },
+                                 index=pd.Index([features['feature_id'].iloc[0]],name='feature_id')), )
+
+        self.executor = ProcessPoolExecutor( max_workers = self.num_workers,
+                                             initializer = init_service_worker,
+                                             initargs = (hydrofabric_dir, max_cached_branches, warm_up) )
+
+        # start all workers now instead of on the first forecast
+        wait([ self.executor.submit(service_worker_pid) for _ in range(self.num_workers) ])
+
+        # HUC grids are reused across forecasts
+        self.mosaics = {}
+
+        self.startup_seconds = time.perf_counter() - start
+        self.latencies = []
+
+        if verbose:
+            print("Started inundation service over {} branches with {} workers in {:.2f} s".format(
+                  len(self.branches), self.num_workers, self.startup_seconds))
+
+    def inundate(self, forecast, inundation_raster=None, depths_raster=None, mosaic=False,
+                 mask=None, nodata=elev_raster_ndv, log_file=None, output_fileNames=None, prune_branches=False):
+
+        """
+        Inundates the branches with discharges for a forecast
+
+        forecast is a forecast csv or NWM netcdf file, or a DataFrame of discharges indexed by
+        feature_id. Without mosaic, inundation_raster and depths_raster are branch outputs named
+        as in Inundate_gms and a DataFrame of their file names by branch is returned. With mosaic,
+        they are HUC mosaic outputs as in Inundate_gms_fused, optionally masked by mask, and a
+        DataFrame of the mosaic records by HUC is returned. prune_branches skips branches without
+        forecast discharges as in Inundate_gms instead of mapping them all dry.
+        """
+
+        if (inundation_raster is None) and (depths_raster is None):
+            raise ValueError("Pass inundation_raster and/or depths_raster")
+
+        start = time.perf_counter()
+
+        # forecast discharges by branch
+        branch_forecasts = self.branch_index.branch_forecasts(forecast, prune_branches and self.skip_dry_branches)
+        if prune_branches:
+            branch_forecasts = { ids : branch_forecasts[ids] for ids in self.branches if ids in branch_forecasts }
+        else:
+            # branches without discharges map all dry (negative HydroIDs)
+            no_discharges = pd.DataFrame({ 'discharge' : [] }, index=pd.Index([],name='feature_id',dtype=object))
+            branch_forecasts = { ids : branch_forecasts.get(ids,no_discharges) for ids in self.branches }
+
+        keep_inundation = mosaic and (inundation_raster is not None)
+        keep_depths = mosaic and (depths_raster is not None)
+
+        branches_left = {}
+        for hucCode, _ in branch_forecasts:
+            branches_left[hucCode] = branches_left.get(hucCode,0) + 1
+
+        records = []
+        pending = {}
+
+        progress = tqdm(total=len(branch_forecasts),
+                        desc="Inundating branches with {} workers".format(self.num_workers),
+                        disable=(not self.verbose) )
+
+        def __collect_done(done):
+
+            for future in done:
+
+                hucCode, branch_id = pending.pop(future)
+
+                try:
+                    branch_result = future.result()
+                except Exception as exc:
+                    self.__log(exc,hucCode,branch_id,log_file)
+                    branch_result = None
+
+                if not mosaic:
+                    if branch_result is not None:
+                        records.append( { 'huc8' : hucCode, 'branchID' : branch_id,
+                                          'inundation_rasters' : branch_result[6][0],
+                                          'depths_rasters' : branch_result[6][1] } )
+                else:
+                    if hucCode not in self.mosaics:
+                        huc_branch_ids = [ b for h,b in self.branches if h == hucCode ]
+                        self.mosaics[hucCode] = HucMosaic( self.hydrofabric_dir, hucCode, huc_branch_ids,
+                                                           keep_inundation, keep_depths, nodata )
+                    self.mosaics[hucCode].nodata = nodata
+
+                    if branch_result is not None:
+                        self.mosaics[hucCode].reduce(*branch_result[:6], branch_id=branch_id)
+
+                    # write finished HUCs
+                    branches_left[hucCode] -= 1
+                    if branches_left[hucCode] == 0:
+                        huc_mosaic = self.mosaics[hucCode]
+                        records.append( huc_mosaic.write( self.output_name(inundation_raster,hucCode),
+                                                          self.output_name(depths_raster,hucCode),
+                                                          mask, self.raster_encoding, self.raster_compression ) )
+                        huc_mosaic.clear()
+
+                del future
+                progress.update(1)
+
+        # bound the branch arrays held in memory
+        for (hucCode, branch_id), branch_forecast in branch_forecasts.items():
+
+            if mosaic:
+                branch_outputs = (None, None)
+            else:
+                branch_outputs = ( self.output_name(inundation_raster,hucCode,branch_id),
+                                   self.output_name(depths_raster,hucCode,branch_id) )
+
+            pending[ self.executor.submit( serve_branch, hucCode, branch_id, branch_forecast, *branch_outputs,
+                                           keep_inundation, keep_depths,
+                                           self.raster_encoding, self.raster_compression ) ] = (hucCode, branch_id)
+
+            if len(pending) >= 2 * self.num_workers:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                __collect_done(done)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            __collect_done(done)
+
+        progress.close()
+
+        if mosaic:
+            fileNames_df = pd.DataFrame( records,
+                                         columns=['huc8','inundation_rasters','depths_rasters',
+                                                  'branches','branch_raster_bytes','uncompressed_io_bytes_saved'] )
+        else:
+            fileNames_df = pd.DataFrame( records,
+                                         columns=['huc8','branchID','inundation_rasters','depths_rasters'] )
+
+        if output_fileNames is not None:
+            fileNames_df.to_csv(output_fileNames,index=False)
+
+        self.latencies.append(time.perf_counter() - start)
+
+        if self.verbose:
+            print("Forecast {} inundated {} of {} branches in {:.2f} s".format(
+                  len(self.latencies), len(branch_forecasts), len(self.branches), self.latencies[-1]))
+
+        return(fileNames_df)
+
+    def close(self):
+
+        self.executor.shutdown(wait=True)
+
+    def __enter__(self):
+
+        return(self)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+
+        self.close()
+
+    @staticmethod
+    def output_name(output, hucCode, branch_id=None):
+
+        """ Appends the HUC, if not in the name already, and the branch to an output file name """
+
+        if output is None:
+            return(None)
+
+        ids = [] if hucCode in output else [hucCode]
+        if branch_id is not None:
+            ids.append(branch_id)
+
+        return(fh.append_id_to_file_name(output,ids) if ids else output)
+
+    def __log(self, exc, hucCode, branch_id, log_file):
+
+        if log_file is not None:
+            print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}',
+                  file=open(log_file,'a'))
+        else:
+            print(f'{hucCode},{branch_id},{exc.__class__.__name__}, {exc}')
+
+
+def branch_file_name(hydrofabric_dir, hucCode, branch_id, input_name):
+
+    """ File name of the rem, catchments or hydro_table of a branch """
+
+    file_names = { 'rem' : 'rem_zeroed_masked_{}.tif',
+                   'catchments' : 'gw_catchments_reaches_filtered_addedAttributes_{}.tif',
+                   'hydro_table' : 'hydroTable_{}.csv' }
+
+    return(os.path.join(hydrofabric_dir, hucCode, 'branches', branch_id, file_names[input_name].format(branch_id)))
+
+
+def init_service_worker(hydrofabric_dir, max_cached_branches, warm_up=None):
+
+    """ Process pool initializer. Sets up the branch cache of a worker and compiles the mapping kernels """
+
+    global __service_worker
+
+    __service_worker = { 'hydrofabric_dir' : hydrofabric_dir,
+                         'max_cached_branches' : max_cached_branches,
+                         'branches' : OrderedDict() }
+
+    # a failed warm up only leaves compiling to the first forecast, the branch reports its error then
+    if warm_up is not None:
+        try:
+            serve_branch(*warm_up)
+        except Exception:
+            pass
+
+
+def service_worker_pid():
+
+    return(os.getpid())
+
+
+def serve_branch(hucCode, branch_id, forecast, inundation_raster=None, depths_raster=None,
+                 keep_inundation=False, keep_depths=False, raster_encoding='native', raster_compression='lzw'):
+
+    """ Process pool worker. Maps a branch from its cached inputs and returns the arrays needed by the HUC mosaics """
+
+    rem, catchments, hydroTable = __cached_branch(hucCode, branch_id)
+
+    inundation_array, depths_array, transform, inundation_nodata, depths_nodata, output_names = \
+        inundate_arrays( rem, catchments, hydroTable, forecast,
+                         inundation_raster = inundation_raster,
+                         depths = depths_raster,
+                         raster_encoding = raster_encoding,
+                         raster_compression = raster_compression )
+
+    # only send back the arrays that are mosaicked
+    if not keep_inundation: inundation_array = None
+    if not keep_depths: depths_array = None
+
+    # uncompressed raster bytes written by the worker
+    bytes_written = sum( a.nbytes for a,name in zip((inundation_array,depths_array),output_names)
+                         if (a is not None) and (name is not None) )
+
+    return(inundation_array, depths_array, transform, inundation_nodata, depths_nodata, bytes_written, output_names)
+
+
+def __cached_branch(hucCode, branch_id):
+
+    """ Open REM and catchments datasets and parsed hydroTable of a branch, least recently used out first """
+
+    branches = __service_worker['branches']
+    key = (hucCode, branch_id)
+
+    if key in branches:
+        branches.move_to_end(key)
+        return(branches[key])
+
+    hydrofabric_dir = __service_worker['hydrofabric_dir']
+    branches[key] = ( rasterio.open(branch_file_name(hydrofabric_dir,hucCode,branch_id,'rem')),
+                      rasterio.open(branch_file_name(hydrofabric_dir,hucCode,branch_id,'catchments')),
+                      read_hydroTable(branch_file_name(hydrofabric_dir,hucCode,branch_id,'hydro_table')) )
+
+    while len(branches) > __service_worker['max_cached_branches']:
+        _, (rem, catchments, _) = branches.popitem(last=False)
+        rem.close() ; catchments.close()
+
+    return(branches[key])
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Inundates GMS branches for a series of forecasts with warm workers')
+    parser.add_argument('-y','--hydrofabric_dir', help='Directory path to FIM hydrofabric by processing unit', required=True)
+    parser.add_argument('-u','--hucs',help='List of HUCS to run',required=False,default=None,type=str,nargs='+')
+    parser.add_argument('-f','--forecasts',help='Forecast discharges in CMS as CSV or NWM netcdf files, inundated in order',required=True,nargs='+')
+    parser.add_argument('-i','--inundation-raster',help='Inundation raster output. Appends the forecast name when there are many forecasts.',required=False,default=None)
+    parser.add_argument('-d','--depths-raster',help='Depths raster output. Appends the forecast name when there are many forecasts.',required=False,default=None)
+    parser.add_argument('-m','--mosaic',help='Reduce branches into HUC mosaics instead of writing branch rasters',required=False,default=False,action='store_true')
+    parser.add_argument('-k','--mask',help='Mosaic only. Polygons to mask the HUC mosaics with',required=False,default=None)
+    parser.add_argument('-l','--log-file',help='Log-file to store level-path exceptions',required=False,default=None)
+    parser.add_argument('-w','--num-workers', help='Number of Workers', required=False,default=1,type=int)
+    parser.add_argument('-p','--prune-branches',help='Skip branches without forecast discharges instead of mapping them all dry. Their dry cells are left nodata',required=False,default=False,action='store_true')
+    parser.add_argument('-s','--skip-dry-branches',help='With -p, also skip branches whose forecast discharges are all zero',required=False,default=False,action='store_true')
+    parser.add_argument('-c','--max-cached-branches', help='Branches kept open by each worker', required=False,default=256,type=int)
+    parser.add_argument('-v','--verbose',help='Verbose printing',required=False,default=False,action='store_true')
+
+    args = vars(parser.parse_args())
+
+    with InundationService( args['hydrofabric_dir'], num_workers=args['num_workers'], hucs=args['hucs'],
+                            max_cached_branches=args['max_cached_branches'],
+                            skip_dry_branches=args['skip_dry_branches'], verbose=args['verbose'] ) as service:
+
+        for forecast in args['forecasts']:
+
+            forecast_name = os.path.splitext(os.path.basename(forecast))[0]
+            outputs = [ args[output] for output in ('inundation_raster','depths_raster') ]
+            if len(args['forecasts']) > 1:
+                outputs = [ fh.append_id_to_file_name(output,forecast_name) if output is not None else None
+                            for output in outputs ]
+
+            service.inundate( forecast, *outputs, mosaic=args['mosaic'], mask=args['mask'], log_file=args['log_file'],
+                              prune_branches=args['prune_branches'] )
+
+        print("Startup: {:.2f} s. First forecast: {:.2f} s. Later forecasts: {} s".format(
+              service.startup_seconds, service.latencies[0],
+              ', '.join('{:.2f}'.format(l) for l in service.latencies[1:]) or '-'))
@@ -7,7 +7,7 @@ import pandas as pd
 import sys
 
 from glob import glob
-from gms_tools.overlapping_inundation import OverlapWindowMerge
+from gms_tools.overlapping_inundation import OverlapWindowMerge, MANIFEST_SUFFIX
 from tqdm import tqdm
 from utils.shared_variables import elev_raster_ndv
 from utils.shared_functions import FIM_Helpers as fh
@@ -22,11 +22,19 @@ def Mosaic_inundation( map_file,
                        remove_inputs = False,
                        subset = None,
                        verbose = True,
-                       is_mosaic_for_gms_branches = False ):
+                       is_mosaic_for_gms_branches = False,
+                       mask_cache = None,
+                       cog = False,
+                       incremental = False ):
     
     # Notes:
     #    - If is_mosaic_for_gms_branches is true, the mosaic output name
     #      will add the HUC into the output name for overwrite resons.
+    #    - The mask is applied while merging. Rasterized masks are kept for
+    #      the process and, if mask_cache is a directory, on disk.
+    #    - With cog, mosaics are written as cloud optimized GeoTIFFs with overviews.
+    #    - With incremental, a manifest of the inputs of each window is kept beside
+    #      each mosaic and a re-run only merges the windows whose inputs changed.
 
     # check input
     if mosaic_attribute not in ('inundation_rasters','depths_rasters'):
@@ -88,7 +96,10 @@ def Mosaic_inundation( map_file,
                       workers = workers, 
                       remove_inputs = remove_inputs,
                       mask = mask,
-                      verbose = verbose)
+                      mask_cache = mask_cache,
+                      verbose = verbose,
+                      cog = cog,
+                      incremental = incremental)
 
 
     # inundation maps
@@ -99,16 +110,18 @@ def Mosaic_inundation( map_file,
     return ag_mosaic_output
 
 
-# Note: This uses threading and not processes. If the number of workers is more than 
-# the number of possible threads, no results will be returned. But it is usually
-# pretty fast anyways. This needs to be fixed.
+# Note: With more than one worker, windows are read and aggregated by a thread pool
+# and written in order by the calling thread.
 def mosaic_by_unit(inundation_maps_list,
                    mosaic_output,
                    nodata = elev_raster_ndv,
                    workers = 1,
                    remove_inputs = False,
                    mask = None,
-                   verbose = False):
+                   verbose = False,
+                   mask_cache = None,
+                   cog = False,
+                   incremental = False):
 
     # overlap object instance
     overlap = OverlapWindowMerge( inundation_maps_list, (30, 30) )
@@ -119,11 +132,13 @@ def mosaic_by_unit(inundation_maps_list,
         else:
             threaded= False
         
-        overlap.merge_rasters(mosaic_output, threaded=threaded, workers=workers, nodata=nodata)
+        # masked window by window
+        manifest = mosaic_output + MANIFEST_SUFFIX if incremental else None
+        merged = overlap.merge_rasters(mosaic_output, threaded=threaded, workers=workers, nodata=nodata,
+                                       mask=mask if mask else None, mask_cache=mask_cache, cog=cog,
+                                       manifest=manifest)
 
-        if mask:
-            fh.vprint("Masking ...", verbose)                
-            overlap.mask_mosaic(mosaic_output, mask, outfile=mosaic_output)
+        fh.vprint(f"Merged {merged['windows_merged']} of {merged['windows']} windows", verbose and incremental)
     
     if remove_inputs:
         fh.vprint("Removing inputs ...", verbose)
@@ -156,6 +171,15 @@ if __name__ == '__main__':
                         required=False, default=False, action='store_true')
     parser.add_argument('-v','--verbose', help='Remove original input inundation Maps', 
                         required=False, default=False, action='store_true')
+    parser.add_argument('-c','--mask-cache',
+                        help='Directory to cache rasterized masks in for reuse across runs',
+                        required=False, default=None)
+    parser.add_argument('-o','--cog',
+                        help='Write mosaics as cloud optimized GeoTIFFs with internal overviews',
+                        required=False, default=False, action='store_true')
+    parser.add_argument('-e','--incremental',
+                        help='Keep a manifest of the inputs of each window beside the mosaics and only merge windows whose inputs changed',
+                        required=False, default=False, action='store_true')
     parser.add_argument('-g','--is-mosaic-for-gms-branches', 
                         help='If the mosaic is for gms branchs, include this arg',
                         required=False, default=False, action='store_true')
@@ -1,17 +1,26 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+import os
+import json
+import hashlib
+import tempfile
 import rasterio
-from rasterio.windows import from_bounds
+import rasterio.shutil
+from rasterio.enums import Resampling
+from rasterio.windows import from_bounds, Window, WindowMethodsMixin
+from rasterio.mask import mask, raster_geometry_mask
+from rasterio.transform import TransformMethodsMixin
 import numpy as np
 from functools import partial
 from affine import Affine
 from scipy.optimize import newton
 from threading import Lock
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
 import concurrent.futures
 from numba import njit
 import geopandas as gpd
-from rasterio.mask import mask
 import sys
 import warnings
 
@@ -20,27 +29,42 @@ class OverlapWindowMerge:
     def __init__(self,
                  inundation_rsts,
                  num_partitions=None,
-                 window_xy_size=None):
+                 window_xy_size=None,
+                 max_open_datasets=128):
         """
         Initialize the object
 
+        Only the headers of the inputs are kept (see RasterHeader). Their data are read
+        through a pool of open handles (see DatasetPool), which keeps at most
+        max_open_datasets idle handles open, so HUCs with thousands of branches stay
+        within file descriptor limits.
+
         :param inundation_rsts: list of inundation paths or datasets
         :param num_partitions: tuple of integers representing num windows in x and y space
         :param window_xy_size: tuple of integers represeting num of pixels in windows in x an y space
+        :param max_open_datasets: int maximum number of idle input handles kept open
         """
 
         # sort for largest spanning dataset (todo: handle mismatched resolutions)
         size_func = lambda x: np.abs(x.bounds.left - x.bounds.right) * \
                               np.abs(x.bounds.top - x.bounds.bottom)
         key_sort_func = lambda x: x['size']
-        datasets = [rasterio.open(ds) for ds in inundation_rsts]
-        ds_dict = [{'dataset': ds, 'size': size_func(ds)} for ds in datasets]
+        datasets = []
+        for ds in inundation_rsts:
+            with rasterio.open(ds) as rst:
+                datasets.append(RasterHeader(rst))
+        ds_dict = [{'dataset': ds, 'size': size_func(ds), 'idx': idx} for idx, ds in enumerate(datasets)]
         ds_dict.sort(key=key_sort_func, reverse=True)
 
-        # load sample overlapping inundation depth rasters
+        # headers of sample overlapping inundation depth rasters
         self.depth_rsts = [x['dataset'] for x in ds_dict]
+
+        # position in inundation_rsts of each sorted dataset
+        self.input_idx = [x['idx'] for x in ds_dict]
         del ds_dict
 
+        self.pool = DatasetPool([x.name for x in self.depth_rsts], max_open_datasets)
+
         self.rst_dims = [[x.height, x.width] for x in self.depth_rsts]
 
         self.res = self.depth_rsts[0].meta['transform'][0]
@@ -132,12 +156,12 @@ class OverlapWindowMerge:
         # Get window widths (both normal and edge windows)
         window_width1 = np.repeat(int(self.proc_unit_width / x_res), x_res) * self.lat_lon_sign[1]
         window_width2 = window_width1.copy()
-        window_width2[-1] += self.proc_unit_width - window_width1[0] * x_res * self.lat_lon_sign[1]
+        window_width2[-1] += (self.proc_unit_width - abs(window_width1[0]) * x_res) * self.lat_lon_sign[1]
 
         # Get window heights (both normal and edge windows)
         window_height1 = np.repeat(int(self.proc_unit_height / y_res), y_res) * self.lat_lon_sign[0]
         window_height2 = window_height1.copy()
-        window_height2[-1] += self.proc_unit_height - window_height1[0] * y_res * self.lat_lon_sign[0]
+        window_height2[-1] += (self.proc_unit_height - abs(window_height1[0]) * y_res) * self.lat_lon_sign[0]
 
         # Get window sizes (both normal and edge windows)
         window_bounds1 = np.flip(np.array(np.meshgrid(window_width1,
@@ -224,75 +248,134 @@ class OverlapWindowMerge:
         :return: rasterio window object for final window, rasterio window of data window bounds,
         data for each raster in window,
         """
-        # Get window bounding box and get final array output dimensions
-        window = path_points[win_idx]
-        window_height, window_width = np.array([np.abs(bbox[win_idx][2] - bbox[win_idx][0]),
-                                                np.abs(bbox[win_idx][3] - bbox[win_idx][1])]).astype(np.int)
+        rsts = self.pool.check_out(datasets)
+        try:
+            return read_window_data(win_idx, datasets, rsts, path_points, bbox, meta['transform'])
+        finally:
+            self.pool.check_in(rsts)
 
-        bnds = []
-        data = []
-        for ds in datasets:
-            # Get rasterio window for each pair of window bounds and depth dataset
+    def index_windows(self, window_bounds, window_idx):
+        """
+        Return the datasets overlapping each window
 
-            bnd = from_bounds(window[0][1],
-                              window[-1][0],
-                              window[-1][1],
-                              window[0][0],
-                              transform=self.depth_rsts[ds].transform,
-                              height=window_height,
-                              width=window_width)
+        The windows of a dataset are found by binary search of the window edges for the
+        rows and columns it spans on the final grid, instead of scanning all window centers
+        for the nearest ones as get_window_idx does.
 
-            bnds.append(bnd)
+        :param window_bounds: list of window sizes from get_window_coords
+        :param window_idx: array of window rows and columns from get_window_coords
 
-            # Read raster data with window
-            read_data = self.depth_rsts[ds].read(1, window=bnd).astype(np.float32)
-            # Convert all no data to nan values
-            read_data[read_data == np.float32(self.depth_rsts[ds].meta['nodata'])] = np.nan
-            data.append(read_data)
-            del bnd
+        :return: dict of list of int dataset idx in ascending order by int window idx
+        """
 
-        final_bnds = from_bounds(window[0][1],
-                                 window[-1][0],
-                                 window[-1][1],
-                                 window[0][0],
-                                 transform=meta['transform'],
-                                 height=window_height,
-                                 width=window_width)
+        window_height, window_width = np.abs(window_bounds[0][0])
+        y_res, x_res = window_idx[0].max() + 1, window_idx[1].max() + 1
 
-        return [final_bnds, bnds, data]
+        # the last windows take the remainder of the grid
+        row_edges = np.arange(1, y_res) * window_height
+        col_edges = np.arange(1, x_res) * window_width
 
+        # rows and columns spanned by each dataset on the final grid
+        bounds = np.array([tuple(x.bounds) for x in self.depth_rsts])
+        top, left = self.proc_unit_transform.f, self.proc_unit_transform.c
+        rows = np.round(np.stack([top - bounds[:, 3], top - bounds[:, 1]], axis=1) / self.res, 6)
+        cols = np.round(np.stack([bounds[:, 0] - left, bounds[:, 2] - left], axis=1) / self.res, 6)
 
-    def merge_rasters(self, out_fname, nodata=-9999, threaded=False, workers=4):
+        first_rows = np.searchsorted(row_edges, rows[:, 0], side='right')
+        last_rows = np.maximum(np.searchsorted(row_edges, rows[:, 1], side='left'), first_rows)
+        first_cols = np.searchsorted(col_edges, cols[:, 0], side='right')
+        last_cols = np.maximum(np.searchsorted(col_edges, cols[:, 1], side='left'), first_cols)
+
+        data_dict = {}
+        for idx in range(len(self.depth_rsts)):
+            window_rows, window_cols = np.meshgrid(np.arange(first_rows[idx], last_rows[idx] + 1),
+                                                   np.arange(first_cols[idx], last_cols[idx] + 1),
+                                                   indexing='ij')
+            for win_idx in np.ravel_multi_index([window_rows.ravel(), window_cols.ravel()],
+                                                (y_res, x_res), order='F'):
+                data_dict.setdefault(int(win_idx), []).append(idx)
+
+        return data_dict
+
+    def merge_rasters(self, out_fname, nodata=-9999, threaded=False, workers=4,
+                      backend='thread', max_in_flight=None, max_open_datasets=128,
+                      mask=None, mask_layer=None, mask_cache=None, cog=False,
+                      overview_resampling='nearest', manifest=None):
         """
         Merge multiple raster datasets
 
+        Each window is reduced one input at a time into a running maximum, so at most the
+        window and the data of one input are held per window (see reduce_window_data), and
+        inputs are read through handles checked out of the pool of this object.
+
+        With threaded=True, columns of windows are read and aggregated by a pool of
+        workers while the calling thread writes them to the output in column order. At
+        most max_in_flight columns (default twice the workers) are read or waiting to be
+        written at any time, which bounds memory use. As GDAL datasets can not be read
+        from several threads at once, each worker checks out its own handles from the
+        pool (see DatasetPool), which keeps at most max_open_datasets idle handles open.
+
+        With a mask, the output is cropped to the mask polygons and cells outside them are
+        set to nodata as each window is written, giving the same raster as mask_mosaic
+        without a second pass over the mosaic (see MosaicMask).
+
+        With cog=True, the output is a cloud optimized GeoTIFF with internal overviews (see
+        cog_writer).
+
+        With a manifest file, the inputs of each window and their content hashes are recorded
+        in it (see MosaicManifest). When the output and the manifest of a previous merge on the
+        same grid exist, only windows whose inputs changed are merged again and patched into
+        the output, giving the same raster as merging all windows. The patched output is then
+        rewritten compactly (see compact_raster). COGs are always merged whole as they can not
+        be patched in place.
+
         :param out_fname: str path for final merged dataset
         :param nodata: int/float representing no data value
+        :param threaded: bool merge windows with a pool of workers
+        :param workers: int number of workers
+        :param backend: str 'thread' or 'process' pool of workers
+        :param max_in_flight: int maximum number of columns of windows read but not yet written
+        :param max_open_datasets: int maximum number of idle input handles kept open by the pool
+        :param mask: str path or geopandas GeoDataFrame of polygons to mask the output with
+        :param mask_layer: str layer of the mask polygons
+        :param mask_cache: str directory to cache rasterized masks in
+        :param cog: bool write a cloud optimized GeoTIFF
+        :param overview_resampling: str rasterio resampling method of the COG overviews
+        :param manifest: str path of the manifest of the output
+
+        :return: dict of the number of windows with inputs and of windows merged
         """
 
+        if backend not in ('thread', 'process'):
+            raise ValueError("Pass 'thread' or 'process' for backend")
+
         window_bounds, window_idx = self.get_window_coords()
         latitudes, longitudes, path_points, bbox = self.create_lat_lons(window_bounds,
                                                                         window_idx)
-        
-        windows = [self.get_window_idx(latitudes,
-                                       longitudes,
-                                       coords,
-                                       self.partitions)
-                   for coords in self.depth_bounds]
 
         # Create dict with window idx key and dataset idx vals
-        data_dict = {}
-        for idx, win in enumerate(windows):
-            for win_idx in win:
-                if win_idx in data_dict:
-                    data_dict[win_idx].append(idx)
-                else:
-                    data_dict[win_idx] = [idx]
+        data_dict = self.index_windows(window_bounds, window_idx)
+
+        self.pool.max_open_datasets = max_open_datasets
 
         agg_function = partial(np.nanmax, axis=0)
 
         meta = self.depth_rsts[0].meta
 
+        # Keep the encoding of the inputs if they share it, otherwise write decoded values as float32
+        encodings = { (x.dtypes[0], x.scales[0], x.offsets[0]) for x in self.depth_rsts }
+        if len(encodings) == 1:
+            _, scale, offset = encodings.pop()
+        else:
+            meta.update(dtype='float32')
+            scale, offset = 1, 0
+
+        # Integer outputs can not hold every nodata value, use the nodata of the inputs then
+        if np.issubdtype(np.dtype(meta['dtype']), np.integer):
+            dtype_info = np.iinfo(meta['dtype'])
+            if not (dtype_info.min <= float(nodata) <= dtype_info.max):
+                nodata = meta['nodata']
+
         meta.update(transform=self.proc_unit_transform,
                     width=self.proc_unit_width,
                     height=self.proc_unit_height,
@@ -300,56 +383,126 @@ class OverlapWindowMerge:
                     blockysize=256, tiled=True,
                     compress='lzw')
 
-        final_windows, data_windows, data = [], [], []
+        # Output cropped to the mask polygons, windows are still read on the grid of meta
+        out_meta = meta.copy()
+        mosaic_mask = None
+        if mask is not None:
+            mosaic_mask = MosaicMask.rasterize(mask, self.proc_unit_transform, self.proc_unit_width,
+                                               self.proc_unit_height, mask_layer, mask_cache)
+            out_meta.update(transform=mosaic_mask.transform,
+                            width=mosaic_mask.window.width,
+                            height=mosaic_mask.window.height)
+
+        # Only windows whose inputs changed since the manifest of the existing output
+        manifest_record, changed_windows = None, None
+        number_of_windows = len(data_dict)
+        if manifest is not None:
+            input_names = [ds.name for ds in self.depth_rsts]
+            grid = { 'transform' : tuple(self.proc_unit_transform)[:6],
+                     'width' : self.proc_unit_width, 'height' : self.proc_unit_height,
+                     'dtype' : meta['dtype'], 'nodata' : float(meta['nodata']), 'scale' : scale, 'offset' : offset,
+                     'partitions' : self.partitions, 'window_sizes' : self.window_sizes,
+                     'mask' : MosaicMask.cache_key(mask, self.proc_unit_transform, self.proc_unit_width,
+                                                   self.proc_unit_height, mask_layer) if mask is not None else None }
+
+            previous = None
+            if os.path.exists(out_fname) and (not cog) and ((mask is None) or isinstance(mask, str)):
+                previous = MosaicManifest.read(manifest)
+
+            manifest_record = MosaicManifest(grid, MosaicManifest.hash_inputs(input_names, previous),
+                                             { w : [input_names[i] for i in ds] for w, ds in data_dict.items() })
+
+            # windows left without inputs are merged to nodata
+            changed_windows = manifest_record.changed_windows(previous)
+            if changed_windows is not None:
+                data_dict = { int(w) : data_dict.get(int(w), []) for w in changed_windows }
+
+        def __write_window(rst, window_data, final_window):
+
+            if mosaic_mask is not None:
+                masked = mosaic_mask.apply(window_data, final_window, meta['nodata'])
+                if masked is None:
+                    return
+                final_window, window_data = masked
+
+            rst.write_band(1, window_data, window=final_window)
+
+        merge_kwargs = dict(dtype=meta['dtype'],
+                            agg_function=agg_function,
+                            nodata=meta['nodata'],
+                            rst_dims=self.rst_dims,
+                            scale=scale,
+                            offset=offset)
+
+        # a partly rewritten output must not be patched later
+        if (changed_windows is None) and (manifest is not None) and os.path.exists(manifest):
+            os.remove(manifest)
+
+        if cog:
+            writer = cog_writer(out_fname, overview_resampling, **out_meta)
+        elif changed_windows is not None:
+            writer = rasterio.open(out_fname, 'r+')
+        else:
+            writer = rasterio.open(out_fname, 'w', **out_meta)
+
+        with writer as rst:
 
-        def __data_generator(data_dict,path_points,bbox,meta):
+            if (scale != 1) or (offset != 0):
+                rst.scales = (scale,)
+                rst.offsets = (offset,)
 
-            for key, val in data_dict.items():
+            # windows are merged a column at a time, holding the handles of the column
+            window_merger = WindowMerger(self.pool,
+                                         path_points,
+                                         bbox,
+                                         meta['transform'],
+                                         merge_kwargs)
 
-                f_window, window, dat = self.read_rst_data(key,
-                                                           val,
-                                                           path_points,
-                                                           bbox,
-                                                           meta
-                                                          )
-                yield(dat, window, f_window, val)
-                #final_windows.append(f_window)
-                #data_windows.append(window)
-                #data.append(dat)
-                #del f_window, window, dat
+            window_columns = {}
+            for win_idx in sorted(data_dict):
+                window_columns.setdefault(window_idx[1][win_idx], []).append((win_idx, data_dict[win_idx]))
 
-        # create data generator
-        dgen = __data_generator(data_dict,path_points,bbox,meta)
-        
-        lock = Lock()
-
-        with rasterio.open(out_fname, 'w', **meta) as rst:
-
-            merge_partial = partial(merge_data,
-                             rst=rst,
-                             lock=lock,
-                             dtype=meta['dtype'],
-                             agg_function=agg_function,
-                             nodata=meta['nodata'],
-                             rst_dims=self.rst_dims)
-            
             if not threaded:
-                #for d, dw, fw, ddict in zip(data,
-                #                            data_windows,
-                #                            final_windows,
-                #                            data_dict.values()):
-                for d, dw, fw, ddict in dgen:
-                    merge_partial(d, dw, fw, ddict)
+
+                try:
+                    for column in window_columns.values():
+                        for final_window, window_data in window_merger.merge(column):
+                            __write_window(rst, window_data, final_window)
+                            del window_data
+                finally:
+                    self.pool.close()
             else:
-                with concurrent.futures.ThreadPoolExecutor(
-                        max_workers=workers
-                ) as executor:
-                    executor.map(merge_partial,
-                                 data,
-                                 data_windows,
-                                 final_windows,
-                                 data_dict.values()
-                                 )
+                # thread workers share the pool of this object, process workers make their own
+                if max_in_flight is None:
+                    max_in_flight = 2 * workers
+
+                if backend == 'thread':
+                    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+                else:
+                    executor = concurrent.futures.ProcessPoolExecutor(max_workers=workers,
+                                                                      initializer=init_window_merger,
+                                                                      initargs=(window_merger,))
+                    window_merger = merge_windows_in_process
+
+                try:
+                    with executor:
+                        for merged in ordered_map(executor,
+                                                  window_merger,
+                                                  ((column,) for column in window_columns.values()),
+                                                  max_in_flight):
+                            for final_window, window_data in merged:
+                                __write_window(rst, window_data, final_window)
+                finally:
+                    self.pool.close()
+
+        # patched blocks were appended to the compressed output
+        if changed_windows is not None:
+            compact_raster(out_fname, **{ k : out_meta[k] for k in ('tiled', 'blockxsize', 'blockysize', 'compress') })
+
+        if manifest_record is not None:
+            manifest_record.write(manifest)
+
+        return({ 'windows' : number_of_windows, 'windows_merged' : len(data_dict) })
 
     def mask_mosaic(self,mosaic,polys,polys_layer=None,outfile=None):
         
@@ -382,10 +535,165 @@ class OverlapWindowMerge:
                                       blockxsize=256, blockysize=256, tiled=True, compress='lzw')
 
             with rasterio.open(outfile,'w',**out_profile) as otfi:
+                otfi.scales = mosaic.scales
+                otfi.offsets = mosaic.offsets
                 otfi.write(mosaic_array,indexes=1)
          
         return(mosaic_array,out_profile)
 
+
+# per cell rules of OverlapWindowComposite
+COMPOSITE_RULES = ('max', 'priority', 'mean')
+
+# composite extents as 1 (inundated) and 0 (dry), sources as bits of models
+COMPOSITE_EXTENT_PROFILE = { 'dtype' : 'int8', 'nodata' : -128 }
+COMPOSITE_SOURCE_PROFILE = { 'dtype' : 'uint8', 'nodata' : 0 }
+
+
+class OverlapWindowComposite(OverlapWindowMerge):
+
+    def __init__(self,
+                 inundation_rsts,
+                 models,
+                 num_partitions=None,
+                 window_xy_size=None,
+                 max_open_datasets=128):
+        """
+        Composite rasters of several models (e.g. FR, MS and GMS) on the grid of their union
+
+        :param inundation_rsts: list of depth or inundation paths
+        :param models: list of str model of each raster, at most 8 distinct models
+        :param num_partitions: tuple of integers representing num windows in x and y space
+        :param window_xy_size: tuple of integers represeting num of pixels in windows in x an y space
+        :param max_open_datasets: int maximum number of idle input handles kept open
+        """
+
+        if len(models) != len(inundation_rsts):
+            raise ValueError("Pass a model for each raster")
+
+        super().__init__(inundation_rsts, num_partitions, window_xy_size, max_open_datasets)
+
+        # distinct models in order of appearance, each a bit of the source raster
+        self.models = list(OrderedDict.fromkeys(models))
+        if len(self.models) > 8:
+            raise ValueError("At most 8 models can be composited")
+
+        self.rst_models = [models[idx] for idx in self.input_idx]
+
+    def composite_rasters(self, depths_output=None, extent_output=None, source_output=None,
+                          rule='max', priority=None, values='depths', nodata=-9999,
+                          max_open_datasets=128):
+        """
+        Composite the rasters by a per cell rule in one windowed pass
+
+        Each window of every input is read once and folded into the depth, extent and
+        source model outputs together (see composite_window_data). Rules are 'max' (deepest
+        model, the first model in models on ties), 'priority' (first model in priority with
+        data, so a model fills in only where the models before it have no data) and 'mean'
+        (average of the models with data). Dry cells (0) count as data.
+
+        Depths are float32 with nodata. Extents are int8 1 (inundated), 0 (dry) and -128
+        (no data). Sources are uint8 bits of the models the value of a cell comes from, bit
+        i for the i-th model of models (one model for 'max' and 'priority', all models with
+        data for 'mean') and 0 for no data, with the bit of each model in the MODEL_BITS tag.
+
+        With values='extent', the inputs are inundation rasters read as 1 (positive,
+        inundated) and 0 (dry), such as HydroID inundation rasters, and only the extent and
+        source outputs can be written.
+
+        :param depths_output: str path of the composite depths raster
+        :param extent_output: str path of the composite extent raster
+        :param source_output: str path of the source models raster
+        :param rule: str 'max', 'priority' or 'mean'
+        :param priority: list of str models from first to last priority, defaults to models
+        :param values: str 'depths' or 'extent'
+        :param nodata: float no data value of the depths output
+        :param max_open_datasets: int maximum number of idle input handles kept open by the pool
+
+        :return: dict of the output paths by 'depths', 'extent' and 'source'
+        """
+
+        if rule not in COMPOSITE_RULES:
+            raise ValueError("Pass one of {} for rule".format(", ".join(COMPOSITE_RULES)))
+        if values not in ('depths', 'extent'):
+            raise ValueError("Pass 'depths' or 'extent' for values")
+        if (values == 'extent') and (depths_output is not None):
+            raise ValueError("Composite depths need depth rasters, pass values='depths'")
+        if (depths_output is None) and (extent_output is None) and (source_output is None):
+            raise ValueError("Pass at least one of depths_output, extent_output or source_output")
+
+        if priority is None:
+            priority = self.models
+        elif sorted(priority) != sorted(self.models):
+            raise ValueError("Priority must list each of the models {}".format(", ".join(self.models)))
+
+        window_bounds, window_idx = self.get_window_coords()
+        latitudes, longitudes, path_points, bbox = self.create_lat_lons(window_bounds,
+                                                                        window_idx)
+        data_dict = self.index_windows(window_bounds, window_idx)
+
+        self.pool.max_open_datasets = max_open_datasets
+
+        # folding order: models by priority (by models for max ties), then inputs by position
+        model_order = priority if rule == 'priority' else self.models
+        fold_key = lambda ds: (model_order.index(self.rst_models[ds]), self.input_idx[ds])
+        model_bits = [1 << self.models.index(model) for model in self.rst_models]
+
+        meta = self.depth_rsts[0].meta
+        meta.update(transform=self.proc_unit_transform,
+                    width=self.proc_unit_width,
+                    height=self.proc_unit_height,
+                    count=1, blockxsize=256,
+                    blockysize=256, tiled=True,
+                    compress='lzw')
+
+        outputs = { 'depths' : depths_output, 'extent' : extent_output, 'source' : source_output }
+        profiles = { 'depths' : { 'dtype' : 'float32', 'nodata' : nodata },
+                     'extent' : COMPOSITE_EXTENT_PROFILE,
+                     'source' : COMPOSITE_SOURCE_PROFILE }
+
+        window_columns = {}
+        for win_idx in sorted(data_dict):
+            window_columns.setdefault(window_idx[1][win_idx], []).append(
+                (win_idx, sorted(data_dict[win_idx], key=fold_key)))
+
+        with ExitStack() as stack:
+
+            rsts = {}
+            for output, out_fname in outputs.items():
+                if out_fname is not None:
+                    rsts[output] = stack.enter_context(rasterio.open(out_fname, 'w', **dict(meta, **profiles[output])))
+
+            if 'source' in rsts:
+                rsts['source'].update_tags(MODEL_BITS=json.dumps({ model : 1 << i for i, model in enumerate(self.models) }))
+
+            try:
+                for column in window_columns.values():
+                    held = {}
+                    try:
+                        for win_idx, datasets in column:
+                            final_window, window_data, window_source = \
+                            composite_window_data(win_idx, datasets, self.pool, path_points, bbox,
+                                                  meta['transform'], self.rst_dims, model_bits,
+                                                  rule=rule, values=values, held=held)
+
+                            no_data = np.isnan(window_data)
+                            if 'depths' in rsts:
+                                rsts['depths'].write_band(1, np.where(no_data, np.float32(nodata), window_data),
+                                                          window=final_window)
+                            if 'extent' in rsts:
+                                extent = np.where(no_data, COMPOSITE_EXTENT_PROFILE['nodata'], window_data > 0)
+                                rsts['extent'].write_band(1, extent.astype(np.int8), window=final_window)
+                            if 'source' in rsts:
+                                rsts['source'].write_band(1, window_source, window=final_window)
+                    finally:
+                        self.pool.check_in(held)
+            finally:
+                self.pool.close()
+
+        return({ output : out_fname for output, out_fname in outputs.items() })
+
+
 # Quasi multi write
 # Throughput achieved assuming processing time is not identical between windows
 # and queued datasets, preferably approx N/2 threads for 9 windows
@@ -399,7 +707,9 @@ def merge_data(rst_data,
                lock,
                agg_function,
                nodata,
-               rst_dims
+               rst_dims,
+               scale=1,
+               offset=0
                ):
     """
     Merge data in to final dataset (multi threaded)
@@ -414,50 +724,853 @@ def merge_data(rst_data,
     :param agg_function: function to aggregate datasets
     :param nodata: nodata of final output
     :param rst_dims: dimensions of overlapping rasters
+    :param scale: scale of the final output encoding
+    :param offset: offset of the final output encoding
     """
 
-    nan_tile = np.array([np.nan]).astype(dtype)[0]
-    window_data = np.tile(float(nan_tile), [int(final_window.height), int(final_window.width)])
+    window_data = aggregate_data(rst_data, window_bnds, final_window, datasets,
+                                 dtype, agg_function, nodata, rst_dims, scale, offset)
 
-    for data, bnds, idx in zip(rst_data, window_bnds, datasets):
-        # Get indices to apply to base
+    with lock:
+        rst.write_band(1, window_data, window=final_window)
+    del window_data
 
-        col_slice = slice(int(np.max([0,
-                                      np.ceil(bnds.col_off * -1)])),
-                          int(np.min([bnds.width,
-                                      rst_dims[idx][1] - bnds.col_off])))
 
-        row_slice = slice(int(np.max([0,
-                                      np.ceil(bnds.row_off * -1)])),
-                          int(np.min([bnds.height,
-                                      rst_dims[idx][0] - bnds.row_off])))
+def aggregate_data(rst_data,
+                   window_bnds,
+                   final_window,
+                   datasets,
+                   dtype,
+                   agg_function,
+                   nodata,
+                   rst_dims,
+                   scale=1,
+                   offset=0
+                   ):
+    """
+    Aggregate the data of overlapping rasters in to the final window
 
-        win_shape = window_data[row_slice, col_slice].shape
+    :param rst_data: list of rst data from window
+    :param window_bnds: list rasterio windows representing data window bounds
+    :param final_window: rasterio window representing final window bounds
+    :param datasets: list of int representing dataset idx
+    :param dtype: data type of final output
+    :param agg_function: function to aggregate datasets
+    :param nodata: nodata of final output
+    :param rst_dims: dimensions of overlapping rasters
+    :param scale: scale of the final output encoding
+    :param offset: offset of the final output encoding
 
-        if not np.all(np.sign(np.array(win_shape) - np.array(data.shape)) > 0):
-            data = data[:win_shape[0], :win_shape[1]]
-        # Assign the data to the base array with aggregate function
-        merge = [window_data[row_slice,
-                             col_slice],
-                 data]
+    :return: ndarray of final window in the final data type
+    """
+
+    window_data = __empty_window_data(final_window, dtype)
 
+    for data, bnds, idx in zip(rst_data, window_bnds, datasets):
+        __fold_window_data(window_data, data, bnds, rst_dims[idx], agg_function, nodata)
         del data
-        
-        with warnings.catch_warnings():
-            # This `with` block supresses the RuntimeWarning thrown by numpy when aggregating nan values
-            warnings.simplefilter("ignore", category=RuntimeWarning)
-            window_data[row_slice, col_slice] = agg_function(merge)
-        
-        window_data[np.isnan(window_data)] = nodata
-        del merge
 
     del rst_data, window_bnds, datasets
 
+    return __encode_window_data(window_data, dtype, nodata, scale, offset)
+
+
+def reduce_window_data(win_idx,
+                       datasets,
+                       pool,
+                       path_points,
+                       bbox,
+                       transform,
+                       dtype,
+                       agg_function,
+                       nodata,
+                       rst_dims,
+                       scale=1,
+                       offset=0,
+                       held=None
+                       ):
+    """
+    Read and aggregate the data of overlapping rasters in to the final window one raster at a time
+
+    Gives the window of read_window_data followed by aggregate_data while holding only the
+    window and the data of one raster, whose handle is checked out of the pool for the read.
+    With a held dict, handles are kept in it instead of being returned, for the caller to
+    reuse with the next windows and return to the pool.
+
+    :param win_idx: int window index
+    :param datasets: list of int representing dataset idx
+    :param pool: DatasetPool of handles by dataset idx
+    :param path_points: list of bbox for windows
+    :param bbox: list of ul/br coords of windows
+    :param transform: Affine transform of final dataset
+    :param dtype: data type of final output
+    :param agg_function: function to aggregate datasets
+    :param nodata: nodata of final output
+    :param rst_dims: dimensions of overlapping rasters
+    :param scale: scale of the final output encoding
+    :param offset: offset of the final output encoding
+    :param held: dict of handles by dataset idx held by the caller
+
+    :return: rasterio window object for final window, ndarray of final window in the final data type
+    """
+
+    final_window = __window_bounds(win_idx, path_points, bbox, transform)
+    window_data = __empty_window_data(final_window, dtype)
+
+    for ds in datasets:
+        if (held is not None) and (ds in held):
+            rsts = { ds : held[ds] }
+        else:
+            rsts = pool.check_out([ds])
+        try:
+            window_bnds, data = __read_dataset_window(win_idx, rsts[ds], path_points, bbox)
+        finally:
+            if held is not None:
+                held.update(rsts)
+            else:
+                pool.check_in(rsts)
+
+        __fold_window_data(window_data, data, window_bnds, rst_dims[ds], agg_function, nodata)
+        del data
+
+    return final_window, __encode_window_data(window_data, dtype, nodata, scale, offset)
+
+
+def __empty_window_data(final_window, dtype):
+
+    # Integer outputs start from -inf, as NaN cast to small integer types collides with valid values
+    nan_tile = np.nan if np.issubdtype(np.dtype(dtype), np.floating) else -np.inf
+    return np.tile(float(nan_tile), [int(final_window.height), int(final_window.width)])
+
+
+def __fold_window_data(window_data, data, bnds, rst_dim, agg_function, nodata):
+
+    row_slice, col_slice, data = __window_slices(window_data, data, bnds, rst_dim)
+
+    # Assign the data to the base array with aggregate function
+    merge = [window_data[row_slice,
+                         col_slice],
+             data]
+
+    del data
+
+    with warnings.catch_warnings():
+        # This `with` block supresses the RuntimeWarning thrown by numpy when aggregating nan values
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        window_data[row_slice, col_slice] = agg_function(merge)
+
+    window_data[np.isnan(window_data)] = nodata
+    del merge
+
+
+def __window_slices(window_data, data, bnds, rst_dim):
+
+    # Get indices to apply to base
+    col_slice = slice(int(np.max([0,
+                                  np.ceil(bnds.col_off * -1)])),
+                      int(np.min([bnds.width,
+                                  rst_dim[1] - bnds.col_off])))
+
+    row_slice = slice(int(np.max([0,
+                                  np.ceil(bnds.row_off * -1)])),
+                      int(np.min([bnds.height,
+                                  rst_dim[0] - bnds.row_off])))
+
+    win_shape = window_data[row_slice, col_slice].shape
+
+    if not np.all(np.sign(np.array(win_shape) - np.array(data.shape)) > 0):
+        data = data[:win_shape[0], :win_shape[1]]
+
+    return row_slice, col_slice, data
+
+
+def __encode_window_data(window_data, dtype, nodata, scale, offset):
+
+    # Encode values of scaled outputs
+    if (scale != 1) or (offset != 0):
+        has_data = (window_data != nodata) & np.isfinite(window_data)
+        window_data[has_data] = np.round((window_data[has_data] - offset) / scale)
+
+    nan_tile = np.nan if np.issubdtype(np.dtype(dtype), np.floating) else -np.inf
     window_data[(window_data == nan_tile) | (np.isnan(window_data))] = nodata
 
-    with lock:
-        rst.write_band(1, window_data.astype(dtype), window=final_window)
-    del window_data
+    return window_data.astype(dtype)
+
+
+def composite_window_data(win_idx,
+                          datasets,
+                          pool,
+                          path_points,
+                          bbox,
+                          transform,
+                          rst_dims,
+                          model_bits,
+                          rule='max',
+                          values='depths',
+                          held=None
+                          ):
+    """
+    Read and composite the data of rasters of several models in to the final window
+
+    Inputs are folded one at a time, in the order of datasets, by rule: 'max' keeps the
+    deepest value (the first input on ties), 'priority' keeps the first input with data
+    and 'mean' averages the inputs with data. Dry cells (0) are data. With values='extent',
+    inputs are read as 1 (positive, inundated) and 0 (dry), e.g. HydroID inundation rasters.
+
+    :param win_idx: int window index
+    :param datasets: list of int representing dataset idx in folding order
+    :param pool: DatasetPool of handles by dataset idx
+    :param path_points: list of bbox for windows
+    :param bbox: list of ul/br coords of windows
+    :param transform: Affine transform of final dataset
+    :param rst_dims: dimensions of overlapping rasters
+    :param model_bits: list of int source bit of the model of each dataset idx
+    :param rule: str 'max', 'priority' or 'mean'
+    :param values: str 'depths' or 'extent'
+    :param held: dict of handles by dataset idx held by the caller
+
+    :return: rasterio window object for final window, float32 ndarray of values (nan for no data),
+    uint8 ndarray of the bits of the models each value comes from
+    """
+
+    final_window = __window_bounds(win_idx, path_points, bbox, transform)
+    shape = (int(final_window.height), int(final_window.width))
+
+    window_data = np.full(shape, np.nan, dtype=np.float32)
+    window_source = np.zeros(shape, dtype=np.uint8)
+    if rule == 'mean':
+        window_count = np.zeros(shape, dtype=np.uint8)
+        window_data[:] = 0
+
+    for ds in datasets:
+        if (held is not None) and (ds in held):
+            rsts = { ds : held[ds] }
+        else:
+            rsts = pool.check_out([ds])
+        try:
+            window_bnds, data = __read_dataset_window(win_idx, rsts[ds], path_points, bbox)
+        finally:
+            if held is not None:
+                held.update(rsts)
+            else:
+                pool.check_in(rsts)
+
+        if values == 'extent':
+            data = np.where(np.isnan(data), np.nan, data > 0).astype(np.float32)
+
+        row_slice, col_slice, data = __window_slices(window_data, data, window_bnds, rst_dims[ds])
+        base = window_data[row_slice, col_slice]
+        source = window_source[row_slice, col_slice]
+        has_data = ~np.isnan(data)
+
+        if rule == 'max':
+            take = has_data & ~(base >= data)
+        elif rule == 'priority':
+            take = has_data & np.isnan(base)
+        else:
+            base[has_data] += data[has_data]
+            window_count[row_slice, col_slice][has_data] += 1
+            source[has_data] |= np.uint8(model_bits[ds])
+            continue
+
+        base[take] = data[take]
+        source[take] = model_bits[ds]
+        del data, take
+
+    if rule == 'mean':
+        with np.errstate(invalid='ignore', divide='ignore'):
+            window_data = np.where(window_count > 0, window_data / window_count, np.nan).astype(np.float32)
+
+    return final_window, window_data, window_source
+
+
+def read_window_data(win_idx,
+                     datasets,
+                     depth_rsts,
+                     path_points,
+                     bbox,
+                     transform):
+    """
+    Return data windows and final bounds of window
+
+    :param win_idx: int window index
+    :param datasets: list of int representing dataset inx
+    :param depth_rsts: list or dict of open datasets by dataset idx
+    :param path_points: list of bbox for windows
+    :param bbox: list of ul/br coords of windows
+    :param transform: Affine transform of final dataset
+
+    :return: rasterio window object for final window, rasterio window of data window bounds,
+    data for each raster in window,
+    """
+    bnds = []
+    data = []
+    for ds in datasets:
+        # Get rasterio window for each pair of window bounds and depth dataset
+        bnd, read_data = __read_dataset_window(win_idx, depth_rsts[ds], path_points, bbox)
+        bnds.append(bnd)
+        data.append(read_data)
+
+    final_bnds = __window_bounds(win_idx, path_points, bbox, transform)
+
+    return [final_bnds, bnds, data]
+
+
+def __window_bounds(win_idx, path_points, bbox, transform):
+
+    # Get window bounding box and final array output dimensions on the grid of transform
+    window = path_points[win_idx]
+    window_height, window_width = np.array([np.abs(bbox[win_idx][2] - bbox[win_idx][0]),
+                                            np.abs(bbox[win_idx][3] - bbox[win_idx][1])]).astype(int)
+
+    return from_bounds(window[0][1],
+                       window[-1][0],
+                       window[-1][1],
+                       window[0][0],
+                       transform=transform,
+                       height=window_height,
+                       width=window_width)
+
+
+def __read_dataset_window(win_idx, rst, path_points, bbox):
+
+    bnd = __window_bounds(win_idx, path_points, bbox, rst.transform)
+
+    # Read raster data with window, as floats holding every value (int32 HydroIDs need float64)
+    read_data = rst.read(1, window=bnd)
+    read_data = read_data.astype(np.promote_types(read_data.dtype, np.float32))
+    # Convert all no data to nan values
+    read_data[read_data == read_data.dtype.type(rst.nodata)] = np.nan
+    # Decode scaled rasters (e.g. compact int16 depths) to their values
+    scale, offset = rst.scales[0], rst.offsets[0]
+    if (scale != 1) or (offset != 0):
+        read_data = read_data * np.float32(scale) + np.float32(offset)
+
+    return bnd, read_data
+
+
+class RasterHeader:
+
+    def __init__(self, dataset):
+        """
+        Header of a raster, standing in for its dataset once closed
+
+        :param dataset: open rasterio dataset
+        """
+
+        self.name = dataset.name
+        self.bounds = dataset.bounds
+        self.transform = dataset.transform
+        self.height = dataset.height
+        self.width = dataset.width
+        self.crs = dataset.crs
+        self.dtypes = dataset.dtypes
+        self.nodata = dataset.nodata
+        self.scales = dataset.scales
+        self.offsets = dataset.offsets
+        self.__meta = dataset.meta
+
+    @property
+    def meta(self):
+        """ Copy of the metadata of the raster, as rasterio datasets return """
+        return self.__meta.copy()
+
+
+class DatasetPool:
+
+    def __init__(self, rst_paths, max_open_datasets=128):
+        """
+        Pool of open handles of rasters, least recently used closed first
+
+        GDAL datasets can not be read from several threads at once, so readers check out
+        handles for their exclusive use and return them once read. A handle is only opened
+        when all handles of its dataset are checked out, and the least recently returned
+        handles are closed beyond max_open_datasets idle ones. Handles are not pickled,
+        so a pool passed to another process starts empty there.
+
+        :param rst_paths: list of paths of rasters by dataset idx
+        :param max_open_datasets: int maximum number of idle handles kept open
+        """
+
+        self.rst_paths = rst_paths
+        self.max_open_datasets = max_open_datasets
+        self.lock = Lock()
+
+        # returned handles from least to most recently used
+        self.idle_rsts = OrderedDict()
+
+    def __getstate__(self):
+        # open datasets and locks stay in the process that made them
+        state = self.__dict__.copy()
+        del state['lock'], state['idle_rsts']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = Lock()
+        self.idle_rsts = OrderedDict()
+
+    def check_out(self, datasets):
+        """
+        Return dict of handles by dataset idx for the exclusive use of the caller
+
+        :param datasets: list of int representing dataset idx
+        """
+
+        rsts = {}
+        with self.lock:
+            for ds in datasets:
+                # most recently returned handle of the dataset
+                for key in reversed(self.idle_rsts):
+                    if self.idle_rsts[key][0] == ds:
+                        rsts[ds] = self.idle_rsts.pop(key)[1]
+                        break
+
+        for ds in datasets:
+            if ds not in rsts:
+                rsts[ds] = rasterio.open(self.rst_paths[ds])
+
+        return rsts
+
+    def check_in(self, rsts):
+        """
+        Return handles to the pool and close the least recently used beyond the limit
+
+        :param rsts: dict of handles by dataset idx
+        """
+
+        with self.lock:
+            for ds, rst in rsts.items():
+                self.idle_rsts[id(rst)] = (ds, rst)
+
+            while len(self.idle_rsts) > self.max_open_datasets:
+                self.idle_rsts.popitem(last=False)[1][1].close()
+
+    def close(self):
+        """ Close the idle handles """
+
+        with self.lock:
+            while self.idle_rsts:
+                self.idle_rsts.popitem(last=False)[1][1].close()
+
+
+class WindowMerger:
+
+    def __init__(self,
+                 pool,
+                 path_points,
+                 bbox,
+                 transform,
+                 merge_kwargs):
+        """
+        Read and aggregate windows of the final dataset in pool workers
+
+        Windows are reduced one input at a time (see reduce_window_data), so a worker holds
+        the data of one input at a time. Handles checked out of pool are held for the windows
+        of a call, so their block caches are reused by neighbouring windows.
+
+        :param pool: DatasetPool of the overlapping rasters by dataset idx
+        :param path_points: list of bbox for windows
+        :param bbox: list of ul/br coords of windows
+        :param transform: Affine transform of final dataset
+        :param merge_kwargs: dict of keyword arguments of aggregate_data
+        """
+
+        self.pool = pool
+        self.path_points = path_points
+        self.bbox = bbox
+        self.transform = transform
+        self.merge_kwargs = merge_kwargs
+
+    def __call__(self, windows):
+        """
+        Return final window bounds and aggregated data of each window
+
+        :param windows: list of tuples of int window index and list of int dataset idx
+        """
+
+        return list(self.merge(windows))
+
+    def merge(self, windows):
+        """
+        Yield final window bounds and aggregated data of each window
+
+        :param windows: list of tuples of int window index and list of int dataset idx
+        """
+
+        held = {}
+        try:
+            for win_idx, datasets in windows:
+                yield reduce_window_data(win_idx, datasets, self.pool, self.path_points, self.bbox,
+                                         self.transform, held=held, **self.merge_kwargs)
+        finally:
+            self.pool.check_in(held)
+
+
+# window merger of process pool workers
+process_window_merger = None
+
+
+def init_window_merger(window_merger):
+    global process_window_merger
+    process_window_merger = window_merger
+
+
+def merge_windows_in_process(windows):
+    return process_window_merger(windows)
+
+
+def ordered_map(executor, function, arguments, max_in_flight):
+    """
+    Yield results of function in the order of arguments with a bounded number of pending calls
+
+    :param executor: concurrent.futures executor
+    :param function: callable
+    :param arguments: iterable of argument tuples
+    :param max_in_flight: int maximum number of submitted calls whose result was not yielded
+    """
+
+    pending = deque()
+
+    for args in arguments:
+        pending.append(executor.submit(function, *args))
+
+        if len(pending) >= max_in_flight:
+            yield pending.popleft().result()
+
+    while pending:
+        yield pending.popleft().result()
+
+
+# block size of cloud optimized GeoTIFF outputs
+COG_BLOCKSIZE = 512
+
+
+def cog_overview_factors(width, height, blocksize=COG_BLOCKSIZE):
+    """
+    Overview decimation factors of a cloud optimized GeoTIFF
+
+    Halves the raster until its coarsest overview fits in one block.
+
+    :param width: int width of the raster
+    :param height: int height of the raster
+    :param blocksize: int block width and height
+
+    :return: list of int factors, empty if the raster fits in one block
+    """
+
+    factors = []
+    factor = 2
+    while max(width, height) / (factor // 2) > blocksize:
+        factors.append(factor)
+        factor *= 2
+
+    return factors
+
+
+@contextmanager
+def cog_writer(out_fname, overview_resampling='nearest', blocksize=COG_BLOCKSIZE, **profile):
+    """
+    Open a raster writer whose output is a cloud optimized GeoTIFF (COG)
+
+    The yielded dataset is a tiled GeoTIFF beside out_fname. Once it is written, overviews are
+    built from it before it is closed and it is copied into out_fname with its overviews
+    ahead of the full resolution tiles, the layout of a COG, so readers at any zoom level only
+    fetch the blocks they need.
+
+    :param out_fname: str path of the COG
+    :param overview_resampling: str rasterio resampling method of the overviews
+    :param blocksize: int block width and height
+    :param profile: rasterio creation profile of the raster
+    """
+
+    profile.update(driver='GTiff', tiled=True, blockxsize=blocksize, blockysize=blocksize)
+    creation_options = { k : profile[k] for k in ('compress', 'predictor', 'zlevel', 'bigtiff') if k in profile }
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(out_fname)), suffix='.tif') as temp_file:
+
+        with rasterio.open(temp_file.name, 'w', **profile) as dst:
+            yield dst
+
+            factors = cog_overview_factors(dst.width, dst.height, blocksize)
+            if factors:
+                dst.build_overviews(factors, Resampling[overview_resampling])
+                dst.update_tags(ns='rio_overview', resampling=overview_resampling)
+
+        rasterio.shutil.copy(temp_file.name, out_fname, driver='GTiff', copy_src_overviews=True,
+                             tiled=True, blockxsize=blocksize, blockysize=blocksize, **creation_options)
+
+
+def compact_raster(raster, **creation_options):
+    """
+    Rewrite a GeoTIFF without the space of blocks rewritten in place
+
+    GDAL appends compressed blocks rewritten in update mode to the end of the file, so
+    rasters patched on every run keep growing. The raster is copied to a temporary file
+    beside it, which is then moved over it.
+
+    :param raster: str path of the GeoTIFF
+    :param creation_options: GeoTIFF creation options of the copy, such as its compression
+    """
+
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(raster)), suffix='.tif',
+                                     delete=False) as temp_file:
+        pass
+
+    try:
+        rasterio.shutil.copy(raster, temp_file.name, driver='GTiff', **creation_options)
+        os.replace(temp_file.name, raster)
+    finally:
+        if os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+
+
+class MosaicGrid(WindowMethodsMixin, TransformMethodsMixin):
+
+    """ Transform and shape of a mosaic, standing in for its dataset in rasterio window functions """
+
+    def __init__(self, transform, width, height):
+
+        self.transform = transform
+        self.width = width
+        self.height = height
+        self.shape = (height, width)
+
+
+class MosaicMask:
+
+    """
+    Polygon mask rasterized onto the grid of a mosaic
+
+    window is the part of the mosaic grid covered by the bounds of the polygons and inside the
+    cells of it within the polygons, as rasterio.mask.mask with crop=True uses, so applying it
+    to the windows of a merge gives the raster mask_mosaic writes.
+
+    Masks of polygon files are cached by the path, size and modification time of the file, the
+    layer and the grid, in memory for the process up to max_memory_cache_bytes of masks and,
+    if mask_cache is passed, on disk as packed bits, so the masks of a HUC are reused across
+    magnitudes and forecasts.
+    """
+
+    # masks rasterized by this process, least recently used first
+    memory_cache = OrderedDict()
+    max_memory_cache_bytes = 256 * 2**20
+
+    def __init__(self, inside, window, transform):
+
+        self.inside = inside
+        self.window = window
+        self.transform = transform
+
+    @classmethod
+    def rasterize(cls, polys, transform, width, height, polys_layer=None, mask_cache=None):
+
+        """ Rasterizes polygons, a file path or GeoDataFrame, onto a grid or returns the cached mask """
+
+        key = cls.cache_key(polys, transform, width, height, polys_layer)
+        if key is not None:
+
+            if key in cls.memory_cache:
+                cls.memory_cache.move_to_end(key)
+                return(cls.memory_cache[key])
+
+            mosaic_mask = cls.__read_cache(mask_cache, key) if mask_cache is not None else None
+            if mosaic_mask is not None:
+                return(cls.__remember(key, mosaic_mask))
+
+            polys = gpd.read_file(polys, layer=polys_layer)
+
+        elif not isinstance(polys, gpd.GeoDataFrame):
+            raise TypeError("Pass geopandas dataset or filepath for catchment polygons")
+
+        # same crop and cells as rasterio.mask.mask
+        outside, window_transform, window = raster_geometry_mask(MosaicGrid(transform, width, height),
+                                                                 polys['geometry'], crop=True)
+        window = Window(int(round(window.col_off)), int(round(window.row_off)),
+                        outside.shape[1], outside.shape[0])
+        mosaic_mask = cls(~outside, window, window_transform)
+
+        if key is None:
+            return(mosaic_mask)
+
+        if mask_cache is not None:
+            cls.__write_cache(mask_cache, key, mosaic_mask)
+
+        return(cls.__remember(key, mosaic_mask))
+
+    @staticmethod
+    def cache_key(polys, transform, width, height, polys_layer=None):
+
+        """ Key of the mask of a polygon file on a grid, None for GeoDataFrames """
+
+        if not isinstance(polys, str):
+            return(None)
+
+        stat = os.stat(polys)
+        return(hashlib.sha1(repr((os.path.abspath(polys), stat.st_size, stat.st_mtime_ns, polys_layer,
+                                  tuple(transform)[:6], width, height)).encode()).hexdigest())
+
+    def apply(self, window_data, final_window, nodata):
+
+        """
+        Crops a window of the mosaic grid to the mask and sets cells outside the polygons to nodata
+
+        :return: rasterio window in the masked output and the masked data, None if outside the mask
+        """
+
+        row_off = int(round(final_window.row_off)) - self.window.row_off
+        col_off = int(round(final_window.col_off)) - self.window.col_off
+
+        rows = slice(max(row_off, 0), min(row_off + window_data.shape[0], self.window.height))
+        cols = slice(max(col_off, 0), min(col_off + window_data.shape[1], self.window.width))
+
+        if (rows.start >= rows.stop) or (cols.start >= cols.stop):
+            return(None)
+
+        window_data = window_data[rows.start - row_off:rows.stop - row_off, cols.start - col_off:cols.stop - col_off]
+        window_data[~self.inside[rows, cols]] = nodata
+
+        return(Window(cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start), window_data)
+
+    @classmethod
+    def __remember(cls, key, mosaic_mask):
+
+        # a mask larger than the cache is not kept
+        if mosaic_mask.inside.nbytes > cls.max_memory_cache_bytes:
+            return(mosaic_mask)
+
+        cls.memory_cache[key] = mosaic_mask
+        while sum(m.inside.nbytes for m in cls.memory_cache.values()) > cls.max_memory_cache_bytes:
+            cls.memory_cache.popitem(last=False)
+
+        return(mosaic_mask)
+
+    @classmethod
+    def __read_cache(cls, mask_cache, key):
+
+        try:
+            with np.load(os.path.join(mask_cache, 'mask_{}.npz'.format(key))) as cached:
+                height, width = cached['shape']
+                inside = np.unpackbits(cached['inside'], count=height * width).reshape(height, width).astype(bool)
+                window = Window(*[int(v) for v in cached['window']])
+                window_transform = Affine(*cached['transform'])
+        except (OSError, KeyError, ValueError):
+            return(None)
+
+        return(cls(inside, window, window_transform))
+
+    @staticmethod
+    def __write_cache(mask_cache, key, mosaic_mask):
+
+        os.makedirs(mask_cache, exist_ok=True)
+
+        # written to a temporary file first so readers never see a partial mask
+        with tempfile.NamedTemporaryFile(dir=mask_cache, suffix='.npz', delete=False) as temp_file:
+            np.savez(temp_file,
+                     inside=np.packbits(mosaic_mask.inside.ravel()),
+                     shape=np.array(mosaic_mask.inside.shape),
+                     window=np.array([mosaic_mask.window.col_off, mosaic_mask.window.row_off,
+                                      mosaic_mask.window.width, mosaic_mask.window.height]),
+                     transform=np.array(tuple(mosaic_mask.transform)[:6]))
+        os.replace(temp_file.name, os.path.join(mask_cache, 'mask_{}.npz'.format(key)))
+
+
+# stored beside mosaics merged with a manifest
+MANIFEST_SUFFIX = '.manifest.json'
+
+
+class MosaicManifest:
+
+    """
+    Inputs of the windows of a mosaic, to merge again only the windows whose inputs changed
+
+    grid describes the grid, encoding and windows of the mosaic, inputs the size,
+    modification time and sha1 content hash of each input file by path, and windows the
+    input paths of each output window. Hashes of inputs whose size and modification time
+    did not change are taken from the previous manifest, so only new or rewritten inputs are
+    read. A rewritten input with the same content leaves its windows unchanged.
+    """
+
+    # 2: windows of the last row cover the whole remainder of the grid
+    version = 2
+
+    def __init__(self, grid, inputs, windows):
+
+        # as stored, so manifests compare equal after a round trip
+        self.grid = json.loads(json.dumps(grid))
+        self.inputs = inputs
+        self.windows = { str(k) : list(v) for k, v in windows.items() }
+
+    @classmethod
+    def read(cls, manifest_file):
+
+        """ Loads a manifest, None if it is missing, unreadable or of another version """
+
+        try:
+            with open(manifest_file) as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return(None)
+
+        if manifest.get('version') != cls.version:
+            return(None)
+
+        return(cls(manifest['grid'], manifest['inputs'], manifest['windows']))
+
+    def write(self, manifest_file):
+
+        """ Stores the manifest, through a temporary file so readers never see a partial manifest """
+
+        with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(manifest_file)),
+                                         suffix='.json', delete=False) as temp_file:
+            json.dump({ 'version' : self.version, 'grid' : self.grid,
+                        'inputs' : self.inputs, 'windows' : self.windows }, temp_file)
+        os.replace(temp_file.name, manifest_file)
+
+    @classmethod
+    def hash_inputs(cls, paths, previous=None):
+
+        """ Size, modification time and sha1 of files by path, reusing the hashes of previous for unchanged files """
+
+        inputs = {}
+        for path in paths:
+            stat = os.stat(path)
+            record = previous.inputs.get(path) if previous is not None else None
+
+            if (record is None) or (record['size'] != stat.st_size) or (record['mtime_ns'] != stat.st_mtime_ns):
+                record = { 'size' : stat.st_size, 'mtime_ns' : stat.st_mtime_ns, 'sha1' : cls.__file_sha1(path) }
+
+            inputs[path] = record
+
+        return(inputs)
+
+    def changed_windows(self, previous):
+
+        """
+        Windows whose inputs or their contents differ from those of a previous manifest
+
+        :return: set of str window keys, including windows that no longer have inputs, or None if
+        previous is None or of another grid and the whole mosaic has to be merged
+        """
+
+        if (previous is None) or (previous.grid != self.grid):
+            return(None)
+
+        def __contents(manifest, key):
+            return(sorted( (path, manifest.inputs[path]['sha1']) for path in manifest.windows.get(key, []) ))
+
+        return({ key for key in set(self.windows) | set(previous.windows)
+                 if __contents(self, key) != __contents(previous, key) })
+
+    @staticmethod
+    def __file_sha1(path, chunk_size=1 << 20):
+
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                sha1.update(chunk)
+
+        return(sha1.hexdigest())
 
 
 if __name__ == '__main__':
@@ -8,13 +8,16 @@ import shutil
 import sys
 
 from multiprocessing import Pool
+from rasterio.errors import WindowError
 from rasterio.merge import merge
+from rasterio.windows import Window
 from osgeo import gdal, ogr
 
 sys.path.append('/foss_fim/src')
 from datetime import datetime
 from gms_tools.mosaic_inundation import Mosaic_inundation
 from gms_tools.inundate_gms import Inundate_gms
+from gms_tools.overlapping_inundation import cog_writer, compact_raster, MosaicManifest, MANIFEST_SUFFIX
 from inundation import inundate
 from utils.shared_variables import elev_raster_ndv, PREP_PROJECTION
 from utils.shared_functions import FIM_Helpers as fh
@@ -27,7 +30,19 @@ from utils.shared_functions import FIM_Helpers as fh
 #DEFAULT_OUTPUT_DIR = '/data/inundation_review/inundate_nation/mosaic_output/'
 
 
-def inundate_nation(fim_run_dir, output_dir, magnitude_key, flow_file, inc_mosaic, job_number):
+def inundate_nation(fim_run_dir, output_dir, magnitude_key, flow_file, inc_mosaic, job_number,
+                    cog = False, vrt_only = False, incremental = False):
+
+    # Notes:
+    #    - With cog, the boolean HUC rasters and the national mosaic are cloud optimized
+    #      GeoTIFFs with internal overviews.
+    #    - With vrt_only, the boolean HUC rasters are kept as COGs and only a VRT index over
+    #      them is written instead of the national mosaic. Viewers read the overviews of the
+    #      HUC COGs through the VRT.
+    #    - With incremental, the HUC mosaics, boolean HUC rasters and national mosaic are
+    #      kept with manifests of their inputs. A re-run only merges the windows of HUC
+    #      mosaics whose branch rasters changed, only remakes the boolean rasters of changed
+    #      HUCs, and patches their areas into the national mosaic unless it is a COG.
 
     
     assert os.path.isdir(fim_run_dir), f'ERROR: could not find the input fim_dir location: {fim_run_dir}'
@@ -52,6 +67,12 @@ def inundate_nation(fim_run_dir, output_dir, magnitude_key, flow_file, inc_mosai
     logging.info(f'magnitude_key: {magnitude_key}')
     logging.info(f'flow_file: {flow_file}')
     logging.info(f'inc_mosaic: {str(inc_mosaic)}')
+    logging.info(f'cog: {str(cog)}')
+    logging.info(f'vrt_only: {str(vrt_only)}')
+    logging.info(f'incremental: {str(incremental)}')
+
+    # the VRT index is built from the boolean HUC rasters of the mosaic step
+    inc_mosaic = inc_mosaic or vrt_only
 
     print("Preparing to generate inundation outputs for magnitude: " + magnitude_key)
     print("Input flow file: " + flow_file)
@@ -61,6 +82,9 @@ def inundate_nation(fim_run_dir, output_dir, magnitude_key, flow_file, inc_mosai
     if not os.path.exists(magnitude_output_dir):
         print('Creating new output directory for raw mosaic files: ' + magnitude_output_dir)
         os.mkdir(magnitude_output_dir)
+    elif incremental:
+        # keep the HUC mosaics and their manifests
+        pass
     else:
         # we need to empty it. we will kill it and remake it (using rmtree to force it)
         shutil.rmtree(magnitude_output_dir, ignore_errors=True)
@@ -77,7 +101,8 @@ def inundate_nation(fim_run_dir, output_dir, magnitude_key, flow_file, inc_mosai
     
     config = "GMS"
     
-    run_inundation([fim_run_dir, huc_list, magnitude_key, magnitude_output_dir, config, flow_file, job_number])
+    run_inundation([fim_run_dir, huc_list, magnitude_key, magnitude_output_dir, config, flow_file, job_number,
+                    incremental])
                 
     # Perform mosaic operation
     if inc_mosaic:
@@ -86,37 +111,78 @@ def inundate_nation(fim_run_dir, output_dir, magnitude_key, flow_file, inc_mosai
         print("Performing bool mosaic process...")
         logging.info("Performing bool mosaic process...")
         
-        output_bool_dir = os.path.join(output_dir, "bool_temp")
+        # the HUC COGs stay beside the VRT index, and the HUC rasters for incremental re-runs
+        if vrt_only:
+            output_bool_dir = os.path.join(output_dir, output_base_file_name + "_huc_cogs")
+        elif incremental:
+            output_bool_dir = os.path.join(output_dir, output_base_file_name + "_huc_rasters")
+        else:
+            output_bool_dir = os.path.join(output_dir, "bool_temp")
         if not os.path.exists(output_bool_dir):
             os.mkdir(output_bool_dir)
-        else:
+        elif not incremental:
             # we need to empty it. we will kill it and remake it (using rmtree to force it)
             shutil.rmtree(output_bool_dir, ignore_errors=True)
             os.mkdir(output_bool_dir)
 
-        procs_list = []
+        extent_rasters = {}
         for rasfile in os.listdir(magnitude_output_dir):
             if rasfile.endswith('.tif') and "extent" in rasfile:
+                extent_rasters[rasfile] = os.path.join(magnitude_output_dir, rasfile)
+
+        # boolean rasters of HUCs whose extent changed since the last run, all without a manifest
+        bool_manifest_file = os.path.join(output_bool_dir, output_base_file_name + MANIFEST_SUFFIX)
+        previous_manifest = MosaicManifest.read(bool_manifest_file) if incremental else None
+        bool_manifest = MosaicManifest( { 'cog' : cog or vrt_only },
+                                        MosaicManifest.hash_inputs(extent_rasters.values(), previous_manifest),
+                                        { rasfile : [path] for rasfile, path in extent_rasters.items() } )
+        changed_rasfiles = bool_manifest.changed_windows(previous_manifest)
+
+        # areas to patch into the national mosaic, before and after the change
+        changed_bounds = None
+        if changed_rasfiles is not None:
+            changed_bounds = []
+            for rasfile in changed_rasfiles:
+                bool_raster = os.path.join(output_bool_dir, "bool_" + rasfile)
+                if os.path.exists(bool_raster):
+                    with rasterio.open(bool_raster) as bool_dataset:
+                        changed_bounds.append(tuple(bool_dataset.bounds))
+                    os.remove(bool_raster)
+                if rasfile in extent_rasters:
+                    with rasterio.open(extent_rasters[rasfile]) as extent_dataset:
+                        changed_bounds.append(tuple(extent_dataset.bounds))
+
+            print(f"{len(changed_rasfiles)} of {len(extent_rasters)} HUC extent rasters changed")
+            logging.info(f"{len(changed_rasfiles)} of {len(extent_rasters)} HUC extent rasters changed")
+
+        procs_list = []
+        for rasfile in extent_rasters:
+            if (changed_rasfiles is None) or (rasfile in changed_rasfiles):
                 #p = magnitude_output_dir + rasfile
-                procs_list.append([magnitude_output_dir, rasfile, output_bool_dir])
+                procs_list.append([magnitude_output_dir, rasfile, output_bool_dir, cog or vrt_only])
 
         # Multiprocess --> create boolean inundation rasters for all hucs
         if len(procs_list) > 0:
             with Pool(processes=job_number) as pool:
                 pool.map(create_bool_rasters, procs_list)
-        else:
+        elif len(extent_rasters) == 0:
             msg = f'Did not find any valid FIM extent rasters: {magnitude_output_dir}'
             print(msg)
             logging.info(msg)
 
         # Perform VRT creation and final mosaic using boolean rasters
-        vrt_raster_mosaic(output_bool_dir, output_dir, output_base_file_name)
+        vrt_raster_mosaic(output_bool_dir, output_dir, output_base_file_name, cog, vrt_only, changed_bounds)
+
+        if incremental:
+            bool_manifest.write(bool_manifest_file)
         
         # now cleanup the raw mosiac directories
-        shutil.rmtree(output_bool_dir, ignore_errors=True)
+        if not (vrt_only or incremental):
+            shutil.rmtree(output_bool_dir, ignore_errors=True)
 
     # now cleanup the raw mosiac directories
-    shutil.rmtree(magnitude_output_dir, ignore_errors=True)
+    if not incremental:
+        shutil.rmtree(magnitude_output_dir, ignore_errors=True)
         
     fh.print_current_date_time()
     logging.info(logging.info(datetime.now().strftime("%Y_%m_%d-%H_%M_%S")))
@@ -129,7 +195,7 @@ def run_inundation(args):
     This script is a wrapper for the inundate function and is designed for multiprocessing.
     
     Args:
-        args (list): [fim_run_dir (str), huc_list (list), magnitude (str), magnitude_output_dir (str), config (str), forecast (str), job_number (int)]
+        args (list): [fim_run_dir (str), huc_list (list), magnitude (str), magnitude_output_dir (str), config (str), forecast (str), job_number (int), incremental (bool, optional)]
     
     """
     
@@ -140,6 +206,7 @@ def run_inundation(args):
     config = args[4]
     forecast = args[5]
     job_number = args[6]
+    incremental = args[7] if len(args) > 7 else False
    
     # Define file paths for use in inundate().
 
@@ -169,12 +236,14 @@ def run_inundation(args):
                                     remove_inputs = True,
                                     subset = None,
                                     verbose = True,
-                                    is_mosaic_for_gms_branches = True )
+                                    is_mosaic_for_gms_branches = True,
+                                    incremental = incremental )
 
 def create_bool_rasters(args):
     in_raster_dir = args[0]
     rasfile = args[1]
     output_bool_dir = args[2]
+    cog = args[3] if len(args) > 3 else False
 
     print("Calculating boolean inundate raster: " + rasfile)
     p = in_raster_dir + os.sep + rasfile
@@ -196,15 +265,26 @@ def create_bool_rasters(args):
                 dtype='int8',
                 crs=PREP_PROJECTION,
                 compress='lzw')
-    with rasterio.open(output_bool_dir + os.sep + "bool_" + rasfile, 'w', **profile) as dst:
+    output_bool_raster = output_bool_dir + os.sep + "bool_" + rasfile
+
+    # averaging skips the nodata (dry) cells, so overview cells are wet if any cell is
+    if cog:
+        writer = cog_writer(output_bool_raster, overview_resampling='average', **profile)
+    else:
+        writer = rasterio.open(output_bool_raster, 'w', **profile)
+
+    with writer as dst:
         dst.write(array.astype(rasterio.int8))
 
 
-def vrt_raster_mosaic(output_bool_dir, output_dir, fim_version_tag):
+def vrt_raster_mosaic(output_bool_dir, output_dir, fim_version_tag, cog = False, vrt_only = False,
+                      changed_bounds = None):
     
   
     # NOTE: Oct 2022.. we no longer need the VRT, only the large mosaic'd raster. 
     # this code is about to be deprecated, so we will leave it as is.
+    # With vrt_only, the VRT index over the HUC COGs is the output and the mosaic is skipped.
+    # With changed_bounds, only those areas are written into an existing mosaic on the grid of the VRT.
     
     rasters_to_mosaic = []
     for rasfile in os.listdir(output_bool_dir):
@@ -214,19 +294,69 @@ def vrt_raster_mosaic(output_bool_dir, output_dir, fim_version_tag):
             rasters_to_mosaic.append(p)
 
     logging.info(fh.print_current_date_time())
-    output_mosiac_vrt = os.path.join(output_bool_dir, fim_version_tag + "_merged.vrt")
+    if vrt_only:
+        output_mosiac_vrt = os.path.join(output_dir, fim_version_tag + "_mosaic.vrt")
+    else:
+        output_mosiac_vrt = os.path.join(output_bool_dir, fim_version_tag + "_merged.vrt")
     print("Creating virtual raster: " + output_mosiac_vrt)
     logging.info("Creating virtual raster: " + output_mosiac_vrt)
     vrt = gdal.BuildVRT(output_mosiac_vrt, rasters_to_mosaic)
+
+    if vrt_only:
+        vrt = None
+        return output_mosiac_vrt
     
     output_mosiac_raster = os.path.join(output_dir, fim_version_tag + "_mosaic.tif")    
+    if (changed_bounds is not None) and (not cog) and os.path.exists(output_mosiac_raster):
+        vrt = None
+        if __patch_raster_mosaic(output_mosiac_vrt, output_mosiac_raster, changed_bounds):
+            return output_mosiac_raster
+        vrt = gdal.Open(output_mosiac_vrt)
+
     print("Building raster mosaic: " + output_mosiac_raster)
     logging.info("Building raster mosaic: " + output_mosiac_raster)
     print("This can take a number of hours, watch 'docker stats' cpu value to ensure the process"\
         "to ensure the process is still working")
-    gdal.Translate(output_mosiac_raster, vrt, xRes = 10, yRes = -10, creationOptions = ['COMPRESS=LZW','TILED=YES','PREDICTOR=2'])
+    if cog:
+        # the COG driver builds the overviews while writing the mosaic
+        gdal.Translate(output_mosiac_raster, vrt, xRes = 10, yRes = -10, format = 'COG',
+                       creationOptions = ['COMPRESS=LZW','PREDICTOR=YES','BLOCKSIZE=512',
+                                          'OVERVIEW_RESAMPLING=AVERAGE','BIGTIFF=IF_SAFER'])
+    else:
+        gdal.Translate(output_mosiac_raster, vrt, xRes = 10, yRes = -10, creationOptions = ['COMPRESS=LZW','TILED=YES','PREDICTOR=2'])
     vrt = None        
 
+    return output_mosiac_raster
+
+
+def __patch_raster_mosaic(mosaic_vrt, mosaic_raster, changed_bounds):
+
+    # Rewrites the areas of changed HUCs of a mosaic from the VRT.
+    # Returns False when the mosaic is not on the grid of the VRT.
+    # The patched mosaic is then rewritten, as patched blocks are appended to the file.
+
+    with rasterio.open(mosaic_vrt) as vrt, rasterio.open(mosaic_raster, 'r+') as mosaic:
+
+        if (vrt.transform != mosaic.transform) or (vrt.shape != mosaic.shape):
+            return False
+
+        print(f"Patching {len(changed_bounds)} areas of raster mosaic: {mosaic_raster}")
+        logging.info(f"Patching {len(changed_bounds)} areas of raster mosaic: {mosaic_raster}")
+
+        full_window = Window(0, 0, mosaic.width, mosaic.height)
+        for bounds in changed_bounds:
+            window = mosaic.window(*bounds).round_offsets().round_lengths()
+            try:
+                window = window.intersection(full_window)
+            except WindowError:
+                continue
+            mosaic.write(vrt.read(1, window=window), 1, window=window)
+
+    # same creation options as the full mosaic
+    compact_raster(mosaic_raster, tiled=True, compress='lzw', predictor=2)
+
+    return True
+
 
 def __setup_logger(output_folder_path, log_file_name_key):
 
@@ -281,6 +411,17 @@ if __name__ == '__main__':
                         action='store_true')
                         
     parser.add_argument('-j', '--job-number', help='The number of jobs', required=False, default=1, type=int)
+
+    parser.add_argument('-c', '--cog', help='Optional flag to write the boolean HUC rasters and '\
+        'the mosaic as cloud optimized GeoTIFFs with internal overviews', action='store_true')
+
+    parser.add_argument('-i', '--incremental', help='Optional flag to keep the HUC mosaics, boolean '\
+        'HUC rasters and mosaic with manifests of their inputs and on re-runs only remake the parts '\
+        'whose inputs changed', action='store_true')
+
+    parser.add_argument('-x', '--vrt-only', help='Optional flag to keep the boolean HUC rasters as '\
+        'cloud optimized GeoTIFFs and write only a VRT index over them instead of the mosaic. '\
+        'Implies -s', action='store_true')
         
     args = vars(parser.parse_args())
 
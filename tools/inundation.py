@@ -3,15 +3,29 @@
 import numpy as np
 import pandas as pd
 from numba import njit, typed, types
-from concurrent.futures import ThreadPoolExecutor,as_completed
+from concurrent.futures import ThreadPoolExecutor,ProcessPoolExecutor,as_completed
+from multiprocessing import shared_memory, resource_tracker
 from subprocess import run
+import os
+import time
+import hashlib
+import resource
+import threading
+import tempfile
+import zipfile
 from os.path import splitext
 import rasterio
 import fiona
-from shapely.geometry import shape
+from shapely.geometry import shape, mapping
+from shapely.ops import unary_union
+from itertools import islice
 from rasterio.mask import mask
+from rasterio.features import shapes, geometry_mask, geometry_window
+from rasterio.windows import Window
+from rasterio.errors import WindowError
 from rasterio.io import DatasetReader,DatasetWriter
-from collections import OrderedDict
+from collections import OrderedDict, defaultdict
+from contextlib import contextmanager, nullcontext
 import argparse
 from warnings import warn
 from gdal import BuildVRT
@@ -28,6 +42,22 @@ class NoForecastFound(Exception):
     """ Raised when no forecast is available for a given Hydro-Table """
     pass
 
+# bump when the layout of the hydro-table cache changes
+HYDROTABLE_CACHE_VERSION = 1
+
+# number of inundation polygons passed to fiona per write
+POLYGON_WRITE_BATCH_SIZE = 10000
+
+# compact raster encoding. Depths in centimeters, inundation as 1 (inundated) and 0 (dry).
+COMPACT_DEPTHS_PROFILE = { 'dtype' : 'int16', 'nodata' : -32768 }
+COMPACT_DEPTHS_SCALE = 0.01
+COMPACT_INUNDATION_PROFILE = { 'dtype' : 'int8', 'nodata' : -128 }
+
+# GeoTIFF compression profiles. A predictor suited to each output data type is added to deflate and zstd.
+RASTER_COMPRESSION_PROFILES = { 'lzw' : { 'compress' : 'lzw' },
+                                'deflate' : { 'compress' : 'deflate', 'zlevel' : 6 },
+                                'zstd' : { 'compress' : 'zstd', 'zstd_level' : 9 } }
+
 class hydroTableHasOnlyLakes(Exception): 
     """ Raised when a Hydro-Table only has lakes """
     pass
@@ -37,12 +67,84 @@ class NoForecastFound(Exception):
     """ Raised when no forecast is available for a given Hydro-Table """
     pass
 
+
+class InundationProfiler:
+
+    """
+    Records the wall time, bytes read and written, and peak memory of the stages of inundate()
+
+    Stages are 'hydrotable' (reading the hydro-table and forecast), 'interpolation' (stages
+    from discharges and the stage lookups), 'masking' (reading and masking the REM and
+    catchments), 'mapping' (the numba mapping), 'raster_write' (encoding, writing and closing
+    the rasters) and 'polygonize'. Repeated stages of a HUC, such as the blocks of streaming
+    mode, are summed into one record. Bytes are the characters read and written through
+    system calls by the thread running the stage (/proc/thread-self/io, zero where it is not
+    available) so they include GDAL and OGR I/O. Peak RSS is the high water mark of the
+    process resident memory at the end of the stage.
+    """
+
+    columns = ['huc','stage','calls','seconds','bytes_read','bytes_written','peak_rss_mb']
+
+    def __init__(self):
+        self.records = OrderedDict()
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def stage(self,stage,hucCode=None):
+
+        start_io = self.thread_io() ; start_time = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start_time
+            end_io = self.thread_io()
+            peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+            self.add({ 'huc' : hucCode, 'stage' : stage, 'calls' : 1, 'seconds' : seconds,
+                       'bytes_read' : end_io[0] - start_io[0], 'bytes_written' : end_io[1] - start_io[1],
+                       'peak_rss_mb' : peak_rss_mb })
+
+    def add(self,record):
+
+        """ Adds a record, summing it into the record of the same HUC and stage """
+
+        key = (record['huc'],record['stage'])
+
+        with self.lock:
+            if key not in self.records:
+                self.records[key] = dict(record)
+                return
+
+            total = self.records[key]
+            for column in ('calls','seconds','bytes_read','bytes_written'):
+                total[column] += record[column]
+            total['peak_rss_mb'] = max(total['peak_rss_mb'],record['peak_rss_mb'])
+
+    def to_dataframe(self):
+        return(pd.DataFrame(list(self.records.values()),columns=self.columns))
+
+    @staticmethod
+    def thread_io():
+
+        try:
+            with open('/proc/thread-self/io') as io:
+                counters = dict(line.split(':') for line in io)
+        except OSError:
+            return(0,0)
+
+        return(int(counters['rchar']),int(counters['wchar']))
+
+
 def inundate(rem, catchments, catchment_poly, hydro_table, forecast,
              mask_type, hucs = None, hucs_layerName = None,
              subset_hucs = None, num_workers = 1, aggregate = False, 
              inundation_raster = None, inundation_polygon = None,
              depths = None, out_raster_profile = None, out_vector_profile = None,
-             src_table = None, quiet = False):
+             src_table = None, quiet = False, lookup_mode = 'dict', streaming = False,
+             parallel_backend = 'thread', hydro_table_cache = False, window_cache = None,
+             polygon_mode = 'features', simplify_tolerance = None,
+             raster_encoding = 'native', raster_compression = 'lzw', instrument = False):
     """
 
     Run inundation on FIM >=3.0 outputs at job-level scale or aggregated scale
@@ -81,11 +183,33 @@ def inundate(rem, catchments, catchment_poly, hydro_table, forecast,
         Override the default kwargs passed to fiona.Collection including crs, driver, and schema.
     quiet : bool, optional
         Quiet output.
+    lookup_mode : str, optional
+        Catchment stage lookup engine used when mapping. 'dict' (default) tests each pixel against the numba typed dictionary. 'array' compiles the hydro-table stages once into a dense HydroID indexed array (or a sorted array searched with np.searchsorted for sparse HydroIDs) and maps with array indexing. Both engines produce identical outputs.
+    streaming : bool, optional
+        Map the REM block by block and write each block straight to the output rasters so peak memory scales with the REM block size rather than the HUC size. Output rasters are identical to the default mode. Inundation polygons are split along block edges.
+    parallel_backend : str, optional
+        Batch mode only. 'thread' (default) runs HUCs on a thread pool. 'process' runs HUCs on a process pool where each worker opens the REM and catchments itself and maps them block by block (as in streaming) with the compiled stage lookup arrays shared through multiprocessing.shared_memory. Only output paths are returned from the workers so outputs must be file paths.
+    hydro_table_cache : bool or str, optional
+        Read hydro-table csv files through a binary cache of the non-lake rating curves (see read_hydroTable). True writes the cache next to the csv, a directory path writes it there, for read-only or shared hydrofabrics. The cache is rebuilt when the csv changes. False (default) always parses the csv.
+    window_cache : str, optional
+        Batch mode with mask_type 'filter' only. Directory of cached masked REM and catchments windows by HUC. On first use the windows are written as .npy files keyed by the HUC, a hash of the paths of the rem, catchments and catchment_poly files and a hash of their sizes and modification times. Later runs on the same inputs memory map them and skip reading the catchment polygons and masking. Writing the window of a HUC removes its entries of earlier versions of the same input files. Not used in streaming mode or with the process backend, which mask block by block.
+    polygon_mode : str, optional
+        Layout of inundation_polygon. 'features' (default) writes a polygon for each connected inundated area of each HydroID. 'dissolved' writes one MultiPolygon per HydroID, which is much faster to write and read for large floods and is not split along block edges in streaming mode. 'extent' writes a single MultiPolygon of the inundated extent without HydroIDs.
+    simplify_tolerance : float, optional
+        Simplify inundation polygons with this tolerance in units of the CRS, preserving topology.
+    raster_encoding : str, optional
+        'native' (default) writes depths in the REM data type and inundation as positive (inundated) and negative (dry) HydroIDs in the catchments data type. 'compact' writes depths as int16 centimeters with a 0.01 scale in the raster metadata and inundation as int8 1 (inundated) and 0 (dry). Depths deeper than 327.67 m are clipped.
+    raster_compression : str, optional
+        GeoTIFF compression of the output rasters. 'lzw' (default), 'deflate' or 'zstd'. Deflate and zstd use a horizontal predictor for integer outputs and a floating point predictor for float outputs.
+    instrument : bool, optional
+        Record the wall time, bytes read and written, and peak memory of each stage per HUC (see InundationProfiler) and return them as a fourth output.
 
     Returns
     -------
     error_code : int
         Zero for successful completion.
+    stage_records : pandas.DataFrame
+        Only if instrument is True. One row per HUC and stage with the columns of InundationProfiler. The hydro-table stages have no HUC.
 
     Raises
     ------
@@ -122,6 +246,350 @@ def inundate(rem, catchments, catchment_poly, hydro_table, forecast,
     # bool quiet
     quiet = bool(quiet)
 
+    # check lookup mode
+    if lookup_mode not in ('dict','array'):
+        raise ValueError("Pass 'dict' or 'array' for lookup_mode")
+
+    # check raster encoding and compression
+    if raster_encoding not in ('native','compact'):
+        raise ValueError("Pass 'native' or 'compact' for raster_encoding")
+    if raster_compression not in RASTER_COMPRESSION_PROFILES:
+        raise ValueError("Pass one of {} for raster_compression".format(list(RASTER_COMPRESSION_PROFILES)))
+
+    # check polygon mode
+    if polygon_mode not in ('features','dissolved','extent'):
+        raise ValueError("Pass 'features', 'dissolved', or 'extent' for polygon_mode")
+
+    # check parallel backend
+    if parallel_backend not in ('thread','process'):
+        raise ValueError("Pass 'thread' or 'process' for parallel_backend")
+    if parallel_backend == 'process':
+        if hucs is None:
+            raise AssertionError("Pass a HUCs file to use the process backend")
+        for output in (inundation_raster,inundation_polygon,depths):
+            if (output is not None) and (not isinstance(output,str)):
+                raise TypeError("Pass file paths for outputs when using the process backend")
+
+    # stage instrumentation
+    profiler = InundationProfiler() if instrument else None
+
+    # open and check inputs
+    rem,catchments,hucs = __open_inputs(rem,catchments,hucs,hucs_layerName)
+
+    # catchment stages dictionary
+    if hydro_table is not None:
+        catchmentStagesDict,hucSet = __subset_hydroTable_to_forecast(hydro_table,forecast,subset_hucs,
+                                                                     hydro_table_cache,profiler)
+    else:
+        raise TypeError("Pass hydro table csv")
+
+        
+    if catchmentStagesDict is not None:
+        if src_table is not None:
+            create_src_subset_csv(hydro_table,catchmentStagesDict,src_table)
+
+        # compile stages to lookup arrays once for all windows
+        if (lookup_mode == 'array') | (parallel_backend == 'process'):
+            with __stage(profiler,'interpolation'):
+                catchmentStagesLookup = make_stages_lookup(catchmentStagesDict)
+        else:
+            catchmentStagesLookup = None
+
+        # the shared lookup is released even if a submit or a worker fails
+        shared_stages = None ; executor = None
+        try:
+            if parallel_backend == 'process':
+
+                # share the lookup arrays with the workers instead of pickling them for every HUC
+                shared_stages, shared_stages_spec = share_stages_lookup(catchmentStagesLookup)
+
+                # workers open their own datasets so only paths, windows and mask shapes are sent
+                window_gen = __make_windows_generator(rem, catchments, catchment_poly,
+                                                      mask_type, None, inundation_raster,
+                                                      inundation_polygon, depths, out_raster_profile,
+                                                      out_vector_profile, quiet,
+                                                      hucs = hucs, hucSet = hucSet,
+                                                      catchmentStagesLookup = None,
+                                                      streaming = True,
+                                                      profiler = profiler)
+
+                # start up process pool
+                executor = ProcessPoolExecutor(max_workers=num_workers)
+
+                # submit jobs
+                results = {executor.submit(__inundate_in_huc_shared,shared_stages_spec,*wg,
+                                           polygon_mode=polygon_mode,simplify_tolerance=simplify_tolerance,
+                                           raster_encoding=raster_encoding,raster_compression=raster_compression,
+                                           instrument=instrument) : wg[6]
+                           for wg in window_gen}
+
+            else:
+
+                # make windows generator
+                window_gen = __make_windows_generator(rem, catchments, catchment_poly,
+                                                      mask_type, catchmentStagesDict, inundation_raster,
+                                                      inundation_polygon, depths, out_raster_profile,
+                                                      out_vector_profile, quiet, 
+                                                      hucs = hucs, hucSet = hucSet,
+                                                      catchmentStagesLookup = catchmentStagesLookup,
+                                                      streaming = streaming,
+                                                      window_cache = window_cache,
+                                                      profiler = profiler)
+
+                # start up thread pool
+                executor = ThreadPoolExecutor(max_workers=num_workers)
+
+                # submit jobs
+                inundate_function = __inundate_in_huc_by_blocks if streaming else __inundate_in_huc
+                results = {executor.submit(inundate_function,*wg,
+                                           polygon_mode=polygon_mode,simplify_tolerance=simplify_tolerance,
+                                           raster_encoding=raster_encoding,raster_compression=raster_compression,
+                                           profiler=profiler) : wg[6]
+                           for wg in window_gen}
+
+            inundation_rasters = [] ; depth_rasters = [] ; inundation_polys = []
+            for future in as_completed(results):
+                try:
+                    future.result()
+                except Exception as exc:
+                    __vprint("Exception {} for {}".format(exc,results[future]),not quiet)
+                else:
+                    if results[future] is not None:
+                        __vprint("... {} complete".format(results[future]),not quiet)
+                    else:
+                        __vprint("... complete",not quiet)
+
+                    inundation_rasters += [future.result()[0]]
+                    depth_rasters += [future.result()[1]]
+                    inundation_polys += [future.result()[2]]
+
+                    # records of process workers
+                    if len(future.result()) > 3:
+                        for record in future.result()[3]:
+                            profiler.add(record)
+
+        finally:
+            # power down pool
+            if executor is not None:
+                executor.shutdown(wait=True)
+            if shared_stages is not None:
+                shared_stages.close()
+                shared_stages.unlink()
+
+    # close datasets
+    rem.close()
+    catchments.close()
+
+    if instrument:
+        return(inundation_rasters,depth_rasters,inundation_polys,profiler.to_dataframe())
+
+    return(inundation_rasters,depth_rasters,inundation_polys)
+
+
+def inundate_forecasts(rem, catchments, catchment_poly, hydro_table, forecasts,
+                       mask_type, hucs = None, hucs_layerName = None,
+                       subset_hucs = None, num_workers = 1,
+                       inundation_raster = None, depths = None,
+                       max_depths = None, exceedance_counts = None,
+                       members_as_bands = True, out_raster_profile = None,
+                       quiet = False, hydro_table_cache = False):
+    """
+
+    Run inundation for many forecasts (ensemble members or time steps) in a single pass over the rasters
+
+    Each REM and catchments block is read once and mapped for every forecast. Outputs can be written per forecast as bands of one raster or as separate files, and the maximum depth and the number of forecasts inundating each pixel can be written without writing any of the individual forecasts.
+
+    Parameters
+    ----------
+    rem : str or rasterio.DatasetReader
+        File path to or rasterio dataset reader of Relative Elevation Model raster. Must have the same CRS as catchments raster.
+    catchments : str or rasterio.DatasetReader
+        File path to or rasterio dataset reader of Catchments raster. Must have the same CRS as REM raster
+    catchment_poly : str or geopandas.GeoDataFrame
+        Catchment polygons used when mask_type is 'filter'.
+    hydro_table : str or pandas.DataFrame
+        File path to hydro-table csv or Pandas DataFrame object with correct indices and columns.
+    forecasts : str, list of str, or pandas.DataFrame
+        Pandas DataFrame indexed by feature_id with one discharge column per forecast, file path to a csv with a feature_id column and one discharge column per forecast, file path to a NWM netcdf file (one forecast per time step), or list of forecast csv or netcdf file paths (one forecast per file, named after the file).
+    mask_type : str
+        'huc' or 'filter'. Batch mode only. See inundate().
+    hucs : str or fiona.Collection, optional
+        Batch mode only. See inundate().
+    hucs_layerName : str, optional
+        Batch mode only. Layer name in hucs to use if multi-layer file is passed.
+    subset_hucs : str or list of str, optional
+        Batch mode only. See inundate().
+    num_workers : int, optional
+        Batch mode only. Number of HUCs to process concurrently.
+    inundation_raster : str, optional
+        Path to optional inundation raster output for each forecast. Appends HUC number if ran in batch mode.
+    depths : str, optional
+        Path to optional depths raster output for each forecast. Appends HUC number if ran in batch mode.
+    max_depths : str, optional
+        Path to optional raster of the maximum depth across forecasts. Appends HUC number if ran in batch mode.
+    exceedance_counts : str, optional
+        Path to optional raster of the number of forecasts with positive depths. Appends HUC number if ran in batch mode.
+    members_as_bands : bool, optional
+        Write inundation_raster and depths as one band per forecast (default) with the forecast names as band descriptions. If False, writes one file per forecast with the forecast name appended.
+    out_raster_profile : dictionary, optional
+        Override the default raster profile for outputs. See Rasterio profile documentation for more information.
+    quiet : bool, optional
+        Quiet output.
+    hydro_table_cache : bool or str, optional
+        Read hydro-table csv files through their binary cache. See inundate().
+
+    Returns
+    -------
+    inundation_rasters, depth_rasters, max_depth_rasters, exceedance_count_rasters : lists
+        Output file names by HUC. For per forecast files, each entry of inundation_rasters and depth_rasters is a list of file names by forecast.
+
+    """
+
+    # check for num_workers
+    num_workers = int(num_workers)
+    assert num_workers >= 1, "Number of workers should be 1 or greater"
+    if (num_workers > 1) & (hucs is None):
+        raise AssertionError("Pass a HUCs file to batch process inundation mapping")
+
+    for output in (inundation_raster,depths,max_depths,exceedance_counts):
+        if (output is not None) and (not isinstance(output,str)):
+            raise TypeError("Pass file paths for outputs")
+
+    # bool quiet
+    quiet = bool(quiet)
+
+    # open and check inputs
+    rem,catchments,hucs = __open_inputs(rem,catchments,hucs,hucs_layerName)
+
+    # catchment stages for all forecasts
+    if hydro_table is not None:
+        hydroIDs,stages,forecast_names,hucSet = __subset_hydroTable_to_forecasts(hydro_table,forecasts,subset_hucs,
+                                                                                hydro_table_cache)
+    else:
+        raise TypeError("Pass hydro table csv")
+
+    catchmentStagesLookup = (hydroIDs,stages,make_dense_index(hydroIDs))
+
+    # make windows generator. Datasets are opened by the workers.
+    window_gen = __make_windows_generator(rem, catchments, catchment_poly,
+                                          mask_type, None, None, None, None, None, None, quiet,
+                                          hucs = hucs, hucSet = hucSet, streaming = True)
+
+    # start up thread pool
+    executor = ThreadPoolExecutor(max_workers=num_workers)
+
+    # submit jobs
+    results = { executor.submit(__inundate_forecasts_in_huc,*wg[:7],
+                                catchmentStagesLookup,forecast_names,
+                                inundation_raster,depths,max_depths,exceedance_counts,
+                                members_as_bands,out_raster_profile,quiet) : wg[6]
+                for wg in window_gen }
+
+    inundation_rasters = [] ; depth_rasters = [] ; max_depth_rasters = [] ; exceedance_count_rasters = []
+    for future in as_completed(results):
+        try:
+            future.result()
+        except Exception as exc:
+            __vprint("Exception {} for {}".format(exc,results[future]),not quiet)
+        else:
+            if results[future] is not None:
+                __vprint("... {} complete".format(results[future]),not quiet)
+            else:
+                __vprint("... complete",not quiet)
+
+            inundation_rasters += [future.result()[0]]
+            depth_rasters += [future.result()[1]]
+            max_depth_rasters += [future.result()[2]]
+            exceedance_count_rasters += [future.result()[3]]
+
+    # power down pool
+    executor.shutdown(wait=True)
+
+    # close datasets
+    rem.close()
+    catchments.close()
+
+    return(inundation_rasters,depth_rasters,max_depth_rasters,exceedance_count_rasters)
+
+
+def inundate_arrays(rem, catchments, hydro_table, forecast,
+                    inundation_raster = None, depths = None, out_raster_profile = None,
+                    lookup_mode = 'dict', hydro_table_cache = False,
+                    raster_encoding = 'native', raster_compression = 'lzw'):
+    """
+
+    Run inundation on a whole REM (a GMS branch) and return the inundation and depths arrays
+
+    Maps the REM as inundate() does without HUCs and keeps the outputs in memory so they can be reduced into a larger grid without a GeoTIFF round trip. The rasters are only written when inundation_raster or depths are passed.
+
+    Parameters
+    ----------
+    rem : str or rasterio.DatasetReader
+        File path to or rasterio dataset reader of Relative Elevation Model raster. Dataset readers are left open.
+    catchments : str or rasterio.DatasetReader
+        File path to or rasterio dataset reader of Catchments raster. Dataset readers are left open.
+    hydro_table : str or pandas.DataFrame
+        File path to hydro-table csv or Pandas DataFrame object with correct indices and columns, such as returned by read_hydroTable.
+    forecast : str or pandas.DataFrame
+        File path to forecast csv or Pandas DataFrame with correct column names.
+    inundation_raster : str, optional
+        Path to optional inundation raster output.
+    depths : str, optional
+        Path to optional depths raster output.
+    out_raster_profile, lookup_mode, hydro_table_cache, raster_encoding, raster_compression : optional
+        See inundate().
+
+    Returns
+    -------
+    inundation_array, depths_array : numpy.ndarray
+        Inundation (positive inundated and negative dry HydroIDs) and depths arrays in the catchments and REM data types.
+    transform : affine.Affine
+        Transform of the arrays.
+    inundation_nodata, depths_nodata : int or float
+        Nodata values of the arrays.
+    output_names : tuple
+        File names of the inundation raster and depths raster or None.
+
+    """
+
+    if lookup_mode not in ('dict','array'):
+        raise ValueError("Pass 'dict' or 'array' for lookup_mode")
+
+    # callers passing dataset readers keep them open
+    close_inputs = [ isinstance(rem,str), isinstance(catchments,str) ]
+
+    rem,catchments,_ = __open_inputs(rem,catchments)
+
+    catchmentStagesDict,_ = __subset_hydroTable_to_forecast(hydro_table,forecast,None,hydro_table_cache)
+    catchmentStagesLookup = make_stages_lookup(catchmentStagesDict) if lookup_mode == 'array' else None
+
+    rem_array = rem.read(1) ; catchments_array = catchments.read(1)
+    rem_nodata = rem.nodata ; catchments_nodata = catchments.nodata
+    transform = rem.transform
+
+    inundation_array,depths_array = __map_window(rem_array,catchments_array,rem_nodata,catchments_nodata,
+                                                 catchmentStagesDict,catchmentStagesLookup)
+
+    output_names = (None,None)
+    if (inundation_raster is not None) or (depths is not None):
+        depths,inundation_raster,_,_,_ = __open_inundation_outputs(rem.profile,catchments.profile,rem_array.shape,
+                                                                   transform,rem.crs.wkt,None,
+                                                                   depths,inundation_raster,None,
+                                                                   out_raster_profile,None,
+                                                                   raster_encoding=raster_encoding,
+                                                                   raster_compression=raster_compression)
+        __write_inundation_rasters(inundation_raster,depths,inundation_array,depths_array,
+                                   catchments_nodata,rem_nodata,raster_encoding)
+        output_names = __close_inundation_outputs(depths,inundation_raster,None)[:2]
+
+    for dataset,close_input in zip((rem,catchments),close_inputs):
+        if close_input: dataset.close()
+
+    return(inundation_array,depths_array,transform,catchments_nodata,rem_nodata,output_names)
+
+
+def __open_inputs(rem,catchments,hucs=None,hucs_layerName=None):
+
     # input rem
     if isinstance(rem,str):
         rem = rasterio.open(rem)
@@ -164,64 +632,420 @@ def inundate(rem, catchments, catchment_poly, hydro_table, forecast,
     # check for matching projections
     #assert to_string(hucs.crs) == rem.crs.to_proj4() == catchments.crs.to_proj4(), "REM, Catchment, and HUCS CRS definitions must match"
 
-    # catchment stages dictionary
-    if hydro_table is not None:
-        catchmentStagesDict,hucSet = __subset_hydroTable_to_forecast(hydro_table,forecast,subset_hucs)
-    else:
-        raise TypeError("Pass hydro table csv")
+    return(rem,catchments,hucs)
 
-        
-    if catchmentStagesDict is not None:
-        if src_table is not None:
-            create_src_subset_csv(hydro_table,catchmentStagesDict,src_table)
 
-        # make windows generator
-        window_gen = __make_windows_generator(rem, catchments, catchment_poly,
-                                              mask_type, catchmentStagesDict, inundation_raster,
-                                              inundation_polygon, depths, out_raster_profile,
-                                              out_vector_profile, quiet, 
-                                              hucs = hucs, hucSet = hucSet)
+def __inundate_in_huc(rem_array,catchments_array,crs,window_transform,rem_profile,catchments_profile,hucCode,
+                      catchmentStagesDict,depths,inundation_raster,inundation_polygon,
+                      out_raster_profile,out_vector_profile,quiet,
+                      catchmentStagesLookup=None,polygon_mode='features',simplify_tolerance=None,
+                      raster_encoding='native',raster_compression='lzw',profiler=None):
 
-        # start up thread pool
-        executor = ThreadPoolExecutor(max_workers=num_workers)
+    # verbose print
+    if hucCode is not None:
+        __vprint("Inundating {} ...".format(hucCode),not quiet)
 
-        # submit jobs
-        results = {executor.submit(__inundate_in_huc,*wg) : wg[6] for wg in window_gen}
+    # nodata of the inputs, the output profiles are updated in place
+    rem_nodata = rem_profile['nodata'] ; catchments_nodata = catchments_profile['nodata']
 
-        inundation_rasters = [] ; depth_rasters = [] ; inundation_polys = []
-        for future in as_completed(results):
-            try:
-                future.result()
-            except Exception as exc:
-                __vprint("Exception {} for {}".format(exc,results[future]),not quiet)
-            else:
-                if results[future] is not None:
-                    __vprint("... {} complete".format(results[future]),not quiet)
-                else:
-                    __vprint("... complete",not quiet)
+    # open outputs
+    depths,inundation_raster,inundation_polygon,depths_profile,inundation_profile = \
+        __open_inundation_outputs(rem_profile,catchments_profile,rem_array.shape,window_transform,crs,hucCode,
+                                  depths,inundation_raster,inundation_polygon,
+                                  out_raster_profile,out_vector_profile,polygon_mode,
+                                  raster_encoding,raster_compression)
 
-                inundation_rasters += [future.result()[0]]
-                depth_rasters += [future.result()[1]]
-                inundation_polys += [future.result()[2]]
+    # make output arrays
+    with __stage(profiler,'mapping',hucCode):
+        inundation_array,depths_array = __map_window(rem_array,catchments_array,
+                                                     rem_nodata,catchments_nodata,
+                                                     catchmentStagesDict,catchmentStagesLookup)
 
-        # power down pool
-        executor.shutdown(wait=True)
+    # write out inundation and depth rasters
+    with __stage(profiler,'raster_write',hucCode):
+        __write_inundation_rasters(inundation_raster,depths,inundation_array,depths_array,
+                                   catchments_nodata,rem_nodata,raster_encoding)
 
-    # close datasets
-    rem.close()
-    catchments.close()
+    # polygonize inundation
+    if isinstance(inundation_polygon,fiona.Collection):
+        with __stage(profiler,'polygonize',hucCode):
+            __write_inundation_polygons(inundation_array,window_transform,inundation_polygon,
+                                        polygon_mode,simplify_tolerance)
 
-    return(inundation_rasters,depth_rasters,inundation_polys)
+    return(__close_inundation_outputs(depths,inundation_raster,inundation_polygon,profiler,hucCode))
 
 
-def __inundate_in_huc(rem_array,catchments_array,crs,window_transform,rem_profile,catchments_profile,hucCode,
-                      catchmentStagesDict,depths,inundation_raster,inundation_polygon,
-                      out_raster_profile,out_vector_profile,quiet):
+def __inundate_in_huc_by_blocks(rem,catchments,crs,window,window_transform,mask_shapes,hucCode,
+                                catchmentStagesDict,depths,inundation_raster,inundation_polygon,
+                                out_raster_profile,out_vector_profile,quiet,
+                                catchmentStagesLookup=None,polygon_mode='features',simplify_tolerance=None,
+                                raster_encoding='native',raster_compression='lzw',profiler=None):
+
+    """
+    Streaming version of __inundate_in_huc
+
+    Walks the REM blocks overlapping window, maps each one and writes it straight to the
+    outputs so peak memory scales with the block size instead of the HUC size. The REM and
+    catchments are passed as file paths and opened here so concurrent workers do not share
+    dataset handles. Pixels outside of mask_shapes are set to nodata, matching
+    rasterio.mask.mask with crop=True. Polygons are generated per block so they are split
+    along block edges, except for dissolved polygons which are stitched back together.
+    """
 
     # verbose print
     if hucCode is not None:
         __vprint("Inundating {} ...".format(hucCode),not quiet)
 
+    with rasterio.open(rem) as rem, rasterio.open(catchments) as catchments:
+
+        rem_nodata = rem.nodata ; catchments_nodata = catchments.nodata
+
+        # open outputs
+        out_shape = (int(window.height),int(window.width))
+        depths,inundation_raster,inundation_polygon,depths_profile,inundation_profile = \
+            __open_inundation_outputs(rem.profile,catchments.profile,out_shape,window_transform,crs,hucCode,
+                                      depths,inundation_raster,inundation_polygon,
+                                      out_raster_profile,out_vector_profile,polygon_mode,
+                                      raster_encoding,raster_compression)
+
+        # dissolved polygons are collected over all blocks
+        polygon_parts = None if polygon_mode == 'features' else defaultdict(lambda: ([],[]))
+
+        for block_window in __block_windows(rem,window):
+
+            with __stage(profiler,'masking',hucCode):
+                rem_array = rem.read(1,window=block_window)
+                catchments_array = catchments.read(1,window=block_window)
+                block_transform = rem.window_transform(block_window)
+
+                # set pixels outside of the mask to nodata
+                if mask_shapes is not None:
+                    outside_mask = geometry_mask(mask_shapes,out_shape=rem_array.shape,transform=block_transform)
+                    if outside_mask.all():
+                        continue
+                    rem_array[outside_mask] = rem_nodata
+                    catchments_array[outside_mask] = catchments_nodata
+
+            with __stage(profiler,'mapping',hucCode):
+                inundation_array,depths_array = __map_window(rem_array,catchments_array,
+                                                             rem_nodata,catchments_nodata,
+                                                             catchmentStagesDict,catchmentStagesLookup)
+
+            # location of block in outputs
+            out_window = Window(block_window.col_off - window.col_off, block_window.row_off - window.row_off,
+                                block_window.width, block_window.height)
+
+            with __stage(profiler,'raster_write',hucCode):
+                __write_inundation_rasters(inundation_raster,depths,inundation_array,depths_array,
+                                           catchments_nodata,rem_nodata,raster_encoding,out_window)
+            if isinstance(inundation_polygon,fiona.Collection):
+                with __stage(profiler,'polygonize',hucCode):
+                    __write_inundation_polygons(inundation_array,block_transform,inundation_polygon,
+                                                polygon_mode,simplify_tolerance,polygon_parts)
+
+        if isinstance(inundation_polygon,fiona.Collection) and (polygon_parts is not None):
+            with __stage(profiler,'polygonize',hucCode):
+                __write_dissolved_polygons(polygon_parts,inundation_polygon,polygon_mode,simplify_tolerance)
+
+    return(__close_inundation_outputs(depths,inundation_raster,inundation_polygon,profiler,hucCode))
+
+
+def __inundate_in_huc_shared(shared_stages_spec,rem,catchments,crs,window,window_transform,mask_shapes,hucCode,
+                             catchmentStagesDict,depths,inundation_raster,inundation_polygon,
+                             out_raster_profile,out_vector_profile,quiet,
+                             catchmentStagesLookup=None,polygon_mode='features',simplify_tolerance=None,
+                             raster_encoding='native',raster_compression='lzw',instrument=False):
+
+    """
+    Process pool worker. Attaches to the shared stage lookup and runs __inundate_in_huc_by_blocks
+
+    When instrument is True, the stage records of the worker are returned after the output names.
+    """
+
+    shared_stages, catchmentStagesLookup = attach_stages_lookup(shared_stages_spec)
+    profiler = InundationProfiler() if instrument else None
+
+    try:
+        output_names = __inundate_in_huc_by_blocks(rem,catchments,crs,window,window_transform,mask_shapes,hucCode,
+                                                   catchmentStagesDict,depths,inundation_raster,inundation_polygon,
+                                                   out_raster_profile,out_vector_profile,quiet,
+                                                   catchmentStagesLookup,polygon_mode,simplify_tolerance,
+                                                   raster_encoding,raster_compression,profiler)
+    finally:
+        # views into the shared buffer have to be released before closing it
+        del catchmentStagesLookup
+        shared_stages.close()
+
+    if instrument:
+        return(output_names + (list(profiler.records.values()),))
+
+    return(output_names)
+
+
+def __inundate_forecasts_in_huc(rem,catchments,crs,window,window_transform,mask_shapes,hucCode,
+                                catchmentStagesLookup,forecast_names,
+                                inundation_raster,depths,max_depths,exceedance_counts,
+                                members_as_bands,out_raster_profile,quiet):
+
+    """ Maps all forecasts block by block for one HUC (or the whole raster). See inundate_forecasts. """
+
+    # verbose print
+    if hucCode is not None:
+        __vprint("Inundating {} ...".format(hucCode),not quiet)
+
+    hydroIDs, stages, dense_index = catchmentStagesLookup
+    if dense_index is None:
+        dense_index = np.empty(0,dtype=np.int64)
+
+    number_of_forecasts = len(forecast_names)
+    out_shape = (int(window.height),int(window.width))
+
+    with rasterio.open(rem) as rem, rasterio.open(catchments) as catchments:
+
+        depths_profile,inundation_profile = __make_output_profiles(rem.profile,catchments.profile,out_shape,
+                                                                   window_transform,out_raster_profile)
+        rem_nodata = depths_profile['nodata'] ; catchments_nodata = inundation_profile['nodata']
+
+        # open outputs
+        outputs = {}
+        try:
+            for name,output,profile in ( ('inundation',inundation_raster,inundation_profile),
+                                         ('depths',depths,depths_profile) ):
+                if output is None:
+                    continue
+                output = __append_huc_code_to_file_name(output,hucCode)
+                if members_as_bands:
+                    outputs[name] = rasterio.open(output,'w',**dict(profile,count=number_of_forecasts))
+                    for band,forecast_name in enumerate(forecast_names):
+                        outputs[name].set_band_description(band + 1,str(forecast_name))
+                else:
+                    outputs[name] = [ rasterio.open(__append_huc_code_to_file_name(output,forecast_name),'w',**profile)
+                                      for forecast_name in forecast_names ]
+
+            if max_depths is not None:
+                outputs['max_depths'] = rasterio.open(__append_huc_code_to_file_name(max_depths,hucCode),'w',**depths_profile)
+
+            if exceedance_counts is not None:
+                outputs['exceedance_counts'] = rasterio.open(__append_huc_code_to_file_name(exceedance_counts,hucCode),'w',
+                                                             **dict(depths_profile,dtype='int16',nodata=-1))
+
+            for block_window in __block_windows(rem,window):
+
+                rem_array = rem.read(1,window=block_window)
+                catchments_array = catchments.read(1,window=block_window)
+                block_transform = rem.window_transform(block_window)
+
+                # set pixels outside of the mask to nodata
+                if mask_shapes is not None:
+                    outside_mask = geometry_mask(mask_shapes,out_shape=rem_array.shape,transform=block_transform)
+                    if outside_mask.all():
+                        continue
+                    rem_array[outside_mask] = rem_nodata
+                    catchments_array[outside_mask] = catchments_nodata
+
+                block_shape = rem_array.shape
+                rem_array = rem_array.ravel() ; catchments_array = catchments_array.ravel()
+                valid = rem_array != rem_nodata
+
+                # depths for every forecast
+                depths_array = np.where(valid,0,rem_nodata).astype(rem_array.dtype)
+                depths_array = np.repeat(depths_array[np.newaxis,:],number_of_forecasts,axis=0)
+                if len(hydroIDs) > 0:
+                    depths_array = __go_fast_multi_mapping(rem_array,catchments_array,hydroIDs,stages,dense_index,depths_array)
+
+                out_window = Window(block_window.col_off - window.col_off, block_window.row_off - window.row_off,
+                                    block_window.width, block_window.height)
+
+                if 'depths' in outputs:
+                    __write_forecast_bands(outputs['depths'],depths_array.reshape((number_of_forecasts,) + block_shape),out_window)
+
+                if 'inundation' in outputs:
+                    # negative catchment values where dry, positive where inundated
+                    inundation_array = np.where(catchments_array != catchments_nodata,catchments_array * -1,catchments_array)
+                    inundation_array = np.where(depths_array > 0,catchments_array,inundation_array).astype(catchments_array.dtype)
+                    __write_forecast_bands(outputs['inundation'],inundation_array.reshape((number_of_forecasts,) + block_shape),out_window)
+
+                if 'max_depths' in outputs:
+                    outputs['max_depths'].write(depths_array.max(axis=0).reshape(block_shape),indexes=1,window=out_window)
+
+                if 'exceedance_counts' in outputs:
+                    counts = np.where(valid,(depths_array > 0).sum(axis=0),-1).astype(np.int16)
+                    outputs['exceedance_counts'].write(counts.reshape(block_shape),indexes=1,window=out_window)
+
+        finally:
+            for output in outputs.values():
+                for dataset in (output if isinstance(output,list) else [output]):
+                    dataset.close()
+
+    # return file names of outputs. Handle Nones
+    output_names = []
+    for name in ('inundation','depths','max_depths','exceedance_counts'):
+        if name not in outputs:
+            output_names += [None]
+        elif isinstance(outputs[name],list):
+            output_names += [[dataset.name for dataset in outputs[name]]]
+        else:
+            output_names += [outputs[name].name]
+
+    return(tuple(output_names))
+
+
+def __write_forecast_bands(output,arrays,window):
+
+    # writes forecasts as bands of one dataset or to a list of datasets
+    if isinstance(output,list):
+        for dataset,array in zip(output,arrays):
+            dataset.write(array,indexes=1,window=window)
+    else:
+        output.write(arrays,window=window)
+
+
+@njit
+def __go_fast_multi_mapping(rem,catchments,hydroIDs,stages,dense_index,depths):
+
+    use_dense_index = len(dense_index) > 0
+    first_id = np.int64(hydroIDs[0])
+    number_of_catchments = len(hydroIDs)
+    number_of_forecasts = stages.shape[1]
+
+    for i in range(len(rem)):
+
+        # position of the catchment in the compiled stages
+        if use_dense_index:
+            offset = np.int64(catchments[i]) - first_id
+            if (offset < 0) or (offset >= len(dense_index)):
+                continue
+            s = dense_index[offset]
+            if s < 0:
+                continue
+        else:
+            s = np.searchsorted(hydroIDs,catchments[i])
+            if (s >= number_of_catchments) or (hydroIDs[s] != catchments[i]):
+                continue
+
+        r = rem[i]
+        for f in range(number_of_forecasts):
+
+            stage = stages[s,f]
+
+            # no forecast for this catchment
+            if np.isnan(stage):
+                continue
+
+            if r >= 0:
+                depth = stage - r
+                depths[f,i] = max(depth,0) # set negative depths to 0
+            else:
+                depths[f,i] = 0
+
+    return(depths)
+
+
+def share_stages_lookup(catchmentStagesLookup):
+
+    """
+    Copies a lookup from make_stages_lookup into a new shared memory block
+
+    Returns the SharedMemory object, which the caller has to close and unlink, and a
+    picklable spec to pass to attach_stages_lookup in the worker processes.
+    """
+
+    hydroIDs, stages, dense_index = catchmentStagesLookup
+
+    number_of_catchments = len(hydroIDs)
+    dense_length = -1 if dense_index is None else len(dense_index)
+
+    offsets = __shared_stages_offsets(number_of_catchments,dense_length)
+    shared_stages = shared_memory.SharedMemory(create=True,size=max(offsets[-1],1))
+
+    for array,offset,dtype in zip((hydroIDs,stages,dense_index),offsets[:-1],(np.int32,np.float64,np.int64)):
+        if array is None:
+            continue
+        shared_array = np.ndarray(array.shape,dtype=dtype,buffer=shared_stages.buf,offset=offset)
+        shared_array[:] = array
+        del shared_array
+
+    return(shared_stages,(shared_stages.name,number_of_catchments,dense_length))
+
+
+def attach_stages_lookup(shared_stages_spec):
+
+    """ Attaches to a lookup shared by share_stages_lookup. Returns the SharedMemory object and the lookup tuple of views. """
+
+    name, number_of_catchments, dense_length = shared_stages_spec
+
+    shared_stages = __attach_shared_memory(name)
+
+    offsets = __shared_stages_offsets(number_of_catchments,dense_length)
+
+    hydroIDs = np.ndarray((number_of_catchments,),dtype=np.int32,buffer=shared_stages.buf,offset=offsets[0])
+    stages = np.ndarray((number_of_catchments,),dtype=np.float64,buffer=shared_stages.buf,offset=offsets[1])
+
+    if dense_length < 0:
+        dense_index = None
+    else:
+        dense_index = np.ndarray((dense_length,),dtype=np.int64,buffer=shared_stages.buf,offset=offsets[2])
+
+    return(shared_stages,(hydroIDs,stages,dense_index))
+
+
+def __attach_shared_memory(name):
+
+    """
+    Attaches to a shared memory block without registering it with the resource tracker
+
+    Only the process that created the block tracks it. A worker registering it would have the
+    tracker of a spawned worker warn of a leak and unlink the block when the worker exits, and
+    unregistering it from the tracker a forked worker shares with its parent would drop the
+    registration of the parent.
+    """
+
+    register = resource_tracker.register
+    resource_tracker.register = lambda *args: None
+
+    try:
+        shared_stages = shared_memory.SharedMemory(name=name)
+    finally:
+        resource_tracker.register = register
+
+    return(shared_stages)
+
+
+def __shared_stages_offsets(number_of_catchments,dense_length):
+
+    # byte offsets of HydroIDs, stages and dense index and total size, aligned to 8 bytes
+    stages_offset = int(np.ceil(number_of_catchments * 4 / 8) * 8)
+    dense_offset = stages_offset + number_of_catchments * 8
+    total_size = dense_offset + max(dense_length,0) * 8
+
+    return(0,stages_offset,dense_offset,total_size)
+
+
+def __block_windows(dataset,window,min_block_rows=256):
+
+    """ Yields windows of the dataset's internal blocks clipped to window. Strips are grouped to min_block_rows. """
+
+    block_rows,block_cols = dataset.block_shapes[0]
+    if block_rows < min_block_rows:
+        block_rows = int(np.ceil(min_block_rows / block_rows) * block_rows)
+
+    row_start = int(window.row_off) ; row_stop = int(window.row_off + window.height)
+    col_start = int(window.col_off) ; col_stop = int(window.col_off + window.width)
+
+    # start on the block boundaries so reads are aligned to the internal tiling
+    for row in range((row_start // block_rows) * block_rows, row_stop, block_rows):
+        for col in range((col_start // block_cols) * block_cols, col_stop, block_cols):
+
+            row_off = max(row,row_start) ; col_off = max(col,col_start)
+            height = min(row + block_rows,row_stop) - row_off
+            width = min(col + block_cols,col_stop) - col_off
+
+            yield Window(col_off,row_off,width,height)
+
+
+def __make_output_profiles(rem_profile,catchments_profile,out_shape,window_transform,out_raster_profile,
+                           raster_encoding='native',raster_compression='lzw'):
+
     # save desired profiles for outputs
     depths_profile = rem_profile
     inundation_profile = catchments_profile
@@ -236,17 +1060,79 @@ def __inundate_in_huc(rem_array,catchments_array,crs,window_transform,rem_profil
     else:
         raise TypeError("Pass dictionary for output raster profiles")
 
+    # compact data types
+    if raster_encoding == 'compact':
+        depths_profile.update(**COMPACT_DEPTHS_PROFILE)
+        inundation_profile.update(**COMPACT_INUNDATION_PROFILE)
+
+    # compression with horizontal (integer) or floating point predictor
+    if raster_compression != 'lzw':
+        for profile in (depths_profile,inundation_profile):
+            profile.update(**RASTER_COMPRESSION_PROFILES[raster_compression])
+            profile.update(predictor=3 if np.dtype(profile['dtype']).kind == 'f' else 2)
+
     # update profiles with width and heights from array sizes
-    depths_profile.update(height=rem_array.shape[0],width=rem_array.shape[1])
-    inundation_profile.update(height=catchments_array.shape[0],width=catchments_array.shape[1])
+    depths_profile.update(height=out_shape[0],width=out_shape[1])
+    inundation_profile.update(height=out_shape[0],width=out_shape[1])
 
     # update transforms of outputs with window transform
     depths_profile.update(transform=window_transform)
     inundation_profile.update(transform=window_transform)
+
+    return(depths_profile,inundation_profile)
+
+
+def encode_compact_depths(depths_array,depths_nodata):
+
+    """ Encodes depths in meters as int16 centimeters. Depths beyond the int16 range are clipped. """
+
+    encoded = np.clip(np.round(depths_array / COMPACT_DEPTHS_SCALE),0,np.iinfo(np.int16).max)
+    encoded = np.where(depths_array == depths_nodata,COMPACT_DEPTHS_PROFILE['nodata'],encoded)
+
+    return(encoded.astype(np.int16))
+
+
+def encode_compact_inundation(inundation_array,inundation_nodata):
+
+    """ Encodes inundation as int8 1 (inundated), 0 (dry) and nodata """
+
+    encoded = np.where(inundation_array == inundation_nodata,COMPACT_INUNDATION_PROFILE['nodata'],
+                       (inundation_array > 0).astype(np.int8))
+
+    return(encoded.astype(np.int8))
+
+
+def __write_inundation_rasters(inundation_raster,depths,inundation_array,depths_array,
+                               inundation_nodata,depths_nodata,raster_encoding='native',window=None):
+
+    """ Writes a window of the inundation and depths rasters in the requested encoding """
+
+    if raster_encoding == 'compact':
+        inundation_array = encode_compact_inundation(inundation_array,inundation_nodata)
+        depths_array = encode_compact_depths(depths_array,depths_nodata)
+
+    if isinstance(inundation_raster,DatasetWriter):
+        inundation_raster.write(inundation_array,indexes=1,window=window)
+    if isinstance(depths,DatasetWriter):
+        depths.write(depths_array,indexes=1,window=window)
+
+
+def __open_inundation_outputs(rem_profile,catchments_profile,out_shape,window_transform,crs,hucCode,
+                              depths,inundation_raster,inundation_polygon,
+                              out_raster_profile,out_vector_profile,polygon_mode='features',
+                              raster_encoding='native',raster_compression='lzw'):
+
+    depths_profile,inundation_profile = __make_output_profiles(rem_profile,catchments_profile,out_shape,
+                                                               window_transform,out_raster_profile,
+                                                               raster_encoding,raster_compression)
+
     # open output depths
     if isinstance(depths,str):
         depths = __append_huc_code_to_file_name(depths,hucCode)
         depths = rasterio.open(depths, "w", **depths_profile)
+        if raster_encoding == 'compact':
+            depths.scales = (COMPACT_DEPTHS_SCALE,)
+            depths.offsets = (0.0,)
     elif isinstance(depths,DatasetWriter):
         pass
     elif depths is None:
@@ -274,6 +1160,10 @@ def __inundate_in_huc(rem_array,catchments_array,crs,window_transform,rem_profil
                                          'geometry' : 'Polygon',
                                          'properties' : OrderedDict([('HydroID' , 'int')])
                                        }
+        if polygon_mode == 'dissolved':
+            out_vector_profile['schema']['geometry'] = 'MultiPolygon'
+        elif polygon_mode == 'extent':
+            out_vector_profile['schema'] = { 'geometry' : 'MultiPolygon', 'properties' : OrderedDict() }
 
         # open output inundation polygons
         if isinstance(inundation_polygon,str):
@@ -284,6 +1174,12 @@ def __inundate_in_huc(rem_array,catchments_array,crs,window_transform,rem_profil
         else:
             raise TypeError("Pass fiona collection or file path as inundation_polygon")
 
+    return(depths,inundation_raster,inundation_polygon,depths_profile,inundation_profile)
+
+
+def __map_window(rem_array,catchments_array,rem_nodata,catchments_nodata,
+                 catchmentStagesDict,catchmentStagesLookup=None):
+
     # save desired array shape
     desired_shape = rem_array.shape
 
@@ -296,87 +1192,277 @@ def __inundate_in_huc(rem_array,catchments_array,crs,window_transform,rem_profil
     inundation_array = catchments_array.copy()
 
     # reset output values
-    depths_array[depths_array != depths_profile['nodata']] = 0
-    inundation_array[inundation_array != inundation_profile['nodata']] = inundation_array[inundation_array != inundation_profile['nodata']] * -1
+    depths_array[depths_array != rem_nodata] = 0
+    inundation_array[inundation_array != catchments_nodata] = inundation_array[inundation_array != catchments_nodata] * -1
 
     # make output arrays
-    inundation_array,depths_array = __go_fast_mapping(rem_array,catchments_array,catchmentStagesDict,inundation_array,depths_array)
+    if catchmentStagesLookup is None:
+        inundation_array,depths_array = __go_fast_mapping(rem_array,catchments_array,catchmentStagesDict,inundation_array,depths_array)
+    else:
+        inundation_array,depths_array = __go_fast_mapping_array(rem_array,catchments_array,catchmentStagesLookup,inundation_array,depths_array)
 
     # reshape output arrays
     inundation_array = inundation_array.reshape(desired_shape)
     depths_array = depths_array.reshape(desired_shape)
 
-    # write out inundation and depth rasters
-    if isinstance(inundation_raster,DatasetWriter):
-        inundation_raster.write(inundation_array,indexes=1)
-    if isinstance(depths,DatasetWriter):
-        depths.write(depths_array,indexes=1)
+    return(inundation_array,depths_array)
 
-    # polygonize inundation
-    if isinstance(inundation_polygon,fiona.Collection):
 
-        # make generator for inundation polygons
-        inundation_polygon_generator = shapes(inundation_array,mask=inundation_array>0,connectivity=8,transform=window_transform)
-        
+def __write_inundation_polygons(inundation_array,window_transform,inundation_polygon,
+                                polygon_mode='features',simplify_tolerance=None,polygon_parts=None):
+
+    """
+    Polygonizes the inundated pixels of a window and writes them to inundation_polygon
+
+    'features' writes one polygon per connected inundated area of each HydroID in batches.
+    'dissolved' and 'extent' group the polygons into one MultiPolygon per HydroID or for
+    the whole inundated area. The polygons of one window do not overlap so they are grouped
+    without unions. When windows are blocks of a larger output, pass a polygon_parts dict
+    to collect them in and write them with __write_dissolved_polygons once all blocks are
+    done. Only the polygons touching block edges are then unioned.
+    """
+
+    if polygon_mode == 'extent':
+        inundation_array = (inundation_array > 0).astype(np.uint8)
+
+    # make generator for inundation polygons
+    inundation_polygon_generator = shapes(inundation_array,mask=inundation_array>0,connectivity=8,transform=window_transform)
+
+    if polygon_mode == 'features':
+
         # generate records
-        records = []
-        for i,(g,h) in enumerate(inundation_polygon_generator):
-            record = dict()
-            record['geometry'] = g
-            record['properties'] = {'HydroID' : int(h)}
-            records += [record]
-        
-        # write out
-        inundation_polygon.writerecords(records)
+        records = ( { 'geometry' : __simplify_geometry(g,simplify_tolerance), 'properties' : {'HydroID' : int(h)} }
+                    for g,h in inundation_polygon_generator )
+
+        # write out in batches to bound memory
+        for batch in iter(lambda: list(islice(records,POLYGON_WRITE_BATCH_SIZE)),[]):
+            inundation_polygon.writerecords(batch)
+
+        return
+
+    write_now = polygon_parts is None
+    if write_now:
+        polygon_parts = defaultdict(lambda: ([],[]))
+    else:
+        height,width = inundation_array.shape
+        left,top = window_transform * (0,0)
+        right,bottom = window_transform * (width,height)
+        half_pixel = abs(window_transform.a) / 2
+
+    for g,h in inundation_polygon_generator:
+
+        hydroID = int(h) if polygon_mode == 'dissolved' else None
+
+        # polygons on the edge of a block may continue in the next one
+        on_edge = False
+        if not write_now:
+            exterior = np.asarray(g['coordinates'][0])
+            xmin,ymin = exterior.min(axis=0) ; xmax,ymax = exterior.max(axis=0)
+            on_edge = (xmin < left + half_pixel) | (xmax > right - half_pixel) | \
+                      (ymin < bottom + half_pixel) | (ymax > top - half_pixel)
+
+        polygon_parts[hydroID][int(on_edge)].append(g['coordinates'])
+
+    if write_now:
+        __write_dissolved_polygons(polygon_parts,inundation_polygon,polygon_mode,simplify_tolerance)
+
+
+def __write_dissolved_polygons(polygon_parts,inundation_polygon,polygon_mode,simplify_tolerance=None):
+
+    """ Writes one MultiPolygon per HydroID (or one for the extent) from collected polygon parts """
+
+    def __records():
+        for hydroID,(interior_parts,edge_parts) in polygon_parts.items():
+
+            parts = list(interior_parts)
+
+            # stitch parts split by block edges
+            if len(edge_parts) > 0:
+                stitched = unary_union([shape({'type' : 'Polygon', 'coordinates' : c}) for c in edge_parts])
+                stitched = mapping(stitched)
+                if stitched['type'] == 'Polygon':
+                    parts += [stitched['coordinates']]
+                else:
+                    parts += list(stitched['coordinates'])
+
+            geometry = __simplify_geometry({'type' : 'MultiPolygon', 'coordinates' : parts},simplify_tolerance)
+            properties = {'HydroID' : hydroID} if polygon_mode == 'dissolved' else {}
+
+            yield({ 'geometry' : geometry, 'properties' : properties })
+
+    records = __records()
+    for batch in iter(lambda: list(islice(records,POLYGON_WRITE_BATCH_SIZE)),[]):
+        inundation_polygon.writerecords(batch)
+
+
+def __simplify_geometry(geometry,simplify_tolerance):
+
+    """
+    Simplifies a GeoJSON-like Polygon preserving topology, or each part of a MultiPolygon
+
+    Topology preserving simplification slows down sharply with the number of holes, which
+    dissolved parts have plenty of. Their parts are simplified with Douglas-Peucker instead
+    and repaired with a zero buffer. Parts simplified apart may overlap their neighbours,
+    so they are unioned back into one valid MultiPolygon.
+    """
+
+    if simplify_tolerance is None:
+        return(geometry)
+
+    if geometry['type'] == 'Polygon':
+        return(mapping(shape(geometry).simplify(simplify_tolerance,preserve_topology=True)))
+
+    parts = []
+    for coordinates in geometry['coordinates']:
+        simplified = shape({'type' : 'Polygon', 'coordinates' : coordinates})
+        parts.append(simplified.simplify(simplify_tolerance,preserve_topology=False).buffer(0))
+
+    simplified = unary_union(parts)
+    simplified = [simplified] if simplified.geom_type == 'Polygon' else list(getattr(simplified,'geoms',[]))
+
+    return({'type' : 'MultiPolygon',
+            'coordinates' : [ mapping(p)['coordinates'] for p in simplified if (p.geom_type == 'Polygon') and (not p.is_empty) ]})
+
+
+def __close_inundation_outputs(depths,inundation_raster,inundation_polygon,profiler=None,hucCode=None):
+
+    # compressed blocks still in the GDAL cache are written on close
+    if isinstance(depths,DatasetWriter) | isinstance(inundation_raster,DatasetWriter):
+        with __stage(profiler,'raster_write',hucCode):
+            if isinstance(depths,DatasetWriter): depths.close()
+            if isinstance(inundation_raster,DatasetWriter): inundation_raster.close()
+    if isinstance(inundation_polygon,fiona.Collection):
+        with __stage(profiler,'polygonize',hucCode):
+            inundation_polygon.close()
+
+    # return file names of outputs for aggregation. Handle Nones
+    try:
+        ir_name = inundation_raster.name
+    except AttributeError:
+        ir_name = None
+
+    try:
+        d_name = depths.name
+    except AttributeError:
+        d_name = None
+
+    try:
+        ip_name = inundation_polygon.path
+    except AttributeError:
+        ip_name = None
+
+    return(ir_name,d_name,ip_name)
+
+
+@njit
+def __go_fast_mapping(rem,catchments,catchmentStagesDict,inundation,depths):
+
+    for i,(r,cm) in enumerate(zip(rem,catchments)):
+        if cm in catchmentStagesDict:
+            if r >= 0:
+                depth = catchmentStagesDict[cm] - r
+                depths[i] = max(depth,0) # set negative depths to 0
+            else:
+                depths[i] = 0
+
+            if depths[i] > 0: # set positive depths to positive
+                inundation[i] *= -1
+            #else: # set positive depths to value of positive catchment value
+                #inundation[i] = cm
+
+    return(inundation,depths)
+
+
+def __go_fast_mapping_array(rem,catchments,catchmentStagesLookup,inundation,depths):
+
+    """ Array lookup equivalent of __go_fast_mapping using the output of make_stages_lookup """
+
+    hydroIDs, stages, dense_index = catchmentStagesLookup
+
+    if len(hydroIDs) == 0:
+        return(inundation,depths)
+
+    if dense_index is None:
+        dense_index = np.empty(0,dtype=np.int64)
+
+    return(__go_fast_array_mapping(rem,catchments,hydroIDs,stages,dense_index,inundation,depths))
+
+
+@njit
+def __go_fast_array_mapping(rem,catchments,hydroIDs,stages,dense_index,inundation,depths):
+
+    use_dense_index = len(dense_index) > 0
+    first_id = np.int64(hydroIDs[0])
+    number_of_catchments = len(hydroIDs)
+
+    for i in range(len(rem)):
+
+        # position of the catchment in the compiled stages
+        if use_dense_index:
+            offset = np.int64(catchments[i]) - first_id
+            if (offset < 0) or (offset >= len(dense_index)):
+                continue
+            s = dense_index[offset]
+            if s < 0:
+                continue
+        else:
+            s = np.searchsorted(hydroIDs,catchments[i])
+            if (s >= number_of_catchments) or (hydroIDs[s] != catchments[i]):
+                continue
+
+        r = rem[i]
+        if r >= 0:
+            depth = stages[s] - r
+            depths[i] = max(depth,0) # set negative depths to 0
+        else:
+            depths[i] = 0
+
+        if depths[i] > 0: # set positive depths to positive
+            inundation[i] *= -1
+
+    return(inundation,depths)
+
+
+def make_stages_lookup(catchmentStagesDict,max_dense_ratio=4):
+
+    """
+    Compiles a catchment stages dictionary into arrays for __go_fast_mapping_array
+
+    Returns a tuple of sorted HydroIDs, their stages, and a dense index from HydroID offset
+    to stage position (see make_dense_index).
+    """
 
-    if isinstance(depths,DatasetWriter): depths.close()
-    if isinstance(inundation_raster,DatasetWriter): inundation_raster.close()
-    if isinstance(inundation_polygon,fiona.Collection): inundation_polygon.close()
-    #if isinstance(hucs,fiona.Collection): inundation_polygon.close()
+    number_of_catchments = len(catchmentStagesDict)
 
-    # return file names of outputs for aggregation. Handle Nones
-    try:
-        ir_name = inundation_raster.name
-    except AttributeError:
-        ir_name = None
+    hydroIDs = np.fromiter(catchmentStagesDict.keys(),dtype=np.int32,count=number_of_catchments)
+    stages = np.fromiter(catchmentStagesDict.values(),dtype=np.float64,count=number_of_catchments)
 
-    try:
-        d_name = depths.name
-    except AttributeError:
-        d_name = None
+    sort_idx = np.argsort(hydroIDs,kind='stable')
+    hydroIDs = hydroIDs[sort_idx] ; stages = stages[sort_idx]
 
-    try:
-        ip_name = inundation_polygon.path
-    except AttributeError:
-        ip_name = None
-    
-    #print(ir_name)
-    #yield(ir_name,d_name,ip_name)
-    
-    if isinstance(depths,DatasetWriter): depths.close()
-    if isinstance(inundation_raster,DatasetWriter): inundation_raster.close()
-    if isinstance(inundation_polygon,fiona.Collection): inundation_polygon.close()
+    return(hydroIDs,stages,make_dense_index(hydroIDs,max_dense_ratio))
 
-    return(ir_name,d_name,ip_name)
 
+def make_dense_index(hydroIDs,max_dense_ratio=4):
 
-@njit
-def __go_fast_mapping(rem,catchments,catchmentStagesDict,inundation,depths):
+    """
+    Makes an index from HydroID offset (HydroID minus the first HydroID) to position in the sorted hydroIDs
 
-    for i,(r,cm) in enumerate(zip(rem,catchments)):
-        if cm in catchmentStagesDict:
-            if r >= 0:
-                depth = catchmentStagesDict[cm] - r
-                depths[i] = max(depth,0) # set negative depths to 0
-            else:
-                depths[i] = 0
+    Absent HydroIDs are -1. The dense index is only built when the HydroID range is at most
+    max_dense_ratio times the number of HydroIDs, otherwise None is returned and lookups use
+    np.searchsorted on the sorted HydroIDs.
+    """
 
-            if depths[i] > 0: # set positive depths to positive
-                inundation[i] *= -1
-            #else: # set positive depths to value of positive catchment value
-                #inundation[i] = cm
+    number_of_catchments = len(hydroIDs)
 
-    return(inundation,depths)
+    dense_index = None
+    if number_of_catchments > 0:
+        id_range = int(hydroIDs[-1]) - int(hydroIDs[0]) + 1
+        if id_range <= max_dense_ratio * number_of_catchments:
+            dense_index = np.full(id_range, -1, dtype=np.int64)
+            dense_index[hydroIDs.astype(np.int64) - hydroIDs[0]] = np.arange(number_of_catchments)
+
+    return(dense_index)
 
 
 def __make_windows_generator(rem, 
@@ -391,11 +1477,17 @@ def __make_windows_generator(rem,
                              out_vector_profile,
                              quiet,
                              hucs = None,
-                             hucSet = None):
+                             hucSet = None,
+                             catchmentStagesLookup = None,
+                             streaming = False,
+                             window_cache = None,
+                             profiler = None):
 
     
     if hucs is not None:
 
+        catchment_polygons = None
+
         # get attribute name for HUC column
         for huc in hucs:
             for hucColName in huc['properties'].keys():
@@ -419,50 +1511,152 @@ def __make_windows_generator(rem,
             if  __return_huc_in_hucSet(huc['properties'][hucColName],hucSet) is None:
                 continue
 
+            hucCode = huc['properties'][hucColName]
+
             try:
-                if mask_type == "huc":
-                    #window = geometry_window(rem,shape(huc['geometry']))
-                    rem_array,window_transform = mask(rem,[shape(huc['geometry'])],crop=True,indexes=1)
-                    catchments_array,_ = mask(catchments,[shape(huc['geometry'])],crop=True,indexes=1)
-                elif mask_type == "filter":
-
-                    # input catchments polygon
-                    if isinstance(catchment_poly,str):
-                        catchment_poly=gpd.read_file(catchment_poly)
-                    elif isinstance(catchment_poly,DatasetReader):
-                        pass
+                with __stage(profiler,'masking',hucCode):
+
+                    # masked windows of previous runs on the same inputs
+                    window_key = None ; cached_window = None
+                    if (window_cache is not None) and (mask_type == "filter") and (not streaming) \
+                       and isinstance(catchment_poly,str):
+                        window_key = __window_cache_key(rem,catchments,catchment_poly,huc['properties']['fossid'],
+                                                        hucCode)
+                        cached_window = __read_window_cache(window_cache,window_key)
+
+                    if cached_window is not None:
+                        rem_array,catchments_array,window_transform = cached_window
                     else:
-                        raise TypeError("Pass geopandas dataset or filepath for catchment polygons")
-
-                    fossid = huc['properties']['fossid']
-                    if catchment_poly.HydroID.dtype != 'str': catchment_poly.HydroID = catchment_poly.HydroID.astype(str)
-                    catchment_poly=catchment_poly[catchment_poly.HydroID.str.startswith(fossid)]
-
-                    rem_array,window_transform = mask(rem,catchment_poly['geometry'],crop=True,indexes=1)
-                    catchments_array,_ = mask(catchments,catchment_poly['geometry'],crop=True,indexes=1)
-                    del catchment_poly
-                elif mask_type is None:
-                    pass
-                else:
-                    print ("invalid mask type. Options are 'huc' or 'filter'")
-            except ValueError: # shape doesn't overlap raster
+                        if mask_type == "huc":
+                            mask_shapes = [shape(huc['geometry'])]
+                        elif mask_type == "filter":
+
+                            # input catchments polygon, read once for all HUCs
+                            if catchment_polygons is None:
+                                if isinstance(catchment_poly,str):
+                                    catchment_polygons = gpd.read_file(catchment_poly)
+                                elif isinstance(catchment_poly,(gpd.GeoDataFrame,DatasetReader)):
+                                    catchment_polygons = catchment_poly
+                                else:
+                                    raise TypeError("Pass geopandas dataset or filepath for catchment polygons")
+                                catchment_polygons = catchment_polygons.assign(HydroID=catchment_polygons.HydroID.astype(str))
+
+                            fossid = huc['properties']['fossid']
+                            mask_shapes = catchment_polygons.loc[catchment_polygons.HydroID.str.startswith(fossid),'geometry']
+                        elif mask_type is None:
+                            pass
+                        else:
+                            print ("invalid mask type. Options are 'huc' or 'filter'")
+
+                        if streaming:
+                            # only the extent of the shapes is needed, blocks are masked by the workers
+                            window = geometry_window(rem,mask_shapes)
+                            window_transform = rem.window_transform(window)
+                        else:
+                            rem_array,window_transform = mask(rem,mask_shapes,crop=True,indexes=1)
+                            catchments_array,_ = mask(catchments,mask_shapes,crop=True,indexes=1)
+
+                            if window_key is not None:
+                                __write_window_cache(window_cache,window_key,rem_array,catchments_array,window_transform)
+            except (ValueError,WindowError): # shape doesn't overlap raster
                 continue # skip to next HUC
 
-            hucCode = huc['properties'][hucColName]
-
-            yield (rem_array, catchments_array, rem.crs.wkt,
-                   window_transform, rem.profile, catchments.profile, hucCode,
-                   catchmentStagesDict, depths, inundation_raster,
-                   inundation_polygon, out_raster_profile, out_vector_profile, quiet)
+            if streaming:
+                yield (rem.name, catchments.name, rem.crs.wkt,
+                       window, window_transform, list(mask_shapes), hucCode,
+                       catchmentStagesDict, depths, inundation_raster,
+                       inundation_polygon, out_raster_profile, out_vector_profile, quiet,
+                       catchmentStagesLookup)
+            else:
+                yield (rem_array, catchments_array, rem.crs.wkt,
+                       window_transform, rem.profile, catchments.profile, hucCode,
+                       catchmentStagesDict, depths, inundation_raster,
+                       inundation_polygon, out_raster_profile, out_vector_profile, quiet,
+                       catchmentStagesLookup)
 
     else:
         hucCode = None
        #window = Window(col_off=0,row_off=0,width=rem.width,height=rem.height)
 
-        yield (rem.read(1),catchments.read(1),rem.crs.wkt,
-               rem.transform,rem.profile,catchments.profile,hucCode,
-               catchmentStagesDict,depths,inundation_raster,
-               inundation_polygon,out_raster_profile,out_vector_profile,quiet)
+        if streaming:
+            yield (rem.name,catchments.name,rem.crs.wkt,
+                   Window(col_off=0,row_off=0,width=rem.width,height=rem.height),rem.transform,None,hucCode,
+                   catchmentStagesDict,depths,inundation_raster,
+                   inundation_polygon,out_raster_profile,out_vector_profile,quiet,
+                   catchmentStagesLookup)
+        else:
+            with __stage(profiler,'masking',hucCode):
+                rem_array = rem.read(1) ; catchments_array = catchments.read(1)
+
+            yield (rem_array,catchments_array,rem.crs.wkt,
+                   rem.transform,rem.profile,catchments.profile,hucCode,
+                   catchmentStagesDict,depths,inundation_raster,
+                   inundation_polygon,out_raster_profile,out_vector_profile,quiet,
+                   catchmentStagesLookup)
+
+
+def __window_cache_key(rem,catchments,catchment_poly,fossid,hucCode):
+
+    """ Key of a masked window: the HUC code, a hash of the input paths and fossid and a hash of the input sizes and modification times """
+
+    inputs_key = hashlib.sha1() ; signature_key = hashlib.sha1()
+    for file_name in (rem.name,catchments.name,catchment_poly):
+        file_path,file_size,file_mtime_ns = __file_signature(file_name)
+        inputs_key.update(file_path.encode())
+        signature_key.update('{}_{}'.format(file_size,file_mtime_ns).encode())
+    inputs_key.update('{}_{}'.format(fossid,hucCode).encode())
+
+    return('{}_{}_{}'.format(hucCode,inputs_key.hexdigest()[:16],signature_key.hexdigest()[:16]))
+
+
+def __file_signature(file_name):
+
+    file_stat = os.stat(file_name)
+
+    return(os.path.abspath(file_name),file_stat.st_size,file_stat.st_mtime_ns)
+
+
+def __read_window_cache(window_cache,window_key):
+
+    """ Memory maps the cached REM and catchments arrays of a window. Returns None if not cached. """
+
+    transform_file = os.path.join(window_cache,window_key + '_transform.npy')
+
+    # the transform is written last and marks a complete entry
+    if not os.path.isfile(transform_file):
+        return(None)
+
+    try:
+        window_transform = rasterio.Affine(*np.load(transform_file))
+        rem_array = np.load(os.path.join(window_cache,window_key + '_rem.npy'),mmap_mode='r')
+        catchments_array = np.load(os.path.join(window_cache,window_key + '_catchments.npy'),mmap_mode='r')
+    except (OSError,ValueError):
+        return(None)
+
+    return(rem_array,catchments_array,window_transform)
+
+
+def __write_window_cache(window_cache,window_key,rem_array,catchments_array,window_transform):
+
+    os.makedirs(window_cache,exist_ok=True)
+
+    arrays = (('_rem.npy',rem_array),('_catchments.npy',catchments_array),
+              ('_transform.npy',np.array(window_transform[:6],dtype=np.float64)))
+
+    # write to temporary files and move them in place so concurrent runs never read partial entries
+    for suffix,array in arrays:
+        with tempfile.NamedTemporaryFile(dir=window_cache,suffix='.npy',delete=False) as temp_file:
+            np.save(temp_file,array)
+        os.replace(temp_file.name,os.path.join(window_cache,window_key + suffix))
+
+    # entries of the same HUC and inputs written before the inputs changed
+    stale_prefix = window_key.rsplit('_',1)[0] + '_'
+    for file_name in os.listdir(window_cache):
+        if file_name.startswith(stale_prefix) and (not file_name.startswith(window_key + '_')):
+            try:
+                os.remove(os.path.join(window_cache,file_name))
+            except FileNotFoundError:
+                pass
 
 
 def __append_huc_code_to_file_name(fileName,hucCode):
@@ -475,45 +1669,209 @@ def __append_huc_code_to_file_name(fileName,hucCode):
     return("{}_{}{}".format(base_file_path,hucCode,extension))
 
 
-def __subset_hydroTable_to_forecast(hydroTable,forecast,subset_hucs=None):
+def __subset_hydroTable_to_forecast(hydroTable,forecast,subset_hucs=None,hydro_table_cache=False,profiler=None):
 
-    if isinstance(hydroTable,str):
-        hydroTable = pd.read_csv(
-                                 hydroTable,
-                                 dtype={'HUC':str,'feature_id':str,
-                                         'HydroID':str,'stage':float,
-                                         'discharge_cms':float,'LakeID' : int}
-                                )
-        huc_error = hydroTable.HUC.unique()
-        hydroTable.set_index(['HUC','feature_id','HydroID'],inplace=True)
+    with __stage(profiler,'hydrotable'):
+        hydroTable = __load_hydroTable(hydroTable,subset_hucs,hydro_table_cache)
+        forecast = __load_forecast(forecast)
+
+    # join tables
+    try:
+        with __stage(profiler,'hydrotable'):
+            hydroTable = hydroTable.join(forecast,on=['feature_id'],how='inner')
+    except AttributeError:
+        #print("FORECAST ERROR")
+        raise NoForecastFound("No forecast value found for the passed feature_ids in the Hydro-Table")
 
-    elif isinstance(hydroTable,pd.DataFrame):
-        pass #consider checking for correct dtypes, indices, and columns
     else:
-        raise TypeError("Pass path to hydro-table csv or Pandas DataFrame")
 
-    hydroTable = hydroTable[hydroTable["LakeID"] == -999]  # Subset hydroTable to include only non-lake catchments.
+        with __stage(profiler,'interpolation'):
+
+            # interpolate stages
+            hydroIDs,stages = __interpolate_stages(hydroTable,['discharge'])
+
+            # catchment stages dictionary
+            catchmentStagesDict = __make_stages_dict(hydroIDs,stages[:,0])
+
+        # huc set
+        hucSet = [str(i) for i in hydroTable.index.get_level_values('HUC').unique().to_list()]
+
+        return(catchmentStagesDict,hucSet)
+
+
+def __subset_hydroTable_to_forecasts(hydroTable,forecasts,subset_hucs=None,hydro_table_cache=False):
+
+    """
+    Interpolates stages for many forecasts at once
+
+    Returns sorted HydroIDs (int32), a HydroIDs by forecasts array of stages (float64, NaN
+    where a HydroID has no forecast), the forecast names and the HUC set.
+    """
+
+    hydroTable = __load_hydroTable(hydroTable,subset_hucs,hydro_table_cache)
+    forecasts = __load_forecasts(forecasts)
+
+    # positional column names so forecasts can not collide with hydro-table columns
+    forecast_names = forecasts.columns.tolist()
+    forecast_columns = ['forecast_{}'.format(i) for i in range(len(forecast_names))]
+    forecasts.columns = forecast_columns
+
+    hydroTable = hydroTable.join(forecasts,on=['feature_id'],how='inner')
 
-    # raises error if hydroTable is empty due to all segments being lakes
     if hydroTable.empty:
-        raise hydroTableHasOnlyLakes("All stream segments in HUC are within lake boundaries.")
+        raise NoForecastFound("No forecast value found for the passed feature_ids in the Hydro-Table")
 
+    # interpolate stages
+    hydroIDs,stages = __interpolate_stages(hydroTable,forecast_columns)
 
-    if isinstance(forecast,str):
+    # huc set
+    hucSet = [str(i) for i in hydroTable.index.get_level_values('HUC').unique().to_list()]
 
-        try:
-            forecast = pd.read_csv(
-                                   forecast,
-                                   dtype={'feature_id' : str , 'discharge' : float}
-                                  )
-            forecast.set_index('feature_id',inplace=True)
-        except UnicodeDecodeError:
-            forecast = read_nwm_forecast_file(forecast)
-    
-    elif isinstance(forecast,pd.DataFrame):
-        pass # consider checking for dtypes, indices, and columns
+    return(hydroIDs,stages,forecast_names,hucSet)
+
+
+def __interpolate_stages(hydroTable,discharge_columns):
+
+    """
+    Interpolates stages from the rating curves for one or many discharge columns of a joined hydro-table
+
+    Vectorized equivalent of calling np.interp per HydroID with the discharge of the
+    HydroID's first row. Rows are sorted by HydroID once and the rating curve segment
+    for every HydroID and discharge is found in one array pass. Returns sorted HydroIDs
+    (int32) and a HydroIDs by discharge columns array of stages rounded to 4 decimals at
+    float32 precision, as stored in the catchment stages dict.
+    """
+
+    hydroIDs = hydroTable.index.get_level_values('HydroID').to_numpy().astype(np.int64)
+    discharge_cms = hydroTable.loc[:,'discharge_cms'].to_numpy(dtype=np.float64)
+    stage = hydroTable.loc[:,'stage'].to_numpy(dtype=np.float64)
+    discharges = hydroTable.loc[:,discharge_columns].to_numpy(dtype=np.float64)
+
+    hydroIDs,stages = interpolate_stages(hydroIDs,discharge_cms,stage,discharges)
+
+    # same rounding and precision as the catchment stages dict
+    stages = np.round(stages,4).astype(np.float32).astype(np.float64)
+
+    return(hydroIDs.astype(np.int32),stages)
+
+
+def interpolate_stages(hydroIDs,discharge_cms,stage,discharges):
+
+    """
+    Segmented linear interpolation of stage from discharge for all HydroIDs at once
+
+    Parameters
+    ----------
+    hydroIDs : numpy.ndarray
+        HydroID of each rating curve row.
+    discharge_cms, stage : numpy.ndarray
+        Rating curve discharge and stage of each row.
+    discharges : numpy.ndarray
+        Rows by forecasts array of discharges to interpolate. The discharge of the first row
+        of each HydroID is used.
+
+    Returns
+    -------
+    unique_hydroIDs : numpy.ndarray
+        Sorted HydroIDs.
+    stages : numpy.ndarray
+        HydroIDs by forecasts array of interpolated stages. Identical to np.interp on each
+        HydroID's rating curve. Rating curves with decreasing or nan discharges, on which
+        np.interp is not defined, are passed to np.interp directly.
+    """
+
+    # no HydroID has a forecast discharge, e.g. a branch outside of the forecast
+    if len(hydroIDs) == 0:
+        number_of_forecasts = discharges.shape[1] if discharges.ndim > 1 else 1
+        return(np.empty(0,dtype=hydroIDs.dtype),np.empty((0,number_of_forecasts),dtype=np.float64))
+
+    discharges = discharges.reshape(len(hydroIDs),-1)
+
+    # sort once, keeping the row order within each HydroID
+    sort_idx = np.argsort(hydroIDs,kind='stable')
+    hydroIDs = hydroIDs[sort_idx] ; xp = discharge_cms[sort_idx] ; fp = stage[sort_idx]
+
+    starts = np.flatnonzero(np.r_[True,hydroIDs[1:] != hydroIDs[:-1]])
+    lengths = np.diff(np.r_[starts,len(hydroIDs)])
+    lasts = starts + lengths - 1
+    groups = np.repeat(np.arange(len(starts)),lengths)
+
+    x = discharges[sort_idx[starts],:]
+
+    # np.interp's binary search gives the last rating curve point at or below the discharge.
+    # For non-decreasing curves that is the number of points at or below it, minus one.
+    at_or_below = np.add.reduceat((xp[:,np.newaxis] <= x[groups,:]).astype(np.int64),starts,axis=0)
+    j = starts[:,np.newaxis] + at_or_below - 1
+
+    stages = np.empty(x.shape,dtype=np.float64)
+
+    # below the curve, at or above the last point
+    left = at_or_below == 0
+    right = j == lasts[:,np.newaxis]
+    stages[left] = fp[np.broadcast_to(starts[:,np.newaxis],x.shape)[left]]
+    stages[right] = fp[j[right]]
+
+    # within the curve, same arithmetic as np.interp
+    inside = ~left & ~right
+    j_in = j[inside] ; x_in = x[inside]
+    with np.errstate(divide='ignore',invalid='ignore'):
+        slope = (fp[j_in + 1] - fp[j_in]) / (xp[j_in + 1] - xp[j_in])
+        interpolated = slope * (x_in - xp[j_in]) + fp[j_in]
+
+        # if we get nan in one direction, try the other
+        nan_idx = np.isnan(interpolated)
+        interpolated[nan_idx] = slope[nan_idx] * (x_in[nan_idx] - xp[j_in[nan_idx] + 1]) + fp[j_in[nan_idx] + 1]
+        flat_idx = np.isnan(interpolated) & (fp[j_in] == fp[j_in + 1])
+        interpolated[flat_idx] = fp[j_in[flat_idx]]
+
+    # avoid non-finite interpolation on exact matches
+    exact = xp[j_in] == x_in
+    interpolated[exact] = fp[j_in[exact]]
+    stages[inside] = interpolated
+
+    # np.interp returns the only stage of single point curves, even for nan discharges
+    stages[np.isnan(x) & (lengths[:,np.newaxis] > 1)] = np.nan
+
+    # np.interp is not defined for decreasing or nan discharges, use it directly to match its output
+    unsorted = (xp[1:] < xp[:-1]) | np.isnan(xp[1:]) | np.isnan(xp[:-1])
+    unsorted_groups = np.unique(np.r_[groups[1:][unsorted & (groups[1:] == groups[:-1])],
+                                      groups[np.isnan(xp)]])
+    for g in unsorted_groups:
+        curve = slice(starts[g],lasts[g] + 1)
+        stages[g,:] = np.interp(x[g,:],xp[curve],fp[curve])
+
+    return(hydroIDs[starts],stages)
+
+
+@njit
+def __make_stages_dict(hydroIDs,stages):
+
+    catchmentStagesDict = typed.Dict.empty(types.int32,types.float64)
+
+    for i in range(len(hydroIDs)):
+        catchmentStagesDict[hydroIDs[i]] = stages[i]
+
+    return(catchmentStagesDict)
+
+
+def __load_hydroTable(hydroTable,subset_hucs=None,hydro_table_cache=False):
+
+    """ Reads the hydro-table, removes lake catchments and subsets to subset_hucs if passed """
+
+    if isinstance(hydroTable,str):
+        hydroTable = read_hydroTable(hydroTable,hydro_table_cache)
+
+    elif isinstance(hydroTable,pd.DataFrame):
+        #consider checking for correct dtypes, indices, and columns
+        # read_hydroTable already dropped the lake catchments and the LakeID column
+        if "LakeID" in hydroTable.columns:
+            hydroTable = hydroTable[hydroTable["LakeID"] == -999]  # Subset hydroTable to include only non-lake catchments.
     else:
-        raise TypeError("Pass path to forecast file csv or Pandas DataFrame")
+        raise TypeError("Pass path to hydro-table csv or Pandas DataFrame")
+
+    # raises error if hydroTable is empty due to all segments being lakes
+    if hydroTable.empty:
+        raise hydroTableHasOnlyLakes("All stream segments in HUC are within lake boundaries.")
 
     # susbset hucs if passed
     if subset_hucs is not None:
@@ -529,80 +1887,234 @@ def __subset_hydroTable_to_forecast(hydroTable,forecast,subset_hucs=None):
                 except FileNotFoundError:
                     subset_hucs = [subset_hucs]
 
-    if not hydroTable.empty:
+        # subsets HUCS
+        subset_hucs_orig = subset_hucs.copy() ; subset_hucs = []
+        for huc in np.unique(hydroTable.index.get_level_values('HUC')):
+            for sh in subset_hucs_orig:
+                if huc.startswith(sh):
+                    subset_hucs += [huc]
+
+        hydroTable = hydroTable[np.in1d(hydroTable.index.get_level_values('HUC'), subset_hucs)]
+
+    return(hydroTable)
+
+
+def read_hydroTable(hydroTable,hydro_table_cache=False):
+
+    """
+    Reads the non-lake rows of a hydro-table csv indexed by HUC, feature_id, and HydroID
+
+    HydroIDs are int32. When hydro_table_cache is True, the rows are read from a binary
+    cache written next to the csv (hydroTable_cache.npz for hydroTable.csv) on first use.
+    When it is a directory, the cache is written there instead, named after the csv and a
+    hash of its path. The cache holds the stage and discharge_cms columns plus the factorized
+    index levels, so loading it only reads arrays and skips parsing the csv and building the
+    index. The cache is rebuilt when the size and hash of the csv no longer match. A csv that
+    was only touched or copied is hashed once and its new modification time stored in the
+    cache. If the cache can not be written, the csv is read as is.
+    """
+
+    if not hydro_table_cache:
+        return(__read_hydroTable_csv(hydroTable))
+
+    if hydro_table_cache is True:
+        cache_file = splitext(hydroTable)[0] + '_cache.npz'
+    else:
+        # hydro-tables of different branches can share a file name
+        path_hash = hashlib.sha1(os.path.abspath(hydroTable).encode()).hexdigest()[:16]
+        cache_file = os.path.join(hydro_table_cache,
+                                  '{}_{}_cache.npz'.format(splitext(os.path.basename(hydroTable))[0],path_hash))
+
+    source_stat = os.stat(hydroTable)
+
+    try:
+        cache = __read_hydroTable_cache(cache_file,hydroTable,source_stat)
+    except (OSError,ValueError,KeyError,zipfile.BadZipFile):
+        cache = None
+
+    if cache is None:
+        cache = __write_hydroTable_cache(cache_file,hydroTable,source_stat)
+
+    index = pd.MultiIndex(levels=[cache['HUC_levels'].astype(object),
+                                  cache['feature_id_levels'].astype(object),
+                                  cache['HydroID_levels'].astype(np.int32)],
+                          codes=[cache['HUC_codes'],cache['feature_id_codes'],cache['HydroID_codes']],
+                          names=['HUC','feature_id','HydroID'],
+                          verify_integrity=False)
+
+    return(pd.DataFrame({'stage' : cache['stage'], 'discharge_cms' : cache['discharge_cms']},index=index))
+
+
+def __read_hydroTable_csv(hydroTable):
+
+    hydroTable = pd.read_csv(
+                             hydroTable,
+                             dtype={'HUC':str,'feature_id':str,
+                                     'HydroID':np.int32,'stage':float,
+                                     'discharge_cms':float,'LakeID' : int}
+                            )
+    hydroTable.set_index(['HUC','feature_id','HydroID'],inplace=True)
+
+    hydroTable = hydroTable[hydroTable["LakeID"] == -999]  # Subset hydroTable to include only non-lake catchments.
+
+    return(hydroTable)
+
+
+def __read_hydroTable_cache(cache_file,hydroTable,source_stat):
+
+    """ Returns the cached arrays if the cache is current for the csv, None otherwise """
+
+    if not os.path.isfile(cache_file):
+        return(None)
+
+    with np.load(cache_file,allow_pickle=False) as npz:
+        cache = { k : npz[k] for k in npz.files }
 
-        if isinstance(forecast,str):
+    if int(cache['version']) != HYDROTABLE_CACHE_VERSION:
+        return(None)
+
+    if (int(cache['source_size']) == source_stat.st_size) and (int(cache['source_mtime_ns']) == source_stat.st_mtime_ns):
+        return(cache)
+
+    # the csv was touched or copied, check its content once and store its modification time
+    if (int(cache['source_size']) == source_stat.st_size) and (str(cache['source_sha1']) == __file_sha1(hydroTable)):
+        cache['source_mtime_ns'] = np.array(source_stat.st_mtime_ns,dtype=np.int64)
+        __save_hydroTable_cache(cache_file,cache)
+        return(cache)
+
+    return(None)
+
+
+def __write_hydroTable_cache(cache_file,hydroTable,source_stat):
+
+    """ Reads the csv and writes its cache. Returns the cached arrays. """
+
+    hydroTable_df = __read_hydroTable_csv(hydroTable)
+
+    cache = { 'version' : np.array(HYDROTABLE_CACHE_VERSION),
+              'source_size' : np.array(source_stat.st_size,dtype=np.int64),
+              'source_mtime_ns' : np.array(source_stat.st_mtime_ns,dtype=np.int64),
+              'source_sha1' : np.array(__file_sha1(hydroTable)),
+              'stage' : hydroTable_df['stage'].to_numpy(dtype=np.float64),
+              'discharge_cms' : hydroTable_df['discharge_cms'].to_numpy(dtype=np.float64) }
+
+    for level in ('HUC','feature_id','HydroID'):
+        values = hydroTable_df.index.get_level_values(level).to_numpy()
+        if level == 'HydroID':
+            values = values.astype(np.int32)
+        codes,uniques = pd.factorize(values,sort=True)
+        cache[level + '_codes'] = codes.astype(np.int32)
+        cache[level + '_levels'] = np.asarray(uniques) if level == 'HydroID' else np.asarray(uniques).astype(str)
+
+    __save_hydroTable_cache(cache_file,cache)
+
+    return(cache)
+
+
+def __save_hydroTable_cache(cache_file,cache):
+
+    """ Writes the cached arrays. Caches that can not be written, e.g. in read-only directories, are skipped. """
+
+    # write to a temporary file and move it in place so concurrent readers never see a partial cache
+    temp_file = None
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(cache_file)),exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(cache_file)),
+                                         suffix='.npz',delete=False) as temp_file:
+            np.savez(temp_file,**cache)
+        os.replace(temp_file.name,cache_file)
+    except OSError:
+        if (temp_file is not None) and os.path.exists(temp_file.name):
+            os.remove(temp_file.name)
+
+
+def __file_sha1(file_name,chunk_size=2**20):
+
+    sha1 = hashlib.sha1()
+    with open(file_name,'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size),b''):
+            sha1.update(chunk)
+
+    return(sha1.hexdigest())
+
+
+def read_forecast(forecast):
+
+    """ Reads a forecast csv or NWM netcdf file to a data frame of discharges indexed by feature_id """
+
+    return(__load_forecast(forecast))
+
+
+def __load_forecast(forecast):
+
+    """ Reads a forecast csv or NWM netcdf file to a data frame indexed by feature_id """
+
+    if isinstance(forecast,str):
+
+        try:
             forecast = pd.read_csv(
                                    forecast,
                                    dtype={'feature_id' : str , 'discharge' : float}
                                   )
             forecast.set_index('feature_id',inplace=True)
-        elif isinstance(forecast,pd.DataFrame):
-            pass # consider checking for dtypes, indices, and columns
-        else:
-            raise TypeError("Pass path to forecast file csv or Pandas DataFrame")
-
-        # susbset hucs if passed
-        if subset_hucs is not None:
-            if isinstance(subset_hucs,list):
-                if len(subset_hucs) == 1:
-                    try:
-                        subset_hucs = open(subset_hucs[0]).read().split('\n')
-                    except FileNotFoundError:
-                        pass
-            elif isinstance(subset_hucs,str):
-                    try:
-                        subset_hucs = open(subset_hucs).read().split('\n')
-                    except FileNotFoundError:
-                        subset_hucs = [subset_hucs]
-
-            # subsets HUCS
-            subset_hucs_orig = subset_hucs.copy() ; subset_hucs = []
-            for huc in np.unique(hydroTable.index.get_level_values('HUC')):
-                for sh in subset_hucs_orig:
-                    if huc.startswith(sh):
-                        subset_hucs += [huc]
-
-            hydroTable = hydroTable[np.in1d(hydroTable.index.get_level_values('HUC'), subset_hucs)]
-
-    # join tables
-    try:
-        hydroTable = hydroTable.join(forecast,on=['feature_id'],how='inner')
-    except AttributeError:
-        #print("FORECAST ERROR")
-        raise NoForecastFound("No forecast value found for the passed feature_ids in the Hydro-Table")
+        except UnicodeDecodeError:
+            forecast = read_nwm_forecast_file(forecast)
 
+    elif isinstance(forecast,pd.DataFrame):
+        pass # consider checking for dtypes, indices, and columns
     else:
+        raise TypeError("Pass path to forecast file csv or Pandas DataFrame")
 
-        # initialize dictionary
-        catchmentStagesDict = typed.Dict.empty(types.int32,types.float64)
+    return(forecast)
 
-        # interpolate stages
-        for hid,sub_table in hydroTable.groupby(level='HydroID'):
 
-            interpolated_stage = np.interp(sub_table.loc[:,'discharge'].unique(),sub_table.loc[:,'discharge_cms'],sub_table.loc[:,'stage'])
+def __load_forecasts(forecasts):
 
-            # add this interpolated stage to catchment stages dict
-            h = round(interpolated_stage[0],4)
+    """ Reads many forecasts to a data frame indexed by feature_id with one discharge column per forecast """
 
-            hid = types.int32(hid) ; h = types.float32(h)
-            catchmentStagesDict[hid] = h
+    if isinstance(forecasts,pd.DataFrame):
+        return(forecasts.copy())
 
-        # huc set
-        hucSet = [str(i) for i in hydroTable.index.get_level_values('HUC').unique().to_list()]
+    elif isinstance(forecasts,str):
 
-        return(catchmentStagesDict,hucSet)
+        try:
+            forecasts = pd.read_csv(forecasts,dtype={'feature_id' : str})
+            forecasts = forecasts.set_index('feature_id').astype(float)
+        except UnicodeDecodeError:
+            forecasts = read_nwm_forecast_file(forecasts,by_time=True)
 
+        return(forecasts)
 
-def read_nwm_forecast_file(forecast_file,rename_headers=True):
+    elif isinstance(forecasts,list):
+
+        # one forecast per file named after the file
+        forecast_list = []
+        for forecast_file in forecasts:
+            forecast = __load_forecast(forecast_file)
+            forecast_list += [forecast.loc[:,'discharge'].rename(splitext(os.path.basename(forecast_file))[0])]
+
+        return(pd.concat(forecast_list,axis=1))
+
+    else:
+        raise TypeError("Pass path to forecasts file, list of forecast file paths, or Pandas DataFrame")
+
+
+def read_nwm_forecast_file(forecast_file,rename_headers=True,by_time=False):
         
-    """ Reads NWM netcdf comp files and converts to forecast data frame """
+    """ Reads NWM netcdf comp files and converts to forecast data frame. If by_time, returns one discharge column per time step. """
 
     flows_nc = xr.open_dataset(forecast_file,decode_cf='feature_id',engine='netcdf4')
     
     flows_df = flows_nc.to_dataframe()
     flows_df.reset_index(inplace=True)
-    
+
+    if by_time:
+        flows_df = flows_df.pivot_table(index='feature_id',columns='time',values='streamflow')
+        flows_df.columns = [pd.Timestamp(t).strftime('%Y%m%d%H%M') for t in flows_df.columns]
+        flows_df.index = flows_df.index.astype(str)
+        flows_df.columns.name = None
+        return(flows_df.astype(float))
+
     flows_df = flows_df[['streamflow','feature_id']]
     
     if rename_headers:
@@ -618,6 +2130,16 @@ def read_nwm_forecast_file(forecast_file,rename_headers=True):
     return(flows_df)
 
 
+def __stage(profiler,stage,hucCode=None):
+
+    """ Times a stage with profiler or does nothing when profiler is None """
+
+    if profiler is None:
+        return(nullcontext())
+
+    return(profiler.stage(stage,hucCode))
+
+
 def __vprint(message,verbose):
     if verbose:
         print(message)
@@ -684,6 +2206,41 @@ if __name__ == '__main__':
                         required=False, default=None)
     parser.add_argument('-q','--quiet', help='Quiet terminal output',
                         required=False, default=False, action='store_true')
+    parser.add_argument('-k','--lookup-mode',
+                        help="""Catchment stage lookup engine. 'dict' uses the numba typed dictionary,
+                        'array' uses compiled HydroID arrays.""",
+                        required=False, default='dict', choices=['dict','array'])
+    parser.add_argument('-w','--streaming',
+                        help="""Map and write the REM block by block to bound memory use.
+                        Inundation polygons are split along block edges.""",
+                        required=False, default=False, action='store_true')
+    parser.add_argument('-x','--parallel-backend',
+                        help="""Batch mode only. Run HUCs on a 'thread' or 'process' pool. The process pool
+                        shares the hydro-table stages through shared memory.""",
+                        required=False, default='thread', choices=['thread','process'])
+    parser.add_argument('-y','--hydro-table-cache',
+                        help="""Read the hydro-table csv through a binary cache written next to it, or in
+                        the directory passed, instead of parsing the csv.""",
+                        required=False, default=False, nargs='?', const=True)
+    parser.add_argument('-g','--polygon-mode',
+                        help="""Layout of the inundation polygons. 'features' writes a polygon per connected
+                        area and HydroID, 'dissolved' one MultiPolygon per HydroID, 'extent' one
+                        MultiPolygon of the inundated extent.""",
+                        required=False, default='features', choices=['features','dissolved','extent'])
+    parser.add_argument('-o','--simplify-tolerance',
+                        help='Simplify inundation polygons with this tolerance in CRS units.',
+                        required=False, default=None, type=float)
+    parser.add_argument('-z','--raster-encoding',
+                        help="""'native' writes depths and inundation in the REM and catchments data types.
+                        'compact' writes depths as int16 centimeters and inundation as int8.""",
+                        required=False, default='native', choices=['native','compact'])
+    parser.add_argument('-v','--raster-compression',
+                        help='GeoTIFF compression of output rasters.',
+                        required=False, default='lzw', choices=['lzw','deflate','zstd'])
+    parser.add_argument('-e','--window-cache',
+                        help="""Batch mode with filter masks only. Directory to cache masked REM and
+                        catchments windows in for later runs on the same inputs.""",
+                        required=False, default=None)
 
     # extract to dictionary
     args = vars(parser.parse_args())
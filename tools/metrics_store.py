@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import os
+import csv
+import json
+import sqlite3
+import argparse
+from contextlib import contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from tools_shared_variables import TEST_CASES_DIR, METRICS_DB, MASTER_METRICS, AHPS_BENCHMARK_CATEGORIES, MAGNITUDE_DICT
+
+# a row per version, official or testing, test case, magnitude, stats mode and lid ('NA' for non-AHPS test cases)
+METRICS_KEY = ['version', 'official', 'test_id', 'magnitude', 'stats_mode', 'nws_lid']
+METRICS_ATTRIBUTES = ['huc', 'benchmark_source', 'extent_config', 'calibrated', 'flow', 'full_json_path', 'updated']
+
+# columns of the master metrics CSV around the metrics
+MASTER_METRICS_PREFIX = ['version', 'nws_lid', 'magnitude', 'huc']
+MASTER_METRICS_SUFFIX = ['full_json_path', 'flow', 'benchmark_source', 'extent_config', 'calibrated']
+
+
+class MetricsStore:
+
+    """
+    SQLite store of the evaluation metrics of test cases
+
+    Alpha tests upsert the statistics of each stats mode as they are computed, keyed by
+    METRICS_KEY, so a rerun replaces its rows and concurrent test cases can write to the same
+    store. The master metrics CSV is a query of the store instead of a crawl of the test_cases
+    tree. import_test_cases() loads the stats JSONs of test cases evaluated before the store,
+    as write_master_metrics_csv() does for the test cases of the versions it is asked for that
+    have no rows.
+    """
+
+    def __init__(self, db_path=METRICS_DB, timeout=300):
+
+        self.db_path = db_path
+        self.timeout = timeout
+
+        os.makedirs(os.path.dirname(os.path.abspath(db_path)), exist_ok=True)
+
+        columns = ', '.join('"{}"'.format(c) for c in METRICS_KEY + METRICS_ATTRIBUTES + MASTER_METRICS)
+        with self.__transaction() as connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS metrics ({}, PRIMARY KEY ({}))'.format(columns, ', '.join(METRICS_KEY)))
+
+    @staticmethod
+    def record(test_id, version, official, magnitude, stats_mode, nws_lid, stats_dictionary, full_json_path='', flow_file=None):
+
+        """ Row of the statistics of a stats mode. The flow is read from the flow file of AHPS test cases. """
+
+        huc, benchmark_source = test_id.split('_')
+
+        # as named by the FIM versions
+        if '_ms' in version:
+            extent_config = 'MS'
+        elif ('_fr' in version) or (version == 'fim_2_3_3'):
+            extent_config = 'FR'
+        else:
+            extent_config = 'COMP'
+        calibrated = 'yes' if ('_c' in version) and (version.split('_c')[1] == '') else 'no'
+
+        flow = 'NA'
+        if benchmark_source in AHPS_BENCHMARK_CATEGORIES:
+            flow = ''
+            if (flow_file is not None) and os.path.exists(flow_file):
+                with open(flow_file, newline='') as csv_file:
+                    reader = csv.reader(csv_file)
+                    next(reader)
+                    for row in reader:
+                        flow = row[1]
+
+        row = { 'version' : version, 'official' : int(bool(official)), 'test_id' : test_id, 'magnitude' : magnitude,
+                'stats_mode' : stats_mode, 'nws_lid' : nws_lid if nws_lid else 'NA', 'huc' : huc,
+                'benchmark_source' : benchmark_source, 'extent_config' : extent_config, 'calibrated' : calibrated,
+                'flow' : flow, 'full_json_path' : full_json_path, 'updated' : datetime.now().isoformat(timespec='seconds') }
+
+        for metric in MASTER_METRICS:
+            value = stats_dictionary.get(metric)
+            # numpy scalars are not bound by sqlite3
+            row[metric] = value.item() if hasattr(value, 'item') else value
+
+        return(row)
+
+    def upsert(self, records):
+
+        """ Inserts rows, replacing the rows with the same key """
+
+        records = list(records)
+        if not records:
+            return
+
+        columns = METRICS_KEY + METRICS_ATTRIBUTES + MASTER_METRICS
+        statement = 'INSERT OR REPLACE INTO metrics ({}) VALUES ({})'.format(', '.join('"{}"'.format(c) for c in columns),
+                                                                            ', '.join('?' * len(columns)))
+
+        with self.__transaction() as connection:
+            connection.executemany(statement, [[r[c] for c in columns] for r in records])
+
+    def delete(self, version, official, test_id):
+
+        """ Deletes the rows of a test case of a version, as when its directory is overwritten """
+
+        with self.__transaction() as connection:
+            connection.execute('DELETE FROM metrics WHERE version = ? AND official = ? AND test_id = ?',
+                               (version, int(bool(official)), test_id))
+
+    def query(self, official_versions=None, comparison_versions=None):
+
+        """
+        DataFrame of the rows of the official_versions and of the testing (comparison) versions
+
+        None selects every version of a kind and an empty list none.
+        """
+
+        conditions, parameters = [], []
+        for official, versions in ((1, official_versions), (0, comparison_versions)):
+            if versions is None:
+                conditions.append('(official = ?)')
+                parameters.append(official)
+            elif len(versions) > 0:
+                conditions.append('(official = ? AND version IN ({}))'.format(', '.join('?' * len(versions))))
+                parameters += [official] + list(versions)
+
+        statement = 'SELECT * FROM metrics'
+        if conditions:
+            statement += ' WHERE ' + ' OR '.join(conditions)
+        else:
+            statement += ' WHERE 0'
+        statement += ' ORDER BY benchmark_source, test_id, official DESC, magnitude, version, nws_lid, stats_mode'
+
+        with self.__transaction() as connection:
+            metrics = pd.read_sql_query(statement, connection, params=parameters)
+
+        return(metrics)
+
+    def write_master_metrics_csv(self, master_metrics_csv_output, official_versions=None, comparison_versions=(),
+                                 test_cases_dir=TEST_CASES_DIR):
+
+        """ Writes the master metrics CSV of the official and comparison versions, importing their test cases not in the store first """
+
+        self.import_missing_test_cases(official_versions, comparison_versions, test_cases_dir)
+
+        metrics = self.query(official_versions, comparison_versions)
+        metrics.loc[:, MASTER_METRICS_PREFIX + MASTER_METRICS + MASTER_METRICS_SUFFIX].to_csv(master_metrics_csv_output, index=False)
+
+        return(len(metrics))
+
+    def import_missing_test_cases(self, official_versions=None, comparison_versions=(), test_cases_dir=TEST_CASES_DIR):
+
+        """
+        Upserts the stats JSONs of the test cases of the versions of a query with no rows in the store, returns the number of rows
+
+        Rows are tracked by version and test case, so a version partly written by alpha tests still
+        gets its test cases evaluated before the store, and the JSONs of test cases in the store
+        are not read again. None selects every version of a kind.
+        """
+
+        with self.__transaction() as connection:
+            stored_test_cases = set(connection.execute('SELECT DISTINCT version, official, test_id FROM metrics').fetchall())
+
+        versions = { True : official_versions, False : comparison_versions }
+
+        number_of_rows = 0
+        for test_id, version, official, version_dir in self.__version_dirs(test_cases_dir):
+            if (versions[official] is not None) and (version not in versions[official]):
+                continue
+            if (version, int(official), test_id) in stored_test_cases:
+                continue
+            number_of_rows += self.import_version_dir(test_id, version, official, version_dir, test_cases_dir)
+
+        return(number_of_rows)
+
+    def import_version_dir(self, test_id, version, official, version_dir, test_cases_dir=TEST_CASES_DIR):
+
+        """ Upserts the stats JSONs of the magnitudes of a test case directory of a version, returns the number of rows """
+
+        huc, benchmark_source = test_id.split('_')
+        is_ahps = benchmark_source in AHPS_BENCHMARK_CATEGORIES
+
+        records = []
+        for magnitude in MAGNITUDE_DICT[benchmark_source]:
+            magnitude_dir = os.path.join(version_dir, magnitude)
+            if not os.path.isdir(magnitude_dir):
+                continue
+
+            for f in os.listdir(magnitude_dir):
+                if not f.endswith('_stats.json'):
+                    continue
+                # AHPS total_area outputs are cleaned up by the alpha test
+                if is_ahps and ('total_area' in f):
+                    continue
+
+                nws_lid = f[:5] if is_ahps else 'NA'
+                flow_file = os.path.join(test_cases_dir, benchmark_source + '_test_cases', 'validation_data_' + benchmark_source,
+                                         huc, nws_lid, magnitude, 'ahps_' + nws_lid + '_huc_' + huc + '_flows_' + magnitude + '.csv')
+
+                full_json_path = os.path.join(magnitude_dir, f)
+                with open(full_json_path) as stats_json:
+                    stats_dictionary = json.load(stats_json)
+
+                records.append(self.record(test_id, version, official, magnitude, f[:-len('_stats.json')], nws_lid,
+                                           stats_dictionary, full_json_path, flow_file if is_ahps else None))
+
+        self.upsert(records)
+
+        return(len(records))
+
+    def import_test_cases(self, test_cases_dir=TEST_CASES_DIR, benchmark_categories=tuple(MAGNITUDE_DICT), versions=None):
+
+        """ Upserts the stats JSONs of every test case, or of versions only, returns the number of rows """
+
+        number_of_rows = 0
+        for test_id, version, official, version_dir in self.__version_dirs(test_cases_dir, benchmark_categories):
+            if (versions is None) or (version in versions):
+                number_of_rows += self.import_version_dir(test_id, version, official, version_dir, test_cases_dir)
+
+        return(number_of_rows)
+
+    @staticmethod
+    def __version_dirs(test_cases_dir, benchmark_categories=tuple(MAGNITUDE_DICT)):
+
+        """ Test case, version, official and directory of every version of every test case, listing directories only """
+
+        for benchmark_source in benchmark_categories:
+            benchmark_test_case_dir = os.path.join(test_cases_dir, benchmark_source + '_test_cases')
+            if not os.path.isdir(benchmark_test_case_dir):
+                continue
+
+            for test_id in os.listdir(benchmark_test_case_dir):
+                if not test_id.endswith('_' + benchmark_source) or not test_id.split('_')[0].isdigit():
+                    continue
+
+                for official, versions_dir in ((True, 'official_versions'), (False, 'testing_versions')):
+                    versions_dir = os.path.join(benchmark_test_case_dir, test_id, versions_dir)
+                    if not os.path.isdir(versions_dir):
+                        continue
+
+                    for version in os.listdir(versions_dir):
+                        yield(test_id, version, official, os.path.join(versions_dir, version))
+
+    @contextmanager
+    def __transaction(self):
+
+        connection = sqlite3.connect(self.db_path, timeout=self.timeout)
+        try:
+            # readers do not block the alpha tests writing
+            connection.execute('PRAGMA journal_mode=WAL')
+            with connection:
+                yield connection
+        finally:
+            connection.close()
+
+
+if __name__ == '__main__':
+
+    # parse arguments
+    parser = argparse.ArgumentParser(description='Loads test case metrics into the metrics store and queries the master metrics CSV from it')
+    parser.add_argument('-s','--metrics-db',help='Path of the metrics store',required=False,default=METRICS_DB)
+    parser.add_argument('-i','--import-test-cases',help='Load the stats JSONs of the test_cases directory into the store',required=False,default=False,action='store_true')
+    parser.add_argument('-v','--versions',help='Versions to load or to query as official versions. Defaults to all.',required=False,default=None,nargs='+')
+    parser.add_argument('-dc','--dev-version-to-compare',help='Testing versions to include in the master metrics CSV',required=False,default=[],nargs='+')
+    parser.add_argument('-m','--master-metrics-csv',help='Path of the master metrics CSV to write',required=False,default=None)
+
+    args = vars(parser.parse_args())
+
+    metrics_store = MetricsStore(args['metrics_db'])
+
+    if args['import_test_cases']:
+        print("Loaded {} rows".format(metrics_store.import_test_cases(versions=args['versions'])))
+
+    if args['master_metrics_csv'] is not None:
+        number_of_rows = metrics_store.write_master_metrics_csv(args['master_metrics_csv'], args['versions'], args['dev_version_to_compare'])
+        print("Wrote {} rows to {}".format(number_of_rows, args['master_metrics_csv']))
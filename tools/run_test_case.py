@@ -1,13 +1,14 @@
 #!/usr/bin/env python3
 
 import os, re, shutil, json, sys
-import pandas as pd
 
-from tools_shared_variables import TEST_CASES_DIR, INPUTS_DIR, PREVIOUS_FIM_DIR, OUTPUTS_DIR, AHPS_BENCHMARK_CATEGORIES, MAGNITUDE_DICT, elev_raster_ndv
+from tools_shared_variables import TEST_CASES_DIR, EVALUATION_MASK_CACHE_DIR, INPUTS_DIR, PREVIOUS_FIM_DIR, OUTPUTS_DIR, AHPS_BENCHMARK_CATEGORIES, MAGNITUDE_DICT, elev_raster_ndv
 from inundation import inundate
 from gms_tools.mosaic_inundation import Mosaic_inundation
 from gms_tools.inundate_gms import Inundate_gms
+from gms_tools.overlapping_inundation import OverlapWindowComposite
 from tools_shared_functions import compute_contingency_stats_from_rasters
+from metrics_store import MetricsStore
 from utils.shared_functions import FIM_Helpers as fh
 
 class benchmark(object):
@@ -145,7 +146,7 @@ class test_case(benchmark):
         return test_case_list
 
     def alpha_test(self, calibrated=False, model='', mask_type='huc', inclusion_area='',
-                inclusion_area_buffer=0, overwrite=True, verbose=False, gms_workers=1):
+                inclusion_area_buffer=0, overwrite=True, verbose=False, gms_workers=1, zonal_stats=False):
         '''Compares a FIM directory with benchmark data from a variety of sources.
         
             Parameters
@@ -166,63 +167,22 @@ class test_case(benchmark):
                 If True, prints out all pertinent data.
             gms_workers : int
                 Number of worker processes assigned to GMS processing.
+            zonal_stats : bool
+                If True, also writes the stats of each HydroID of the predicted raster.
         '''
         
         try:
-            if not overwrite and os.path.isdir(self.dir):
-                print(f"Metrics for {self.dir} already exist. Use overwrite flag (-o) to overwrite metrics.")
+            validation_data = self.prepare_alpha_test(model, mask_type, inclusion_area, inclusion_area_buffer, overwrite, verbose)
+            if validation_data is None:
                 return
 
-            fh.vprint(f"Starting alpha test for {self.dir}", verbose)
-            
-            self.stats_modes_list = ['total_area']
-
-            # Create paths to fim_run outputs for use in inundate()
-            if model != 'GMS':
-                self.rem = os.path.join(self.fim_dir, 'rem_zeroed_masked.tif')
-                if not os.path.exists(self.rem):
-                    self.rem = os.path.join(self.fim_dir, 'rem_clipped_zeroed_masked.tif')
-                self.catchments = os.path.join(self.fim_dir, 'gw_catchments_reaches_filtered_addedAttributes.tif')
-                if not os.path.exists(self.catchments):
-                    self.catchments = os.path.join(self.fim_dir, 'gw_catchments_reaches_clipped_addedAttributes.tif')
-                self.mask_type = mask_type
-                if mask_type == 'huc':
-                    self.catchment_poly = ''
-                else:
-                    self.catchment_poly = os.path.join(self.fim_dir, 'gw_catchments_reaches_filtered_addedAttributes_crosswalked.gpkg')
-                self.hydro_table = os.path.join(self.fim_dir, 'hydroTable.csv')
-
-            # Map necessary inputs for inundate().
-            self.hucs, self.hucs_layerName = os.path.join(INPUTS_DIR, 'wbd', 'WBD_National.gpkg'), 'WBDHU8'
-
-            if inclusion_area != '':
-                inclusion_area_name = os.path.split(inclusion_area)[1].split('.')[0]  # Get layer name
-                self.mask_dict.update({inclusion_area_name: {'path': inclusion_area,
-                                                        'buffer': int(inclusion_area_buffer),
-                                                        'operation': 'include'}})
-                # Append the concatenated inclusion_area_name and buffer.
-                if inclusion_area_buffer == None:
-                    inclusion_area_buffer = 0
-                self.stats_modes_list.append(inclusion_area_name + '_b' + str(inclusion_area_buffer) + 'm')
-
-            # Delete the directory if it exists
-            if os.path.exists(self.dir):
-                shutil.rmtree(self.dir)
-            os.mkdir(self.dir)
-
-            # Get the magnitudes and lids for the current huc and loop through them
-            validation_data = self.data(self.huc)
             for magnitude in validation_data:
                 for instance in validation_data[magnitude]:      # instance will be the lid for AHPS sites and '' for other sites
                     # For each site, inundate the REM and compute aggreement raster with stats
-                    self._inundate_and_compute(magnitude, instance, model=model, verbose=verbose, gms_workers=gms_workers)
-
-                # Clean up 'total_area' outputs from AHPS sites
-                if self.is_ahps:
-                    self.clean_ahps_outputs(os.path.join(self.dir, magnitude))
+                    self._inundate_and_compute(magnitude, instance, model=model, verbose=verbose, gms_workers=gms_workers,
+                                               zonal_stats=zonal_stats)
 
-            # Write out evaluation meta-data
-            self.write_metadata(calibrated, model)
+            self.finish_alpha_test(calibrated, model, validation_data)
 
         except KeyboardInterrupt:
             print("Program aborted via keyboard interrupt")
@@ -231,13 +191,112 @@ class test_case(benchmark):
             print(ex)
             sys.exit(1)
         
+    def prepare_alpha_test(self, model='', mask_type='huc', inclusion_area='', inclusion_area_buffer=0, overwrite=True, verbose=False):
+        '''Sets up the inputs and an empty directory of the alpha_test and returns the magnitudes and lids to evaluate,
+           or None if metrics exist and overwrite is False. Parameters as in alpha_test().
+        '''
+        if not overwrite and os.path.isdir(self.dir):
+            print(f"Metrics for {self.dir} already exist. Use overwrite flag (-o) to overwrite metrics.")
+            return None
+
+        fh.vprint(f"Starting alpha test for {self.dir}", verbose)
+        
+        self.stats_modes_list = ['total_area']
+
+        # Create paths to fim_run outputs for use in inundate()
+        if model != 'GMS':
+            self.rem = os.path.join(self.fim_dir, 'rem_zeroed_masked.tif')
+            if not os.path.exists(self.rem):
+                self.rem = os.path.join(self.fim_dir, 'rem_clipped_zeroed_masked.tif')
+            self.catchments = os.path.join(self.fim_dir, 'gw_catchments_reaches_filtered_addedAttributes.tif')
+            if not os.path.exists(self.catchments):
+                self.catchments = os.path.join(self.fim_dir, 'gw_catchments_reaches_clipped_addedAttributes.tif')
+            self.mask_type = mask_type
+            if mask_type == 'huc':
+                self.catchment_poly = ''
+            else:
+                self.catchment_poly = os.path.join(self.fim_dir, 'gw_catchments_reaches_filtered_addedAttributes_crosswalked.gpkg')
+            self.hydro_table = os.path.join(self.fim_dir, 'hydroTable.csv')
+
+        # Map necessary inputs for inundate().
+        self.hucs, self.hucs_layerName = os.path.join(INPUTS_DIR, 'wbd', 'WBD_National.gpkg'), 'WBDHU8'
+
+        if inclusion_area != '':
+            inclusion_area_name = os.path.split(inclusion_area)[1].split('.')[0]  # Get layer name
+            self.mask_dict.update({inclusion_area_name: {'path': inclusion_area,
+                                                    'buffer': int(inclusion_area_buffer),
+                                                    'operation': 'include'}})
+            # Append the concatenated inclusion_area_name and buffer.
+            if inclusion_area_buffer == None:
+                inclusion_area_buffer = 0
+            self.stats_modes_list.append(inclusion_area_name + '_b' + str(inclusion_area_buffer) + 'm')
+
+        # Delete the directory if it exists
+        if os.path.exists(self.dir):
+            shutil.rmtree(self.dir)
+        os.mkdir(self.dir)
+        MetricsStore().delete(self.version, self.archive, self.test_id)
+
+        # Get the magnitudes and lids for the current huc
+        return self.data(self.huc)
+
+    def finish_alpha_test(self, calibrated, model, validation_data):
+        '''Cleans up AHPS outputs and writes the meta-data once every magnitude of the alpha_test is evaluated.'''
+        for magnitude in validation_data:
+            # Clean up 'total_area' outputs from AHPS sites
+            if self.is_ahps and os.path.isdir(os.path.join(self.dir, magnitude)):
+                self.clean_ahps_outputs(os.path.join(self.dir, magnitude))
+
+        # Write out evaluation meta-data
+        self.write_metadata(calibrated, model)
+
+    def _instance_paths(self, magnitude, lid):
+        '''Returns the output and benchmark paths of a magnitude and lid of the test case, with 'available'
+           False when a benchmark file is missing.
+        '''
+        test_case_out_dir     = os.path.join(self.dir, magnitude)
+        inundation_prefix     = lid + '_' if lid else ''
+        inundation_path       = os.path.join(test_case_out_dir, f'{inundation_prefix}inundation_extent.tif')
+
+        # Benchmark raster and flow files
+        benchmark_rast = (f'ahps_{lid}' if lid else self.benchmark_cat) + f'_huc_{self.huc}_extent_{magnitude}.tif'
+        benchmark_rast = os.path.join(self.benchmark_dir, lid, magnitude, benchmark_rast)
+        benchmark_flows = benchmark_rast.replace(f'_extent_{magnitude}.tif', f'_flows_{magnitude}.csv')
+        domain = os.path.join(self.benchmark_dir, lid, f'{lid}_domain.shp') if self.is_ahps else None
+
+        # Check to make sure all relevant files exist
+        available = os.path.isfile(benchmark_rast) and os.path.isfile(benchmark_flows) and (not self.is_ahps or os.path.isfile(domain))
+
+        return { 'test_case_out_dir' : test_case_out_dir,
+                 'inundation_path' : inundation_path,
+                 'predicted_raster_path' : inundation_path.replace('.tif', f'_{self.huc}.tif'),
+                 'benchmark_rast' : benchmark_rast,
+                 'benchmark_flows' : benchmark_flows,
+                 'domain' : domain,
+                 'available' : available }
+
+    def _mosaic_branches(self, map_file, predicted_raster_path, verbose=False):
+        '''Mosaics the GMS branch inundation rasters of map_file into the predicted raster of the HUC.'''
+        fh.vprint("Begin GMS Mosaic", verbose)
+        Mosaic_inundation( map_file,
+                            mosaic_attribute = 'inundation_rasters',
+                            mosaic_output = predicted_raster_path,
+                            mask = os.path.join(self.fim_dir,'wbd.gpkg'),
+                            unit_attribute_name = 'huc8',
+                            nodata = elev_raster_ndv,
+                            workers = 1,
+                            remove_inputs = True,
+                            subset = None,
+                            verbose = verbose )
+
     def _inundate_and_compute(self, 
                               magnitude, 
                               lid, 
                               compute_only = False, 
                               model = '',
                               verbose = False,
-                              gms_workers = 1):
+                              gms_workers = 1,
+                              zonal_stats = False):
         '''Method for inundating and computing contingency rasters as part of the alpha_test.
            Used by both the alpha_test() and composite() methods.
 
@@ -249,36 +308,36 @@ class test_case(benchmark):
                 lid of the current benchmark site. For non-AHPS sites, this should be an empty string ('').
             compute_only : bool
                 If true, skips inundation and only computes contingency stats.
+            zonal_stats : bool
+                If true, also writes the stats of each HydroID of the predicted raster.
         '''
         # Output files
         fh.vprint("Creating output files", verbose)
 
-        test_case_out_dir     = os.path.join(self.dir, magnitude)
-        inundation_prefix     = lid + '_' if lid else ''
-        inundation_path       = os.path.join(test_case_out_dir, f'{inundation_prefix}inundation_extent.tif')
-        predicted_raster_path = inundation_path.replace('.tif', f'_{self.huc}.tif')
+        paths                 = self._instance_paths(magnitude, lid)
+        test_case_out_dir     = paths['test_case_out_dir']
+        inundation_path       = paths['inundation_path']
+        predicted_raster_path = paths['predicted_raster_path']
         agreement_raster      = os.path.join(test_case_out_dir, (f'ahps_{lid}' if lid else '') +'total_area_agreement.tif')
         stats_json            = os.path.join(test_case_out_dir, 'stats.json')
         stats_csv             = os.path.join(test_case_out_dir, 'stats.csv')
+        zonal_stats_csv       = os.path.join(test_case_out_dir, (f'ahps_{lid}_' if lid else '') + 'hydroid_stats.csv')
 
         # Create directory
         if not os.path.isdir(test_case_out_dir):
             os.mkdir(test_case_out_dir)
 
-        # Benchmark raster and flow files
-        benchmark_rast = (f'ahps_{lid}' if lid else self.benchmark_cat) + f'_huc_{self.huc}_extent_{magnitude}.tif'
-        benchmark_rast = os.path.join(self.benchmark_dir, lid, magnitude, benchmark_rast)
-        benchmark_flows = benchmark_rast.replace(f'_extent_{magnitude}.tif', f'_flows_{magnitude}.csv')
+        benchmark_rast = paths['benchmark_rast']
+        benchmark_flows = paths['benchmark_flows']
         mask_dict_indiv = self.mask_dict.copy()
         if self.is_ahps: # add domain shapefile to mask for AHPS sites
-            domain = os.path.join(self.benchmark_dir, lid, f'{lid}_domain.shp')
             mask_dict_indiv.update({lid:
-                            {'path': domain,
+                            {'path': paths['domain'],
                             'buffer': None,
                             'operation': 'include'}
                                 })
         # Check to make sure all relevant files exist
-        if not os.path.isfile(benchmark_rast) or not os.path.isfile(benchmark_flows) or (self.is_ahps and not os.path.isfile(domain)):
+        if not paths['available']:
             return -1
 
         # Inundate REM
@@ -296,17 +355,7 @@ class test_case(benchmark):
                                          log_file = None,
                                          output_fileNames = None )
                 #if (len(map_file) > 0):
-                fh.vprint("Begin GMS Mosaic", verbose)
-                Mosaic_inundation( map_file,
-                                    mosaic_attribute = 'inundation_rasters',
-                                    mosaic_output = predicted_raster_path,
-                                    mask = os.path.join(self.fim_dir,'wbd.gpkg'),
-                                    unit_attribute_name = 'huc8',
-                                    nodata = elev_raster_ndv,
-                                    workers = 1,
-                                    remove_inputs = True,
-                                    subset = None,
-                                    verbose = verbose )
+                self._mosaic_branches(map_file, predicted_raster_path, verbose)
             # FIM v3 and before
             else:
                 fh.vprint("Begin FIM v3 (or earlier) Inundation", verbose)
@@ -322,28 +371,39 @@ class test_case(benchmark):
         # Create contingency rasters and stats
         fh.vprint("Begin creating contingency rasters and stats", verbose)
         if os.path.isfile(predicted_raster_path):
-            compute_contingency_stats_from_rasters( predicted_raster_path,
-                                                    benchmark_rast,
-                                                    agreement_raster,
-                                                    stats_csv=stats_csv,
-                                                    stats_json=stats_json,
-                                                    mask_values=[],
-                                                    stats_modes_list=self.stats_modes_list,
-                                                    test_id=self.test_id,
-                                                    mask_dict=mask_dict_indiv )
+            stats_dictionary = compute_contingency_stats_from_rasters( predicted_raster_path,
+                                                                       benchmark_rast,
+                                                                       agreement_raster,
+                                                                       stats_csv=stats_csv,
+                                                                       stats_json=stats_json,
+                                                                       mask_values=[],
+                                                                       stats_modes_list=self.stats_modes_list,
+                                                                       test_id=self.test_id,
+                                                                       mask_dict=mask_dict_indiv,
+                                                                       mask_cache=EVALUATION_MASK_CACHE_DIR,
+                                                                       zone_raster=predicted_raster_path if zonal_stats else None,
+                                                                       zonal_stats_csv=zonal_stats_csv )
+
+            # AHPS total_area outputs are cleaned up, only the domain of the lid is kept
+            MetricsStore().upsert([ MetricsStore.record(self.test_id, self.version, self.archive, magnitude, stats_mode, lid,
+                                                        mode_stats, os.path.join(test_case_out_dir, stats_mode + '_stats.json'),
+                                                        benchmark_flows)
+                                    for stats_mode, mode_stats in stats_dictionary.items()
+                                    if not (lid and stats_mode == 'total_area') ])
         return
 
 
     @classmethod
     def run_alpha_test(cls, version, test_id, magnitude, calibrated, model, archive_results=False, 
-                       mask_type='huc', inclusion_area='', inclusion_area_buffer=0, light_run=False, overwrite=True, verbose=False, gms_workers=1):
+                       mask_type='huc', inclusion_area='', inclusion_area_buffer=0, light_run=False, overwrite=True, verbose=False, gms_workers=1,
+                       zonal_stats=False):
         '''Class method for instantiating the test_case class and running alpha_test directly'''
 
         alpha_class = cls(test_id, version, archive_results)
         alpha_class.alpha_test(calibrated, model, mask_type, inclusion_area,
-                inclusion_area_buffer, overwrite, verbose, gms_workers)
+                inclusion_area_buffer, overwrite, verbose, gms_workers, zonal_stats)
 
-    def composite(self, version_2, calibrated = False, overwrite = True, verbose = False):
+    def composite(self, version_2, calibrated = False, overwrite = True, verbose = False, composite_rule = 'max'):
         '''Class method for compositing MS and FR inundation and creating an agreement raster with stats
 
             Parameters
@@ -354,6 +414,9 @@ class test_case(benchmark):
                 Whether or not this FIM version is calibrated.
             overwrite : bool
                 If True, overwites pre-existing test cases within the test_cases directory.
+            composite_rule : str
+                Per pixel rule of the composite, 'max' (inundated in either version) or 'priority'
+                (this version where it has data, version_2 elsewhere).
         '''
 
         if re.match(r'(.*)(_ms|_fr)', self.version):
@@ -373,6 +436,7 @@ class test_case(benchmark):
         # Delete the directory if it exists
         if os.path.exists(composite_test_case.dir):
             shutil.rmtree(composite_test_case.dir)
+        MetricsStore().delete(composite_version_name, self.archive, self.test_id)
 
         validation_data = composite_test_case.data(composite_test_case.huc)
         for magnitude in validation_data:
@@ -384,26 +448,25 @@ class test_case(benchmark):
                 output_inundation = os.path.join(composite_test_case.dir, magnitude, f'{inundation_prefix}inundation_extent.tif')
 
                 if os.path.isfile(input_inundation) and os.path.isfile(input_inundation_2):
-                    inundation_map_file = pd.DataFrame({ 
-                                            'huc8' : [composite_test_case.huc] * 2,
-                                            'branchID' : [None] * 2,
-                                            'inundation_rasters' : [input_inundation,input_inundation_2],
-                                            'depths_rasters' : [None] * 2,
-                                            'inundation_polygons' : [None] * 2
-                                        })
                     os.makedirs(os.path.dirname(output_inundation), exist_ok=True)
 
-                    fh.vprint(f"Begin mosaic inundation for version : {composite_version_name}", verbose)
-                    Mosaic_inundation(inundation_map_file,mosaic_attribute='inundation_rasters',
-                                            mosaic_output=output_inundation, mask=None, unit_attribute_name='huc8',
-                                            nodata=elev_raster_ndv, workers=1, remove_inputs=False, subset=None, verbose=False
-                                            )
-                    composite_test_case._inundate_and_compute(magnitude, instance, compute_only=True)
+                    # the extents are composited with the version each pixel comes from in one pass
+                    fh.vprint(f"Begin composite inundation for version : {composite_version_name}", verbose)
+                    composite = OverlapWindowComposite([input_inundation, input_inundation_2],
+                                                       [self.version, version_2], (30, 30))
+                    composite.composite_rasters(extent_output = fh.append_id_to_file_name(output_inundation, composite_test_case.huc),
+                                                source_output = os.path.join(composite_test_case.dir, magnitude,
+                                                                             f'{inundation_prefix}inundation_source_{composite_test_case.huc}.tif'),
+                                                rule = composite_rule,
+                                                values = 'extent')
+                    # composited extents have no HydroIDs
+                    composite_test_case._inundate_and_compute(magnitude, instance, compute_only=True, zonal_stats=False)
 
                 elif os.path.isfile(input_inundation) or os.path.isfile(input_inundation_2): 
                     # If only one model (MS or FR) has inundation, simply copy over all files as the composite
                     single_test_case = self if os.path.isfile(input_inundation) else input_test_case_2
                     shutil.copytree(single_test_case.dir, re.sub(r'(.*)(_ms|_fr)', r'\1_comp', single_test_case.dir, count=1))
+                    MetricsStore().import_version_dir(self.test_id, composite_version_name, self.archive, composite_test_case.dir)
                     composite_test_case.write_metadata(calibrated, 'COMP')
                     return
 
@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import os, argparse, json, csv, ast, re, sys, traceback, signal
+import os, argparse, ast, sys, traceback, signal
 from datetime import datetime
 from multiprocessing import Pool
 from concurrent.futures import ProcessPoolExecutor, as_completed, wait
@@ -8,212 +8,33 @@ from tqdm import tqdm
 
 from utils.shared_functions import FIM_Helpers as fh
 from run_test_case import test_case
-from tools_shared_variables import TEST_CASES_DIR, PREVIOUS_FIM_DIR, OUTPUTS_DIR, AHPS_BENCHMARK_CATEGORIES, MAGNITUDE_DICT
+from metrics_store import MetricsStore
+from alpha_test_scheduler import Schedule_alpha_tests
+from tools_shared_variables import PREVIOUS_FIM_DIR, OUTPUTS_DIR
 
 
 def create_master_metrics_csv(master_metrics_csv_output, dev_versions_to_include_list):
     """
-    This function searches for and collates metrics into a single CSV file that can queried database-style. The
-    CSV is an input to eval_plots.py. This function automatically looks for metrics produced for official versions
-    and loads them into memory to be written to the output CSV.
+    This function queries metrics from the metrics store into a single CSV file that can queried database-style. The
+    CSV is an input to eval_plots.py. This function automatically includes metrics produced for official versions.
+    Alpha tests write their metrics to the store as they run; test cases of these versions with no metrics in the store, as
+    those evaluated before it, are loaded into it from the test_cases directory first.
     
     Args:
         master_metrics_csv_output (str): Full path to CSV output. If a file already exists at this path, it will be overwritten.
         dev_versions_to_include_list (list): A list of non-official FIM version names. If a user supplied information on the command
-                                            line using the -dc flag, then this function will search for metrics in the "testing_versions"
-                                            library of metrics and include them in the CSV output.
+                                            line using the -dc flag, then this function will include their metrics from the
+                                            "testing_versions" library of metrics in the CSV output.
     
     """
-    
-    # Construct header
-    metrics_to_write = ['true_negatives_count',
-                        'false_negatives_count',
-                        'true_positives_count',
-                        'false_positives_count',
-                        'contingency_tot_count',
-                        'cell_area_m2',
-                        'TP_area_km2',
-                        'FP_area_km2',
-                        'TN_area_km2',
-                        'FN_area_km2',
-                        'contingency_tot_area_km2',
-                        'predPositive_area_km2',
-                        'predNegative_area_km2',
-                        'obsPositive_area_km2',
-                        'obsNegative_area_km2',
-                        'positiveDiff_area_km2',
-                        'CSI',
-                        'FAR',
-                        'TPR',
-                        'TNR',
-                        'PND',
-                        'PPV',
-                        'NPV',
-                        'ACC',
-                        'Bal_ACC',
-                        'MCC',
-                        'EQUITABLE_THREAT_SCORE',
-                        'PREVALENCE',
-                        'BIAS',
-                        'F1_SCORE',
-                        'TP_perc',
-                        'FP_perc',
-                        'TN_perc',
-                        'FN_perc',
-                        'predPositive_perc',
-                        'predNegative_perc',
-                        'obsPositive_perc',
-                        'obsNegative_perc',
-                        'positiveDiff_perc',
-                        'masked_count',
-                        'masked_perc',
-                        'masked_area_km2'
-                        ]
-
-
-    additional_header_info_prefix = ['version', 'nws_lid', 'magnitude', 'huc']
-    list_to_write = [additional_header_info_prefix + metrics_to_write + ['full_json_path'] + ['flow'] + ['benchmark_source'] + ['extent_config'] + ["calibrated"]]
 
     versions_to_aggregate = os.listdir(PREVIOUS_FIM_DIR)
+    # add in composite of versions
+    versions_to_aggregate += [v.replace('_ms', '_comp') for v in versions_to_aggregate if '_ms' in v]
 
-    if len(dev_versions_to_include_list) > 0:
-        iteration_list = ['official', 'comparison']
-    else:
-        iteration_list = ['official']
-
-    for benchmark_source in ['ble', 'nws', 'usgs', 'ifc','ras2fim']:
-        benchmark_test_case_dir = os.path.join(TEST_CASES_DIR, benchmark_source + '_test_cases')
-        test_cases_list = [d for d in os.listdir(benchmark_test_case_dir) if re.match('\d{8}_\w{3,7}', d)]
-        if benchmark_source in ['ble', 'ifc','ras2fim']:
-            
-            magnitude_list = MAGNITUDE_DICT[benchmark_source]
-            
-            for test_case in test_cases_list:
-                try:
-                    int(test_case.split('_')[0])
-
-                    huc = test_case.split('_')[0]
-
-                    for iteration in iteration_list:
-
-                        if iteration == "official":
-                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'official_versions')
-                            versions_to_aggregate = os.listdir(PREVIOUS_FIM_DIR)
-                            # add in composite of versions
-                            composite_versions = [v.replace('_ms', '_comp') for v in versions_to_aggregate if '_ms' in v]
-                            versions_to_aggregate += composite_versions
-                        if iteration == "comparison":
-                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'testing_versions')
-                            versions_to_aggregate = dev_versions_to_include_list
-
-                        for magnitude in magnitude_list:
-                            for version in versions_to_aggregate:
-                                if '_ms' in version:
-                                    extent_config = 'MS'
-                                elif ('_fr' in version) or (version == 'fim_2_3_3'):
-                                    extent_config = 'FR'
-                                else:
-                                    extent_config = 'COMP'
-                                if "_c" in version and version.split('_c')[1] == "":
-                                    calibrated = "yes"
-                                else:
-                                    calibrated = "no"
-                                version_dir = os.path.join(versions_to_crawl, version)
-                                magnitude_dir = os.path.join(version_dir, magnitude)
-
-                                if os.path.exists(magnitude_dir):
-                                    magnitude_dir_list = os.listdir(magnitude_dir)
-                                    for f in magnitude_dir_list:
-                                        if '.json' in f:
-                                            flow = 'NA'
-                                            nws_lid = "NA"
-                                            sub_list_to_append = [version, nws_lid, magnitude, huc]
-                                            full_json_path = os.path.join(magnitude_dir, f)
-                                            if os.path.exists(full_json_path):
-                                                stats_dict = json.load(open(full_json_path))
-                                                for metric in metrics_to_write:
-                                                    sub_list_to_append.append(stats_dict[metric])
-                                                sub_list_to_append.append(full_json_path)
-                                                sub_list_to_append.append(flow)
-                                                sub_list_to_append.append(benchmark_source)
-                                                sub_list_to_append.append(extent_config)
-                                                sub_list_to_append.append(calibrated)
-
-                                                list_to_write.append(sub_list_to_append)
-                except ValueError:
-                    pass
-        
-        if benchmark_source in AHPS_BENCHMARK_CATEGORIES:
-            test_cases_list = os.listdir(benchmark_test_case_dir)
-
-            for test_case in test_cases_list:
-                try:
-                    int(test_case.split('_')[0])
-
-                    huc = test_case.split('_')[0]
-
-                    for iteration in iteration_list:
-
-                        if iteration == "official":
-                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'official_versions')
-                            versions_to_aggregate = os.listdir(PREVIOUS_FIM_DIR)
-                            # add in composite of versions
-                            composite_versions = [v.replace('_ms', '_comp') for v in versions_to_aggregate if '_ms' in v]
-                            versions_to_aggregate += composite_versions
-                        if iteration == "comparison":
-                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'testing_versions')
-                            versions_to_aggregate = dev_versions_to_include_list
-
-                        for magnitude in ['action', 'minor', 'moderate', 'major']:
-                            for version in versions_to_aggregate:
-                                if '_ms' in version:
-                                    extent_config = 'MS'
-                                elif ('_fr' in version) or (version == 'fim_2_3_3'):
-                                    extent_config = 'FR'
-                                else:
-                                    extent_config = 'COMP'
-                                if "_c" in version and version.split('_c')[1] == "":
-                                    calibrated = "yes"
-                                else:
-                                    calibrated = "no"
-
-                                version_dir = os.path.join(versions_to_crawl, version)
-                                magnitude_dir = os.path.join(version_dir, magnitude)
-                                if os.path.exists(magnitude_dir):
-                                    magnitude_dir_list = os.listdir(magnitude_dir)
-                                    for f in magnitude_dir_list:
-                                        if '.json' in f and 'total_area' not in f:
-                                            nws_lid = f[:5]
-                                            sub_list_to_append = [version, nws_lid, magnitude, huc]
-                                            full_json_path = os.path.join(magnitude_dir, f)
-                                            flow = ''
-                                            if os.path.exists(full_json_path):
-
-                                                # Get flow used to map.
-                                                flow_file = os.path.join(benchmark_test_case_dir, 'validation_data_' + benchmark_source, huc, nws_lid, magnitude, 'ahps_' + nws_lid + '_huc_' + huc + '_flows_' + magnitude + '.csv')
-                                                if os.path.exists(flow_file):
-                                                    with open(flow_file, newline='') as csv_file:
-                                                        reader = csv.reader(csv_file)
-                                                        next(reader)
-                                                        for row in reader:
-                                                            flow = row[1]
-
-                                                stats_dict = json.load(open(full_json_path))
-                                                for metric in metrics_to_write:
-                                                    sub_list_to_append.append(stats_dict[metric])
-                                                sub_list_to_append.append(full_json_path)
-                                                sub_list_to_append.append(flow)
-                                                sub_list_to_append.append(benchmark_source)
-                                                sub_list_to_append.append(extent_config)
-                                                sub_list_to_append.append(calibrated)
-
-                                                list_to_write.append(sub_list_to_append)
-                except ValueError:
-                    pass
-    
-    with open(master_metrics_csv_output, 'w', newline='') as csvfile:
-        csv_writer = csv.writer(csvfile)
-        csv_writer.writerows(list_to_write)
+    MetricsStore().write_master_metrics_csv(master_metrics_csv_output,
+                                            official_versions = versions_to_aggregate,
+                                            comparison_versions = dev_versions_to_include_list)
 
 def progress_bar_handler(executor_dict, verbose, desc):
 
@@ -245,6 +66,9 @@ if __name__ == '__main__':
        -jb 3 -jh 25 was noticably better. You can likely go more jb cores with better success, just
          experiment.  Start times, End Times and duration are now included.
        - The -m can be any path and any name.
+       - Instead of -jh and -jb, -w runs the branches, mosaics and evaluations of all test cases in one
+         queue of that many workers, e.g. -w 80 on a 96 core machine, and reports worker utilization
+         over time. -u writes that utilization to a CSV.
     
      To see your outputs in the test_case folder (hard coded path), you can check for outputs using
          (cd .... to your test_case folder), then command becomes  find . -name gms_test_* -type d (Notice the
@@ -277,6 +101,8 @@ if __name__ == '__main__':
     parser.add_argument('-v','--fim-version',help='Name of fim version to cache.',required=False, default="all")
     parser.add_argument('-jh','--job-number-huc',help='Number of processes to use for HUC scale operations. HUC and Batch job numbers should multiply to no more than one less than the CPU count of the machine.',required=False, default=1,type=int)
     parser.add_argument('-jb','--job-number-branch',help='Number of processes to use for Branch scale operations. HUC and Batch job numbers should multiply to no more than one less than the CPU count of the machine.',required=False, default=1,type=int)
+    parser.add_argument('-w','--workers',help='Number of processes of one queue of the branch, mosaic and evaluation tasks of all test cases. Replaces -jh and -jb.',required=False, default=None,type=int)
+    parser.add_argument('-u','--utilization-csv',help='Path of a CSV of the worker utilization over time of -w.',required=False,default=None)
     parser.add_argument('-s','--special-string',help='Add a special name to the end of the branch.',required=False, default="")
     parser.add_argument('-b','--benchmark-category',help='A benchmark category to specify. Defaults to process all categories.',required=False, default="all")
     parser.add_argument('-o','--overwrite',help='Overwrite all metrics or only fill in missing metrics.',required=False, action="store_true")
@@ -285,6 +111,7 @@ if __name__ == '__main__':
     parser.add_argument('-d','--fr-run-dir',help='Name of test case directory containing FIM for FR model',required=False,default=None)
     parser.add_argument('-vr','--verbose',help='Verbose',required=False,default=None,action='store_true')
     parser.add_argument('-vg','--gms-verbose',help='GMS Verbose Progress Bar',required=False,default=None,action='store_true')
+    parser.add_argument('-z','--zonal-stats',help='Also write the stats of each HydroID of the predicted rasters (hydroid_stats.csv).',required=False,default=False,action='store_true')
 
     # Assign variables from arguments.
     args = vars(parser.parse_args())
@@ -292,6 +119,8 @@ if __name__ == '__main__':
     fim_version = args['fim_version']
     job_number_huc = args['job_number_huc']
     job_number_branch = args['job_number_branch']
+    workers = args['workers']
+    utilization_csv = args['utilization_csv']
     special_string = args['special_string']
     benchmark_category = args['benchmark_category']
     overwrite = args['overwrite']
@@ -302,6 +131,7 @@ if __name__ == '__main__':
     model = args['model']
     verbose = bool(args['verbose'])
     gms_verbose = bool(args['gms_verbose'])
+    zonal_stats = args['zonal_stats']
 
     print("================================")
     print("Start synthesize test cases")
@@ -311,9 +141,11 @@ if __name__ == '__main__':
     print()
 
     # check job numbers
-    total_cpus_requested = job_number_huc * job_number_branch
+    total_cpus_requested = job_number_huc * job_number_branch if workers is None else workers
     total_cpus_available = os.cpu_count() - 1
-    if total_cpus_requested > total_cpus_available:
+    if (workers is not None) and (workers > os.cpu_count()):
+        raise ValueError('The number of workers, {}, exceeds your machine\'s CPU count.'.format(workers))
+    elif (workers is None) and (total_cpus_requested > total_cpus_available):
         raise ValueError('The HUC job number, {}, multiplied by the branch job number, {}, '\
                           'exceeds your machine\'s available CPU count minus one. '\
                           'Please lower the job_number_huc or job_number_branch'\
@@ -341,47 +173,61 @@ if __name__ == '__main__':
     all_test_cases = test_case.list_all_test_cases(version = fim_version, archive = archive_results,
             benchmark_categories=[] if benchmark_category == "all" else [benchmark_category])
     
-    # Set up multiprocessor
-    with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
+    if workers is not None:
+        # One queue of the branches, mosaics and evaluations of all test cases
+        Schedule_alpha_tests( [t for t in all_test_cases if os.path.exists(t.fim_dir)], workers,
+                              calibrated = calibrated,
+                              model = model,
+                              mask_type = 'huc',
+                              overwrite = overwrite,
+                              verbose = True,
+                              zonal_stats = zonal_stats,
+                              utilization_csv = utilization_csv )
+    else:
+        # Set up multiprocessor
+        with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
 
-        ## Loop through all test cases, build the alpha test arguments, and submit them to the process pool
-        executor_dict = {}
-        for test_case_class in all_test_cases:
+            ## Loop through all test cases, build the alpha test arguments, and submit them to the process pool
+            executor_dict = {}
+            for test_case_class in all_test_cases:
             
-            if not os.path.exists(test_case_class.fim_dir):
-                continue
-
-            fh.vprint(f"test_case_class.test_id is {test_case_class.test_id}", verbose)
-
-            alpha_test_args = { 
-                                'calibrated': calibrated,
-                                'model': model,
-                                'mask_type': 'huc',
-                                'overwrite': overwrite,
-                                'verbose':gms_verbose if model == 'GMS' else verbose,
-                                'gms_workers': job_number_branch
-                                }
-
-            try:
-                future = executor.submit(test_case_class.alpha_test, **alpha_test_args)
-                executor_dict[future] = test_case_class.test_id
-            except Exception as ex:
-                print(f"*** {ex}")
-                traceback.print_exc()
-                sys.exit(1)
-
-        # Send the executor to the progress bar and wait for all MS tasks to finish
-        progress_bar_handler(executor_dict, True, f"Running {model} alpha test cases with {job_number_huc} workers")
-        #wait(executor_dict.keys())
+                if not os.path.exists(test_case_class.fim_dir):
+                    continue
+
+                fh.vprint(f"test_case_class.test_id is {test_case_class.test_id}", verbose)
+
+                alpha_test_args = { 
+                                    'calibrated': calibrated,
+                                    'model': model,
+                                    'mask_type': 'huc',
+                                    'overwrite': overwrite,
+                                    'verbose':gms_verbose if model == 'GMS' else verbose,
+                                    'gms_workers': job_number_branch,
+                                    'zonal_stats': zonal_stats
+                                    }
+
+                try:
+                    future = executor.submit(test_case_class.alpha_test, **alpha_test_args)
+                    executor_dict[future] = test_case_class.test_id
+                except Exception as ex:
+                    print(f"*** {ex}")
+                    traceback.print_exc()
+                    sys.exit(1)
+
+            # Send the executor to the progress bar and wait for all MS tasks to finish
+            progress_bar_handler(executor_dict, True, f"Running {model} alpha test cases with {job_number_huc} workers")
+            #wait(executor_dict.keys())
 
     ## Composite alpha test run is initiated by a MS `model` and providing a `fr_run_dir`
     if model == 'MS' and fr_run_dir:
 
+        huc_workers = job_number_huc if workers is None else workers
+
         ## Rebuild all test cases list with the FR version, loop through them and apply the alpha test
         all_test_cases = test_case.list_all_test_cases(version = fr_run_dir, archive = archive_results,
                 benchmark_categories=[] if benchmark_category == "all" else [benchmark_category])
 
-        with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
+        with ProcessPoolExecutor(max_workers=huc_workers) as executor:
             executor_dict = {}
             for test_case_class in all_test_cases:
                 if not os.path.exists(test_case_class.fim_dir):
@@ -391,7 +237,8 @@ if __name__ == '__main__':
                                     'model': model,
                                     'mask_type': 'huc',
                                     'verbose':verbose,
-                                    'overwrite': overwrite
+                                    'overwrite': overwrite,
+                                    'zonal_stats': zonal_stats
                                     }
                 try:
                     future = executor.submit(test_case_class.alpha_test, **alpha_test_args)
@@ -402,11 +249,11 @@ if __name__ == '__main__':
                     sys.exit(1)
 
             # Send the executor to the progress bar and wait for all FR tasks to finish
-            progress_bar_handler(executor_dict, True, f"Running FR test cases with {job_number_huc} workers")
+            progress_bar_handler(executor_dict, True, f"Running FR test cases with {huc_workers} workers")
             #wait(executor_dict.keys())
 
         # Loop through FR test cases, build composite arguments, and submit the composite method to the process pool
-        with ProcessPoolExecutor(max_workers=job_number_huc) as executor:
+        with ProcessPoolExecutor(max_workers=huc_workers) as executor:
             executor_dict = {}
             for test_case_class in all_test_cases:
                 composite_args = { 
@@ -425,7 +272,7 @@ if __name__ == '__main__':
                     sys.exit(1)
 
             # Send the executor to the progress bar
-            progress_bar_handler(executor_dict, verbose, f"Compositing test cases with {job_number_huc} workers")
+            progress_bar_handler(executor_dict, verbose, f"Compositing test cases with {huc_workers} workers")
 
     if dev_versions_to_compare != None:
         dev_versions_to_include_list = dev_versions_to_compare + previous_fim_list
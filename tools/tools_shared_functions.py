@@ -2,6 +2,8 @@
 
 import os
 import json
+import hashlib
+import tempfile
 import rasterio
 import pandas as pd
 import geopandas as gpd
@@ -13,11 +15,16 @@ import rasterio.shutil
 from rasterio.warp import calculate_default_transform, reproject, Resampling
 import rasterio.crs
 from rasterio import features
+from rasterio.windows import Window
 from shapely.geometry import shape
 from shapely.geometry import Polygon
 from shapely.geometry import MultiPolygon
+from shapely.geometry import box
 from dotenv import load_dotenv
 
+# width and height in pixels of the blocks of get_contingency_table_from_binary_rasters
+CONTINGENCY_BLOCK_SIZE = 2048
+
 
 def get_env_paths():
     load_dotenv()
@@ -70,7 +77,7 @@ def check_for_regression(stats_json_to_test, previous_version, previous_version_
     return difference_dict
 
 
-def compute_contingency_stats_from_rasters(predicted_raster_path, benchmark_raster_path, agreement_raster=None, stats_csv=None, stats_json=None, mask_values=None, stats_modes_list=['total_area'], test_id='', mask_dict={}):
+def compute_contingency_stats_from_rasters(predicted_raster_path, benchmark_raster_path, agreement_raster=None, stats_csv=None, stats_json=None, mask_values=None, stats_modes_list=['total_area'], test_id='', mask_dict={}, mask_cache=None, zone_raster=None, zonal_stats_csv=None):
     """
     This function contains FIM-specific logic to prepare raster datasets for use in the generic get_contingency_table_from_binary_rasters() function.
     This function also calls the generic compute_stats_from_contingency_table() function and writes the results to CSV and/or JSON, depending on user input.
@@ -81,6 +88,9 @@ def compute_contingency_stats_from_rasters(predicted_raster_path, benchmark_rast
         agreement_raster (str): Optional. An agreement raster will be written to this path. 0: True Negatives, 1: False Negative, 2: False Positive, 3: True Positive.
         stats_csv (str): Optional. Performance statistics will be written to this path. CSV allows for readability and other tabular processes.
         stats_json (str): Optional. Performance statistics will be written to this path. JSON allows for quick ingestion into Python dictionary in other processes.
+        mask_cache (str): Optional. Directory of the rasterized mask layers reused between evaluations on the same grid.
+        zone_raster (str): Optional. Path to a raster of zones, such as catchments, or the predicted raster for its HydroIDs.
+        zonal_stats_csv (str): Optional. Performance statistics of every zone and stats mode will be written to this path.
 
     Returns:
         stats_dictionary (dict): A dictionary of statistics produced by compute_stats_from_contingency_table(). Statistic names are keys and statistic values are the values.
@@ -94,7 +104,20 @@ def compute_contingency_stats_from_rasters(predicted_raster_path, benchmark_rast
     cell_area = abs(cell_x*cell_y)
 
     # Get contingency table from two rasters.
-    contingency_table_dictionary = get_contingency_table_from_binary_rasters(benchmark_raster_path, predicted_raster_path, agreement_raster, mask_values=mask_values, mask_dict=mask_dict)
+    contingency_table_dictionary = get_contingency_table_from_binary_rasters(benchmark_raster_path, predicted_raster_path, agreement_raster, mask_values=mask_values, mask_dict=mask_dict, mask_cache=mask_cache, zone_raster=zone_raster)
+
+    if zone_raster != None:
+        contingency_table_dictionary, zonal_contingency_table = contingency_table_dictionary
+
+        # Statistics of each zone from its contingency table.
+        zonal_stats = [compute_stats_from_contingency_table(row.true_negatives, row.false_negatives, row.false_positives,
+                                                            row.true_positives, cell_area, row.masked_count)
+                       for row in zonal_contingency_table.itertuples()]
+        zonal_stats = pd.concat([zonal_contingency_table.loc[:, ['zone', 'stats_mode']],
+                                 pd.DataFrame(zonal_stats, index=zonal_contingency_table.index)], axis=1)
+
+        if zonal_stats_csv != None:
+            zonal_stats.to_csv(zonal_stats_csv, index=False)
 
     stats_dictionary = {}
 
@@ -386,128 +409,282 @@ def compute_stats_from_contingency_table(true_negatives, false_negatives, false_
     return stats_dictionary
 
 
-def get_contingency_table_from_binary_rasters(benchmark_raster_path, predicted_raster_path, agreement_raster=None, mask_values=None, mask_dict={}):
+class EvaluationMask:
+
+    """
+    A mask layer of get_contingency_table_from_binary_rasters rasterized on the grid of a predicted raster
+
+    read() returns None when no polygons of the layer intersect the grid. With a mask_cache
+    directory the mask is rasterized once into a 1 bit, deflate compressed and tiled GeoTIFF
+    named by the key of the layer file (path, size and modification time), its buffer and the
+    crs, transform and shape of the grid, so later evaluations on the same grid, at any
+    magnitude or FIM version, read windows of it instead of reading and rasterizing the
+    polygons again. Without a mask_cache the polygons are rasterized for each window.
+    """
+
+    def __init__(self, geometry=None, cache_file=None):
+
+        self.geometry = geometry
+        self.cache_file = cache_file
+        self.cache_src = None
+
+    @classmethod
+    def read(cls, poly_path, buffer_val, reference, mask_cache=None, block_size=CONTINGENCY_BLOCK_SIZE):
+
+        """ Mask of a polygon layer (buffered if buffer_val) on the grid of the reference raster, or None if it has no polygons there """
+
+        if mask_cache is None:
+            geometry = cls.__read_geometry(poly_path, buffer_val, reference)
+            return(None if geometry is None else cls(geometry=geometry))
+
+        cache_file = os.path.join(mask_cache, 'mask_{}.tif'.format(cls.cache_key(poly_path, buffer_val, reference)))
+        empty_file = os.path.splitext(cache_file)[0] + '.empty'
+
+        if os.path.isfile(cache_file):
+            return(cls(cache_file=cache_file))
+        if os.path.isfile(empty_file):
+            return(None)
+
+        os.makedirs(mask_cache, exist_ok=True)
+
+        geometry = cls.__read_geometry(poly_path, buffer_val, reference)
+
+        if geometry is None:
+            pathlib.Path(empty_file).touch()
+            return(None)
+
+        # written to a temporary file first so concurrent evaluations never read a partial mask
+        temp_file = tempfile.NamedTemporaryFile(dir=mask_cache, suffix='.tif', delete=False).name
+        try:
+            with rasterio.open(temp_file, 'w', driver='GTiff', width=reference.width, height=reference.height,
+                               count=1, dtype='uint8', crs=reference.crs, transform=reference.transform,
+                               tiled=True, blockxsize=512, blockysize=512, compress='deflate', nbits=1) as dst:
+                for row_off in range(0, reference.height, block_size):
+                    window = Window(0, row_off, reference.width, min(block_size, reference.height - row_off))
+                    in_poly = features.geometry_mask(geometry, (window.height, window.width),
+                                                     reference.window_transform(window), invert=True)
+                    dst.write(in_poly.astype(np.uint8), 1, window=window)
+            os.replace(temp_file, cache_file)
+        except Exception:
+            os.remove(temp_file)
+            raise
+
+        return(cls(cache_file=cache_file))
+
+    @staticmethod
+    def cache_key(poly_path, buffer_val, reference):
+
+        """ Hash of the layer file, its buffer and the grid of the reference raster """
+
+        stat = os.stat(poly_path)
+        key = ( os.path.abspath(poly_path), stat.st_size, stat.st_mtime_ns, buffer_val,
+                reference.crs.to_wkt(), tuple(reference.transform)[:6], reference.width, reference.height )
+
+        return(hashlib.sha1(repr(key).encode()).hexdigest())
+
+    def inside(self, window, window_transform):
+
+        """ Boolean array of the pixels of a window of the grid inside the mask """
+
+        if self.cache_file is None:
+            return(features.geometry_mask(self.geometry, (window.height, window.width), window_transform, invert=True))
+
+        if self.cache_src is None:
+            self.cache_src = rasterio.open(self.cache_file)
+
+        return(self.cache_src.read(1, window=window).astype(bool))
+
+    def close(self):
+
+        if self.cache_src is not None:
+            self.cache_src.close()
+            self.cache_src = None
+
+    @staticmethod
+    def __read_geometry(poly_path, buffer_val, reference):
+
+        """ Mask polygons (buffered if buffer_val) intersecting the reference raster in its crs, or None if there are none """
+
+        bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
+        #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
+        poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+
+        if poly_all.empty:
+            return None
+
+        #Project layer to reference crs.
+        poly_all_proj = poly_all.to_crs(reference.crs)
+        if poly_all_proj.empty:
+            return None
+
+        #Check if a buffer value is passed to function.
+        if buffer_val is None:
+            return poly_all_proj.geometry
+
+        return poly_all_proj.buffer(buffer_val)
+
+
+def get_contingency_table_from_binary_rasters(benchmark_raster_path, predicted_raster_path, agreement_raster=None, mask_values=None, mask_dict={}, block_size=CONTINGENCY_BLOCK_SIZE, mask_cache=None, zone_raster=None):
     """
     Produces contingency table from 2 rasters and returns it. Also exports an agreement raster classified as:
         0: True Negatives
         1: False Negative
         2: False Positive
         3: True Positive
+        4: Masked area
+
+    The rasters are processed in blocks of block_size x block_size pixels of the predicted raster,
+    so memory use does not grow with the raster size. Each block is read once, classified and
+    bincounted for the total area and every inclusion mask at the same time.
+
+    With a zone_raster, such as a catchments raster, the same bincount is taken over the zone of
+    each pixel as well, giving the contingency table of every stats mode in every zone. Passing
+    the predicted raster as zone_raster uses its HydroIDs (positive or negative) as zones without
+    any further reads.
 
     Args:
         benchmark_raster_path (str): Path to the binary benchmark raster. 0 = phenomena not present, 1 = phenomena present, NoData = NoData.
         predicted_raster_path (str): Path to the predicted raster. 0 = phenomena not present, 1 = phenomena present, NoData = NoData.
+        block_size (int): Width and height of the blocks processed at a time.
+        mask_cache (str): Optional. Directory of the rasterized mask layers reused between evaluations on the same grid (see EvaluationMask).
+        zone_raster (str): Optional. Path to a raster of integer zones. Pixels that are NoData in it are in no zone.
 
     Returns:
         contingency_table_dictionary (dict): A Python dictionary of a contingency table. Key/value pair formatted as:
                                             {true_negatives: int, false_negatives: int, false_positives: int, true_positives: int}
+        zonal_contingency_table (DataFrame): Only returned with a zone_raster. One row per zone and stats mode with
+                                            columns zone, stats_mode, true_negatives, false_negatives, false_positives,
+                                            true_positives and masked_count, for the zones with any pixel in the stats mode.
 
     """
-    from rasterio.warp import reproject, Resampling
-    import rasterio
-    import numpy as np
-    import os
-    import rasterio.mask
-    import geopandas as gpd
-    from shapely.geometry import box
-
-#    print("-----> Evaluating performance across the total area...")
-    # Load rasters.
-    benchmark_src = rasterio.open(benchmark_raster_path)
-    predicted_src = rasterio.open(predicted_raster_path)
-    predicted_array = predicted_src.read(1)
-
-    benchmark_array_original = benchmark_src.read(1)
-
-    if benchmark_array_original.shape != predicted_array.shape:
-        benchmark_array = np.empty(predicted_array.shape, dtype=np.int8)
-
-        reproject(benchmark_array_original,
-              destination = benchmark_array,
-              src_transform = benchmark_src.transform,
-              src_crs = benchmark_src.crs,
-              src_nodata = benchmark_src.nodata,
-              dst_transform = predicted_src.transform,
-              dst_crs = predicted_src.crs,
-              dst_nodata = benchmark_src.nodata,
-              dst_resolution = predicted_src.res,
-              resampling = Resampling.nearest)
-
-    predicted_array_raw = predicted_src.read(1)
-
-    # Align the benchmark domain to the modeled domain.
-    benchmark_array = np.where(predicted_array==predicted_src.nodata, 10, benchmark_array)
-
-    # Ensure zeros and ones for binary comparison. Assume that positive values mean flooding and 0 or negative values mean dry.
-    predicted_array = np.where(predicted_array==predicted_src.nodata, 10, predicted_array)  # Reclassify NoData to 10
-    predicted_array = np.where(predicted_array<0, 0, predicted_array)
-    predicted_array = np.where(predicted_array>0, 1, predicted_array)
 
-    benchmark_array = np.where(benchmark_array==benchmark_src.nodata, 10, benchmark_array)  # Reclassify NoData to 10
+    with rasterio.open(benchmark_raster_path) as benchmark_src, rasterio.open(predicted_raster_path) as predicted_src:
 
-    agreement_array = np.add(benchmark_array, 2*predicted_array)
-    agreement_array = np.where(agreement_array>4, 10, agreement_array)
-
-    del benchmark_src, benchmark_array, predicted_array, predicted_array_raw
-
-    # Loop through exclusion masks and mask the agreement_array.
-    if mask_dict != {}:
+        # Exclusion masks are applied to the agreement of the total area, each inclusion mask is a zone of its own.
+        exclude_masks = []
+        include_masks = []
         for poly_layer in mask_dict:
 
             operation = mask_dict[poly_layer]['operation']
+            buffer_val = mask_dict[poly_layer]['buffer']
 
-            if operation == 'exclude':
-
-                poly_path = mask_dict[poly_layer]['path']
-                buffer_val = mask_dict[poly_layer]['buffer']
-
-                reference = predicted_src
+            if operation not in ('exclude', 'include'):
+                continue
 
-                bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
-                #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
-                poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+            mask = EvaluationMask.read(mask_dict[poly_layer]['path'], buffer_val, predicted_src, mask_cache, block_size)
 
-                # Make sure features are present in bounding box area before projecting. Continue to next layer if features are absent.
-                if poly_all.empty:
-                    continue
+            # Continue to next layer if features are absent.
+            if mask is None:
+                continue
 
-#                print("-----> Masking at " + poly_layer + "...")
-                #Project layer to reference crs.
-                poly_all_proj = poly_all.to_crs(reference.crs)
-                # check if there are any lakes within our reference raster extent.
-                if poly_all_proj.empty:
-                    #If no features within reference raster extent, create a zero array of same shape as reference raster.
-                    poly_mask = np.zeros(reference.shape)
-                else:
-                    #Check if a buffer value is passed to function.
-                    if buffer_val is None:
-                        #If features are present and no buffer is passed, assign geometry to variable.
-                        geometry = poly_all_proj.geometry
+            if operation == 'exclude':
+                exclude_masks.append(mask)
+            else:
+                if buffer_val == None:  # The buffer used is added to filename, and 0 is easier to read than None.
+                    buffer_val = 0
+                include_masks.append((poly_layer + '_b' + str(buffer_val) + 'm', mask))
+
+        # Benchmarks on another grid are reprojected to the grid of each predicted block, or read
+        # with shifted windows when the grids only differ by whole pixels.
+        same_shape = benchmark_src.shape == predicted_src.shape
+        pixel_offsets = __pixel_offsets(benchmark_src, predicted_src)
+
+        # Zones of the predicted raster are its HydroIDs, others are read like the benchmark.
+        zone_src = zone_offsets = None
+        if (zone_raster is not None) and (os.path.abspath(zone_raster) != os.path.abspath(predicted_raster_path)):
+            zone_src = rasterio.open(zone_raster)
+            zone_offsets = __pixel_offsets(zone_src, predicted_src)
+        zonal_counts = []
+
+        # Only write the agreement rasters if user-specified.
+        agreement_rasters = []
+        if agreement_raster != None:
+            profile = predicted_src.profile
+            profile.update(nodata=10)
+            agreement_rasters.append(rasterio.open(agreement_raster, 'w', **profile))
+            for poly_handle, _ in include_masks:
+                layer_agreement_raster = os.path.join(os.path.split(agreement_raster)[0], poly_handle + '_agreement.tif')
+                agreement_rasters.append(rasterio.open(layer_agreement_raster, 'w', **profile))
+
+        # Counts of agreement classes (0 to 4, 5 for NoData and 6 for any other value) by the inclusion masks a pixel is in.
+        number_of_zones = len(include_masks)
+        counts = np.zeros(7 * 2**number_of_zones, dtype=np.int64)
+
+        try:
+            for row_off in range(0, predicted_src.height, block_size):
+                for col_off in range(0, predicted_src.width, block_size):
+
+                    window = Window(col_off, row_off,
+                                    min(block_size, predicted_src.width - col_off),
+                                    min(block_size, predicted_src.height - row_off))
+                    window_transform = predicted_src.window_transform(window)
+
+                    predicted_array = predicted_src.read(1, window=window)
+
+                    if pixel_offsets is not None:
+                        benchmark_array = __read_shifted_window(benchmark_src, window, pixel_offsets)
+                        if not same_shape:
+                            # as reprojected in to int8
+                            benchmark_array = np.clip(benchmark_array, -128, 127).astype(np.int8)
+                    elif same_shape:
+                        benchmark_array = benchmark_src.read(1, window=window)
                     else:
-                        #If  features are present and a buffer is passed, assign buffered geometry to variable.
-                        geometry = poly_all_proj.buffer(buffer_val)
-
-                    #Perform mask operation on the reference raster and using the previously declared geometry geoseries. Invert set to true as we want areas outside of poly areas to be False and areas inside poly areas to be True.
-                    in_poly,transform,c = rasterio.mask.raster_geometry_mask(reference, geometry, invert = True)
-                    #Write mask array, areas inside polys are set to 1 and areas outside poly are set to 0.
-                    poly_mask = np.where(in_poly == True, 1,0)
-
-                    # Perform mask.
-                    masked_agreement_array = np.where(poly_mask == 1, 4, agreement_array)
-
-                    # Get rid of masked values outside of the modeled domain.
-                    agreement_array = np.where(agreement_array == 10, 10, masked_agreement_array)
+                        benchmark_array = np.empty(predicted_array.shape, dtype=np.int8)
+                        reproject(rasterio.band(benchmark_src, 1),
+                                  destination = benchmark_array,
+                                  src_transform = benchmark_src.transform,
+                                  src_crs = benchmark_src.crs,
+                                  src_nodata = benchmark_src.nodata,
+                                  dst_transform = window_transform,
+                                  dst_crs = predicted_src.crs,
+                                  dst_nodata = benchmark_src.nodata,
+                                  resampling = Resampling.nearest)
+
+                    if zone_raster is not None:
+                        zone_array, zone_valid = __read_zone_window(zone_src, zone_offsets, predicted_src,
+                                                                    predicted_array, window)
+
+                    agreement_array = __classify_agreement(benchmark_array, predicted_array,
+                                                           benchmark_src.nodata, predicted_src.nodata)
+                    del benchmark_array, predicted_array
+
+                    # Mask and get rid of masked values outside of the modeled domain.
+                    for mask in exclude_masks:
+                        in_poly = mask.inside(window, window_transform)
+                        agreement_array[in_poly & (agreement_array != 10)] = 4
+
+                    classes = np.where((agreement_array >= 0) & (agreement_array <= 4), agreement_array,
+                                       np.where(agreement_array == 10, 5, 6)).astype(np.int64)
+
+                    if agreement_rasters:
+                        agreement_rasters[0].write(agreement_array.astype(profile['dtype']), 1, window=window)
+
+                    for zone, (_, mask) in enumerate(include_masks):
+                        in_poly = mask.inside(window, window_transform)
+                        classes += (7 << zone) * in_poly
+
+                        if agreement_rasters:
+                            layer_agreement_array = np.where(~in_poly & (agreement_array != 10), 4, agreement_array)
+                            agreement_rasters[zone + 1].write(layer_agreement_array.astype(profile['dtype']), 1, window=window)
+
+                    counts += np.bincount(classes.ravel(), minlength=counts.size)
+
+                    if zone_raster is not None:
+                        zonal_counts.append(__zonal_bincount(zone_array[zone_valid], classes[zone_valid], counts.size))
+                        del zone_array, zone_valid
+
+                    del agreement_array, classes
+        finally:
+            for dst in agreement_rasters:
+                dst.close()
+            if zone_src is not None:
+                zone_src.close()
+            for mask in exclude_masks + [mask for _, mask in include_masks]:
+                mask.close()
 
     contingency_table_dictionary = {}  # Initialize empty dictionary.
 
-    # Only write the agreement raster if user-specified.
     if agreement_raster != None:
-        with rasterio.Env():
-            profile = predicted_src.profile
-            profile.update(nodata=10)
-            with rasterio.open(agreement_raster, 'w', **profile) as dst:
-                dst.write(agreement_array, 1)
-
         # Write legend text file
         legend_txt = os.path.join(os.path.split(agreement_raster)[0], 'read_me.txt')
 
@@ -525,87 +702,161 @@ def get_contingency_table_from_binary_rasters(benchmark_raster_path, predicted_r
             f.write("%s\n" % 'Results produced at: {current_time}'.format(current_time=current_time))
 
     # Store summed pixel counts in dictionary.
-    contingency_table_dictionary.update({'total_area':{'true_negatives': int((agreement_array == 0).sum()),
-                                                      'false_negatives': int((agreement_array == 1).sum()),
-                                                      'false_positives': int((agreement_array == 2).sum()),
-                                                      'true_positives': int((agreement_array == 3).sum()),
-                                                      'masked_count': int((agreement_array == 4).sum()),
-                                                      'file_handle': 'total_area'
+    stats_modes = ['total_area'] + [poly_handle for poly_handle, _ in include_masks]
+    mode_counts = __stats_mode_counts(counts, number_of_zones)
+    for stats_mode, class_counts in zip(stats_modes, mode_counts):
+        contingency_table_dictionary.update({stats_mode: __contingency_counts(class_counts, stats_mode)})
 
-                                                      }})
+    if zone_raster is None:
+        return contingency_table_dictionary
 
-    # After agreement_array is masked with default mask layers, check for inclusion masks in mask_dict.
-    if mask_dict != {}:
-        for poly_layer in mask_dict:
+    # Zones are summed over the blocks they are in.
+    zone_ids = np.concatenate([ids for ids, _ in zonal_counts])
+    zone_ids, zone_idx = np.unique(zone_ids, return_inverse=True)
+    zone_counts = np.zeros((len(zone_ids), counts.size), dtype=np.int64)
+    np.add.at(zone_counts, zone_idx, np.concatenate([block_counts for _, block_counts in zonal_counts]))
 
-            operation = mask_dict[poly_layer]['operation']
+    zonal_tables = []
+    for stats_mode, class_counts in zip(stats_modes, __stats_mode_counts(zone_counts, number_of_zones)):
+        zonal_table = pd.DataFrame(class_counts[:, :5], columns=['true_negatives', 'false_negatives', 'false_positives',
+                                                                 'true_positives', 'masked_count'])
+        zonal_table.insert(0, 'stats_mode', stats_mode)
+        zonal_table.insert(0, 'zone', zone_ids)
+        zonal_tables.append(zonal_table.loc[class_counts[:, :5].sum(axis=1) > 0])
 
-            if operation == 'include':
+    zonal_contingency_table = pd.concat(zonal_tables, ignore_index=True)
 
-                poly_path = mask_dict[poly_layer]['path']
-                buffer_val = mask_dict[poly_layer]['buffer']
+    return contingency_table_dictionary, zonal_contingency_table
 
-                reference = predicted_src
 
-                bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
-                #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
-                poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+def __pixel_offsets(benchmark_src, predicted_src):
 
-                # Make sure features are present in bounding box area before projecting. Continue to next layer if features are absent.
-                if poly_all.empty:
-                    continue
+    """ Row and column of the predicted origin on the benchmark grid if the grids only differ by whole pixels, otherwise None """
 
-#                print("-----> Evaluating performance at " + poly_layer + "...")
-                #Project layer to reference crs.
-                poly_all_proj = poly_all.to_crs(reference.crs)
-                # check if there are any lakes within our reference raster extent.
-                if poly_all_proj.empty:
-                    #If no features within reference raster extent, create a zero array of same shape as reference raster.
-                    poly_mask = np.zeros(reference.shape)
-                else:
-                    #Check if a buffer value is passed to function.
-                    if buffer_val is None:
-                        #If features are present and no buffer is passed, assign geometry to variable.
-                        geometry = poly_all_proj.geometry
-                    else:
-                        #If  features are present and a buffer is passed, assign buffered geometry to variable.
-                        geometry = poly_all_proj.buffer(buffer_val)
+    benchmark_transform, predicted_transform = benchmark_src.transform, predicted_src.transform
+
+    if (benchmark_src.crs != predicted_src.crs) or (benchmark_transform[:2] != predicted_transform[:2]) or \
+       (benchmark_transform[3:5] != predicted_transform[3:5]) or (benchmark_transform.b != 0) or (benchmark_transform.d != 0):
+        return None
+
+    col, row = ~benchmark_transform * (predicted_transform.c, predicted_transform.f)
+    if (abs(row - round(row)) > 1e-6) or (abs(col - round(col)) > 1e-6):
+        return None
+
+    return (int(round(row)), int(round(col)))
+
+
+def __read_shifted_window(benchmark_src, window, pixel_offsets):
+
+    """ Benchmark values of a predicted window on a grid shifted by pixel_offsets, NoData outside of the benchmark """
+
+    row_off, col_off = window.row_off + pixel_offsets[0], window.col_off + pixel_offsets[1]
+    benchmark_array = np.full((window.height, window.width),
+                              benchmark_src.nodata if benchmark_src.nodata is not None else 0,
+                              dtype=benchmark_src.dtypes[0])
+
+    rows = slice(max(0, -row_off), min(window.height, benchmark_src.height - row_off))
+    cols = slice(max(0, -col_off), min(window.width, benchmark_src.width - col_off))
+    if (rows.start < rows.stop) and (cols.start < cols.stop):
+        benchmark_array[rows, cols] = benchmark_src.read(1, window=Window(col_off + cols.start, row_off + rows.start,
+                                                                          cols.stop - cols.start, rows.stop - rows.start))
+
+    return benchmark_array
+
+
+def __classify_agreement(benchmark_array, predicted_array, benchmark_nodata, predicted_nodata):
+
+    """ Agreement classes of a block, 10 for NoData. Positive predicted values mean flooding and 0 or negative values mean dry. """
+
+    predicted_nodata_mask = predicted_array == predicted_nodata
+
+    agreement_array = benchmark_array + 2 * (predicted_array > 0).astype(np.int32)
+
+    # Align the benchmark domain to the modeled domain.
+    agreement_array[predicted_nodata_mask | (benchmark_array == benchmark_nodata) | (agreement_array > 4)] = 10
+
+    return agreement_array
+
+
+def __read_zone_window(zone_src, zone_offsets, predicted_src, predicted_array, window):
+
+    """ Zones of a predicted window and where they are valid, from the HydroIDs of the predicted array if zone_src is None """
+
+    if zone_src is None:
+        return(np.abs(predicted_array.astype(np.int64)), predicted_array != predicted_src.nodata)
+
+    if zone_offsets is not None:
+        zone_array = __read_shifted_window(zone_src, window, zone_offsets)
+    else:
+        zone_array = np.full(predicted_array.shape, zone_src.nodata if zone_src.nodata is not None else 0,
+                             dtype=zone_src.dtypes[0])
+        reproject(rasterio.band(zone_src, 1),
+                  destination = zone_array,
+                  src_transform = zone_src.transform,
+                  src_crs = zone_src.crs,
+                  src_nodata = zone_src.nodata,
+                  dst_transform = predicted_src.window_transform(window),
+                  dst_crs = predicted_src.crs,
+                  dst_nodata = zone_src.nodata,
+                  resampling = Resampling.nearest)
+
+    if zone_src.nodata is None:
+        return(zone_array.astype(np.int64), np.ones(zone_array.shape, dtype=bool))
+
+    return(zone_array.astype(np.int64), zone_array != zone_src.nodata)
+
+
+def __zonal_bincount(zones, codes, number_of_codes):
+
+    """ Zones present in a block and the counts of each code in them, from one bincount of zone * number_of_codes + code """
+
+    if zones.size == 0:
+        return(np.array([], dtype=np.int64), np.zeros((0, number_of_codes), dtype=np.int64))
+
+    # Zones such as HydroIDs are usually within a narrow range, otherwise they are numbered first.
+    zone_min, zone_max = zones.min(), zones.max()
+    if (zone_max - zone_min + 1) <= zones.size:
+        zone_idx = zones - zone_min
+        zone_ids = np.arange(zone_min, zone_max + 1)
+    else:
+        zone_ids, zone_idx = np.unique(zones, return_inverse=True)
+
+    block_counts = np.bincount(zone_idx * number_of_codes + codes,
+                               minlength=len(zone_ids) * number_of_codes).reshape(len(zone_ids), number_of_codes)
+    present = block_counts.any(axis=1)
+
+    return(zone_ids[present], block_counts[present])
+
+
+def __stats_mode_counts(counts, number_of_zones):
 
-                    #Perform mask operation on the reference raster and using the previously declared geometry geoseries. Invert set to true as we want areas outside of poly areas to be False and areas inside poly areas to be True.
-                    in_poly,transform,c = rasterio.mask.raster_geometry_mask(reference, geometry, invert = True)
-                    #Write mask array, areas inside polys are set to 1 and areas outside poly are set to 0.
-                    poly_mask = np.where(in_poly == True, 1, 0)
+    """ Class counts of the total area and of each inclusion mask from counts of class and inclusion masks in their last axis """
 
-                    # Perform mask.
-                    masked_agreement_array = np.where(poly_mask == 0, 4, agreement_array)  # Changed to poly_mask == 0
+    counts = counts.reshape(counts.shape[:-1] + (2**number_of_zones, 7))
+    mode_counts = [counts.sum(axis=-2)]
 
-                    # Get rid of masked values outside of the modeled domain.
-                    temp_agreement_array = np.where(agreement_array == 10, 10, masked_agreement_array)
+    # Pixels outside an inclusion mask are masked, except NoData.
+    in_zone = (np.arange(2**number_of_zones)[:, np.newaxis] >> np.arange(number_of_zones)) & 1
+    for zone in range(number_of_zones):
+        zone_counts = counts[..., in_zone[:, zone] == 1, :].sum(axis=-2)
+        outside_counts = counts[..., in_zone[:, zone] == 0, :].sum(axis=-2)
+        zone_counts[..., 4] += outside_counts[..., [0, 1, 2, 3, 4, 6]].sum(axis=-1)
+        mode_counts.append(zone_counts)
 
-                    if buffer_val == None:  # The buffer used is added to filename, and 0 is easier to read than None.
-                        buffer_val = 0
+    return mode_counts
 
-                    poly_handle = poly_layer + '_b' + str(buffer_val) + 'm'
 
-                    # Write the layer_agreement_raster.
-                    layer_agreement_raster = os.path.join(os.path.split(agreement_raster)[0], poly_handle + '_agreement.tif')
-                    with rasterio.Env():
-                        profile = predicted_src.profile
-                        profile.update(nodata=10)
-                        with rasterio.open(layer_agreement_raster, 'w', **profile) as dst:
-                            dst.write(temp_agreement_array, 1)
+def __contingency_counts(class_counts, file_handle):
 
+    return {'true_negatives': int(class_counts[0]),
+            'false_negatives': int(class_counts[1]),
+            'false_positives': int(class_counts[2]),
+            'true_positives': int(class_counts[3]),
+            'masked_count': int(class_counts[4]),
+            'file_handle': file_handle
+            }
 
-                    # Store summed pixel counts in dictionary.
-                    contingency_table_dictionary.update({poly_handle:{'true_negatives': int((temp_agreement_array == 0).sum()),
-                                                                     'false_negatives': int((temp_agreement_array == 1).sum()),
-                                                                     'false_positives': int((temp_agreement_array == 2).sum()),
-                                                                     'true_positives': int((temp_agreement_array == 3).sum()),
-                                                                     'masked_count': int((temp_agreement_array == 4).sum()),
-                                                                     'file_handle': poly_handle
-                                                                      }})
 
-    return contingency_table_dictionary
 ########################################################################
 ########################################################################
 #Functions related to categorical fim and ahps evaluation
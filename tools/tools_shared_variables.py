@@ -2,6 +2,8 @@ import os
 
 # Environmental variables and constants.
 TEST_CASES_DIR = r'/data/test_cases/'
+EVALUATION_MASK_CACHE_DIR = os.path.join(TEST_CASES_DIR, 'evaluation_mask_cache')
+METRICS_DB = os.path.join(TEST_CASES_DIR, 'metrics.sqlite')
 PREVIOUS_FIM_DIR = r'/data/previous_fim'
 OUTPUTS_DIR = os.environ['outputDataDir']
 INPUTS_DIR = r'/data/inputs'
@@ -17,6 +19,15 @@ PRINTWORTHY_STATS = ['CSI', 'TPR', 'TNR', 'FAR', 'MCC', 'TP_area_km2', 'FP_area_
 GO_UP_STATS = ['CSI', 'TPR', 'MCC', 'TN_area_km2', 'TP_area_km2', 'TN_perc', 'TP_perc', 'TNR']
 GO_DOWN_STATS = ['FAR', 'FN_area_km2', 'FP_area_km2', 'FP_perc', 'FN_perc', 'PND']
 
+# Metrics of the master metrics CSV, in order
+MASTER_METRICS = ['true_negatives_count', 'false_negatives_count', 'true_positives_count', 'false_positives_count',
+                  'contingency_tot_count', 'cell_area_m2', 'TP_area_km2', 'FP_area_km2', 'TN_area_km2', 'FN_area_km2',
+                  'contingency_tot_area_km2', 'predPositive_area_km2', 'predNegative_area_km2', 'obsPositive_area_km2',
+                  'obsNegative_area_km2', 'positiveDiff_area_km2', 'CSI', 'FAR', 'TPR', 'TNR', 'PND', 'PPV', 'NPV', 'ACC',
+                  'Bal_ACC', 'MCC', 'EQUITABLE_THREAT_SCORE', 'PREVALENCE', 'BIAS', 'F1_SCORE', 'TP_perc', 'FP_perc',
+                  'TN_perc', 'FN_perc', 'predPositive_perc', 'predNegative_perc', 'obsPositive_perc', 'obsNegative_perc',
+                  'positiveDiff_perc', 'masked_count', 'masked_perc', 'masked_area_km2']
+
 # Variables for eval_plots.py
 BAD_SITES = [
             'baki3', #USGS: ratio of evaluated vs domain is very low
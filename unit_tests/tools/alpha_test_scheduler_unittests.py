@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import json
+import shutil
+import tempfile
+import warnings
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/')
+import alpha_test_scheduler as src
+
+
+class fake_test_case:
+
+    '''
+    Stands in for run_test_case.test_case in the scheduler. Evaluations, mosaics and the
+    finishing of the test case write JSON files of their arguments in out_dir, as they run in
+    worker processes. Evaluations of the failing magnitudes and lids raise a ValueError.
+    '''
+
+    def __init__(self, test_id, out_dir, validation_data, unavailable=[], failing=[], fim_dir='', benchmark_flows=''):
+
+        self.test_id = test_id
+        self.huc = test_id.split('_')[0]
+        self.dir = os.path.join(out_dir, test_id)
+        self.fim_dir = fim_dir
+        self.benchmark_flows = benchmark_flows
+        self.validation_data = validation_data
+        self.unavailable = [ tuple(i) for i in unavailable ]
+        self.failing = [ tuple(i) for i in failing ]
+
+    def prepare_alpha_test(self, model='', mask_type='huc', overwrite=True):
+
+        os.makedirs(self.dir, exist_ok=True)
+        return(self.validation_data)
+
+    def _instance_paths(self, magnitude, lid):
+
+        test_case_out_dir = os.path.join(self.dir, magnitude)
+        return({ 'available' : (magnitude, lid) not in self.unavailable,
+                 'test_case_out_dir' : test_case_out_dir,
+                 'benchmark_flows' : self.benchmark_flows,
+                 'predicted_raster_path' : os.path.join(test_case_out_dir, f'ahps_{lid}_inundation_extent.tif' if lid else 'inundation_extent.tif') })
+
+    def _mosaic_branches(self, map_file, predicted_raster_path, verbose=False):
+
+        map_file.to_csv(os.path.splitext(predicted_raster_path)[0] + '_map_file.csv', index=False)
+
+    def _inundate_and_compute(self, magnitude, lid, compute_only=False, model='', zonal_stats=False):
+
+        if (magnitude, lid) in self.failing:
+            raise ValueError(f'{self.test_id} {magnitude} {lid} failed')
+
+        os.makedirs(os.path.join(self.dir, magnitude), exist_ok=True)
+        with open(os.path.join(self.dir, magnitude, f'evaluation_{lid}.json'), 'w') as evaluation:
+            json.dump({ 'compute_only' : compute_only, 'model' : model, 'zonal_stats' : zonal_stats }, evaluation)
+
+    def finish_alpha_test(self, calibrated, model, validation_data):
+
+        evaluations = [ os.path.join(magnitude, f) for magnitude in validation_data if os.path.isdir(os.path.join(self.dir, magnitude))
+                        for f in os.listdir(os.path.join(self.dir, magnitude)) if f.startswith('evaluation_') ]
+        with open(os.path.join(self.dir, 'finished.json'), 'a') as finished:
+            finished.write(json.dumps({ 'evaluations' : sorted(evaluations) }) + '\n')
+
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_alpha_test_scheduler(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def setUp(self):
+
+        self.out_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.out_dir, ignore_errors = True)
+
+
+    def test_utilization_timeline_success(self):
+
+        '''
+        Test that the busy workers of each interval are the seconds of the tasks in it over its
+        length, with intervals in seconds since the first task started.
+        '''
+
+        params = self.params["valid_data_task_records"].copy()
+
+        task_records = pd.DataFrame(np.array(params["tasks"]) + params["first_start"], columns=['start', 'end'])
+
+        for timeline_params in params["timelines"]:
+
+            timeline = src.utilization_timeline(task_records, params["workers"], timeline_params["interval"])
+
+            assert timeline.columns.tolist() == ['seconds', 'busy_workers', 'utilization'], "Expected the columns of a timeline"
+            assert np.allclose(timeline['seconds'], timeline_params["seconds"]), \
+                f"Expected intervals of {timeline_params['interval']} s since the first task started"
+            assert np.allclose(timeline['busy_workers'], timeline_params["busy_workers"]), \
+                f"Expected the busy workers of intervals of {timeline_params['interval']} s"
+            assert np.allclose(timeline['utilization'], np.array(timeline_params["busy_workers"]) / params["workers"]), \
+                "Expected the utilization of the workers"
+
+        # tasks of no duration
+        timeline = src.utilization_timeline(task_records.assign(end = params["first_start"], start = params["first_start"]),
+                                            params["workers"])
+        assert timeline['seconds'].tolist() == [0] and timeline['busy_workers'].tolist() == [0], \
+            "Expected one idle interval of tasks of no duration"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_collect_branch_results_success(self):
+
+        '''
+        Test that the inundation rasters of the branches of a task are added to the mosaic rows of
+        their instance, None for branches mapped without a raster, and that failed branches and
+        the branches of a failed task are left out.
+        '''
+
+        collect_branch_results = getattr(src, '__collect_branch_results')
+
+        task = [ ({ 'hydro_table' : f'hydroTable_{branch_id}.csv' }, ('12090301', branch_id), 1.0)
+                 for branch_id in ('0', '1', '2', '3') ]
+        task_results = [ ( (['inundation_0.tif'], [None], [None]), None, 0.1, True ),
+                         ( None, ValueError('no hydro-table'), 0.1, False ),
+                         ( None, None, 0.1, False ),
+                         ( (['inundation_3.tif'], [None], [None]), None, 0.1, False ) ]
+
+        instance = { 'map_rows' : [ ('12090302', '0', 'inundation_12090302_0.tif') ] }
+        collect_branch_results(instance, task, task_results, None, False)
+
+        assert instance['map_rows'] == [ ('12090302', '0', 'inundation_12090302_0.tif'),
+                                         ('12090301', '0', 'inundation_0.tif'),
+                                         ('12090301', '2', None),
+                                         ('12090301', '3', 'inundation_3.tif') ], \
+            "Expected a mosaic row of each branch mapped, after the rows of the instance"
+
+        instance = { 'map_rows' : [] }
+        collect_branch_results(instance, task, None, RuntimeError('worker died'), False)
+        assert instance['map_rows'] == [], "Expected no mosaic rows of a failed task"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_Schedule_alpha_tests_success(self):
+
+        '''
+        Test that every available magnitude and lid of every test case is evaluated once, that a
+        failed evaluation does not stop the others, that each test case is finished once after
+        its last evaluation, and that the task records and utilization CSV are written.
+        '''
+
+        params = self.params["valid_data_fake_test_cases"].copy()
+
+        test_cases = [ fake_test_case(test_case["test_id"], self.out_dir, test_case["validation_data"],
+                                      test_case["unavailable"], test_case["failing"])
+                       for test_case in params["test_cases"] ]
+        utilization_csv = os.path.join(self.out_dir, 'utilization.csv')
+
+        task_records = src.Schedule_alpha_tests( test_cases, params["workers"],
+                                                 model = params["model"],
+                                                 zonal_stats = True,
+                                                 utilization_csv = utilization_csv )
+
+        for test_case, test_case_params in zip(test_cases, params["test_cases"]):
+
+            instances = [ (magnitude, lid) for magnitude, lids in test_case_params["validation_data"].items() for lid in lids
+                          if [magnitude, lid] not in test_case_params["unavailable"] ]
+            evaluated = [ (magnitude, lid) for magnitude, lid in instances if [magnitude, lid] not in test_case_params["failing"] ]
+
+            records = task_records.loc[task_records['test_id'] == test_case.test_id]
+            assert sorted(zip(records['magnitude'], records['lid'])) == sorted(instances), \
+                f"Expected a task of each available instance of {test_case.test_id}"
+            assert (records['kind'] == 'evaluate').all(), f"Expected evaluation tasks of {params['model']}"
+            assert sorted(zip(records.loc[records['success'], 'magnitude'], records.loc[records['success'], 'lid'])) == sorted(evaluated), \
+                f"Expected the failed evaluations of {test_case.test_id} recorded"
+
+            for magnitude, lid in evaluated:
+                with open(os.path.join(test_case.dir, magnitude, f'evaluation_{lid}.json')) as evaluation:
+                    assert json.load(evaluation) == { 'compute_only' : False, 'model' : params["model"], 'zonal_stats' : True }, \
+                        f"Expected {magnitude} {lid} of {test_case.test_id} evaluated with the arguments of the scheduler"
+
+            with open(os.path.join(test_case.dir, 'finished.json')) as finished:
+                finished = [ json.loads(line) for line in finished ]
+            assert finished == [ { 'evaluations' : sorted(os.path.join(magnitude, f'evaluation_{lid}.json') for magnitude, lid in evaluated) } ], \
+                f"Expected {test_case.test_id} finished once after its last evaluation"
+
+        assert task_records['worker'].nunique() <= params["workers"], \
+            "Expected at most the workers of the scheduler"
+        assert (task_records['end'] >= task_records['start']).all(), "Expected tasks to end after they start"
+
+        timeline = pd.read_csv(utilization_csv)
+        assert timeline.columns.tolist() == ['seconds', 'busy_workers', 'utilization'], "Expected the utilization timeline written"
+        assert ((timeline['utilization'] >= 0) & (timeline['utilization'] <= 1 + 1e-9)).all(), "Expected utilizations of at most 1"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_Schedule_alpha_tests_gms_branches_success(self):
+
+        '''
+        Test that the branches of a GMS test case are mapped in branch tasks, that its mosaic gets
+        a row of every branch of the HUC, and that it is evaluated without inundating once its
+        last branch task is done.
+        This test is based on the branches of a single huc within a gms output folder.
+        '''
+
+        params = self.params["valid_data_gms_test_case"].copy()
+
+        test_case = fake_test_case(params["huc"] + '_ble', self.out_dir, { '100yr' : [''] },
+                                   fim_dir = os.path.join(params["hydrofabric_dir"], params["huc"]),
+                                   benchmark_flows = params["forecast"])
+
+        task_records = src.Schedule_alpha_tests( [test_case], params["workers"], model = 'GMS' )
+
+        hucs_branches = pd.read_csv(os.path.join(params["hydrofabric_dir"], 'gms_inputs.csv'), header=None, dtype=str)
+        branch_ids = hucs_branches.loc[hucs_branches[0] == params["huc"], 1].tolist()
+
+        branch_records = task_records.loc[task_records['kind'] == 'branches']
+        evaluation_records = task_records.loc[task_records['kind'] == 'evaluate']
+        assert branch_records['branches'].sum() == len(branch_ids), "Expected a branch task entry of every branch of the HUC"
+        assert len(evaluation_records) == 1 and evaluation_records['success'].all(), "Expected one evaluation of the instance"
+        assert evaluation_records['start'].min() >= branch_records['end'].max(), "Expected the evaluation after the last branch"
+
+        predicted_raster_path = test_case._instance_paths('100yr', '')['predicted_raster_path']
+        map_file = pd.read_csv(os.path.splitext(predicted_raster_path)[0] + '_map_file.csv', dtype={ 'huc8' : str, 'branchID' : str })
+        assert sorted(map_file['branchID']) == sorted(branch_ids), "Expected a mosaic row of every branch of the HUC"
+        assert all(os.path.isfile(r) for r in map_file['inundation_rasters'].dropna()), "Expected the branch rasters mapped"
+
+        with open(os.path.join(test_case.dir, '100yr', 'evaluation_.json')) as evaluation:
+            assert json.load(evaluation)['compute_only'], "Expected the mosaic evaluated without inundating"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+
+
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
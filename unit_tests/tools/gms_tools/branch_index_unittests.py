@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import json
+import warnings
+import unittest
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/gms_tools')
+import branch_index as src
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_branch_index(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def test_BranchIndex_build_and_branch_forecasts_success(self):
+
+        '''
+        Test for building the branch index of a hydrofabric, reading it back without a rebuild,
+        and matching forecast discharges to the branches of a single huc.
+        '''
+
+        params = self.params["valid_data_single_huc"].copy()
+
+        built_index = src.BranchIndex.build(params["hydrofabric_dir"], verbose = params["verbose"])
+        index_file = os.path.join(params["hydrofabric_dir"], src.BRANCH_INDEX_FILE_NAME)
+        assert os.path.exists(index_file), f"Expected file {index_file} but it does not exist."
+
+        branch_index = src.BranchIndex.read(params["hydrofabric_dir"], build = False)
+        assert branch_index.branches.equals(built_index.branches), "Expected the stored branches to match the built ones"
+        assert branch_index.features.equals(built_index.features), "Expected the stored feature_ids to match the built ones"
+
+        branch_forecasts = branch_index.branch_forecasts(params["forecast"])
+        huc_branches = [ ids for ids in branch_forecasts if ids[0] == params["hucs"] ]
+        assert len(huc_branches) > 0, "Expected forecast discharges for at least one branch of the huc"
+
+        wet_branch_forecasts = branch_index.branch_forecasts(params["forecast"], skip_dry = True)
+        assert set(wet_branch_forecasts) <= set(branch_forecasts), "Expected wet branches to be a subset of branches with discharges"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
@@ -5,14 +5,20 @@ import os
 import sys
 
 import json
+import tempfile
 import warnings
 import unittest
 
+import numpy as np
+import pandas as pd
+import rasterio
+
 sys.path.append('/foss_fim/unit_tests/')
 from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
 
 sys.path.append('/foss_fim/tools/gms_tools')
 import inundate_gms as src
+from mosaic_inundation import Mosaic_inundation
 
 # NOTE: This goes directly to the function.
 # Ultimately, it should emulate going through command line (not import -> direct function call)
@@ -65,6 +71,98 @@ class test_inundate_gms(unittest.TestCase):
         print("*************************************************************")
 
         
+    def test_Inundate_gms_fused_create_inundation_mosaic_single_huc_success(self):
+
+        '''
+        Test for creating the gms inundation and depths mosaics of a single huc in fused mode,
+        without branch rasters. The mosaics are expected to have the transform, shape and
+        cells of the mosaics of Inundate_gms followed by Mosaic_inundation, with and without
+        a mask.
+        '''
+
+        params = self.params["valid_data_inudation_raster_single_huc"].copy()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            branch_fileNames_df = src.Inundate_gms(hydrofabric_dir = params["hydrofabric_dir"],
+                                                   forecast = params["forecast"],
+                                                   num_workers = params["num_workers"],
+                                                   hucs = params["hucs"],
+                                                   inundation_raster = os.path.join(tmp_dir, 'branch_inundation.tif'),
+                                                   depths_raster = os.path.join(tmp_dir, 'branch_depths.tif'),
+                                                   verbose = params["verbose"])
+
+            for mask in (None, params["mask"]):
+
+                masked = 'masked' if mask is not None else 'unmasked'
+
+                mosaic_fileNames_df = src.Inundate_gms_fused(hydrofabric_dir = params["hydrofabric_dir"],
+                                                             forecast = params["forecast"],
+                                                             num_workers = params["num_workers"],
+                                                             hucs = params["hucs"],
+                                                             inundation_raster = os.path.join(tmp_dir, f'fused_inundation_{masked}.tif'),
+                                                             depths_raster = os.path.join(tmp_dir, f'fused_depths_{masked}.tif'),
+                                                             mask = mask,
+                                                             verbose = params["verbose"],
+                                                             log_file = params["log_file"])
+
+                assert len(mosaic_fileNames_df) == 1, "Expected one mosaic record for the huc"
+                assert mosaic_fileNames_df.loc[0,'uncompressed_io_bytes_saved'] > 0, "Expected raster I/O to be saved"
+
+                for mosaic_attribute in ('inundation_rasters', 'depths_rasters'):
+
+                    mosaic = mosaic_fileNames_df.loc[0,mosaic_attribute]
+                    assert os.path.exists(mosaic), f"Expected file {mosaic} but it does not exist."
+
+                    expected_mosaic = Mosaic_inundation(branch_fileNames_df.dropna(subset = [mosaic_attribute]),
+                                                        mosaic_attribute = mosaic_attribute,
+                                                        mosaic_output = os.path.join(tmp_dir, f'expected_{mosaic_attribute}_{masked}.tif'),
+                                                        mask = mask,
+                                                        verbose = False,
+                                                        is_mosaic_for_gms_branches = True)
+
+                    with rasterio.open(mosaic) as fused, rasterio.open(expected_mosaic) as expected:
+                        assert fused.transform == expected.transform, f"Expected the transform of the {masked} {mosaic_attribute} mosaic"
+                        assert fused.shape == expected.shape, f"Expected the shape of the {masked} {mosaic_attribute} mosaic"
+                        assert np.array_equal(fused.read(1), expected.read(1)), \
+                            f"Expected the cells of the {masked} {mosaic_attribute} mosaic"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_Inundate_gms_branch_runtimes_single_huc_success(self):
+
+        '''
+        Test for scheduling the branches of a single huc by estimated cost and
+        writing the estimated and measured runtime of each branch.
+        '''
+
+        params = self.params["valid_data_inudation_raster_single_huc"].copy()
+
+        output_fileNames_df = src.Inundate_gms(hydrofabric_dir = params["hydrofabric_dir"],
+                                               forecast = params["forecast"],
+                                               num_workers = params["num_workers"],
+                                               hucs = params["hucs"],
+                                               inundation_raster = params["inundation_raster"],
+                                               verbose = params["verbose"],
+                                               log_file = params["log_file"],
+                                               scheduling = 'cost',
+                                               branch_runtimes_csv = params["branch_runtimes_csv"])
+
+        assert len(output_fileNames_df) > 0, "Expected as least one dataframe record"
+        assert os.path.exists(params["branch_runtimes_csv"]), "Branch runtimes file expected and does not exist"
+
+        branch_runtimes = pd.read_csv(params["branch_runtimes_csv"], dtype={'huc8':str,'branchID':str})
+        assert len(branch_runtimes) == len(output_fileNames_df), "Expected one runtime record per branch"
+        assert (branch_runtimes['estimated_seconds'] > 0).all(), "Expected positive estimated costs"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
     # ***********************
 
 
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import json
+import shutil
+import tempfile
+import warnings
+import unittest
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/gms_tools')
+import inundation_service as src
+from inundate_gms import Inundate_gms
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_inundation_service(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def setUp(self):
+
+        self.out_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.out_dir, ignore_errors = True)
+
+
+    def assert_rasters_match(self, fileNames_df, expected_fileNames_df):
+
+        '''
+        Asserts that every branch raster of fileNames_df has the transform and array of the raster of the
+        same branch in expected_fileNames_df, and that both have rasters of the same branches
+        '''
+
+        rasters = fileNames_df.dropna(subset=['inundation_rasters']).set_index(['huc8','branchID'])['inundation_rasters']
+        expected_rasters = expected_fileNames_df.dropna(subset=['inundation_rasters']) \
+                                                .set_index(['huc8','branchID'])['inundation_rasters']
+
+        assert sorted(rasters.index) == sorted(expected_rasters.index), "Expected rasters of the same branches"
+
+        for ids, raster in rasters.items():
+            with rasterio.open(raster) as output, rasterio.open(expected_rasters[ids]) as expected:
+                assert output.transform == expected.transform, f"Expected the transform of branch {ids}"
+                assert np.array_equal(output.read(1), expected.read(1)), f"Expected the pixels of branch {ids}"
+
+
+    def test_InundationService_repeat_forecast_single_huc_success(self):
+
+        '''
+        Test for inundating the branches of a single huc twice with the same warm workers.
+        Both forecasts are expected to write the same branch rasters.
+        '''
+
+        params = self.params["valid_data_inudation_raster_single_huc"].copy()
+
+        with src.InundationService(hydrofabric_dir = params["hydrofabric_dir"],
+                                   num_workers = params["num_workers"],
+                                   hucs = params["hucs"],
+                                   verbose = params["verbose"]) as service:
+
+            first_fileNames_df = service.inundate(params["forecast"],
+                                                  inundation_raster = params["inundation_raster"],
+                                                  log_file = params["log_file"])
+
+            second_fileNames_df = service.inundate(params["forecast"],
+                                                   inundation_raster = os.path.join(self.out_dir, 'second_forecast.tif'),
+                                                   log_file = params["log_file"])
+
+        assert len(first_fileNames_df) > 0, "Expected as least one dataframe record"
+        assert len(service.latencies) == 2, "Expected the latency of both forecasts"
+
+        for raster in first_fileNames_df['inundation_rasters']:
+            assert os.path.exists(raster), f"Expected file {raster} but it does not exist."
+
+        self.assert_rasters_match(second_fileNames_df, first_fileNames_df)
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_InundationService_matches_Inundate_gms_success(self):
+
+        '''
+        Test that the service writes the branch rasters Inundate_gms writes for the same forecast,
+        with and without prune_branches. The discharges of the last branch of the huc are dropped
+        from the forecast, so it is mapped all dry without pruning and skipped with it.
+        '''
+
+        params = self.params["valid_data_inudation_raster_single_huc"].copy()
+
+        hucs_branches = pd.read_csv(os.path.join(params["hydrofabric_dir"], 'gms_inputs.csv'), header=None, dtype=str)
+        last_branch = hucs_branches.loc[hucs_branches[0] == params["hucs"], 1].iloc[-1]
+        hydroTable = pd.read_csv(os.path.join(params["hydrofabric_dir"], params["hucs"], 'branches', last_branch,
+                                              f'hydroTable_{last_branch}.csv'), dtype={ 'feature_id' : str })
+
+        forecast = pd.read_csv(params["forecast"], dtype={ 'feature_id' : str })
+        forecast = forecast.loc[~forecast['feature_id'].isin(hydroTable['feature_id']),:]
+        forecast_file = os.path.join(self.out_dir, 'forecast.csv')
+        forecast.to_csv(forecast_file, index=False)
+
+        with src.InundationService(hydrofabric_dir = params["hydrofabric_dir"],
+                                   num_workers = params["num_workers"],
+                                   hucs = params["hucs"]) as service:
+
+            for prune_branches in (False, True):
+
+                gms_fileNames_df = Inundate_gms(params["hydrofabric_dir"], forecast_file,
+                                                num_workers = params["num_workers"],
+                                                hucs = params["hucs"],
+                                                inundation_raster = os.path.join(self.out_dir, f'gms_{prune_branches}.tif'),
+                                                prune_branches = prune_branches)
+
+                service_fileNames_df = service.inundate(forecast_file,
+                                                        inundation_raster = os.path.join(self.out_dir, f'service_{prune_branches}.tif'),
+                                                        prune_branches = prune_branches)
+
+                mapped = (service_fileNames_df['branchID'] == last_branch).any()
+                assert mapped != prune_branches, \
+                    f"Expected the branch without discharges {'skipped' if prune_branches else 'mapped'}"
+
+                self.assert_rasters_match(service_fileNames_df, gms_fileNames_df)
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
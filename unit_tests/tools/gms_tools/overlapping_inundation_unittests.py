@@ -0,0 +1,568 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import json
+import pickle
+import shutil
+import tempfile
+import warnings
+import unittest
+
+from functools import partial
+
+import geopandas as gpd
+import numpy as np
+import rasterio
+from affine import Affine
+from shapely.geometry import Polygon
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/gms_tools')
+import overlapping_inundation as src
+
+
+def write_overlapping_rasters(out_dir, params, seed=0):
+
+    '''
+    Writes the overlapping depth rasters of params, with dry cells and nodata, on one grid
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    raster_paths = []
+    for i, raster in enumerate(params["rasters"]):
+
+        depths = rng.uniform(-1, 5, (raster["height"], raster["width"])).astype(np.float32)
+        depths[depths < 0] = 0
+        depths[rng.random(depths.shape) < 0.1] = params["nodata"]
+
+        raster_paths.append(ut_helpers.write_synthetic_raster( os.path.join(out_dir, f'depths_{i}.tif'), depths, params,
+                                                               raster["row_off"], raster["col_off"], params["nodata"] ))
+
+    return(raster_paths)
+
+
+def write_mask_polygons(out_dir, params):
+
+    '''
+    Writes the mask polygons of params to a geopackage
+    '''
+
+    mask_path = os.path.join(out_dir, 'mask.gpkg')
+    gpd.GeoDataFrame( geometry = [ Polygon(p) for p in params["mask_polygons"] ],
+                      crs = params["crs"] ).to_file(mask_path, driver = 'GPKG')
+
+    return(mask_path)
+
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_overlapping_inundation(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def setUp(self):
+
+        self.out_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.out_dir, ignore_errors = True)
+
+
+    def test_merge_rasters_mask_matches_mask_mosaic_success(self):
+
+        '''
+        Test that masking windows while merging gives the raster of merging and then masking the
+        mosaic with mask_mosaic, with the mask rasterized, read from the memory cache and read
+        from the disk cache, and that the memory cache stays within its byte limit.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        mask_path = write_mask_polygons(self.out_dir, params)
+        mask_cache = os.path.join(self.out_dir, 'mask_cache')
+
+        # merge, then mask
+        mosaic = os.path.join(self.out_dir, 'mosaic.tif')
+        expected_mosaic = os.path.join(self.out_dir, 'expected_mosaic.tif')
+        overlap = src.OverlapWindowMerge(raster_paths, params["num_partitions"])
+        overlap.merge_rasters(mosaic, nodata = params["nodata"])
+        overlap.mask_mosaic(mosaic, mask_path, outfile = expected_mosaic)
+
+        with rasterio.open(expected_mosaic) as expected:
+            expected_array, expected_transform = expected.read(1), expected.transform
+
+        src.MosaicMask.memory_cache.clear()
+        for mask_source in ('rasterized', 'memory', 'disk'):
+
+            if mask_source == 'disk':
+                src.MosaicMask.memory_cache.clear()
+
+            masked_mosaic = os.path.join(self.out_dir, f'masked_mosaic_{mask_source}.tif')
+            src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters( masked_mosaic,
+                                                                                            nodata = params["nodata"],
+                                                                                            mask = mask_path,
+                                                                                            mask_cache = mask_cache )
+
+            with rasterio.open(masked_mosaic) as masked:
+                assert masked.transform == expected_transform, f"Expected the mask_mosaic transform with a {mask_source} mask"
+                assert np.array_equal(masked.read(1), expected_array), f"Expected the mask_mosaic raster with a {mask_source} mask"
+
+        # masks beyond the byte limit are evicted, least recently used first
+        max_memory_cache_bytes = src.MosaicMask.max_memory_cache_bytes
+        try:
+            grid = (overlap.proc_unit_transform, overlap.proc_unit_width, overlap.proc_unit_height)
+            mask_bytes = src.MosaicMask.rasterize(mask_path, *grid).inside.nbytes
+            src.MosaicMask.max_memory_cache_bytes = mask_bytes
+
+            src.MosaicMask.rasterize(mask_path, overlap.proc_unit_transform * Affine.translation(1, 0), *grid[1:])
+            assert len(src.MosaicMask.memory_cache) == 1, "Expected only the last mask within the byte limit"
+
+            src.MosaicMask.max_memory_cache_bytes = mask_bytes - 1
+            src.MosaicMask.memory_cache.clear()
+            src.MosaicMask.rasterize(mask_path, *grid)
+            assert len(src.MosaicMask.memory_cache) == 0, "Expected a mask larger than the byte limit not to be kept"
+        finally:
+            src.MosaicMask.max_memory_cache_bytes = max_memory_cache_bytes
+            src.MosaicMask.memory_cache.clear()
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_merge_rasters_threaded_matches_serial_merge_success(self):
+
+        '''
+        Test that merging columns of windows on a pool of threads or of processes, with one
+        column in flight at a time, gives the raster of the serial merge, with and without a
+        mask, and that the handles of the dataset pool are closed afterwards.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        mask_path = write_mask_polygons(self.out_dir, params)
+
+        for mask in (None, mask_path):
+
+            masked = 'masked' if mask is not None else 'unmasked'
+            serial_mosaic = os.path.join(self.out_dir, f'serial_mosaic_{masked}.tif')
+            src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters( serial_mosaic,
+                                                                                         nodata = params["nodata"],
+                                                                                         mask = mask )
+            with rasterio.open(serial_mosaic) as serial:
+                serial_profile, serial_array = serial.profile, serial.read(1)
+
+            for backend in ('thread', 'process'):
+
+                threaded_mosaic = os.path.join(self.out_dir, f'{backend}_mosaic_{masked}.tif')
+                overlap = src.OverlapWindowMerge(raster_paths, params["num_partitions"])
+                overlap.merge_rasters( threaded_mosaic, nodata = params["nodata"], threaded = True, workers = 2,
+                                       backend = backend, max_in_flight = 1, mask = mask )
+
+                with rasterio.open(threaded_mosaic) as threaded:
+                    assert threaded.profile == serial_profile, f"Expected the profile of the serial merge on {backend}s, {masked}"
+                    assert np.array_equal(threaded.read(1), serial_array), \
+                        f"Expected the raster of the serial merge on {backend}s, {masked}"
+
+                assert len(overlap.pool.idle_rsts) == 0, f"Expected the handles of the pool closed on {backend}s"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_merge_rasters_cog_matches_merge_success(self):
+
+        '''
+        Test that merging into a cloud optimized GeoTIFF gives tiles of COG_BLOCKSIZE, the overview
+        levels of cog_overview_factors and the band of the plain merge.
+        '''
+
+        params = self.params["valid_data_cog_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+
+        mosaic = os.path.join(self.out_dir, 'mosaic.tif')
+        cog_mosaic = os.path.join(self.out_dir, 'cog_mosaic.tif')
+        src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters(mosaic, nodata = params["nodata"])
+        src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters(cog_mosaic, nodata = params["nodata"],
+                                                                                     cog = True)
+
+        with rasterio.open(mosaic) as merged, rasterio.open(cog_mosaic) as cog:
+
+            factors = src.cog_overview_factors(cog.width, cog.height)
+            assert len(factors) > 0, "Expected a mosaic larger than one block"
+            assert cog.overviews(1) == factors, "Expected the overview levels of cog_overview_factors"
+
+            assert cog.profile['tiled'], "Expected a tiled COG"
+            assert cog.block_shapes == [ (src.COG_BLOCKSIZE, src.COG_BLOCKSIZE) ], "Expected blocks of COG_BLOCKSIZE"
+
+            for key in ('crs', 'transform', 'width', 'height', 'dtype', 'nodata'):
+                assert cog.profile[key] == merged.profile[key], f"Expected the {key} of the plain merge"
+            assert np.array_equal(cog.read(1), merged.read(1)), "Expected the band of the plain merge"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_index_windows_and_reduce_window_data_match_stacked_merge_success(self):
+
+        '''
+        Test that index_windows gives the windows each input covers, with input edges on window
+        boundaries, that they are among those of get_window_idx, and that reducing the windows
+        one input at a time gives the mosaic of stacking the inputs of the get_window_idx windows
+        for np.nanmax with aggregate_data.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        overlap = src.OverlapWindowMerge(raster_paths, params["num_partitions"])
+
+        window_bounds, window_idx = overlap.get_window_coords()
+        latitudes, longitudes, path_points, bbox = overlap.create_lat_lons(window_bounds, window_idx)
+        transform, height, width = overlap.proc_unit_transform, overlap.proc_unit_height, overlap.proc_unit_width
+
+        data_dict = overlap.index_windows(window_bounds, window_idx)
+
+        stacked_data_dict = {}
+        for idx, coords in enumerate(overlap.depth_bounds):
+            for win_idx in overlap.get_window_idx(latitudes, longitudes, coords, overlap.partitions):
+                stacked_data_dict.setdefault(int(win_idx), []).append(idx)
+
+        # windows sharing more than an edge with each input
+        for win_idx in range(len(bbox)):
+            final_window = src.read_window_data(win_idx, [], [], path_points, bbox, transform)[0]
+            final_rows = (final_window.row_off, final_window.row_off + final_window.height)
+            final_cols = (final_window.col_off, final_window.col_off + final_window.width)
+
+            expected_datasets = []
+            for idx, rst in enumerate(overlap.depth_rsts):
+                rows = ((transform.f - rst.bounds.top) / overlap.res, (transform.f - rst.bounds.bottom) / overlap.res)
+                cols = ((rst.bounds.left - transform.c) / overlap.res, (rst.bounds.right - transform.c) / overlap.res)
+                if (max(rows[0], final_rows[0]) < min(rows[1], final_rows[1])) and \
+                   (max(cols[0], final_cols[0]) < min(cols[1], final_cols[1])):
+                    expected_datasets.append(idx)
+
+            assert data_dict.get(win_idx, []) == expected_datasets, f"Expected the inputs covering window {win_idx}"
+            assert set(expected_datasets) <= set(stacked_data_dict.get(win_idx, [])), \
+                f"Expected the inputs of window {win_idx} among those of get_window_idx"
+
+        merge_kwargs = dict( dtype = 'float32', agg_function = partial(np.nanmax, axis = 0),
+                             nodata = params["nodata"], rst_dims = overlap.rst_dims )
+
+        rsts = [ rasterio.open(rst.name) for rst in overlap.depth_rsts ]
+        try:
+            stacked_mosaic = np.full((height, width), params["nodata"], dtype = np.float32)
+            for win_idx, datasets in stacked_data_dict.items():
+                final_window, bnds, data = src.read_window_data(win_idx, datasets, rsts, path_points, bbox, transform)
+                window_data = src.aggregate_data(data, bnds, final_window, datasets, **merge_kwargs)
+                stacked_mosaic[final_window.toslices()] = window_data
+        finally:
+            for rst in rsts:
+                rst.close()
+
+        # handles returned to the pool per input, and held across windows as WindowMerger does
+        held = {}
+        for held_handles in (None, held):
+            mosaic = np.full((height, width), params["nodata"], dtype = np.float32)
+            for win_idx, datasets in data_dict.items():
+                final_window, window_data = src.reduce_window_data( win_idx, datasets, overlap.pool, path_points, bbox,
+                                                                    transform, held = held_handles, **merge_kwargs )
+                mosaic[final_window.toslices()] = window_data
+
+            assert np.array_equal(mosaic, stacked_mosaic), "Expected the mosaic of the stacked merge"
+            assert (mosaic != params["nodata"]).any(), "Expected data in the mosaic"
+
+        assert sorted(held) == list(range(len(raster_paths))), "Expected a held handle of every input"
+        overlap.pool.check_in(held)
+        overlap.pool.close()
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_DatasetPool_check_out_and_check_in_success(self):
+
+        '''
+        Test that the dataset pool reuses returned handles, opens a handle per concurrent reader,
+        closes the least recently used handles beyond its limit and starts empty when pickled.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        pool = src.DatasetPool(raster_paths, max_open_datasets = 2)
+
+        rsts = pool.check_out([0, 1])
+        assert sorted(rsts) == [0, 1], "Expected a handle of each dataset"
+        assert rsts[0].name == raster_paths[0], "Expected the handle of the dataset idx"
+
+        # a second reader of a checked out dataset gets its own handle
+        other_rsts = pool.check_out([0])
+        assert other_rsts[0] is not rsts[0], "Expected a handle per reader"
+
+        pool.check_in(rsts)
+        assert pool.check_out([1])[1] is rsts[1], "Expected the returned handle to be reused"
+        pool.check_in({ 1 : rsts[1] })
+
+        # the least recently returned handle is closed beyond the limit
+        pool.check_in(other_rsts)
+        assert len(pool.idle_rsts) == 2, "Expected at most max_open_datasets idle handles"
+        assert rsts[0].closed and not (rsts[1].closed or other_rsts[0].closed), \
+            "Expected the least recently returned handle closed"
+
+        pickled_pool = pickle.loads(pickle.dumps(pool))
+        assert (pickled_pool.rst_paths == raster_paths) and (len(pickled_pool.idle_rsts) == 0), \
+            "Expected a pickled pool to keep its paths and no handles"
+
+        pool.close()
+        assert (len(pool.idle_rsts) == 0) and rsts[1].closed and other_rsts[0].closed, "Expected every idle handle closed"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_OverlapWindowComposite_rules_match_per_cell_composite_success(self):
+
+        '''
+        Test that the max, priority and mean composites of three models, and the max composite of
+        their extents, give the depths, extents and source model bits of compositing each cell of
+        the rasters stacked on the grid of their union.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+        models = params["models"]
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        grid_shape = (params["rasters"][0]["height"], params["rasters"][0]["width"])
+
+        # rasters of each model on the grid of their union, nan for no data
+        stacked = np.full((len(models),) + grid_shape, np.nan, dtype = np.float32)
+        for i, (raster_path, raster) in enumerate(zip(raster_paths, params["rasters"])):
+            with rasterio.open(raster_path) as rst:
+                data = rst.read(1)
+            stacked[i, raster["row_off"]:raster["row_off"] + raster["height"],
+                       raster["col_off"]:raster["col_off"] + raster["width"]] = np.where(data == params["nodata"], np.nan, data)
+
+        has_data = ~np.isnan(stacked)
+        bits = np.array([ 1 << i for i in range(len(models)) ], dtype = np.uint8)[:, None, None]
+
+        def first_taken(take, order = range(len(models))):
+            # value and source bit of the first model taken in each cell, in order
+            order = np.array(order)
+            first = order[np.argmax(take[order], axis = 0)]
+            taken = take.any(axis = 0)
+            value = np.where(taken, np.take_along_axis(stacked, first[None], axis = 0)[0], np.nan)
+            return(value, np.where(taken, bits[first, 0, 0], 0).astype(np.uint8))
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category = RuntimeWarning)
+            max_depths = np.nanmax(stacked, axis = 0)
+            mean_depths = np.nansum(stacked, axis = 0) / has_data.sum(axis = 0)
+
+        expected = { 'max' : first_taken(has_data & (stacked == max_depths)),
+                     'priority' : first_taken(has_data, [ models.index(model) for model in params["priority"] ]),
+                     'mean' : (mean_depths, np.bitwise_or.reduce(np.where(has_data, bits, 0), axis = 0).astype(np.uint8)) }
+
+        for rule, (expected_depths, expected_source) in expected.items():
+
+            outputs = { output : os.path.join(self.out_dir, f'composite_{rule}_{output}.tif')
+                        for output in ('depths', 'extent', 'source') }
+
+            composite = src.OverlapWindowComposite(raster_paths, models, params["num_partitions"])
+            composite.composite_rasters( depths_output = outputs['depths'], extent_output = outputs['extent'],
+                                         source_output = outputs['source'], rule = rule,
+                                         priority = params["priority"], nodata = params["nodata"] )
+
+            with rasterio.open(outputs['depths']) as depths, rasterio.open(outputs['extent']) as extent, \
+                 rasterio.open(outputs['source']) as source:
+
+                assert depths.shape == grid_shape, f"Expected the grid of the union for {rule}"
+                depths_array = np.where(depths.read(1) == params["nodata"], np.nan, depths.read(1))
+                assert np.allclose(depths_array, expected_depths, rtol = 1e-6, equal_nan = True), \
+                    f"Expected the per cell {rule} depths"
+
+                expected_extent = np.where(np.isnan(expected_depths), src.COMPOSITE_EXTENT_PROFILE['nodata'],
+                                           expected_depths > 0)
+                assert np.array_equal(extent.read(1), expected_extent), f"Expected the per cell {rule} extent"
+                assert np.array_equal(source.read(1), expected_source), f"Expected the per cell {rule} source bits"
+
+                assert json.loads(source.tags()['MODEL_BITS']) == { model : 1 << i for i, model in enumerate(models) }, \
+                    "Expected the bit of each model in the source tags"
+
+        # extents of the models, inundated wins, the first model on ties
+        extent_output = os.path.join(self.out_dir, 'composite_extent.tif')
+        source_output = os.path.join(self.out_dir, 'composite_extent_source.tif')
+        src.OverlapWindowComposite(raster_paths, models, params["num_partitions"]).composite_rasters(
+            extent_output = extent_output, source_output = source_output, values = 'extent' )
+
+        stacked = np.where(has_data, stacked > 0, np.nan).astype(np.float32)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', category = RuntimeWarning)
+            max_extent = np.nanmax(stacked, axis = 0)
+        expected_extent, expected_source = first_taken(has_data & (stacked == max_extent))
+
+        with rasterio.open(extent_output) as extent, rasterio.open(source_output) as source:
+            assert np.array_equal(extent.read(1), np.where(np.isnan(expected_extent), src.COMPOSITE_EXTENT_PROFILE['nodata'],
+                                                           expected_extent)), "Expected the per cell extent composite"
+            assert np.array_equal(source.read(1), expected_source), "Expected the per cell extent source bits"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_MosaicManifest_changed_windows_success(self):
+
+        '''
+        Test that manifests survive a round trip, that only windows of inputs whose content
+        changed are reported, and that a missing manifest or another grid report the whole mosaic.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        manifest_file = os.path.join(self.out_dir, 'mosaic.tif' + src.MANIFEST_SUFFIX)
+
+        grid = { 'width' : 120, 'height' : 120, 'partitions' : params["num_partitions"] }
+        windows = { 0 : raster_paths[:1], 5 : raster_paths[:2], 10 : raster_paths }
+
+        manifest = src.MosaicManifest(grid, src.MosaicManifest.hash_inputs(raster_paths), windows)
+        manifest.write(manifest_file)
+
+        previous = src.MosaicManifest.read(manifest_file)
+        assert (previous.grid, previous.inputs, previous.windows) == (manifest.grid, manifest.inputs, manifest.windows), \
+            "Expected the manifest read back to equal the manifest written"
+        assert manifest.changed_windows(previous) == set(), "Expected no changed windows"
+        assert manifest.changed_windows(None) is None, "Expected the whole mosaic without a previous manifest"
+
+        other_grid = src.MosaicManifest(dict(grid, width = 121), manifest.inputs, windows)
+        assert other_grid.changed_windows(previous) is None, "Expected the whole mosaic on another grid"
+
+        # touched without a change of content
+        os.utime(raster_paths[1], ns = (0, 0))
+        touched = src.MosaicManifest(grid, src.MosaicManifest.hash_inputs(raster_paths, previous), windows)
+        assert touched.inputs[raster_paths[1]]['mtime_ns'] == 0, "Expected the new modification time"
+        assert touched.changed_windows(previous) == set(), "Expected no changed windows for the same contents"
+
+        # a window left without inputs
+        removed = src.MosaicManifest(grid, manifest.inputs, { 5 : raster_paths[:2], 10 : raster_paths })
+        assert removed.changed_windows(previous) == {'0'}, "Expected the window without inputs"
+
+        # content of the last input changed
+        changed_dir = tempfile.mkdtemp(dir = self.out_dir)
+        changed_path = write_overlapping_rasters(changed_dir, dict(params, rasters = params["rasters"][-1:]), seed = 1)[0]
+        os.replace(changed_path, raster_paths[-1])
+
+        changed = src.MosaicManifest(grid, src.MosaicManifest.hash_inputs(raster_paths, previous), windows)
+        assert changed.inputs[raster_paths[0]] == previous.inputs[raster_paths[0]], "Expected the record of an unchanged input"
+        assert changed.changed_windows(previous) == {'10'}, "Expected the window of the changed input"
+
+        # manifests of another version are not read
+        with open(manifest_file) as f:
+            stored = json.load(f)
+        stored['version'] = src.MosaicManifest.version + 1
+        with open(manifest_file, 'w') as f:
+            json.dump(stored, f)
+        assert src.MosaicManifest.read(manifest_file) is None, "Expected no manifest of another version"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_merge_rasters_incremental_matches_full_merge_success(self):
+
+        '''
+        Test that an incremental merge after one input changed only merges the windows of that
+        input, gives the raster of a full merge, and does not grow the output on re-runs.
+        '''
+
+        params = self.params["valid_data_overlapping_rasters"].copy()
+
+        raster_paths = write_overlapping_rasters(self.out_dir, params)
+        mosaic = os.path.join(self.out_dir, 'mosaic.tif')
+        manifest_file = mosaic + src.MANIFEST_SUFFIX
+
+        merged = src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters( mosaic,
+                                                                                              nodata = params["nodata"],
+                                                                                              manifest = manifest_file )
+        assert merged['windows_merged'] == merged['windows'], "Expected every window merged without a manifest"
+
+        merged = src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters( mosaic,
+                                                                                              nodata = params["nodata"],
+                                                                                              manifest = manifest_file )
+        assert merged['windows_merged'] == 0, "Expected no window merged without changed inputs"
+
+        for seed in (1, 2, 3):
+
+            # change the smallest input
+            changed_params = dict(params, rasters = params["rasters"][-1:])
+            changed_dir = tempfile.mkdtemp(dir = self.out_dir)
+            changed_path = write_overlapping_rasters(changed_dir, changed_params, seed = seed)[0]
+            os.replace(changed_path, raster_paths[-1])
+
+            merged = src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters( mosaic,
+                                                                                                  nodata = params["nodata"],
+                                                                                                  manifest = manifest_file )
+
+            windows = src.MosaicManifest.read(manifest_file).windows
+            changed_windows = sum( raster_paths[-1] in inputs for inputs in windows.values() )
+            assert 0 < merged['windows_merged'] == changed_windows < merged['windows'], \
+                "Expected only the windows of the changed input merged"
+
+            full_mosaic = os.path.join(self.out_dir, 'full_mosaic.tif')
+            src.OverlapWindowMerge(raster_paths, params["num_partitions"]).merge_rasters( full_mosaic,
+                                                                                         nodata = params["nodata"] )
+
+            with rasterio.open(mosaic) as patched, rasterio.open(full_mosaic) as full:
+                assert patched.profile == full.profile, "Expected the profile of a full merge"
+                assert np.array_equal(patched.read(1), full.read(1)), "Expected the raster of a full merge"
+
+            assert os.path.getsize(mosaic) <= 1.05 * os.path.getsize(full_mosaic), \
+                "Expected the patched output no larger than a full merge"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+
+
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
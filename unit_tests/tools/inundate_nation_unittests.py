@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import json
+import shutil
+import tempfile
+import warnings
+import unittest
+
+import numpy as np
+import rasterio
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/')
+import inundate_nation as src
+from gms_tools.overlapping_inundation import cog_overview_factors, COG_BLOCKSIZE
+
+
+def write_bool_rasters(out_dir, params, seed=0):
+
+    '''
+    Writes the boolean HUC extent rasters of params as create_bool_rasters does
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    raster_paths = {}
+    for raster in params["huc_rasters"]:
+
+        extent = (rng.random((raster["height"], raster["width"])) < 0.4).astype(np.int8)
+        raster_paths[raster["huc"]] = ut_helpers.write_synthetic_raster( os.path.join(out_dir, f"bool_100_0_GMS_inund_extent_{raster['huc']}.tif"),
+                                                                         extent, params, raster["row_off"], raster["col_off"], 0,
+                                                                         tiled = True, blockxsize = 512, blockysize = 512,
+                                                                         compress = 'lzw' )
+
+    return(raster_paths)
+
+
+def write_extent_rasters(out_dir, params, seed=0):
+
+    '''
+    Writes HUC extent rasters of params, of positive wet and negative dry HydroIDs, as the HUC mosaics of run_inundation
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    raster_files = []
+    for raster in params["huc_rasters"]:
+
+        hydroIDs = rng.integers(1000000, 2000000, (raster["height"], raster["width"]), dtype=np.int32)
+        hydroIDs[rng.random(hydroIDs.shape) < 0.6] *= -1
+
+        raster_files.append(f"100_0_GMS_inund_extent_{raster['huc']}.tif")
+        ut_helpers.write_synthetic_raster( os.path.join(out_dir, raster_files[-1]), hydroIDs, params,
+                                           raster["row_off"], raster["col_off"], 0 )
+
+    return(raster_files)
+
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_inundate_nation(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def setUp(self):
+
+        self.out_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.out_dir, ignore_errors = True)
+
+
+    def test_vrt_raster_mosaic_patch_matches_full_mosaic_success(self):
+
+        '''
+        Test that patching the area of a changed HUC into the mosaic gives the mosaic built from
+        all boolean HUC rasters, and that the patched mosaic does not grow on re-runs.
+        '''
+
+        params = self.params["valid_data_huc_bool_rasters"].copy()
+        changed_raster = params["huc_rasters"][-1]
+
+        bool_dir = os.path.join(self.out_dir, 'bool')
+        output_dir = os.path.join(self.out_dir, 'output')
+        full_output_dir = os.path.join(self.out_dir, 'full_output')
+        for d in (bool_dir, output_dir, full_output_dir):
+            os.mkdir(d)
+
+        write_bool_rasters(bool_dir, params)
+        mosaic = src.vrt_raster_mosaic(bool_dir, output_dir, params["fim_version_tag"])
+
+        for seed in (1, 2, 3):
+
+            # new extent of the last HUC, patched where it was and where it is
+            changed_dir = tempfile.mkdtemp(dir = self.out_dir)
+            changed_path = write_bool_rasters(changed_dir, dict(params, huc_rasters = [changed_raster]), seed = seed)
+            changed_path = changed_path[changed_raster["huc"]]
+            with rasterio.open(changed_path) as changed:
+                changed_bounds = [ tuple(changed.bounds) ]
+            os.replace(changed_path, os.path.join(bool_dir, os.path.basename(changed_path)))
+
+            patched_mosaic = src.vrt_raster_mosaic(bool_dir, output_dir, params["fim_version_tag"],
+                                                   changed_bounds = changed_bounds)
+            full_mosaic = src.vrt_raster_mosaic(bool_dir, full_output_dir, params["fim_version_tag"])
+
+            assert patched_mosaic == mosaic, "Expected the mosaic to be patched in place"
+            with rasterio.open(patched_mosaic) as patched, rasterio.open(full_mosaic) as full:
+                assert patched.transform == full.transform, "Expected the grid of the full mosaic"
+                assert np.array_equal(patched.read(1), full.read(1)), "Expected the raster of the full mosaic"
+
+            assert os.path.getsize(patched_mosaic) <= 1.05 * os.path.getsize(full_mosaic), \
+                "Expected the patched mosaic no larger than the full mosaic"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_vrt_raster_mosaic_vrt_only_keeps_huc_cogs_success(self):
+
+        '''
+        Test that create_bool_rasters with cog writes boolean HUC COGs with overviews, and that
+        vrt_raster_mosaic with vrt_only writes only a VRT index over them and leaves them in place.
+        '''
+
+        params = self.params["valid_data_huc_extent_rasters"].copy()
+
+        extent_dir = os.path.join(self.out_dir, 'extent')
+        bool_dir = os.path.join(self.out_dir, 'huc_cogs')
+        output_dir = os.path.join(self.out_dir, 'output')
+        for d in (extent_dir, bool_dir, output_dir):
+            os.mkdir(d)
+
+        raster_files = write_extent_rasters(extent_dir, params)
+        for rasfile in raster_files:
+            src.create_bool_rasters([extent_dir, rasfile, bool_dir, True])
+
+        bool_rasters = sorted( os.path.join(bool_dir, "bool_" + rasfile) for rasfile in raster_files )
+        assert sorted( os.path.join(bool_dir, f) for f in os.listdir(bool_dir) ) == bool_rasters, \
+            "Expected a boolean raster of each HUC"
+
+        vrt = src.vrt_raster_mosaic(bool_dir, output_dir, params["fim_version_tag"], cog = True, vrt_only = True)
+
+        assert vrt == os.path.join(output_dir, params["fim_version_tag"] + "_mosaic.vrt"), "Expected the VRT index as output"
+        assert os.listdir(output_dir) == [ os.path.basename(vrt) ], "Expected only the VRT index written"
+        assert sorted( os.path.join(bool_dir, f) for f in os.listdir(bool_dir) ) == bool_rasters, \
+            "Expected the HUC COGs left in place"
+
+        with rasterio.open(vrt) as index:
+            assert sorted( os.path.normpath(f) for f in index.files[1:] ) == bool_rasters, "Expected a VRT index over the HUC COGs"
+
+        for rasfile in raster_files:
+            with rasterio.open(os.path.join(extent_dir, rasfile)) as extent, \
+                 rasterio.open(os.path.join(bool_dir, "bool_" + rasfile)) as huc_cog:
+
+                factors = cog_overview_factors(huc_cog.width, huc_cog.height)
+                assert len(factors) > 0, f"Expected {rasfile} larger than one block"
+                assert huc_cog.overviews(1) == factors, f"Expected the overview levels of a COG of {rasfile}"
+                assert huc_cog.block_shapes == [ (COG_BLOCKSIZE, COG_BLOCKSIZE) ], f"Expected the blocks of a COG of {rasfile}"
+                assert np.array_equal(huc_cog.read(1), (extent.read(1) > 0).astype(np.int8)), \
+                    f"Expected the boolean extent of {rasfile}"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+
+
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
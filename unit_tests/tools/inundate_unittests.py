@@ -5,9 +5,17 @@ import os
 import sys
 
 import json
+import shutil
+import tempfile
 import warnings
 import unittest
 
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import rasterio
+from shapely.ops import unary_union
+
 sys.path.append('/foss_fim/unit_tests/')
 from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
 
@@ -72,7 +80,544 @@ class test_inundate(unittest.TestCase):
         print(f"Test Success: {inspect.currentframe().f_code.co_name}")
         print("*************************************************************")
 
+
+
+    def test_inundate_create_inundation_raster_array_lookup_mode_success(self):
+
+        '''
+        Test for creating a inundation branch raster with the compiled array
+        catchment stage lookup (lookup_mode = 'array'). The inundation and depths
+        rasters are expected to equal the ones of the default dict lookup.
+        '''
+
+        params = self.params["valid_data_inundate_branch"].copy()
+
+        outputs = {}
+        for lookup_mode in ('dict', 'array'):
+
+            inundation_raster = params["inundation_raster"].replace("inundation_extent", f"inundation_extent_{lookup_mode}")
+            depths = params["inundation_raster"].replace("inundation_extent", f"depths_{lookup_mode}")
+
+            inundation_rasters, depth_rasters, inundation_polys = src.inundate(
+                                                rem = params["rem"],
+                                                catchments = params["catchments"],
+                                                catchment_poly = params["catchment_poly"],
+                                                hydro_table = params["hydro_table"],
+                                                forecast = params["forecast"],
+                                                mask_type = params["mask_type"],
+                                                inundation_raster = inundation_raster,
+                                                depths = depths,
+                                                quiet = params["quiet"],
+                                                lookup_mode = lookup_mode
+                                                )
+
+            assert len(inundation_rasters) == 1, "Expected exactly one inundation raster path records"
+            assert inundation_rasters[0] == inundation_raster, f"Expected the inundation raster {inundation_raster}"
+            assert depth_rasters[0] == depths, f"Expected the depths raster {depths}"
+
+            with rasterio.open(inundation_raster) as inundation, rasterio.open(depths) as depth:
+                outputs[lookup_mode] = (inundation.read(1), depth.read(1))
+
+        assert (outputs['array'][0] == outputs['dict'][0]).all(), "Expected the same inundation as the dict lookup"
+        assert (outputs['array'][1] == outputs['dict'][1]).all(), "Expected the same depths as the dict lookup"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_inundate_create_inundation_raster_streaming_success(self):
+
+        '''
+        Test for creating a inundation branch raster block by block (streaming = True).
+        The inundation and depths rasters are expected to equal the ones of the default
+        whole array mode.
+        '''
+
+        params = self.params["valid_data_inundate_branch"].copy()
+
+        outputs = {}
+        for streaming in (False, True):
+
+            mode = 'streaming' if streaming else 'whole_array'
+            inundation_raster = params["inundation_raster"].replace("inundation_extent", f"inundation_extent_{mode}")
+            depths = params["inundation_raster"].replace("inundation_extent", f"depths_{mode}")
+
+            inundation_rasters, depth_rasters, inundation_polys = src.inundate(
+                                                rem = params["rem"],
+                                                catchments = params["catchments"],
+                                                catchment_poly = params["catchment_poly"],
+                                                hydro_table = params["hydro_table"],
+                                                forecast = params["forecast"],
+                                                mask_type = params["mask_type"],
+                                                inundation_raster = inundation_raster,
+                                                depths = depths,
+                                                quiet = params["quiet"],
+                                                streaming = streaming
+                                                )
+
+            assert len(inundation_rasters) == 1, "Expected exactly one inundation raster path records"
+            assert inundation_rasters[0] == inundation_raster, f"Expected the inundation raster {inundation_raster}"
+            assert depth_rasters[0] == depths, f"Expected the depths raster {depths}"
+
+            with rasterio.open(inundation_raster) as inundation, rasterio.open(depths) as depth:
+                outputs[mode] = (inundation.read(1), depth.read(1), inundation.profile, depth.profile)
+
+        for i, output in enumerate(('inundation', 'depths')):
+            assert (outputs['streaming'][i] == outputs['whole_array'][i]).all(), \
+                f"Expected the same {output} as the whole array mode"
+            assert outputs['streaming'][i + 2] == outputs['whole_array'][i + 2], \
+                f"Expected the same {output} raster profile as the whole array mode"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_inundate_polygon_modes_streaming_match_features_success(self):
+
+        '''
+        Test for writing the inundation polygons of a branch block by block (streaming = True)
+        in the 'dissolved' and 'extent' polygon modes. They are expected to cover the area of
+        the 'features' polygons of the whole array mode, per HydroID for 'dissolved', with the
+        parts split by block edges stitched back together, so that no two parts share a
+        boundary. Simplified polygons are expected to be valid, without overlapping parts.
+        '''
+
+        params = self.params["valid_data_inundate_branch"].copy()
+        simplify_tolerance = 15
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            polygons = {}
+            for polygon_mode, streaming, tolerance in (('features', False, None),
+                                                      ('dissolved', True, None), ('extent', True, None),
+                                                      ('dissolved', True, simplify_tolerance),
+                                                      ('extent', True, simplify_tolerance)):
+
+                inundation_polygon = os.path.join(tmp_dir, f'inundation_{polygon_mode}_{streaming}_{tolerance}.gpkg')
+
+                inundation_rasters, depth_rasters, inundation_polys = src.inundate(
+                                                    rem = params["rem"],
+                                                    catchments = params["catchments"],
+                                                    catchment_poly = params["catchment_poly"],
+                                                    hydro_table = params["hydro_table"],
+                                                    forecast = params["forecast"],
+                                                    mask_type = params["mask_type"],
+                                                    inundation_polygon = inundation_polygon,
+                                                    quiet = params["quiet"],
+                                                    streaming = streaming,
+                                                    polygon_mode = polygon_mode,
+                                                    simplify_tolerance = tolerance
+                                                    )
+
+                assert inundation_polys[0] == inundation_polygon, f"Expected the inundation polygons {inundation_polygon}"
+                polygons[(polygon_mode, streaming, tolerance)] = gpd.read_file(inundation_polygon)
+
+            features = polygons[('features', False, None)]
+            assert len(features) > 0, "Expected inundation polygons"
+
+            expected_dissolved = features.dissolve(by = 'HydroID').geometry
+            dissolved = polygons[('dissolved', True, None)]
+            assert dissolved['HydroID'].is_unique, "Expected one dissolved polygon per HydroID"
+            assert sorted(dissolved['HydroID']) == sorted(expected_dissolved.index), "Expected the HydroIDs of the features"
+            for hydroID, geometry in zip(dissolved['HydroID'], dissolved.geometry):
+                expected = expected_dissolved.loc[hydroID]
+                assert geometry.symmetric_difference(expected).area <= 1e-6 * expected.area, \
+                    f"Expected the area of the features of HydroID {hydroID}"
+                assert np.isclose(sum( part.length for part in geometry.geoms ), unary_union(geometry).length), \
+                    f"Expected the parts of HydroID {hydroID} split by block edges stitched together"
+
+            expected_extent = unary_union(features.geometry)
+            extent = polygons[('extent', True, None)]
+            assert len(extent) == 1, "Expected a single extent polygon"
+            assert extent.geometry[0].symmetric_difference(expected_extent).area <= 1e-6 * expected_extent.area, \
+                "Expected the area of the features"
+
+            for polygon_mode in ('dissolved', 'extent'):
+                simplified = polygons[(polygon_mode, True, simplify_tolerance)]
+                assert len(simplified) > 0, f"Expected simplified {polygon_mode} polygons"
+                assert simplified.geometry.is_valid.all(), f"Expected valid simplified {polygon_mode} polygons"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_inundate_process_backend_matches_serial_success(self):
+
+        '''
+        Test for batch inundation of HUCs on the process backend, which shares the stage
+        lookup with its workers through shared memory. The inundation and depths rasters of
+        every HUC are expected to equal the ones of a serial run, and the shared memory
+        block to be released.
+        '''
+
+        params = self.params["valid_data_inundate_batch"].copy()
+
+        shared_memory_blocks = set(os.listdir('/dev/shm')) if os.path.isdir('/dev/shm') else set()
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            outputs = {}
+            for parallel_backend, num_workers in (('thread', 1), ('process', params["num_workers"])):
+
+                inundation_rasters, depth_rasters, inundation_polys = src.inundate(
+                                                    rem = params["rem"],
+                                                    catchments = params["catchments"],
+                                                    catchment_poly = params["catchment_poly"],
+                                                    hydro_table = params["hydro_table"],
+                                                    forecast = params["forecast"],
+                                                    mask_type = params["mask_type"],
+                                                    hucs = params["hucs"],
+                                                    hucs_layerName = params["hucs_layerName"],
+                                                    num_workers = num_workers,
+                                                    inundation_raster = os.path.join(tmp_dir, f'inundation_{parallel_backend}.tif'),
+                                                    depths = os.path.join(tmp_dir, f'depths_{parallel_backend}.tif'),
+                                                    quiet = params["quiet"],
+                                                    parallel_backend = parallel_backend
+                                                    )
+
+                assert len(inundation_rasters) > 0, "Expected at least one inundation raster path records"
+
+                outputs[parallel_backend] = {}
+                for inundation_raster, depths in zip(inundation_rasters, depth_rasters):
+                    hucCode = os.path.splitext(inundation_raster)[0].split('_')[-1]
+                    with rasterio.open(inundation_raster) as inundation, rasterio.open(depths) as depth:
+                        outputs[parallel_backend][hucCode] = (inundation.read(1), depth.read(1))
+
+            assert outputs['process'].keys() == outputs['thread'].keys(), "Expected the same HUCs as the serial run"
+
+            for hucCode in outputs['thread']:
+                for i, output in enumerate(('inundation', 'depths')):
+                    assert (outputs['process'][hucCode][i] == outputs['thread'][hucCode][i]).all(), \
+                        f"Expected the same {output} for HUC {hucCode} as the serial run"
+
+        if os.path.isdir('/dev/shm'):
+            assert set(os.listdir('/dev/shm')) <= shared_memory_blocks, "Expected the shared stage lookup to be unlinked"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_inundate_window_cache_matches_uncached_success(self):
+
+        '''
+        Test for batch inundation with mask_type 'filter' through the masked window cache.
+        The rasters of a first and second cached run are expected to equal the ones of an
+        uncached run, the second run to memory map the windows cached by the first, and
+        touching the REM to replace the cached windows of every HUC.
+        '''
+
+        params = self.params["valid_data_inundate_filter"].copy()
+
+        read_window_cache = getattr(src, '__read_window_cache')
+        cached_windows = []
+
+        def recording_read_window_cache(window_cache, window_key):
+            cached_window = read_window_cache(window_cache, window_key)
+            cached_windows.append(cached_window)
+            return(cached_window)
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            # inputs of the test's own, as their modification times are part of the cache key
+            inputs = { name : shutil.copy(params[name], tmp_dir) for name in ('rem', 'catchments', 'catchment_poly') }
+            window_cache = os.path.join(tmp_dir, 'window_cache')
+
+            def inundate_filter(run, window_cache = None):
+
+                inundation_rasters, depth_rasters, inundation_polys = src.inundate(
+                                                    **inputs,
+                                                    hydro_table = params["hydro_table"],
+                                                    forecast = params["forecast"],
+                                                    mask_type = 'filter',
+                                                    hucs = params["hucs"],
+                                                    hucs_layerName = params["hucs_layerName"],
+                                                    num_workers = 1,
+                                                    inundation_raster = os.path.join(tmp_dir, f'inundation_{run}.tif'),
+                                                    depths = os.path.join(tmp_dir, f'depths_{run}.tif'),
+                                                    quiet = params["quiet"],
+                                                    window_cache = window_cache
+                                                    )
+
+                outputs = {}
+                for inundation_raster, depths in zip(inundation_rasters, depth_rasters):
+                    hucCode = os.path.splitext(inundation_raster)[0].split('_')[-1]
+                    with rasterio.open(inundation_raster) as inundation, rasterio.open(depths) as depth:
+                        outputs[hucCode] = (inundation.read(1), depth.read(1), inundation.transform)
+                return(outputs)
+
+            uncached = inundate_filter('uncached')
+            assert len(uncached) > 0, "Expected at least one inundation raster path records"
+
+            setattr(src, '__read_window_cache', recording_read_window_cache)
+            try:
+                first = inundate_filter('first', window_cache)
+                number_of_windows = len(cached_windows)
+                assert number_of_windows > 0 and all( w is None for w in cached_windows ), \
+                    "Expected no cached windows on the first run"
+                first_entries = set(os.listdir(window_cache))
+                assert len(first_entries) == 3 * number_of_windows, "Expected an entry of three .npy files per HUC"
+
+                cached_windows.clear()
+                second = inundate_filter('second', window_cache)
+                assert len(cached_windows) == number_of_windows, "Expected a cache read per HUC"
+                assert all( isinstance(w[0], np.memmap) and isinstance(w[1], np.memmap) for w in cached_windows ), \
+                    "Expected the second run to memory map the cached windows"
+
+                rem_stat = os.stat(inputs['rem'])
+                os.utime(inputs['rem'], ns = (rem_stat.st_atime_ns, rem_stat.st_mtime_ns + 10**9))
+
+                cached_windows.clear()
+                touched = inundate_filter('touched', window_cache)
+                assert all( w is None for w in cached_windows ), "Expected the cached windows of the touched REM invalidated"
+                touched_entries = set(os.listdir(window_cache))
+                assert len(touched_entries) == len(first_entries) and not (touched_entries & first_entries), \
+                    "Expected the entries of the touched REM to replace the stale ones"
+            finally:
+                setattr(src, '__read_window_cache', read_window_cache)
+
+            for run, outputs in (('first', first), ('second', second), ('touched', touched)):
+                assert outputs.keys() == uncached.keys(), f"Expected the same HUCs on the {run} run as the uncached run"
+                for hucCode in uncached:
+                    assert outputs[hucCode][2] == uncached[hucCode][2], \
+                        f"Expected the transform of HUC {hucCode} on the {run} run of the uncached run"
+                    for i, output in enumerate(('inundation', 'depths')):
+                        assert np.array_equal(outputs[hucCode][i], uncached[hucCode][i]), \
+                            f"Expected the same {output} for HUC {hucCode} on the {run} run as the uncached run"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_inundate_forecasts_create_max_depths_single_branch_success(self):
+
+        '''
+        Test for inundating a list of forecasts in one pass (inundate_forecasts) and
+        writing only the max depth and exceedance count rasters. Their values are
+        expected to equal the maximum and the count of positive depths of an inundate
+        run per forecast.
+        '''
+
+        params = self.params["valid_data_inundate_branch"].copy()
+
+        max_depths = params["inundation_raster"].replace("inundation_extent", "max_depths")
+        exceedance_counts = params["inundation_raster"].replace("inundation_extent", "exceedance_counts")
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+
+            # a second, lower forecast
+            forecast = pd.read_csv(params["forecast"], dtype = {'feature_id' : str})
+            half_forecast = os.path.join(tmp_dir, 'half_forecast.csv')
+            forecast.assign(discharge = forecast['discharge'] / 2).to_csv(half_forecast, index = False)
+            forecasts = [params["forecast"], half_forecast]
+
+            inundation_rasters, depth_rasters, max_depth_rasters, exceedance_count_rasters = src.inundate_forecasts(
+                                                rem = params["rem"],
+                                                catchments = params["catchments"],
+                                                catchment_poly = params["catchment_poly"],
+                                                hydro_table = params["hydro_table"],
+                                                forecasts = forecasts,
+                                                mask_type = params["mask_type"],
+                                                max_depths = max_depths,
+                                                exceedance_counts = exceedance_counts,
+                                                quiet = params["quiet"]
+                                                )
+
+            assert len(max_depth_rasters) == 1, "Expected exactly one max depths raster path records"
+            assert inundation_rasters[0] == None, "Expected no inundation raster path records"
+            assert depth_rasters[0] == None, "Expected no depth raster path records"
+
+            # depths of each forecast on its own
+            forecast_depths = []
+            for f, forecast_file in enumerate(forecasts):
+                depths = os.path.join(tmp_dir, f'depths_{f}.tif')
+                src.inundate( rem = params["rem"],
+                              catchments = params["catchments"],
+                              catchment_poly = params["catchment_poly"],
+                              hydro_table = params["hydro_table"],
+                              forecast = forecast_file,
+                              mask_type = params["mask_type"],
+                              depths = depths,
+                              quiet = params["quiet"] )
+                with rasterio.open(depths) as depth:
+                    forecast_depths.append(depth.read(1))
+                    depths_nodata = depth.nodata
+
+            forecast_depths = np.stack(forecast_depths)
+            valid = forecast_depths[0] != depths_nodata
+
+            with rasterio.open(max_depth_rasters[0]) as max_depth:
+                assert (max_depth.read(1) == forecast_depths.max(axis = 0)).all(), \
+                    "Expected the maximum of the depths of each forecast"
+
+            with rasterio.open(exceedance_count_rasters[0]) as exceedance_count:
+                assert (exceedance_count.read(1) == np.where(valid, (forecast_depths > 0).sum(axis = 0), -1)).all(), \
+                    "Expected the number of forecasts with positive depths"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
         
+    def test_interpolate_stages_matches_np_interp_success(self):
+
+        '''
+        Test that the vectorized stage interpolation equals np.interp on the rating curve of
+        each HydroID, for single point curves, flat segments, decreasing discharges, nan
+        discharges and discharges below, on and above the curves, and that a hydro-table
+        without forecast discharges gives no stages.
+        '''
+
+        rng = np.random.default_rng(0)
+        number_of_forecasts = 3
+
+        hydroIDs = [] ; points = [] ; discharge_cms = [] ; stage = [] ; discharges = []
+        for hydroID in range(1000, 1300):
+
+            number_of_points = int(rng.integers(1, 8))
+            curve_stage = np.sort(rng.choice(np.arange(0, 10, 0.5), number_of_points))
+            curve_discharge = np.round(np.sort(rng.uniform(0, 100, number_of_points)), 1)
+
+            kind = hydroID % 5
+            if (kind == 1) and (number_of_points > 2):
+                # flat segment
+                curve_discharge[1] = curve_discharge[2]
+            elif (kind == 2) and (number_of_points > 2):
+                # decreasing discharges
+                curve_discharge = curve_discharge[rng.permutation(number_of_points)]
+
+            # below, above, on a point of, or within the curve, and nan
+            forecast = rng.choice( [ -5., 150., curve_discharge[int(rng.integers(number_of_points))],
+                                     rng.uniform(curve_discharge.min(), curve_discharge.max()), np.nan ],
+                                   size = number_of_forecasts, p = [0.15, 0.15, 0.2, 0.45, 0.05] )
+
+            hydroIDs += [hydroID] * number_of_points
+            points += list(range(number_of_points))
+            discharge_cms += list(curve_discharge)
+            stage += list(curve_stage)
+            discharges += [forecast] * number_of_points
+
+        # rows of a HydroID are not contiguous in joined hydro-tables, interleave them keeping their order
+        rows = np.argsort(np.array(points), kind = 'stable')
+        hydroIDs = np.array(hydroIDs)[rows] ; discharge_cms = np.array(discharge_cms)[rows]
+        stage = np.array(stage)[rows] ; discharges = np.array(discharges)[rows]
+
+        unique_hydroIDs, stages = src.interpolate_stages(hydroIDs, discharge_cms, stage, discharges)
+
+        assert (unique_hydroIDs == np.unique(hydroIDs)).all(), "Expected the sorted HydroIDs"
+        assert stages.shape == (len(unique_hydroIDs), number_of_forecasts), "Expected HydroIDs by forecasts stages"
+
+        for i, hydroID in enumerate(unique_hydroIDs):
+            curve = hydroIDs == hydroID
+            first_row = np.flatnonzero(curve)[0]
+            expected = np.interp(discharges[first_row, :], discharge_cms[curve], stage[curve])
+            assert np.array_equal(stages[i, :], expected, equal_nan = True), \
+                f"Expected the stages of np.interp for HydroID {hydroID}"
+
+        # no forecast discharges for the hydro-table
+        unique_hydroIDs, stages = src.interpolate_stages( np.empty(0, dtype = np.int64), np.empty(0), np.empty(0),
+                                                          np.empty((0, number_of_forecasts)) )
+
+        assert len(unique_hydroIDs) == 0, "Expected no HydroIDs"
+        assert stages.shape == (0, number_of_forecasts), "Expected no stages"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_read_hydroTable_cache_matches_csv_success(self):
+
+        '''
+        Test that the hydro-table read through its binary cache, next to the csv or in a
+        cache directory, matches the csv, including the HydroID dtype, and that touching the
+        csv stores its new modification time in the cache.
+        '''
+
+        params = self.params["valid_data_inundate_branch"].copy()
+
+        # copy the hydro-table so the cache is not written next to the test data
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            hydro_table = shutil.copy(params["hydro_table"], tmp_dir)
+            cache_dir = os.path.join(tmp_dir, 'hydro_table_cache')
+
+            from_csv = src.read_hydroTable(hydro_table)
+            assert os.listdir(tmp_dir) == [os.path.basename(hydro_table)], "Expected no cache by default"
+
+            first_read = src.read_hydroTable(hydro_table, hydro_table_cache = True)
+            cached_read = src.read_hydroTable(hydro_table, hydro_table_cache = True)
+            first_dir_read = src.read_hydroTable(hydro_table, hydro_table_cache = cache_dir)
+            cached_dir_read = src.read_hydroTable(hydro_table, hydro_table_cache = cache_dir)
+
+            cache_file = os.path.splitext(hydro_table)[0] + '_cache.npz'
+            assert os.path.exists(cache_file), f"Expected file {cache_file} but it does not exist."
+            assert len(os.listdir(cache_dir)) == 1, f"Expected one cache file in {cache_dir}"
+
+            for hydroTable in (first_read, cached_read, first_dir_read, cached_dir_read):
+                assert len(hydroTable) == len(from_csv), "Expected as many rows as in the csv"
+                assert (hydroTable.index.get_level_values('feature_id') == from_csv.index.get_level_values('feature_id')).all()
+                assert hydroTable.index.get_level_values('HydroID').dtype == from_csv.index.get_level_values('HydroID').dtype, \
+                    "Expected the HydroID dtype of the csv"
+                assert (hydroTable.index.get_level_values('HydroID') == from_csv.index.get_level_values('HydroID')).all()
+                assert (hydroTable['stage'].values == from_csv['stage'].values).all()
+                assert (hydroTable['discharge_cms'].values == from_csv['discharge_cms'].values).all()
+
+            # a touched csv is hashed once and its modification time stored
+            os.utime(hydro_table, ns = (os.stat(hydro_table).st_atime_ns, os.stat(hydro_table).st_mtime_ns + 10**9))
+            src.read_hydroTable(hydro_table, hydro_table_cache = True)
+            with np.load(cache_file) as cache:
+                assert int(cache['source_mtime_ns']) == os.stat(hydro_table).st_mtime_ns, \
+                    "Expected the cache to store the modification time of the touched csv"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+    def test_encode_compact_depths_and_inundation_success(self):
+
+        '''
+        Test that depths and inundation encode to scaled int16 and int8 with compact nodata
+        '''
+
+        depths = np.array([[0., 0.004, 1.234], [-9999., 400., 2.5]], dtype = np.float32)
+        inundation = np.array([[0, -5, 7], [-9999, 3, 0]], dtype = np.int32)
+
+        encoded_depths = src.encode_compact_depths(depths, -9999)
+        encoded_inundation = src.encode_compact_inundation(inundation, -9999)
+
+        assert encoded_depths.dtype == np.int16, "Expected int16 depths"
+        assert (encoded_depths == [[0, 0, 123], [src.COMPACT_DEPTHS_PROFILE['nodata'], 32767, 250]]).all()
+
+        assert encoded_inundation.dtype == np.int8, "Expected int8 inundation"
+        assert (encoded_inundation == [[0, 0, 1], [src.COMPACT_INUNDATION_PROFILE['nodata'], 1, 0]]).all()
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+
+
+    def test_inundate_instrument_stage_records_success(self):
+
+        '''
+        Test that instrument = True returns a record of each stage of the branch
+        '''
+
+        params = self.params["valid_data_inundate_branch"].copy()
+
+        inundation_rasters, depth_rasters, inundation_polys, stage_records = src.inundate(
+                                            rem = params["rem"],
+                                            catchments = params["catchments"],
+                                            catchment_poly = params["catchment_poly"],
+                                            hydro_table = params["hydro_table"],
+                                            forecast = params["forecast"],
+                                            mask_type = params["mask_type"],
+                                            inundation_raster = params["inundation_raster"],
+                                            quiet = params["quiet"],
+                                            instrument = True
+                                            )
+
+        assert len(inundation_rasters) == 1, "Expected exactly one inundation raster path records"
+        assert list(stage_records.columns) == src.InundationProfiler.columns
+        assert set(stage_records['stage']) == {'hydrotable','interpolation','masking','mapping','raster_write'}, \
+            "Expected a record for each stage except polygonize"
+        assert (stage_records['seconds'] >= 0).all(), "Expected positive stage times"
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+
+
     # ***********************
 
 
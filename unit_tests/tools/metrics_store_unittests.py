@@ -0,0 +1,500 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import csv
+import json
+import re
+import shutil
+import tempfile
+import warnings
+import unittest
+
+import numpy as np
+import pandas as pd
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/')
+import metrics_store as src
+from tools_shared_variables import MASTER_METRICS, MAGNITUDE_DICT, AHPS_BENCHMARK_CATEGORIES
+
+
+def write_test_cases(test_cases_dir, params, seed=0):
+
+    '''
+    Writes a test_cases tree of the stats JSONs of every magnitude of the test cases of params
+    in their official and testing versions, with the flow files of the AHPS lids. AHPS test
+    cases also have the total_area stats the alpha test cleans up, and some magnitudes are
+    left out. Returns the number of stats JSONs the master metrics CSV is made of.
+    '''
+
+    rng = np.random.default_rng(seed)
+
+    for benchmark_source in MAGNITUDE_DICT:
+        os.makedirs(os.path.join(test_cases_dir, benchmark_source + '_test_cases'), exist_ok=True)
+
+    number_of_jsons = 0
+    for test_case in params["test_cases"]:
+
+        huc, benchmark_source = test_case["test_id"].split('_')
+        benchmark_test_case_dir = os.path.join(test_cases_dir, benchmark_source + '_test_cases')
+        is_ahps = benchmark_source in AHPS_BENCHMARK_CATEGORIES
+        stats_modes = [ lid + '_b0m' for lid in test_case["lids"] ] + ['total_area'] if is_ahps else test_case["stats_modes"]
+
+        for versions_dir, versions in (('official_versions', params["official_versions"]),
+                                       ('testing_versions', params["testing_versions"])):
+            for version in versions:
+
+                version_dir = os.path.join(benchmark_test_case_dir, test_case["test_id"], versions_dir, version)
+                os.makedirs(version_dir)
+                with open(os.path.join(version_dir, 'eval_metadata.json'), 'w') as meta:
+                    json.dump({ 'calibrated' : False, 'model' : 'MS' }, meta)
+
+                for magnitude in MAGNITUDE_DICT[benchmark_source]:
+                    if rng.random() < 0.2:
+                        continue
+
+                    magnitude_dir = os.path.join(version_dir, magnitude)
+                    os.mkdir(magnitude_dir)
+                    for stats_mode in stats_modes:
+                        stats_dictionary = { metric : int(rng.integers(0, 10**6)) if metric.endswith('_count') else float(rng.random())
+                                             for metric in MASTER_METRICS }
+                        with open(os.path.join(magnitude_dir, stats_mode + '_stats.json'), 'w') as stats_json:
+                            json.dump(stats_dictionary, stats_json)
+                        number_of_jsons += not (is_ahps and stats_mode == 'total_area')
+
+        for lid in test_case.get("lids", []):
+            for magnitude in MAGNITUDE_DICT[benchmark_source][:-1]:
+                flow_dir = os.path.join(benchmark_test_case_dir, 'validation_data_' + benchmark_source, huc, lid, magnitude)
+                os.makedirs(flow_dir)
+                with open(os.path.join(flow_dir, 'ahps_' + lid + '_huc_' + huc + '_flows_' + magnitude + '.csv'), 'w', newline='') as flow_file:
+                    csv.writer(flow_file).writerows([['feature_id', 'discharge'], [5791828, 112.4], [5791830, round(rng.uniform(1, 1000), 2)]])
+
+    return(number_of_jsons)
+
+
+def create_master_metrics_csv_by_crawl(master_metrics_csv_output, dev_versions_to_include_list, test_cases_dir, previous_fim_dir):
+    """
+    Former synthesize_test_cases.create_master_metrics_csv, crawling the test_cases tree. The reference of the metrics store.
+    """
+
+    # Construct header
+    metrics_to_write = MASTER_METRICS
+
+    additional_header_info_prefix = ['version', 'nws_lid', 'magnitude', 'huc']
+    list_to_write = [additional_header_info_prefix + metrics_to_write + ['full_json_path'] + ['flow'] + ['benchmark_source'] + ['extent_config'] + ["calibrated"]]
+
+    versions_to_aggregate = os.listdir(previous_fim_dir)
+
+    if len(dev_versions_to_include_list) > 0:
+        iteration_list = ['official', 'comparison']
+    else:
+        iteration_list = ['official']
+
+    for benchmark_source in ['ble', 'nws', 'usgs', 'ifc','ras2fim']:
+        benchmark_test_case_dir = os.path.join(test_cases_dir, benchmark_source + '_test_cases')
+        test_cases_list = [d for d in os.listdir(benchmark_test_case_dir) if re.match('\d{8}_\w{3,7}', d)]
+        if benchmark_source in ['ble', 'ifc','ras2fim']:
+
+            magnitude_list = MAGNITUDE_DICT[benchmark_source]
+
+            for test_case in test_cases_list:
+                try:
+                    int(test_case.split('_')[0])
+
+                    huc = test_case.split('_')[0]
+
+                    for iteration in iteration_list:
+
+                        if iteration == "official":
+                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'official_versions')
+                            versions_to_aggregate = os.listdir(previous_fim_dir)
+                            # add in composite of versions
+                            composite_versions = [v.replace('_ms', '_comp') for v in versions_to_aggregate if '_ms' in v]
+                            versions_to_aggregate += composite_versions
+                        if iteration == "comparison":
+                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'testing_versions')
+                            versions_to_aggregate = dev_versions_to_include_list
+
+                        for magnitude in magnitude_list:
+                            for version in versions_to_aggregate:
+                                if '_ms' in version:
+                                    extent_config = 'MS'
+                                elif ('_fr' in version) or (version == 'fim_2_3_3'):
+                                    extent_config = 'FR'
+                                else:
+                                    extent_config = 'COMP'
+                                if "_c" in version and version.split('_c')[1] == "":
+                                    calibrated = "yes"
+                                else:
+                                    calibrated = "no"
+                                version_dir = os.path.join(versions_to_crawl, version)
+                                magnitude_dir = os.path.join(version_dir, magnitude)
+
+                                if os.path.exists(magnitude_dir):
+                                    magnitude_dir_list = os.listdir(magnitude_dir)
+                                    for f in magnitude_dir_list:
+                                        if '.json' in f:
+                                            flow = 'NA'
+                                            nws_lid = "NA"
+                                            sub_list_to_append = [version, nws_lid, magnitude, huc]
+                                            full_json_path = os.path.join(magnitude_dir, f)
+                                            if os.path.exists(full_json_path):
+                                                stats_dict = json.load(open(full_json_path))
+                                                for metric in metrics_to_write:
+                                                    sub_list_to_append.append(stats_dict[metric])
+                                                sub_list_to_append.append(full_json_path)
+                                                sub_list_to_append.append(flow)
+                                                sub_list_to_append.append(benchmark_source)
+                                                sub_list_to_append.append(extent_config)
+                                                sub_list_to_append.append(calibrated)
+
+                                                list_to_write.append(sub_list_to_append)
+                except ValueError:
+                    pass
+
+        if benchmark_source in AHPS_BENCHMARK_CATEGORIES:
+            test_cases_list = os.listdir(benchmark_test_case_dir)
+
+            for test_case in test_cases_list:
+                try:
+                    int(test_case.split('_')[0])
+
+                    huc = test_case.split('_')[0]
+
+                    for iteration in iteration_list:
+
+                        if iteration == "official":
+                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'official_versions')
+                            versions_to_aggregate = os.listdir(previous_fim_dir)
+                            # add in composite of versions
+                            composite_versions = [v.replace('_ms', '_comp') for v in versions_to_aggregate if '_ms' in v]
+                            versions_to_aggregate += composite_versions
+                        if iteration == "comparison":
+                            versions_to_crawl = os.path.join(benchmark_test_case_dir, test_case, 'testing_versions')
+                            versions_to_aggregate = dev_versions_to_include_list
+
+                        for magnitude in ['action', 'minor', 'moderate', 'major']:
+                            for version in versions_to_aggregate:
+                                if '_ms' in version:
+                                    extent_config = 'MS'
+                                elif ('_fr' in version) or (version == 'fim_2_3_3'):
+                                    extent_config = 'FR'
+                                else:
+                                    extent_config = 'COMP'
+                                if "_c" in version and version.split('_c')[1] == "":
+                                    calibrated = "yes"
+                                else:
+                                    calibrated = "no"
+
+                                version_dir = os.path.join(versions_to_crawl, version)
+                                magnitude_dir = os.path.join(version_dir, magnitude)
+                                if os.path.exists(magnitude_dir):
+                                    magnitude_dir_list = os.listdir(magnitude_dir)
+                                    for f in magnitude_dir_list:
+                                        if '.json' in f and 'total_area' not in f:
+                                            nws_lid = f[:5]
+                                            sub_list_to_append = [version, nws_lid, magnitude, huc]
+                                            full_json_path = os.path.join(magnitude_dir, f)
+                                            flow = ''
+                                            if os.path.exists(full_json_path):
+
+                                                # Get flow used to map.
+                                                flow_file = os.path.join(benchmark_test_case_dir, 'validation_data_' + benchmark_source, huc, nws_lid, magnitude, 'ahps_' + nws_lid + '_huc_' + huc + '_flows_' + magnitude + '.csv')
+                                                if os.path.exists(flow_file):
+                                                    with open(flow_file, newline='') as csv_file:
+                                                        reader = csv.reader(csv_file)
+                                                        next(reader)
+                                                        for row in reader:
+                                                            flow = row[1]
+
+                                                stats_dict = json.load(open(full_json_path))
+                                                for metric in metrics_to_write:
+                                                    sub_list_to_append.append(stats_dict[metric])
+                                                sub_list_to_append.append(full_json_path)
+                                                sub_list_to_append.append(flow)
+                                                sub_list_to_append.append(benchmark_source)
+                                                sub_list_to_append.append(extent_config)
+                                                sub_list_to_append.append(calibrated)
+
+                                                list_to_write.append(sub_list_to_append)
+                except ValueError:
+                    pass
+
+    with open(master_metrics_csv_output, 'w', newline='') as csvfile:
+        csv_writer = csv.writer(csvfile)
+        csv_writer.writerows(list_to_write)
+
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_metrics_store(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def setUp(self):
+
+        self.out_dir = tempfile.mkdtemp()
+        self.test_cases_dir = os.path.join(self.out_dir, 'test_cases')
+        self.metrics_store = src.MetricsStore(os.path.join(self.out_dir, 'metrics.sqlite'))
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.out_dir, ignore_errors = True)
+
+
+    def test_record_success(self):
+
+        '''
+        Test that a record has the attributes of its test case and version, the flow of AHPS lids
+        from their flow files, and the master metrics as python scalars.
+        '''
+
+        params = self.params["valid_data_test_cases"].copy()
+        write_test_cases(self.test_cases_dir, params)
+
+        stats_dictionary = { metric : np.float64(0.5) for metric in MASTER_METRICS }
+
+        record = src.MetricsStore.record('12090301_ble', 'fim_3_0_24_14_ms', True, '100yr', 'total_area', '', stats_dictionary)
+        assert [ record[c] for c in ['official', 'huc', 'benchmark_source', 'nws_lid', 'extent_config', 'calibrated', 'flow'] ] == \
+               [ 1, '12090301', 'ble', 'NA', 'MS', 'no', 'NA' ], "Expected the attributes of an MS version of a BLE test case"
+        assert all(type(record[metric]) is float for metric in MASTER_METRICS), "Expected python floats of numpy metrics"
+
+        for version, extent_config, calibrated in (('fim_3_0_24_14_fr', 'FR', 'no'), ('fim_2_3_3', 'FR', 'no'),
+                                                   ('fim_4_0_0_0_c', 'COMP', 'yes'), ('fim_3_0_24_14_comp', 'COMP', 'no')):
+            record = src.MetricsStore.record('12090301_ble', version, False, '100yr', 'total_area', '', stats_dictionary)
+            assert (record['official'], record['extent_config'], record['calibrated']) == (0, extent_config, calibrated), \
+                f"Expected the extent configuration and calibration of {version}"
+
+        flow_file = os.path.join(self.test_cases_dir, 'nws_test_cases', 'validation_data_nws', '12040101', 'abcd1', 'minor',
+                                 'ahps_abcd1_huc_12040101_flows_minor.csv')
+        with open(flow_file, newline='') as csv_file:
+            flow = list(csv.reader(csv_file))[-1][1]
+
+        record = src.MetricsStore.record('12040101_nws', 'fim_3_0_24_14_ms', True, 'minor', 'abcd1_b0m', 'abcd1', stats_dictionary,
+                                         flow_file=flow_file)
+        assert (record['nws_lid'], record['flow']) == ('abcd1', flow), "Expected the lid and the last flow of its flow file"
+
+        record = src.MetricsStore.record('12040101_nws', 'fim_3_0_24_14_ms', True, 'major', 'abcd1_b0m', 'abcd1', stats_dictionary,
+                                         flow_file=flow_file.replace('minor', 'major'))
+        assert record['flow'] == '', "Expected no flow of an AHPS lid without a flow file"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_upsert_delete_query_success(self):
+
+        '''
+        Test that upserts keep one row per key with the latest metrics, that deletes only remove
+        the rows of a test case of a version, official or testing, and that queries select
+        official and comparison versions.
+        '''
+
+        stats_dictionary = { metric : 1 for metric in MASTER_METRICS }
+        records = [ src.MetricsStore.record(test_id, version, official, magnitude, 'total_area', '', stats_dictionary)
+                    for test_id in ('12090301_ble', '12090302_ble')
+                    for version, official in (('fim_3_0_24_14_ms', True), ('fim_4_0_0_0_c', True), ('fim_3_0_24_14_ms', False))
+                    for magnitude in ('100yr', '500yr') ]
+
+        self.metrics_store.upsert(records)
+        self.metrics_store.upsert(records[:4])
+        self.metrics_store.upsert([ dict(records[0], CSI = 0.25) ])
+
+        metrics = self.metrics_store.query(None, None)
+        assert len(metrics) == len(records), "Expected one row per key"
+        assert metrics.duplicated(src.METRICS_KEY).sum() == 0, "Expected no duplicated keys"
+        updated = (metrics['test_id'] == '12090301_ble') & (metrics['version'] == 'fim_3_0_24_14_ms') & \
+                  (metrics['official'] == 1) & (metrics['magnitude'] == '100yr')
+        assert metrics.loc[updated, 'CSI'].tolist() == [0.25], "Expected the metrics of the latest upsert"
+        assert (metrics.loc[~updated, 'CSI'] == 1).all(), "Expected the other rows unchanged"
+
+        assert len(self.metrics_store.query(['fim_3_0_24_14_ms'], [])) == 4, "Expected the rows of an official version"
+        assert len(self.metrics_store.query([], ['fim_3_0_24_14_ms'])) == 4, "Expected the rows of a testing version"
+        assert len(self.metrics_store.query(None, [])) == 8, "Expected the rows of every official version"
+        assert len(self.metrics_store.query([], [])) == 0, "Expected no rows of no versions"
+        assert len(self.metrics_store.query(['fim_9_9_9_9'], None)) == 4, "Expected the rows of every testing version"
+
+        self.metrics_store.delete('fim_3_0_24_14_ms', False, '12090301_ble')
+        metrics = self.metrics_store.query(None, None)
+        assert len(metrics) == len(records) - 2, "Expected the rows of the test case of the version deleted"
+        assert not ((metrics['test_id'] == '12090301_ble') & (metrics['version'] == 'fim_3_0_24_14_ms') &
+                    (metrics['official'] == 0)).any(), "Expected no rows of the deleted test case"
+        assert len(self.metrics_store.query(['fim_3_0_24_14_ms'], [])) == 4, "Expected the official rows of the version kept"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_import_version_dir_success(self):
+
+        '''
+        Test that importing the directory of a version of a test case upserts a row per stats JSON
+        of its magnitudes, but the AHPS total_area ones, once however many times it is imported.
+        '''
+
+        params = self.params["valid_data_test_cases"].copy()
+        write_test_cases(self.test_cases_dir, params)
+
+        for test_id, lid in (('12090301_ble', None), ('12040101_nws', 'abcd1')):
+
+            huc, benchmark_source = test_id.split('_')
+            version_dir = os.path.join(self.test_cases_dir, benchmark_source + '_test_cases', test_id, 'testing_versions', 'dev_fim_4_1_ms')
+            stats_jsons = [ os.path.join(root, f) for root, _, files in os.walk(version_dir) for f in files
+                            if f.endswith('_stats.json') and not (lid and f.startswith('total_area')) ]
+
+            for _ in range(2):
+                number_of_rows = self.metrics_store.import_version_dir(test_id, 'dev_fim_4_1_ms', False, version_dir, self.test_cases_dir)
+                assert number_of_rows == len(stats_jsons), f"Expected a row per stats JSON of {test_id}"
+
+            metrics = self.metrics_store.query([], ['dev_fim_4_1_ms'])
+            metrics = metrics.loc[metrics['test_id'] == test_id]
+            assert sorted(metrics['full_json_path']) == sorted(stats_jsons), f"Expected the stats JSONs of {test_id} once"
+
+            for row in metrics.itertuples():
+                with open(row.full_json_path) as stats_json:
+                    stats_dictionary = json.load(stats_json)
+                assert [ getattr(row, metric) for metric in MASTER_METRICS ] == [ stats_dictionary[metric] for metric in MASTER_METRICS ], \
+                    f"Expected the metrics of {row.full_json_path}"
+                assert row.stats_mode == os.path.basename(row.full_json_path)[:-len('_stats.json')], "Expected the stats mode of the file"
+                assert row.nws_lid == (os.path.basename(row.full_json_path)[:5] if lid else 'NA'), "Expected the lid of the file"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_write_master_metrics_csv_matches_crawl_success(self):
+
+        '''
+        Test that the master metrics CSV of a new store, imported from the test_cases tree, has the
+        rows and columns of the former crawl of the tree, and that the test cases are only imported
+        while the store has no rows of them.
+        '''
+
+        params = self.params["valid_data_test_cases"].copy()
+        write_test_cases(self.test_cases_dir, params)
+
+        previous_fim_dir = os.path.join(self.out_dir, 'previous_fim')
+        for version in params["previous_fim_versions"]:
+            os.makedirs(os.path.join(previous_fim_dir, version))
+
+        expected_csv = os.path.join(self.out_dir, 'crawl_metrics.csv')
+        create_master_metrics_csv_by_crawl(expected_csv, params["dev_versions_to_compare"], self.test_cases_dir, previous_fim_dir)
+
+        # as create_master_metrics_csv asks for them
+        official_versions = os.listdir(previous_fim_dir)
+        official_versions += [v.replace('_ms', '_comp') for v in official_versions if '_ms' in v]
+
+        master_metrics_csv = os.path.join(self.out_dir, 'master_metrics.csv')
+        number_of_rows = self.metrics_store.write_master_metrics_csv(master_metrics_csv, official_versions,
+                                                                     params["dev_versions_to_compare"], self.test_cases_dir)
+
+        expected = pd.read_csv(expected_csv)
+        master_metrics = pd.read_csv(master_metrics_csv)
+
+        assert number_of_rows == len(expected) > 0, "Expected the number of rows of the crawl"
+        assert master_metrics.columns.tolist() == expected.columns.tolist(), "Expected the columns of the crawl"
+
+        sort_columns = ['version', 'nws_lid', 'magnitude', 'huc', 'full_json_path']
+        pd.testing.assert_frame_equal(master_metrics.sort_values(sort_columns).reset_index(drop=True),
+                                      expected.sort_values(sort_columns).reset_index(drop=True))
+
+        assert self.metrics_store.import_missing_test_cases(official_versions, params["dev_versions_to_compare"],
+                                                            self.test_cases_dir) == 0, \
+            "Expected no imports of test cases in the store"
+        assert self.metrics_store.import_missing_test_cases(official_versions, ['dev_fim_4_2_gms'], self.test_cases_dir) > 0, \
+            "Expected imports of a version not in the store"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_import_missing_test_cases_partly_stored_version_success(self):
+
+        '''
+        Test that a version with some test cases in the store, as written by alpha tests, gets the
+        stats JSONs of its other test cases imported, that the rows of its stored test cases are
+        kept, and that versions without test case directories import nothing.
+        '''
+
+        params = self.params["valid_data_test_cases"].copy()
+        write_test_cases(self.test_cases_dir, params)
+
+        version = params["dev_versions_to_compare"][0]
+        stored_test_case = params["test_cases"][0]["test_id"]
+
+        # stats JSONs of the version by test case
+        stats_jsons = {}
+        for test_case in params["test_cases"]:
+            huc, benchmark_source = test_case["test_id"].split('_')
+            is_ahps = benchmark_source in AHPS_BENCHMARK_CATEGORIES
+            version_dir = os.path.join(self.test_cases_dir, benchmark_source + '_test_cases', test_case["test_id"], 'testing_versions', version)
+            stats_jsons[test_case["test_id"]] = sorted( os.path.join(root, f) for root, _, files in os.walk(version_dir) for f in files
+                                                        if f.endswith('_stats.json') and not (is_ahps and f.startswith('total_area')) )
+
+        # an alpha test writes the metrics of one test case of the version to the store
+        huc, benchmark_source = stored_test_case.split('_')
+        self.metrics_store.import_version_dir(stored_test_case, version, False,
+                                              os.path.join(self.test_cases_dir, benchmark_source + '_test_cases', stored_test_case,
+                                                           'testing_versions', version),
+                                              self.test_cases_dir)
+        stored = self.metrics_store.query([], [version])
+        self.metrics_store.upsert([ dict(row, CSI = -1.0) for row in stored.to_dict('records') ])
+
+        number_of_rows = self.metrics_store.import_missing_test_cases([], [version], self.test_cases_dir)
+        assert number_of_rows == sum( len(jsons) for test_id, jsons in stats_jsons.items() if test_id != stored_test_case ) > 0, \
+            "Expected the stats JSONs of the test cases of the version not in the store imported"
+
+        metrics = self.metrics_store.query([], [version])
+        assert sorted(metrics['full_json_path']) == sorted( f for jsons in stats_jsons.values() for f in jsons ), \
+            "Expected a row per stats JSON of the version"
+        assert (metrics.loc[metrics['test_id'] == stored_test_case, 'CSI'] == -1.0).all(), \
+            "Expected the rows of the test case in the store kept"
+        assert (metrics.loc[metrics['test_id'] != stored_test_case, 'CSI'] != -1.0).all(), \
+            "Expected the metrics of the stats JSONs of the other test cases"
+
+        assert self.metrics_store.import_missing_test_cases([], [version], self.test_cases_dir) == 0, \
+            "Expected no imports once every test case of the version is in the store"
+        assert self.metrics_store.import_missing_test_cases(['fim_9_9_9_9_comp'], ['dev_fim_9_9'], self.test_cases_dir) == 0, \
+            "Expected no imports of versions without test case directories"
+        assert len(self.metrics_store.query(None, None)) == len(metrics), "Expected only the rows of the version in the store"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+
+
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
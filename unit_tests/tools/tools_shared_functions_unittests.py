@@ -0,0 +1,600 @@
+#!/usr/bin/env python3
+
+import inspect
+import os
+import sys
+
+import json
+import shutil
+import tempfile
+import warnings
+import unittest
+
+import fiona
+import numpy as np
+import rasterio
+from rasterio.windows import Window
+from shapely.geometry import Polygon, mapping
+
+sys.path.append('/foss_fim/unit_tests/')
+from unit_tests_utils import FIM_unit_test_helpers as ut_helpers
+
+sys.path.append('/foss_fim/tools/')
+import tools_shared_functions as src
+
+
+def write_contingency_rasters(out_dir, params, shift=(0, 0), seed=0):
+
+    '''
+    Writes a predicted raster of positive (inundated) and negative (dry) HydroIDs with NoData
+    columns, a binary benchmark raster with NoData on a grid benchmark_margin pixels larger on
+    each side and shifted by shift pixels, and the mask layers of params. Returns the paths of
+    the predicted and benchmark rasters and the mask_dict of the mask layers.
+    '''
+
+    rng = np.random.default_rng(seed)
+    height, width = params["height"], params["width"]
+    margin = params["benchmark_margin"]
+
+    hydroIDs = 1000 + (np.arange(height)[:, np.newaxis] // 25) * 100 + np.arange(width) // 25
+    predicted_array = np.where(rng.random((height, width)) < 0.4, hydroIDs, -hydroIDs).astype(np.int32)
+    predicted_array[:, :params["predicted_nodata_columns"]] = params["predicted_nodata"]
+
+    benchmark_array = (rng.random((height + 2 * margin, width + 2 * margin)) < 0.4).astype(np.int8)
+    benchmark_array[rng.random(benchmark_array.shape) < 0.05] = params["benchmark_nodata"]
+
+    profile = dict( tiled = True, blockxsize = 128, blockysize = 128, compress = 'lzw' )
+
+    predicted_raster = ut_helpers.write_synthetic_raster( os.path.join(out_dir, 'predicted.tif'), predicted_array, params,
+                                                          nodata = params["predicted_nodata"], **profile )
+    benchmark_raster = ut_helpers.write_synthetic_raster( os.path.join(out_dir, 'benchmark.tif'), benchmark_array, params,
+                                                          shift[1] - margin, shift[0] - margin, params["benchmark_nodata"],
+                                                          **profile )
+
+    mask_dict = {}
+    for layer, mask_layer in params["mask_layers"].items():
+        mask_path = os.path.join(out_dir, f'{layer}.gpkg')
+        with fiona.open(mask_path, 'w', driver='GPKG', crs=params["crs"],
+                        schema={ 'geometry' : 'Polygon', 'properties' : { 'id' : 'int' } }) as dst:
+            dst.writerecords([ { 'geometry' : mapping(Polygon(polygon)), 'properties' : { 'id' : i } }
+                               for i, polygon in enumerate(mask_layer["polygons"]) ])
+        mask_dict[layer] = { 'path' : mask_path, 'buffer' : mask_layer["buffer"], 'operation' : mask_layer["operation"] }
+
+    return(predicted_raster, benchmark_raster, mask_dict)
+
+
+def contingency_table_by_full_arrays(benchmark_raster_path, predicted_raster_path, agreement_raster=None, mask_values=None, mask_dict=None):
+    """ Former full array get_contingency_table_from_binary_rasters, the reference of the blockwise one """
+    from rasterio.warp import reproject, Resampling
+    import rasterio
+    import numpy as np
+    import os
+    import rasterio.mask
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    # Load rasters.
+    benchmark_src = rasterio.open(benchmark_raster_path)
+    predicted_src = rasterio.open(predicted_raster_path)
+    predicted_array = predicted_src.read(1)
+
+    benchmark_array_original = benchmark_src.read(1)
+
+    if benchmark_array_original.shape != predicted_array.shape:
+        benchmark_array = np.empty(predicted_array.shape, dtype=np.int8)
+
+        reproject(benchmark_array_original,
+              destination = benchmark_array,
+              src_transform = benchmark_src.transform,
+              src_crs = benchmark_src.crs,
+              src_nodata = benchmark_src.nodata,
+              dst_transform = predicted_src.transform,
+              dst_crs = predicted_src.crs,
+              dst_nodata = benchmark_src.nodata,
+              dst_resolution = predicted_src.res,
+              resampling = Resampling.nearest)
+
+    predicted_array_raw = predicted_src.read(1)
+
+    # Align the benchmark domain to the modeled domain.
+    benchmark_array = np.where(predicted_array==predicted_src.nodata, 10, benchmark_array)
+
+    # Ensure zeros and ones for binary comparison. Assume that positive values mean flooding and 0 or negative values mean dry.
+    predicted_array = np.where(predicted_array==predicted_src.nodata, 10, predicted_array)  # Reclassify NoData to 10
+    predicted_array = np.where(predicted_array<0, 0, predicted_array)
+    predicted_array = np.where(predicted_array>0, 1, predicted_array)
+
+    benchmark_array = np.where(benchmark_array==benchmark_src.nodata, 10, benchmark_array)  # Reclassify NoData to 10
+
+    agreement_array = np.add(benchmark_array, 2*predicted_array)
+    agreement_array = np.where(agreement_array>4, 10, agreement_array)
+
+    del benchmark_src, benchmark_array, predicted_array, predicted_array_raw
+
+    # Loop through exclusion masks and mask the agreement_array.
+    if mask_dict:
+        for poly_layer in mask_dict:
+
+            operation = mask_dict[poly_layer]['operation']
+
+            if operation == 'exclude':
+
+                poly_path = mask_dict[poly_layer]['path']
+                buffer_val = mask_dict[poly_layer]['buffer']
+
+                reference = predicted_src
+
+                bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
+                #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
+                poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+
+                # Make sure features are present in bounding box area before projecting. Continue to next layer if features are absent.
+                if poly_all.empty:
+                    continue
+
+                #Project layer to reference crs.
+                poly_all_proj = poly_all.to_crs(reference.crs)
+                # check if there are any lakes within our reference raster extent.
+                if poly_all_proj.empty:
+                    #If no features within reference raster extent, create a zero array of same shape as reference raster.
+                    poly_mask = np.zeros(reference.shape)
+                else:
+                    #Check if a buffer value is passed to function.
+                    if buffer_val is None:
+                        #If features are present and no buffer is passed, assign geometry to variable.
+                        geometry = poly_all_proj.geometry
+                    else:
+                        #If  features are present and a buffer is passed, assign buffered geometry to variable.
+                        geometry = poly_all_proj.buffer(buffer_val)
+
+                    #Perform mask operation on the reference raster and using the previously declared geometry geoseries. Invert set to true as we want areas outside of poly areas to be False and areas inside poly areas to be True.
+                    in_poly,transform,c = rasterio.mask.raster_geometry_mask(reference, geometry, invert = True)
+                    #Write mask array, areas inside polys are set to 1 and areas outside poly are set to 0.
+                    poly_mask = np.where(in_poly == True, 1,0)
+
+                    # Perform mask.
+                    masked_agreement_array = np.where(poly_mask == 1, 4, agreement_array)
+
+                    # Get rid of masked values outside of the modeled domain.
+                    agreement_array = np.where(agreement_array == 10, 10, masked_agreement_array)
+
+    contingency_table_dictionary = {}  # Initialize empty dictionary.
+
+    # Only write the agreement raster if user-specified.
+    if agreement_raster != None:
+        with rasterio.Env():
+            profile = predicted_src.profile
+            profile.update(nodata=10)
+            with rasterio.open(agreement_raster, 'w', **profile) as dst:
+                dst.write(agreement_array, 1)
+
+
+    # Store summed pixel counts in dictionary.
+    contingency_table_dictionary.update({'total_area':{'true_negatives': int((agreement_array == 0).sum()),
+                                                      'false_negatives': int((agreement_array == 1).sum()),
+                                                      'false_positives': int((agreement_array == 2).sum()),
+                                                      'true_positives': int((agreement_array == 3).sum()),
+                                                      'masked_count': int((agreement_array == 4).sum()),
+                                                      'file_handle': 'total_area'
+
+                                                      }})
+
+    # After agreement_array is masked with default mask layers, check for inclusion masks in mask_dict.
+    if mask_dict:
+        for poly_layer in mask_dict:
+
+            operation = mask_dict[poly_layer]['operation']
+
+            if operation == 'include':
+
+                poly_path = mask_dict[poly_layer]['path']
+                buffer_val = mask_dict[poly_layer]['buffer']
+
+                reference = predicted_src
+
+                bounding_box = gpd.GeoDataFrame({'geometry': box(*reference.bounds)}, index=[0], crs=reference.crs)
+                #Read layer using the bbox option. CRS mismatches are handled if bbox is passed a geodataframe (which it is).
+                poly_all = gpd.read_file(poly_path, bbox = bounding_box)
+
+                # Make sure features are present in bounding box area before projecting. Continue to next layer if features are absent.
+                if poly_all.empty:
+                    continue
+
+                #Project layer to reference crs.
+                poly_all_proj = poly_all.to_crs(reference.crs)
+                # check if there are any lakes within our reference raster extent.
+                if poly_all_proj.empty:
+                    #If no features within reference raster extent, create a zero array of same shape as reference raster.
+                    poly_mask = np.zeros(reference.shape)
+                else:
+                    #Check if a buffer value is passed to function.
+                    if buffer_val is None:
+                        #If features are present and no buffer is passed, assign geometry to variable.
+                        geometry = poly_all_proj.geometry
+                    else:
+                        #If  features are present and a buffer is passed, assign buffered geometry to variable.
+                        geometry = poly_all_proj.buffer(buffer_val)
+
+                    #Perform mask operation on the reference raster and using the previously declared geometry geoseries. Invert set to true as we want areas outside of poly areas to be False and areas inside poly areas to be True.
+                    in_poly,transform,c = rasterio.mask.raster_geometry_mask(reference, geometry, invert = True)
+                    #Write mask array, areas inside polys are set to 1 and areas outside poly are set to 0.
+                    poly_mask = np.where(in_poly == True, 1, 0)
+
+                    # Perform mask.
+                    masked_agreement_array = np.where(poly_mask == 0, 4, agreement_array)  # Changed to poly_mask == 0
+
+                    # Get rid of masked values outside of the modeled domain.
+                    temp_agreement_array = np.where(agreement_array == 10, 10, masked_agreement_array)
+
+                    if buffer_val == None:  # The buffer used is added to filename, and 0 is easier to read than None.
+                        buffer_val = 0
+
+                    poly_handle = poly_layer + '_b' + str(buffer_val) + 'm'
+
+                    # Write the layer_agreement_raster.
+                    layer_agreement_raster = os.path.join(os.path.split(agreement_raster)[0], poly_handle + '_agreement.tif')
+                    with rasterio.Env():
+                        profile = predicted_src.profile
+                        profile.update(nodata=10)
+                        with rasterio.open(layer_agreement_raster, 'w', **profile) as dst:
+                            dst.write(temp_agreement_array, 1)
+
+
+                    # Store summed pixel counts in dictionary.
+                    contingency_table_dictionary.update({poly_handle:{'true_negatives': int((temp_agreement_array == 0).sum()),
+                                                                     'false_negatives': int((temp_agreement_array == 1).sum()),
+                                                                     'false_positives': int((temp_agreement_array == 2).sum()),
+                                                                     'true_positives': int((temp_agreement_array == 3).sum()),
+                                                                     'masked_count': int((temp_agreement_array == 4).sum()),
+                                                                     'file_handle': poly_handle
+                                                                      }})
+
+    return contingency_table_dictionary
+
+
+# NOTE: This goes directly to the function.
+# Ultimately, it should emulate going through command line (not import -> direct function call)
+class test_tools_shared_functions(unittest.TestCase):
+
+    '''
+    Allows the params to be loaded one and used for all test methods
+    '''
+    @classmethod
+    def setUpClass(self):
+
+        warnings.simplefilter('ignore')
+        params_file_path = ut_helpers.get_params_filename(__file__)
+        with open(params_file_path) as params_file:
+            self.params = json.load(params_file)
+
+
+    def setUp(self):
+
+        self.out_dir = tempfile.mkdtemp()
+
+
+    def tearDown(self):
+
+        shutil.rmtree(self.out_dir, ignore_errors = True)
+
+
+    def test_get_contingency_table_from_binary_rasters_matches_full_arrays_success(self):
+
+        '''
+        Test that the blockwise contingency tables and agreement rasters of the total area and of
+        each inclusion mask are those of the former full array function, for benchmarks shifted by
+        whole pixels (read with shifted windows) and by fractions of a pixel (reprojected), at block
+        sizes that do and do not divide the rasters.
+        '''
+
+        params = self.params["valid_data_contingency_rasters"].copy()
+
+        for shift in params["benchmark_shifts"]:
+
+            shift_dir = tempfile.mkdtemp(dir = self.out_dir)
+            predicted_raster, benchmark_raster, mask_dict = write_contingency_rasters(shift_dir, params, shift)
+
+            reference_dir = os.path.join(shift_dir, 'full_arrays')
+            os.mkdir(reference_dir)
+            expected_table = contingency_table_by_full_arrays(benchmark_raster, predicted_raster,
+                                                              os.path.join(reference_dir, 'total_area_agreement.tif'),
+                                                              mask_dict = mask_dict)
+
+            assert sorted(expected_table) == ['domain_b0m', 'levees_b100m', 'total_area'], \
+                "Expected a table of the total area and of each inclusion mask with polygons in the raster"
+            assert expected_table['total_area']['masked_count'] > 0, "Expected pixels in the exclusion mask"
+
+            for block_size in params["block_sizes"]:
+
+                blockwise_dir = os.path.join(shift_dir, f'blockwise_{block_size}')
+                os.mkdir(blockwise_dir)
+                contingency_table = src.get_contingency_table_from_binary_rasters(benchmark_raster, predicted_raster,
+                                                                                  os.path.join(blockwise_dir, 'total_area_agreement.tif'),
+                                                                                  mask_dict = mask_dict, block_size = block_size)
+
+                assert contingency_table == expected_table, \
+                    f"Expected the contingency tables of the full arrays with a shift of {shift} and block size {block_size}"
+
+                for stats_mode in expected_table:
+                    agreement_file = f'{stats_mode}_agreement.tif'
+                    with rasterio.open(os.path.join(reference_dir, agreement_file)) as expected, \
+                         rasterio.open(os.path.join(blockwise_dir, agreement_file)) as agreement:
+                        assert agreement.transform == expected.transform, f"Expected the grid of the full arrays for {stats_mode}"
+                        assert np.array_equal(agreement.read(1), expected.read(1)), \
+                            f"Expected the agreement raster of the full arrays for {stats_mode} with a shift of {shift} and block size {block_size}"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_get_contingency_table_from_binary_rasters_mask_cache_success(self):
+
+        '''
+        Test that the contingency tables and agreement rasters are the same without a mask_cache,
+        with a cold one and with a warm one, that the warm cache is used without reading any mask
+        layer, and that it is rebuilt for a mask layer that changed.
+        '''
+
+        params = self.params["valid_data_contingency_rasters"].copy()
+        predicted_raster, benchmark_raster, mask_dict = write_contingency_rasters(self.out_dir, params)
+        mask_cache = os.path.join(self.out_dir, 'mask_cache')
+
+        def contingency_tables(name, mask_cache=None):
+            agreement_dir = os.path.join(self.out_dir, name)
+            os.mkdir(agreement_dir)
+            contingency_table = src.get_contingency_table_from_binary_rasters(benchmark_raster, predicted_raster,
+                                                                              os.path.join(agreement_dir, 'total_area_agreement.tif'),
+                                                                              mask_dict = mask_dict, block_size = 64,
+                                                                              mask_cache = mask_cache)
+            agreement_arrays = {}
+            for stats_mode in contingency_table:
+                with rasterio.open(os.path.join(agreement_dir, f'{stats_mode}_agreement.tif')) as agreement:
+                    agreement_arrays[stats_mode] = agreement.read(1)
+            return(contingency_table, agreement_arrays)
+
+        expected_table, expected_arrays = contingency_tables('no_cache')
+
+        contingency_table, agreement_arrays = contingency_tables('cold_cache', mask_cache)
+        assert contingency_table == expected_table, "Expected the contingency tables without a cache from a cold cache"
+        for stats_mode in expected_arrays:
+            assert np.array_equal(agreement_arrays[stats_mode], expected_arrays[stats_mode]), \
+                f"Expected the agreement raster without a cache for {stats_mode} from a cold cache"
+
+        cache_files = sorted(os.listdir(mask_cache))
+        assert [os.path.splitext(f)[1] for f in cache_files].count('.tif') == 3, \
+            "Expected a cached mask for each mask layer with polygons on the grid"
+        assert [os.path.splitext(f)[1] for f in cache_files].count('.empty') == 1, \
+            "Expected an empty marker for the mask layer off the grid"
+
+        # a warm cache reads no mask layers
+        read_file = src.gpd.read_file
+        src.gpd.read_file = lambda *args, **kwargs: self.fail("Expected the mask layers read from the cache")
+        try:
+            contingency_table, agreement_arrays = contingency_tables('warm_cache', mask_cache)
+        finally:
+            src.gpd.read_file = read_file
+
+        assert contingency_table == expected_table, "Expected the contingency tables without a cache from a warm cache"
+        for stats_mode in expected_arrays:
+            assert np.array_equal(agreement_arrays[stats_mode], expected_arrays[stats_mode]), \
+                f"Expected the agreement raster without a cache for {stats_mode} from a warm cache"
+        assert sorted(os.listdir(mask_cache)) == cache_files, "Expected no new cache files from a warm cache"
+
+        # a changed mask layer is keyed by its new size and modification time
+        write_contingency_rasters(self.out_dir, dict(params, mask_layers = { 'lakes' : dict(params["mask_layers"]["lakes"],
+                                  polygons = params["mask_layers"]["lakes"]["polygons"][:1]) }))
+        contingency_table, _ = contingency_tables('changed_layer', mask_cache)
+        expected_table, _ = contingency_tables('changed_layer_no_cache')
+
+        assert contingency_table == expected_table, "Expected the contingency tables without a cache for the changed layer"
+        assert len(os.listdir(mask_cache)) == len(cache_files) + 1, "Expected a new cached mask for the changed layer"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_EvaluationMask_read_success(self):
+
+        '''
+        Test that a cached mask has the pixels of the polygons rasterized in each window, and that a
+        layer without polygons on the grid returns None and leaves an empty marker that later reads
+        return None from without reading the layer.
+        '''
+
+        params = self.params["valid_data_contingency_rasters"].copy()
+        predicted_raster, _, mask_dict = write_contingency_rasters(self.out_dir, params)
+        mask_cache = os.path.join(self.out_dir, 'mask_cache')
+
+        with rasterio.open(predicted_raster) as reference:
+
+            for layer in ('lakes', 'levees'):
+
+                poly_path, buffer_val = mask_dict[layer]['path'], mask_dict[layer]['buffer']
+                mask = src.EvaluationMask.read(poly_path, buffer_val, reference)
+                cached_mask = src.EvaluationMask.read(poly_path, buffer_val, reference, mask_cache, block_size = 64)
+
+                assert cached_mask.cache_file is not None, f"Expected the mask of {layer} cached"
+                assert os.path.basename(cached_mask.cache_file) == 'mask_{}.tif'.format(
+                           src.EvaluationMask.cache_key(poly_path, buffer_val, reference)), \
+                    f"Expected the mask of {layer} named by its cache key"
+
+                with rasterio.open(cached_mask.cache_file) as cache:
+                    assert cache.transform == reference.transform and cache.shape == reference.shape, \
+                        f"Expected the mask of {layer} on the grid of the reference"
+                    assert cache.tags(1, 'IMAGE_STRUCTURE').get('NBITS') == '1', f"Expected a 1 bit mask of {layer}"
+
+                for window in (Window(0, 0, 120, 70), Window(100, 130, 130, 120)):
+                    window_transform = reference.window_transform(window)
+                    expected = mask.inside(window, window_transform)
+                    assert expected.any(), f"Expected pixels of {layer} in window {window}"
+                    assert np.array_equal(cached_mask.inside(window, window_transform), expected), \
+                        f"Expected the rasterized polygons of {layer} in window {window} from the cache"
+                cached_mask.close()
+
+            poly_path, buffer_val = mask_dict['outside']['path'], mask_dict['outside']['buffer']
+            assert src.EvaluationMask.read(poly_path, buffer_val, reference) is None, \
+                "Expected no mask of a layer off the grid"
+            assert src.EvaluationMask.read(poly_path, buffer_val, reference, mask_cache) is None, \
+                "Expected no mask of a layer off the grid from a cold cache"
+
+            empty_file = os.path.join(mask_cache, 'mask_{}.empty'.format(src.EvaluationMask.cache_key(poly_path, buffer_val, reference)))
+            assert os.path.isfile(empty_file), "Expected an empty marker of the layer off the grid"
+            assert not os.path.isfile(os.path.splitext(empty_file)[0] + '.tif'), "Expected no mask of the layer off the grid"
+
+            read_file = src.gpd.read_file
+            src.gpd.read_file = lambda *args, **kwargs: self.fail("Expected the empty marker read from the cache")
+            try:
+                assert src.EvaluationMask.read(poly_path, buffer_val, reference, mask_cache) is None, \
+                    "Expected no mask of a layer off the grid from a warm cache"
+            finally:
+                src.gpd.read_file = read_file
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_zonal_bincount_success(self):
+
+        '''
+        Test that the zones and code counts of a block are those counted zone by zone, for zones
+        in a narrow range with gaps (counted by offset) and for sparse zones (numbered first).
+        '''
+
+        params = self.params["valid_data_zonal_counts"].copy()
+        zonal_bincount = getattr(src, '__zonal_bincount')
+        rng = np.random.default_rng(0)
+        number_of_codes = params["number_of_codes"]
+
+        dense_zones = rng.choice(np.arange(params["dense_zone_start"], params["dense_zone_start"] + 60, 3),
+                                 params["number_of_pixels"])
+        sparse_zones = rng.choice(params["sparse_zones"], params["number_of_pixels"])
+
+        assert dense_zones.max() - dense_zones.min() + 1 <= dense_zones.size, "Expected dense zones counted by offset"
+        assert sparse_zones.max() - sparse_zones.min() + 1 > sparse_zones.size, "Expected sparse zones numbered first"
+
+        for zones in (dense_zones, sparse_zones):
+
+            codes = rng.integers(0, number_of_codes, zones.size)
+            zone_ids, block_counts = zonal_bincount(zones.astype(np.int64), codes, number_of_codes)
+
+            expected_ids = np.unique(zones)
+            expected_counts = np.array([ np.bincount(codes[zones == zone], minlength=number_of_codes) for zone in expected_ids ])
+
+            assert np.array_equal(zone_ids, expected_ids), "Expected the zones present in the block"
+            assert np.array_equal(block_counts, expected_counts), "Expected the counts of each code by zone"
+
+        zone_ids, block_counts = zonal_bincount(np.array([], dtype=np.int64), np.array([], dtype=np.int64), number_of_codes)
+        assert zone_ids.size == 0 and block_counts.shape == (0, number_of_codes), "Expected no zones of an empty block"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_stats_mode_counts_success(self):
+
+        '''
+        Test that the counts of the agreement classes 0 to 4 of the total area and of each inclusion
+        mask are those counted pixel by pixel, where pixels outside an inclusion mask are masked
+        unless they are NoData, for the counts of a whole raster and for counts by zone.
+        '''
+
+        params = self.params["valid_data_zonal_counts"].copy()
+        stats_mode_counts = getattr(src, '__stats_mode_counts')
+        rng = np.random.default_rng(1)
+        number_of_masks = params["number_of_masks"]
+        number_of_pixels = params["number_of_pixels"]
+
+        # classes 0 to 4, 5 for NoData and 6 for any other value, as get_contingency_table_from_binary_rasters counts them
+        classes = rng.integers(0, 7, number_of_pixels)
+        in_masks = rng.random((number_of_pixels, number_of_masks)) < 0.5
+        zones = rng.integers(0, params["number_of_zones"], number_of_pixels)
+        codes = classes + 7 * (in_masks.astype(np.int64) << np.arange(number_of_masks)).sum(axis=1)
+
+        counts = np.bincount(codes, minlength=7 * 2**number_of_masks)
+        zone_counts = np.array([ np.bincount(codes[zones == zone], minlength=counts.size)
+                                 for zone in range(params["number_of_zones"]) ])
+
+        mode_classes = [classes] + [ np.where(in_masks[:, mask] | (classes == 5), classes, 4) for mask in range(number_of_masks) ]
+
+        mode_counts = stats_mode_counts(counts, number_of_masks)
+        zonal_mode_counts = stats_mode_counts(zone_counts, number_of_masks)
+
+        assert len(mode_counts) == number_of_masks + 1, "Expected counts of the total area and of each inclusion mask"
+        for stats_mode, expected_classes in enumerate(mode_classes):
+            assert np.array_equal(mode_counts[stats_mode][:5], np.bincount(expected_classes, minlength=7)[:5]), \
+                f"Expected the class counts of stats mode {stats_mode}"
+            expected_zone_counts = np.array([ np.bincount(expected_classes[zones == zone], minlength=7)[:5]
+                                              for zone in range(params["number_of_zones"]) ])
+            assert np.array_equal(zonal_mode_counts[stats_mode][:, :5], expected_zone_counts), \
+                f"Expected the class counts by zone of stats mode {stats_mode}"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    def test_get_contingency_table_from_binary_rasters_zonal_success(self):
+
+        '''
+        Test that the contingency tables by HydroID of the predicted raster are the counts of the
+        agreement rasters of each stats mode grouped by HydroID, and sum to the contingency tables.
+        '''
+
+        params = self.params["valid_data_contingency_rasters"].copy()
+        predicted_raster, benchmark_raster, mask_dict = write_contingency_rasters(self.out_dir, params)
+        agreement_raster = os.path.join(self.out_dir, 'total_area_agreement.tif')
+
+        contingency_table, zonal_table = src.get_contingency_table_from_binary_rasters(benchmark_raster, predicted_raster,
+                                                                                       agreement_raster, mask_dict = mask_dict,
+                                                                                       block_size = 64, zone_raster = predicted_raster)
+
+        columns = ['true_negatives', 'false_negatives', 'false_positives', 'true_positives', 'masked_count']
+
+        with rasterio.open(predicted_raster) as predicted:
+            predicted_array = predicted.read(1)
+            valid = predicted_array != predicted.nodata
+            hydroIDs = np.abs(predicted_array[valid])
+
+        assert sorted(zonal_table['stats_mode'].unique()) == sorted(contingency_table), "Expected zones of every stats mode"
+
+        for stats_mode in contingency_table:
+
+            with rasterio.open(os.path.join(self.out_dir, f'{stats_mode}_agreement.tif')) as agreement:
+                agreement_array = agreement.read(1)[valid]
+
+            expected = np.array([ np.bincount(agreement_array[(hydroIDs == zone) & (agreement_array <= 4)], minlength=5)
+                                  for zone in np.unique(hydroIDs) ])
+            present = expected.sum(axis=1) > 0
+
+            mode_table = zonal_table.loc[zonal_table['stats_mode'] == stats_mode]
+            assert np.array_equal(mode_table['zone'].values, np.unique(hydroIDs)[present]), \
+                f"Expected the HydroIDs with pixels in {stats_mode}"
+            assert np.array_equal(mode_table[columns].values, expected[present]), \
+                f"Expected the agreement raster of {stats_mode} grouped by HydroID"
+            assert mode_table[columns].sum().tolist() == [ contingency_table[stats_mode][c] for c in columns ], \
+                f"Expected the zones of {stats_mode} to sum to its contingency table"
+
+
+        print(f"Test Success: {inspect.currentframe().f_code.co_name}")
+        print("*************************************************************")
+
+
+    # ***********************
+
+
+if __name__ == '__main__':
+
+    script_file_name = os.path.basename(__file__)
+
+    print("*****************************")
+    print(f"Start of {script_file_name} tests")
+    print()
+
+    unittest.main()
+
+    print()
+    print(f"End of {script_file_name} tests")
@@ -4,6 +4,9 @@ import errno
 import os
 import sys
 
+import rasterio
+from affine import Affine
+
 class FIM_unit_test_helpers(object):
     
     @staticmethod
@@ -17,4 +20,26 @@ class FIM_unit_test_helpers(object):
             raise FileNotFoundError(f"{params_file_path} does not exist")
         
         return params_file_path
+
+
+    @staticmethod
+    def write_synthetic_raster(raster_path, array, params, row_off=0, col_off=0, nodata=None, **profile):
+
+        '''
+        Writes a synthetic array as a single band GeoTIFF on the grid of params ("crs", "origin"
+        and "resolution"), with its top left cell row_off rows and col_off columns from the
+        origin. Other profile items, such as tiling and compression, are passed to rasterio.
+        '''
+
+        left, top = params["origin"]
+        res = params["resolution"]
+
+        profile = dict( driver = 'GTiff', height = array.shape[0], width = array.shape[1], count = 1,
+                        dtype = array.dtype.name, nodata = nodata, crs = params["crs"],
+                        transform = Affine(res, 0, left + col_off * res, 0, -res, top - row_off * res), **profile )
+
+        with rasterio.open(raster_path, 'w', **profile) as dst:
+            dst.write(array, 1)
+
+        return raster_path
     